@@ -0,0 +1,126 @@
+"""Offline API benchmark: startup cost and per-endpoint latency on the in-memory backend.
+
+Builds the app with `create_app()` on STORAGE_BACKEND=memory, runs its
+lifespan, then drives the patient flow (signup, assessment, booking,
+payment order, payment, reads) through the full middleware stack with an
+in-process ASGI client. No MongoDB or network is involved, so numbers
+reflect the API's own overhead and are comparable between commits.
+
+    python bench_api.py --flows 500 --concurrency 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import httpx
+
+import server
+from storage import StorageSettings
+
+ASSESSMENT = {
+    "basic_details": {"name": "Bench", "age": 40, "gender": "female", "city_area": "Kothrud", "contact_number": ""},
+    "chief_complaint": "joint_muscle",
+    "conditional_answers": {},
+}
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * pct))], 3)
+
+
+async def patient_flow(client: httpx.AsyncClient, n: int, latencies: Dict[str, List[float]]):
+    async def call(name: str, method: str, url: str, **kwargs) -> Dict[str, Any]:
+        start = time.perf_counter()
+        response = await client.request(method, url, **kwargs)
+        latencies[name].append((time.perf_counter() - start) * 1000)
+        response.raise_for_status()
+        return response.json()
+
+    phone = f"9{n:09d}"
+    # Stands in for the OTP round trip, which is mocked and rate limited per phone
+    signup_token = server.session_tokens.issue(phone, "signup")["token"]
+    user = await call("signup", "POST", "/api/auth/signup",
+                      json={"name": f"Bench {n}", "age": 40, "gender": "female"},
+                      headers={"Authorization": f"Bearer {signup_token}"})
+    auth = {"Authorization": f"Bearer {user['token']}"}
+    details = {**ASSESSMENT["basic_details"], "contact_number": phone}
+    assessment = await call("assessment", "POST", "/api/assessment", json={**ASSESSMENT, "basic_details": details})
+    booking = await call("create_booking", "POST", "/api/booking", headers=auth, json={
+        "service_type": "orthopaedic", "session_count": 1, "amount": 999,
+        "customer_name": user["name"], "customer_phone": phone, "address": "1 Bench Road", "city": "Pune",
+        "pincode": "411038", "preferred_date": "2026-01-01", "preferred_time": "10:00",
+        "assessment_id": assessment["id"],
+    })
+    await call("create_order", "POST", "/api/payment/create-order", json={"booking_id": booking["id"], "amount": 999},
+               headers=auth)
+    await call("pay", "POST", f"/api/payment/mock-success/{booking['id']}", headers=auth)
+    await call("get_booking", "GET", f"/api/booking/{booking['id']}", headers=auth)
+    await call("user_bookings", "GET", f"/api/bookings/user/{user['id']}", headers=auth)
+
+
+async def run(flows: int, concurrency: int) -> Dict[str, Any]:
+    start = time.perf_counter()
+    app = server.create_app(StorageSettings(backend="memory", mongo_url=None, db_name="bench"))
+    create_app_ms = (time.perf_counter() - start) * 1000
+
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            pending = iter(range(flows))
+
+            async def worker():
+                for n in pending:
+                    await patient_flow(client, n, latencies)
+
+            wall_start = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            wall_seconds = time.perf_counter() - wall_start
+        startup = dict(app.state.startup_timings)
+
+    requests = sum(len(v) for v in latencies.values())
+    return {
+        "startup": {**startup, "create_app_ms": round(create_app_ms, 3)},
+        "flows": flows,
+        "concurrency": concurrency,
+        "requests": requests,
+        "requests_per_second": round(requests / wall_seconds, 1),
+        "endpoints": {
+            name: {"count": len(values), "p50_ms": _percentile(values, 0.5), "p90_ms": _percentile(values, 0.9),
+                   "p99_ms": _percentile(values, 0.99)}
+            for name, values in latencies.items()
+        },
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the API against the in-memory storage backend")
+    parser.add_argument("--flows", type=int, default=200, help="patient flows to run (7 requests each)")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(run(args.flows, args.concurrency))
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+        return 0
+
+    print("startup        " + " ".join(f"{k}={v}" for k, v in report["startup"].items()))
+    print(f"throughput     {report['requests_per_second']} req/s "
+          f"({report['requests']} requests, concurrency {report['concurrency']})")
+    for name, stats in report["endpoints"].items():
+        print(f"  {name:<14} p50={stats['p50_ms']}ms p90={stats['p90_ms']}ms p99={stats['p99_ms']}ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+"""Websocket encoding benchmark: bytes on the wire and codec CPU per message.
+
+For the physio_assigned, physio_confirmed and booking_response messages it
+reports, per encoding available in this environment (wire.CODECS):
+
+- frame: the encoded message plus the websocket frame header (client
+  frames such as booking_response are also masked, which adds 4 bytes)
+- deflate: the same frame under permessage-deflate with no context
+  takeover, where each message is compressed on its own
+- stream: permessage-deflate with context takeover, averaged over a run of
+  similar messages on one connection (the compressor remembers earlier
+  messages)
+- encode_us / decode_us: CPU per message
+- batch / batch_deflate: bytes per message when BATCH messages share one
+  batch frame, without and with permessage-deflate (no context takeover)
+
+    python bench_wire.py --iterations 20000
+"""
+import argparse
+import json
+import random
+import sys
+import time
+import uuid
+import zlib
+from typing import Any, Callable, Dict, List, Optional
+
+import wire
+
+BATCH = 10
+
+
+def booking_id(n: int) -> str:
+    # Random-looking but reproducible; sequential ids would flatter the compressors
+    return str(uuid.UUID(int=random.Random(n).getrandbits(128), version=4))
+
+
+# Sent by the server (unmasked) or by the client (masked)
+MESSAGES: Dict[str, Callable[[int], Dict[str, Any]]] = {
+    "physio_assigned": lambda n: {
+        "type": "physio_assigned", "booking_id": booking_id(n), "physio_name": "Dr. Asha Kulkarni",
+        "seq": 1000 + n,
+    },
+    "physio_confirmed": lambda n: {"type": "physio_confirmed", "booking_id": booking_id(n), "seq": 1000 + n},
+    "booking_response": lambda n: {
+        "type": "booking_response", "booking_id": booking_id(n), "accepted": n % 3 != 0, "offer_round": 1,
+    },
+}
+CLIENT_SENT = {"booking_response"}
+
+
+def frame_size(payload: int, masked: bool) -> int:
+    header = 2 if payload < 126 else 4 if payload < 65536 else 10
+    return header + (4 if masked else 0) + payload
+
+
+def _bytes(encoded) -> bytes:
+    return encoded.encode("utf-8") if isinstance(encoded, str) else encoded
+
+
+def deflate(payload: bytes, compressor=None) -> int:
+    """Compressed size as permessage-deflate sends it (RFC 7692 drops the trailing 4 bytes)"""
+    compressor = compressor or zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    return len(compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4
+
+
+def per_call_us(fn: Callable[[Any], Any], args: List[Any]) -> float:
+    start = time.perf_counter()
+    for arg in args:
+        fn(arg)
+    return round((time.perf_counter() - start) / len(args) * 1e6, 3)
+
+
+def measure(codec: wire.Codec, kind: str, iterations: int) -> Dict[str, Any]:
+    messages = [MESSAGES[kind](n) for n in range(iterations)]
+    encoded = [codec.encode(m) for m in messages]
+    payloads = [_bytes(e) for e in encoded]
+    masked = kind in CLIENT_SENT
+    sample = payloads[:1000]
+
+    stream = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    stream_total = sum(frame_size(deflate(p, stream), masked) for p in sample)
+    batches = [codec.encode(wire.batch(messages[i:i + BATCH])) for i in range(0, len(sample), BATCH)]
+    batch_total = sum(frame_size(len(_bytes(b)), masked) for b in batches)
+    batch_deflated = sum(frame_size(deflate(_bytes(b)), masked) for b in batches)
+
+    return {
+        "frame": round(sum(frame_size(len(p), masked) for p in sample) / len(sample), 1),
+        "deflate": round(sum(frame_size(deflate(p), masked) for p in sample) / len(sample), 1),
+        "stream": round(stream_total / len(sample), 1),
+        "batch": round(batch_total / len(sample), 1),
+        "batch_deflate": round(batch_deflated / len(sample), 1),
+        "encode_us": per_call_us(codec.encode, messages),
+        "decode_us": per_call_us(codec.decode, encoded),
+    }
+
+
+def run(iterations: int) -> Dict[str, Any]:
+    codecs = {"json": wire.JSON, **{c.name: c for c in wire.CODECS.values() if c.binary}}
+    return {
+        "iterations": iterations,
+        "encodings": list(codecs),
+        "missing": sorted({"msgpack", "cbor"} - set(codecs)),
+        "messages": {
+            kind: {name: measure(codec, kind, iterations) for name, codec in codecs.items()}
+            for kind in MESSAGES
+        },
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Compare websocket encodings for size and codec CPU")
+    parser.add_argument("--iterations", type=int, default=20000, help="messages encoded per type and encoding")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    report = run(args.iterations)
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+        return 0
+
+    if report["missing"]:
+        print(f"not installed: {', '.join(report['missing'])}")
+    print(f"{'message':<18} {'encoding':<9} {'frame':>7} {'deflate':>8} {'stream':>7} {'batch':>7} "
+          f"{'b_defl':>7} {'enc_us':>7} {'dec_us':>7}")
+    for kind, results in report["messages"].items():
+        for name, r in results.items():
+            print(f"{kind:<18} {name:<9} {r['frame']:>7} {r['deflate']:>8} {r['stream']:>7} {r['batch']:>7} "
+                  f"{r['batch_deflate']:>7} {r['encode_us']:>7} {r['decode_us']:>7}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+"""Declarative booking state machine.
+
+A booking's lifecycle is the pair (`status`, `assignment_status`). Each named
+transition lists the states it may start from and the fields it sets. It is
+applied as one conditional `find_one_and_update` whose filter includes the
+required previous state, so a concurrent or stale transition matches no
+document and is rejected without any extra read.
+"""
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+
+
+class Param(NamedTuple):
+    """Placeholder resolved from the transition's call parameters"""
+    name: str
+
+
+class Transition(NamedTuple):
+    requires: Dict[str, Any]                 # field -> tuple of allowed values, or a Param
+    sets: Dict[str, Any]
+    add_to_set: Dict[str, Any] = {}
+    pull: Dict[str, Any] = {}
+
+
+ACTIVE_STATUSES = ("pending_payment", "confirmed")
+OPEN_ASSIGNMENT = ("unassigned", "no_physio_available")
+OFFERED_TO = {"status": ("confirmed",), "assignment_status": ("offered",), "offered_physio_ids": Param("physio_id")}
+
+TRANSITIONS: Dict[str, Transition] = {
+    # Payment captured (gateway callback, demo success or admin override)
+    "pay": Transition(
+        requires={"status": ("pending_payment",)},
+        sets={"status": "confirmed", "payment_status": "paid"},
+    ),
+    "assign": Transition(
+        requires={"status": ("confirmed",), "assignment_status": OPEN_ASSIGNMENT},
+        sets={"assignment_status": "assigned", "assigned_physio_id": Param("physio_id")},
+    ),
+    "no_physio_available": Transition(
+        requires={"status": ("confirmed",), "assignment_status": OPEN_ASSIGNMENT},
+        sets={"assignment_status": "no_physio_available"},
+    ),
+    # Broadcast mode: several physios hold the offer, the first to accept wins
+    "offer": Transition(
+        requires={"status": ("confirmed",), "assignment_status": OPEN_ASSIGNMENT},
+        sets={"assignment_status": "offered", "assigned_physio_id": None, "offered_physio_ids": Param("physio_ids"),
+              "offer_round": Param("round"), "offer_expires_at": Param("expires_at")},
+    ),
+    "accept_offer": Transition(
+        requires=OFFERED_TO,
+        sets={"assignment_status": "accepted", "assigned_physio_id": Param("physio_id"), "offered_physio_ids": []},
+    ),
+    "decline_offer": Transition(
+        requires=OFFERED_TO,
+        sets={},
+        add_to_set={"rejected_physio_ids": Param("physio_id")},
+        pull={"offered_physio_ids": Param("physio_id")},
+    ),
+    # Nobody took the round in time (or everyone declined); unanswered physios are not asked again
+    "expire_offer": Transition(
+        requires={"status": ("confirmed",), "assignment_status": ("offered",), "offer_round": Param("round")},
+        sets={"assignment_status": "unassigned", "offered_physio_ids": []},
+        add_to_set={"rejected_physio_ids": Param("physio_ids")},
+    ),
+    # Only the physio the booking is currently assigned to may answer
+    "accept": Transition(
+        requires={"status": ("confirmed",), "assignment_status": ("assigned",), "assigned_physio_id": Param("physio_id")},
+        sets={"assignment_status": "accepted"},
+    ),
+    "reject": Transition(
+        requires={"status": ("confirmed",), "assignment_status": ("assigned",), "assigned_physio_id": Param("physio_id")},
+        sets={"assignment_status": "unassigned", "assigned_physio_id": None},
+        add_to_set={"rejected_physio_ids": Param("physio_id")},
+    ),
+    "complete": Transition(
+        requires={"status": ("confirmed",), "assignment_status": ("assigned", "accepted"),
+                  "assigned_physio_id": Param("physio_id")},
+        sets={"status": "completed"},
+    ),
+    # Admin override: complete regardless of who is assigned
+    "admin_complete": Transition(
+        requires={"status": ("confirmed",)},
+        sets={"status": "completed"},
+    ),
+    "cancel": Transition(
+        requires={"status": ACTIVE_STATUSES},
+        sets={"status": "cancelled"},
+    ),
+}
+
+# Target status accepted by the generic status endpoint -> transition
+STATUS_TRANSITIONS = {
+    "confirmed": "pay",
+    "completed": "admin_complete",
+    "cancelled": "cancel",
+}
+
+STATE_FIELDS = ("status", "assignment_status", "assigned_physio_id")
+
+
+class TransitionRejected(Exception):
+    def __init__(self, name: str, booking_id: str, current: Optional[Dict[str, Any]]):
+        self.name = name
+        self.booking_id = booking_id
+        self.current = current
+        if current is None:
+            message = "Booking not found"
+        else:
+            state = ", ".join(f"{f}={current.get(f)}" for f in STATE_FIELDS)
+            message = f"Cannot {name} booking in state {state}"
+        super().__init__(message)
+
+    @property
+    def not_found(self) -> bool:
+        return self.current is None
+
+
+def _resolve(value: Any, params: Dict[str, Any]) -> Any:
+    if isinstance(value, Param):
+        if value.name not in params:
+            raise ValueError(f"Missing transition parameter '{value.name}'")
+        return params[value.name]
+    return value
+
+
+def _each(value: Any) -> Any:
+    return {"$each": value} if isinstance(value, list) else value
+
+
+def build(name: str, booking_id: str, params: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any], Dict[str, Any]]:
+    """Return (filter, $set fields, extra update operators) for a transition"""
+    transition = TRANSITIONS[name]
+
+    query: Dict[str, Any] = {"id": booking_id}
+    for field, allowed in transition.requires.items():
+        if isinstance(allowed, Param):
+            query[field] = _resolve(allowed, params)
+        else:
+            query[field] = {"$in": list(allowed)}
+
+    sets = {field: _resolve(value, params) for field, value in transition.sets.items()}
+    extra: Dict[str, Any] = {}
+    if transition.add_to_set:
+        extra["$addToSet"] = {f: _each(_resolve(v, params)) for f, v in transition.add_to_set.items()}
+    if transition.pull:
+        extra["$pull"] = {f: _resolve(v, params) for f, v in transition.pull.items()}
+    return query, sets, extra
+
+
+def history_entry(name: str, before: Dict[str, Any], sets: Dict[str, Any], actor: str) -> Dict[str, Any]:
+    return {
+        "booking_id": before.get("id"),
+        "transition": name,
+        "actor": actor,
+        "from": {f: before.get(f) for f in STATE_FIELDS},
+        "to": {f: sets.get(f, before.get(f)) for f in STATE_FIELDS},
+    }
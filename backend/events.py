@@ -0,0 +1,258 @@
+"""Admin event bus: incremental dashboard updates for connected ops staff.
+
+Handlers describe each write as an event (booking created, status change,
+practitioner verified, ...) together with the dashboard counter deltas it
+implies. In standalone mode the events are published in-process right after
+the write; with ADMIN_EVENTS_SOURCE=change_stream a MongoDB change stream is
+the source instead, so every worker sees writes made by every other worker.
+"""
+import asyncio
+import logging
+import re
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Set
+
+from ledger import practitioner_share
+
+logger = logging.getLogger(__name__)
+
+# Booking statuses that have their own counter on the admin dashboard
+STATUS_COUNTERS = {
+    "confirmed": "confirmed_bookings",
+    "completed": "completed_bookings",
+    "cancelled": "cancelled_bookings",
+}
+
+PRACTITIONER_STATUS_COUNTERS = {
+    "pending_review": "pending_practitioners",
+}
+
+# Fields pushed for a booking in the live "recent bookings" table
+BOOKING_SUMMARY_FIELDS = (
+    "id", "customer_name", "customer_phone", "service_type", "session_count", "amount",
+    "city", "preferred_date", "status", "payment_status", "assignment_status",
+    "assigned_physio_id", "created_at",
+)
+
+
+def booking_summary(doc: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: doc.get(k) for k in BOOKING_SUMMARY_FIELDS if k in doc}
+
+
+def _bump(counters: Dict[str, int], name: Optional[str], by: int):
+    if name:
+        counters[name] = counters.get(name, 0) + by
+
+
+# ==================== EVENT CONSTRUCTORS ====================
+
+def booking_created(doc: Dict[str, Any]) -> Dict[str, Any]:
+    counters = {"total_bookings": 1}
+    _bump(counters, STATUS_COUNTERS.get(doc.get("status")), 1)
+    return {"type": "booking_created", "booking": booking_summary(doc), "counters": counters}
+
+
+def booking_updated(before: Dict[str, Any], changes: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Event for a booking update, given the document before it and the $set fields"""
+    watched = {k: v for k, v in changes.items() if k in BOOKING_SUMMARY_FIELDS}
+    if not watched:
+        return None
+
+    counters: Dict[str, int] = {}
+    old_status, new_status = before.get("status"), changes.get("status")
+    if new_status and new_status != old_status:
+        _bump(counters, STATUS_COUNTERS.get(old_status), -1)
+        _bump(counters, STATUS_COUNTERS.get(new_status), 1)
+    # Revenue and commission move as the ledger's payment and cancellation entries do
+    amount = before.get("amount", 0)
+    if changes.get("payment_status") == "paid" and before.get("payment_status") != "paid":
+        _bump(counters, "total_revenue", amount)
+        _bump(counters, "platform_commission", amount - practitioner_share(amount))
+    elif new_status == "cancelled" and old_status != "cancelled" and before.get("payment_status") == "paid":
+        _bump(counters, "total_revenue", -amount)
+        _bump(counters, "platform_commission", -(amount - practitioner_share(amount)))
+
+    event = {
+        "type": "booking_updated",
+        "booking_id": before.get("id"),
+        "changes": watched,
+        "counters": counters,
+    }
+    if new_status and new_status != old_status:
+        event["transition"] = {"from": old_status, "to": new_status}
+    return event
+
+
+def booking_deleted(doc: Dict[str, Any]) -> Dict[str, Any]:
+    counters = {"total_bookings": -1}
+    _bump(counters, STATUS_COUNTERS.get(doc.get("status")), -1)
+    return {"type": "booking_deleted", "booking_id": doc.get("id"), "counters": counters}
+
+
+def practitioner_created(doc: Dict[str, Any]) -> Dict[str, Any]:
+    counters = {"total_practitioners": 1}
+    _bump(counters, PRACTITIONER_STATUS_COUNTERS.get(doc.get("status")), 1)
+    return {
+        "type": "practitioner_created",
+        "practitioner": {
+            "id": doc.get("id"),
+            "name": doc.get("personal_details", {}).get("full_name"),
+            "city": doc.get("personal_details", {}).get("city"),
+            "status": doc.get("status"),
+        },
+        "counters": counters,
+    }
+
+
+def practitioner_updated(before: Dict[str, Any], changes: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    counters: Dict[str, int] = {}
+    old_status, new_status = before.get("status"), changes.get("status")
+    if new_status and new_status != old_status:
+        _bump(counters, PRACTITIONER_STATUS_COUNTERS.get(old_status), -1)
+        _bump(counters, PRACTITIONER_STATUS_COUNTERS.get(new_status), 1)
+    if "is_verified" in changes and bool(changes["is_verified"]) != bool(before.get("is_verified")):
+        _bump(counters, "verified_practitioners", 1 if changes["is_verified"] else -1)
+
+    watched = {k: changes[k] for k in ("status", "is_verified", "is_available") if k in changes}
+    if not watched:
+        return None
+    return {
+        "type": "practitioner_updated",
+        "practitioner_id": before.get("id"),
+        "changes": watched,
+        "counters": counters,
+    }
+
+
+def user_created(doc: Dict[str, Any]) -> Dict[str, Any]:
+    return {"type": "user_created", "user_id": doc.get("id"), "counters": {"total_clients": 1}}
+
+
+# ==================== BUS ====================
+
+class Subscription:
+    def __init__(self, bus: "EventBus", maxsize: int):
+        self.bus = bus
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.overflowed = False
+
+    def offer(self, event: Dict[str, Any]):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # A slow client loses the incremental stream and is told to reload
+            self.overflowed = True
+
+    async def get(self) -> Dict[str, Any]:
+        if self.overflowed:
+            self.overflowed = False
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            return {"type": "resync"}
+        return await self.queue.get()
+
+    def close(self):
+        self.bus.subscribers.discard(self)
+
+
+class EventBus:
+    def __init__(self, source: str = "local", queue_size: int = 1000):
+        self.source = source
+        self.queue_size = queue_size
+        self.subscribers: Set[Subscription] = set()
+
+    def subscribe(self) -> Subscription:
+        sub = Subscription(self, self.queue_size)
+        self.subscribers.add(sub)
+        return sub
+
+    def publish(self, event: Optional[Dict[str, Any]]):
+        if not event:
+            return
+        event.setdefault("at", datetime.utcnow().isoformat())
+        for sub in list(self.subscribers):
+            sub.offer(event)
+
+    def emit_local(self, event: Optional[Dict[str, Any]]):
+        """Publish an event raised by a handler in this process.
+
+        Ignored when a change stream is the source, otherwise the watcher
+        would deliver the same write twice.
+        """
+        if self.source == "local" and self.subscribers:
+            self.publish(event)
+
+
+# ==================== CHANGE STREAM SOURCE ====================
+
+def change_to_event(change: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Translate a MongoDB change event into the admin event vocabulary"""
+    # City partitions are named "bookings__west" and so on
+    collection = (change.get("ns", {}).get("coll") or "").partition("__")[0]
+    op = change.get("operationType")
+
+    if op == "insert":
+        doc = change["fullDocument"]
+        if collection == "bookings":
+            return booking_created(doc)
+        if collection == "practitioners":
+            return practitioner_created(doc)
+        if collection == "users":
+            return user_created(doc)
+        return None
+
+    if op == "update":
+        changes = change.get("updateDescription", {}).get("updatedFields", {})
+        before = change.get("fullDocumentBeforeChange")
+        if before is None:
+            # Without a pre-image the old status is unknown, so counter
+            # deltas cannot be derived; clients refresh the counters instead
+            before = dict(change.get("fullDocument") or {})
+            for key in changes:
+                before.pop(key, None)
+            event = _update_event(collection, before, changes)
+            if event:
+                event["counters"] = {}
+                if changes.keys() & {"status", "payment_status", "is_verified"}:
+                    event["refresh_counters"] = True
+            return event
+        return _update_event(collection, before, changes)
+
+    if op == "delete" and collection == "bookings":
+        before = change.get("fullDocumentBeforeChange")
+        if before is None:
+            return {"type": "booking_deleted", "booking_id": None, "counters": {}, "refresh_counters": True}
+        return booking_deleted(before)
+
+    return None
+
+
+def _update_event(collection: str, before: Dict[str, Any], changes: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    if collection == "bookings":
+        return booking_updated(before, changes)
+    if collection == "practitioners":
+        return practitioner_updated(before, changes)
+    return None
+
+
+async def watch_changes(db, bus: EventBus, collections: List[str]):
+    """Feed the bus from a database change stream, resuming after errors"""
+    resume_token = None
+    names = "|".join(re.escape(c) for c in collections)
+    pipeline = [{"$match": {"ns.coll": {"$regex": f"^({names})(__.+)?$"}}}]
+    while True:
+        try:
+            async with db.watch(
+                pipeline,
+                full_document="updateLookup",
+                full_document_before_change="whenAvailable",
+                resume_after=resume_token,
+            ) as stream:
+                async for change in stream:
+                    resume_token = stream.resume_token
+                    bus.publish(change_to_event(change))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("Admin change stream interrupted: %s", e)
+            await asyncio.sleep(5)
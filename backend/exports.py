@@ -0,0 +1,234 @@
+"""Streaming exports of bookings, payments and practitioner payouts.
+
+Rows are read from a MongoDB cursor in batches and encoded batch by batch,
+so memory use stays flat no matter how many documents match. Filters are
+translated into the cursor query rather than applied in Python.
+"""
+import csv
+import io
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Dict, List, NamedTuple, Tuple
+
+import aiofiles
+
+BATCH_SIZE = 1000
+
+
+class ExportError(ValueError):
+    pass
+
+
+class Dataset(NamedTuple):
+    collection: str
+    columns: List[str]
+    base_query: Dict[str, Any]
+    filter_fields: Dict[str, str]  # filter name -> document field
+
+
+DATASETS: Dict[str, Dataset] = {
+    "bookings": Dataset(
+        collection="bookings",
+        columns=[
+            "id", "created_at", "user_id", "customer_name", "customer_phone", "city", "pincode",
+            "service_type", "session_count", "amount", "status", "payment_status",
+            "assignment_status", "assigned_physio_id", "preferred_date", "preferred_time",
+        ],
+        base_query={},
+        filter_fields={"status": "status", "city": "city", "date": "created_at"},
+    ),
+    "payments": Dataset(
+        collection="payments",
+        columns=["id", "order_id", "booking_id", "amount", "currency", "status", "razorpay_payment_id", "created_at"],
+        base_query={},
+        filter_fields={"status": "status", "date": "created_at"},
+    ),
+    # Practitioner earnings (one entry per completed session) and the payouts
+    # that settle them, straight from the ledger so the export agrees with it
+    "payouts": Dataset(
+        collection="ledger_entries",
+        columns=["id", "created_at", "practitioner_id", "type", "booking_id", "run_id", "amount"],
+        base_query={"account": {"$regex": "^practitioner:"}},
+        filter_fields={"status": "type", "date": "created_at"},
+    ),
+}
+
+
+def _projection(dataset: Dataset) -> Dict[str, int]:
+    return {"_id": 0, **{f: 1 for f in dataset.columns}}
+
+
+def build_query(dataset_name: str, filters: Dict[str, Any]) -> Dict[str, Any]:
+    """Translate export filters into a MongoDB query for the dataset"""
+    dataset = DATASETS.get(dataset_name)
+    if not dataset:
+        raise ExportError(f"Unknown dataset '{dataset_name}'")
+
+    query = dict(dataset.base_query)
+    for name in ("status", "city"):
+        if filters.get(name):
+            if name not in dataset.filter_fields:
+                raise ExportError(f"Filter '{name}' is not supported for {dataset_name}")
+            query[dataset.filter_fields[name]] = filters[name]
+
+    date_range = {}
+    if filters.get("date_from"):
+        date_range["$gte"] = _parse_date(filters["date_from"])
+    if filters.get("date_to"):
+        # date_to is inclusive of the whole day
+        date_range["$lt"] = _parse_date(filters["date_to"]) + timedelta(days=1)
+    if date_range:
+        query[dataset.filter_fields["date"]] = date_range
+    return query
+
+
+def _parse_date(value: str) -> datetime:
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise ExportError(f"Invalid date '{value}', expected YYYY-MM-DD")
+
+
+async def iter_batches(db, dataset_name: str, filters: Dict[str, Any]) -> AsyncIterator[List[Dict[str, Any]]]:
+    """Yield lists of export rows, BATCH_SIZE at a time, straight off the cursor"""
+    dataset = DATASETS[dataset_name]
+    query = build_query(dataset_name, filters)
+    cursor = db[dataset.collection].find(query, _projection(dataset)).sort("created_at", 1).batch_size(BATCH_SIZE)
+
+    batch: List[Dict[str, Any]] = []
+    async for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# ==================== CSV ====================
+
+def _csv_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return "" if value is None else value
+
+
+def _encode_csv(columns: List[str], rows: List[Dict[str, Any]], header: bool) -> str:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(columns)
+    for row in rows:
+        writer.writerow([_csv_value(row.get(c)) for c in columns])
+    return buffer.getvalue()
+
+
+async def encode_csv(db, dataset_name: str, filters: Dict[str, Any]) -> AsyncIterator[Tuple[str, int]]:
+    """Yield (encoded chunk, rows in chunk) pairs; the header rides on the first chunk"""
+    columns = DATASETS[dataset_name].columns
+    header = True
+    async for batch in iter_batches(db, dataset_name, filters):
+        yield _encode_csv(columns, batch, header), len(batch)
+        header = False
+    if header:
+        yield _encode_csv(columns, [], True), 0
+
+
+# ==================== PARQUET ====================
+
+def parquet_available() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file object that hands encoded Parquet bytes back batch by batch"""
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _arrow_schema(dataset_name: str):
+    import pyarrow as pa
+    types = {
+        "amount": pa.int64(), "session_count": pa.int64(), "created_at": pa.timestamp("ms"),
+    }
+    return pa.schema([(c, types.get(c, pa.string())) for c in DATASETS[dataset_name].columns])
+
+
+def _arrow_table(schema, rows: List[Dict[str, Any]]):
+    import pyarrow as pa
+    columns = {}
+    for field in schema:
+        values = [row.get(field.name) for row in rows]
+        if pa.types.is_string(field.type):
+            values = [None if v is None else str(v) for v in values]
+        columns[field.name] = pa.array(values, type=field.type)
+    return pa.Table.from_pydict(columns, schema=schema)
+
+
+async def encode_parquet(db, dataset_name: str, filters: Dict[str, Any]) -> AsyncIterator[Tuple[bytes, int]]:
+    """Encode each cursor batch as one Parquet row group and yield its bytes"""
+    import pyarrow.parquet as pq
+
+    schema = _arrow_schema(dataset_name)
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression="snappy")
+    async for batch in iter_batches(db, dataset_name, filters):
+        writer.write_table(_arrow_table(schema, batch))
+        yield sink.drain(), len(batch)
+    writer.close()
+    yield sink.drain(), 0
+
+
+def encode_export(db, dataset_name: str, fmt: str, filters: Dict[str, Any]) -> AsyncIterator[Tuple[Any, int]]:
+    build_query(dataset_name, filters)  # validate before any output is produced
+    if fmt == "csv":
+        return encode_csv(db, dataset_name, filters)
+    if fmt == "parquet":
+        if not parquet_available():
+            raise ExportError("Parquet export requires pyarrow to be installed")
+        return encode_parquet(db, dataset_name, filters)
+    raise ExportError(f"Unsupported format '{fmt}'")
+
+
+def stream_export(db, dataset_name: str, fmt: str, filters: Dict[str, Any]) -> AsyncIterator:
+    """Response body for a synchronous download"""
+    chunks = encode_export(db, dataset_name, fmt, filters)
+
+    async def body():
+        async for chunk, _ in chunks:
+            yield chunk
+    return body()
+
+
+async def write_export(db, dataset_name: str, fmt: str, filters: Dict[str, Any], path, progress) -> Dict[str, Any]:
+    """Background-job body: stream an export to a file, reporting row counts"""
+    rows = 0
+    chunks = encode_export(db, dataset_name, fmt, filters)
+    async with aiofiles.open(path, "w" if fmt == "csv" else "wb") as f:
+        async for chunk, count in chunks:
+            await f.write(chunk)
+            if count:
+                rows += count
+                await progress(rows=rows)
+    return {"file": path.name, "format": fmt, "rows": rows, "bytes": path.stat().st_size}
@@ -0,0 +1,71 @@
+"""Background jobs for long-running admin work (exports, bulk imports).
+
+Job state lives in the `jobs` collection so any worker can report on it;
+the work itself runs as an asyncio task in the worker that accepted it.
+"""
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# fn(job_id, progress) -> result; progress(**fields) records intermediate counters
+JobFunction = Callable[[str, Callable[..., Awaitable[None]]], Awaitable[Dict[str, Any]]]
+
+
+class JobRunner:
+    def __init__(self, collection):
+        self.collection = collection
+        self.tasks: Set[asyncio.Task] = set()
+
+    async def submit(self, kind: str, params: Dict[str, Any], fn: JobFunction) -> Dict[str, Any]:
+        job = {
+            "id": str(uuid.uuid4()),
+            "kind": kind,
+            "params": params,
+            "status": "queued",
+            "progress": {},
+            "result": None,
+            "error": None,
+            "created_at": datetime.utcnow(),
+            "updated_at": datetime.utcnow(),
+            "finished_at": None,
+        }
+        await self.collection.insert_one(dict(job))
+
+        task = asyncio.create_task(self._run(job["id"], fn))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return job
+
+    async def _run(self, job_id: str, fn: JobFunction):
+        async def progress(**fields):
+            await self.collection.update_one(
+                {"id": job_id},
+                {"$set": {"updated_at": datetime.utcnow(), **{f"progress.{k}": v for k, v in fields.items()}}}
+            )
+
+        await self.collection.update_one(
+            {"id": job_id},
+            {"$set": {"status": "running", "updated_at": datetime.utcnow()}}
+        )
+        try:
+            result = await fn(job_id, progress)
+            update = {"status": "completed", "result": result}
+        except Exception as e:
+            logger.exception("Job %s failed", job_id)
+            update = {"status": "failed", "error": str(e)}
+        update["finished_at"] = update["updated_at"] = datetime.utcnow()
+        await self.collection.update_one({"id": job_id}, {"$set": update})
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return await self.collection.find_one({"id": job_id}, {"_id": 0})
+
+    async def fail_interrupted(self, stale_after: timedelta = timedelta(minutes=10)):
+        """Jobs with no progress for a while were left behind by a dead worker"""
+        await self.collection.update_many(
+            {"status": {"$in": ["queued", "running"]}, "updated_at": {"$lt": datetime.utcnow() - stale_after}},
+            {"$set": {"status": "failed", "error": "Interrupted by server restart", "finished_at": datetime.utcnow()}}
+        )
@@ -0,0 +1,215 @@
+"""Append-only earnings ledger with running balances.
+
+Every money movement is written once to `ledger_entries` (payments, refunds
+of cancelled bookings, session completions and payouts) and folded into a per-account running balance in
+`ledger_balances`, so dashboards read earnings with a single document
+lookup instead of aggregating over bookings. Entries carry an idempotency
+key, so replaying an event (retried request, backfill) never double-counts.
+"""
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+# Practitioner's share of a paid booking; the platform keeps the rest
+PRACTITIONER_SHARE = 0.7
+
+PLATFORM_ACCOUNT = "platform"
+
+# A payout lock older than this was left behind by a crashed run
+PAYOUT_LOCK_TIMEOUT = timedelta(hours=1)
+
+
+def practitioner_account(practitioner_id: str) -> str:
+    return f"practitioner:{practitioner_id}"
+
+
+def practitioner_share(amount: int) -> int:
+    return int(amount * PRACTITIONER_SHARE)
+
+
+class LedgerError(Exception):
+    pass
+
+
+class Ledger:
+    def __init__(self, entries, balances, locks):
+        self.entries = entries
+        self.balances = balances
+        self.locks = locks
+
+    async def ensure_indexes(self):
+        await self.entries.create_index("key", unique=True)
+        await self.entries.create_index([("account", 1), ("created_at", -1)])
+
+    async def _record(self, key: str, account: str, entry_type: str, deltas: Dict[str, int], **fields) -> bool:
+        """Append one entry and apply its deltas to the account balance.
+
+        Returns False if an entry with the same key was already recorded.
+        """
+        entry = {
+            "id": str(uuid.uuid4()),
+            "key": key,
+            "account": account,
+            "type": entry_type,
+            "deltas": deltas,
+            "created_at": datetime.utcnow(),
+            **fields,
+        }
+        try:
+            await self.entries.insert_one(entry)
+        except DuplicateKeyError:
+            return False
+        await self.balances.update_one(
+            {"_id": account},
+            {"$inc": {**deltas, "entry_count": 1}, "$set": {"updated_at": entry["created_at"]}},
+            upsert=True
+        )
+        return True
+
+    async def record_payment(self, booking: Dict[str, Any]) -> bool:
+        """Booking paid: gross revenue and the platform's commission on it"""
+        amount = booking.get("amount", 0)
+        return await self._record(
+            f"payment:{booking['id']}", PLATFORM_ACCOUNT, "payment",
+            {"revenue": amount, "commission": amount - practitioner_share(amount), "paid_bookings": 1},
+            booking_id=booking["id"], amount=amount
+        )
+
+    async def record_cancellation(self, booking: Dict[str, Any]) -> bool:
+        """Paid booking cancelled: refunded in full, so its payment entry is reversed"""
+        if booking.get("payment_status") != "paid":
+            return False
+        amount = booking.get("amount", 0)
+        return await self._record(
+            f"cancellation:{booking['id']}", PLATFORM_ACCOUNT, "cancellation",
+            {"revenue": -amount, "commission": -(amount - practitioner_share(amount)), "paid_bookings": -1,
+             "refunded": amount, "refunded_bookings": 1},
+            booking_id=booking["id"], amount=amount
+        )
+
+    async def record_completion(self, booking: Dict[str, Any]) -> bool:
+        """Session completed: the practitioner earns their share, pending payout"""
+        practitioner_id = booking.get("assigned_physio_id")
+        if not practitioner_id or booking.get("payment_status") != "paid":
+            return False
+        share = practitioner_share(booking.get("amount", 0))
+        return await self._record(
+            f"completion:{booking['id']}", practitioner_account(practitioner_id), "completion",
+            {"earned": share, "pending": share, "completed_bookings": 1},
+            booking_id=booking["id"], practitioner_id=practitioner_id, amount=share
+        )
+
+    async def balance(self, account: str) -> Dict[str, Any]:
+        doc = await self.balances.find_one({"_id": account}) or {}
+        doc.pop("_id", None)
+        return doc
+
+    async def history(self, account: str, limit: int = 50, before: Optional[datetime] = None) -> List[Dict[str, Any]]:
+        query: Dict[str, Any] = {"account": account}
+        if before:
+            query["created_at"] = {"$lt": before}
+        return await self.entries.find(query, {"_id": 0}).sort("created_at", -1).to_list(limit)
+
+    # ==================== PAYOUT RUNS ====================
+
+    async def run_payouts(self, min_amount: int = 1, practitioner_ids: Optional[List[str]] = None,
+                          dry_run: bool = False) -> Dict[str, Any]:
+        """Settle every practitioner's pending balance in one pass.
+
+        One query reads the balances due, one insert_many appends the payout
+        entries and one bulk_write moves the amounts from pending to paid_out.
+        A lock document keeps two runs from settling the same balances.
+        """
+        run_id = str(uuid.uuid4())
+        query: Dict[str, Any] = {"_id": {"$regex": "^practitioner:"}, "pending": {"$gte": min_amount}}
+        if practitioner_ids:
+            query["_id"] = {"$in": [practitioner_account(p) for p in practitioner_ids]}
+
+        if not dry_run:
+            await self._acquire_lock(run_id)
+        try:
+            due = await self.balances.find(query, {"_id": 1, "pending": 1}).to_list(None)
+            payouts = [
+                {"practitioner_id": b["_id"].split(":", 1)[1], "amount": b["pending"]}
+                for b in due if b.get("pending", 0) >= min_amount
+            ]
+            if dry_run or not payouts:
+                return {"run_id": run_id, "dry_run": dry_run, "count": len(payouts),
+                        "total": sum(p["amount"] for p in payouts), "payouts": payouts}
+
+            now = datetime.utcnow()
+            await self.entries.insert_many([
+                {
+                    "id": str(uuid.uuid4()),
+                    "key": f"payout:{run_id}:{p['practitioner_id']}",
+                    "account": practitioner_account(p["practitioner_id"]),
+                    "type": "payout",
+                    "deltas": {"pending": -p["amount"], "paid_out": p["amount"], "payouts": 1},
+                    "practitioner_id": p["practitioner_id"],
+                    "amount": p["amount"],
+                    "run_id": run_id,
+                    "created_at": now,
+                }
+                for p in payouts
+            ])
+            # Subtracting the snapshot amount stays correct if new earnings
+            # landed on a balance between the read and this write
+            await self.balances.bulk_write([
+                UpdateOne(
+                    {"_id": practitioner_account(p["practitioner_id"])},
+                    {"$inc": {"pending": -p["amount"], "paid_out": p["amount"], "payouts": 1, "entry_count": 1},
+                     "$set": {"updated_at": now}}
+                )
+                for p in payouts
+            ], ordered=False)
+            return {"run_id": run_id, "dry_run": False, "count": len(payouts),
+                    "total": sum(p["amount"] for p in payouts), "payouts": payouts}
+        finally:
+            if not dry_run:
+                await self.locks.delete_one({"_id": "payout_run", "run_id": run_id})
+
+    async def _acquire_lock(self, run_id: str):
+        now = datetime.utcnow()
+        await self.locks.delete_one({"_id": "payout_run", "started_at": {"$lt": now - PAYOUT_LOCK_TIMEOUT}})
+        try:
+            await self.locks.insert_one({"_id": "payout_run", "run_id": run_id, "started_at": now})
+        except DuplicateKeyError:
+            raise LedgerError("Another payout run is in progress")
+
+    # ==================== RECONCILIATION ====================
+
+    async def backfill(self, bookings) -> Dict[str, int]:
+        """Record entries for paid/completed/cancelled bookings that predate the ledger"""
+        counts = {"payments": 0, "cancellations": 0, "completions": 0}
+        cursor = bookings.find(
+            {"payment_status": "paid"},
+            {"_id": 0, "id": 1, "amount": 1, "status": 1, "payment_status": 1, "assigned_physio_id": 1}
+        ).batch_size(1000)
+        async for booking in cursor:
+            if await self.record_payment(booking):
+                counts["payments"] += 1
+            if booking.get("status") == "cancelled" and await self.record_cancellation(booking):
+                counts["cancellations"] += 1
+            if booking.get("status") == "completed" and await self.record_completion(booking):
+                counts["completions"] += 1
+        return counts
+
+    async def rebuild_balances(self) -> int:
+        """Recompute every running balance from the entries (repairs drift after a crash)"""
+        totals: Dict[str, Dict[str, int]] = {}
+        async for entry in self.entries.find({}, {"_id": 0, "account": 1, "deltas": 1}).batch_size(1000):
+            account = totals.setdefault(entry["account"], {"entry_count": 0})
+            account["entry_count"] += 1
+            for field, delta in entry["deltas"].items():
+                account[field] = account.get(field, 0) + delta
+
+        now = datetime.utcnow()
+        if totals:
+            await self.balances.bulk_write([
+                UpdateOne({"_id": account}, {"$set": {**fields, "updated_at": now}}, upsert=True)
+                for account, fields in totals.items()
+            ], ordered=False)
+        return len(totals)
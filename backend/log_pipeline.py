@@ -0,0 +1,309 @@
+"""Non-blocking structured logging.
+
+Handlers on the event loop only enqueue records; a QueueListener thread
+formats them as JSON and does the I/O. Each record carries the context of
+the request (or background task) that logged it, captured when the record
+is enqueued. Filters drop a sampled share of high-volume INFO/DEBUG records
+per logger and collapse repeats of the same warning into one line per
+interval, with a count of what was suppressed. The time spent logging is
+totalled per request and returned in a Server-Timing header.
+"""
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+import time
+import traceback
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional, Tuple
+
+from tracing import current_span
+
+# Set for the duration of each HTTP request and inherited by tasks it spawns
+request_context: contextvars.ContextVar[Optional["RequestContext"]] = contextvars.ContextVar(
+    "request_context", default=None
+)
+
+
+class RequestContext:
+    __slots__ = ("request_id", "method", "path", "log_records", "log_seconds")
+
+    def __init__(self, request_id: str, method: str, path: str):
+        self.request_id = request_id
+        self.method = method
+        self.path = path
+        self.log_records = 0
+        self.log_seconds = 0.0
+
+    def fields(self) -> Dict[str, Any]:
+        return {"request_id": self.request_id, "method": self.method, "path": self.path}
+
+
+# ==================== FILTERS ====================
+
+class SamplingFilter(logging.Filter):
+    """Keep only a share of INFO/DEBUG records for the configured loggers.
+
+    Rates are matched on the logger name or its nearest configured parent.
+    Warnings and errors are never sampled out.
+    """
+
+    def __init__(self, rates: Dict[str, float], rng: Optional[random.Random] = None):
+        super().__init__()
+        self.rates = rates
+        self.random = (rng or random.Random()).random
+        self._resolved: Dict[str, float] = {}
+
+    def rate_for(self, name: str) -> float:
+        rate = self._resolved.get(name)
+        if rate is None:
+            rate, probe = 1.0, name
+            while probe:
+                if probe in self.rates:
+                    rate = self.rates[probe]
+                    break
+                probe = probe.rpartition(".")[0]
+            self._resolved[name] = rate
+        return rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rate_for(record.name)
+        if rate >= 1.0:
+            return True
+        if self.random() >= rate:
+            return False
+        record.sample_rate = rate
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """Emit each distinct warning (logger + message template) at most once per interval.
+
+    The next emission after a quiet period reports how many repeats were dropped.
+    """
+
+    def __init__(self, interval: float = 60.0, level: int = logging.WARNING):
+        super().__init__()
+        self.interval = interval
+        self.level = level
+        self.lock = threading.Lock()
+        self.state: Dict[Tuple[str, Any], list] = {}  # key -> [next allowed time, suppressed]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno != self.level or self.interval <= 0:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.state.get(key)
+            if entry and now < entry[0]:
+                entry[1] += 1
+                return False
+            if entry and entry[1]:
+                record.suppressed = entry[1]
+            self.state[key] = [now + self.interval, 0]
+            if len(self.state) > 10000:
+                self.state = {k: v for k, v in self.state.items() if v[0] > now}
+        return True
+
+
+# ==================== HANDLERS ====================
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """Enqueue records with their request context; never blocks the caller"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        context = request_context.get()
+        if context is not None:
+            record.context = context.fields()
+        span = current_span.get()
+        if span is not None:
+            record.trace_id = span.trace_id
+            record.span_id = span.span_id
+        if record.exc_info:
+            record.exc_text = "".join(traceback.format_exception(*record.exc_info))
+            record.exc_info = None
+        # Resolve the message here: args may reference objects that change before the listener runs
+        record.template = record.msg if isinstance(record.msg, str) else None
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def handle(self, record: logging.LogRecord) -> bool:
+        start = time.perf_counter()
+        try:
+            return super().handle(record)
+        finally:
+            context = request_context.get()
+            if context is not None:
+                context.log_records += 1
+                context.log_seconds += time.perf_counter() - start
+
+
+STANDARD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {
+    "message", "asctime", "context", "template", "sample_rate", "suppressed", "taskName",
+}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; `extra=` fields are included as-is"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        template = getattr(record, "template", None)
+        if template and template != entry["message"]:
+            entry["template"] = template
+        for attribute in ("context", "sample_rate", "suppressed"):
+            value = getattr(record, attribute, None)
+            if value is not None:
+                entry[attribute] = value
+        for key, value in vars(record).items():
+            if key not in STANDARD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """The original plain-text layout, plus the request ID when there is one"""
+
+    def __init__(self):
+        super().__init__('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        context = getattr(record, "context", None)
+        if context:
+            line += f" [request_id={context['request_id']}]"
+        if getattr(record, "suppressed", None):
+            line += f" [suppressed {record.suppressed} similar]"
+        return line
+
+
+def parse_rates(spec: str) -> Dict[str, float]:
+    """Parse `"server.assign=0.1,voct.access=0.05"` into per-logger sampling rates"""
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, rate = item.partition("=")
+        rates[name.strip()] = float(rate)
+    return rates
+
+
+class LogPipeline:
+    def __init__(self, handler: ContextQueueHandler, listener: logging.handlers.QueueListener,
+                 log_queue: queue.Queue):
+        self.handler = handler
+        self.listener = listener
+        self.queue = log_queue
+
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    def stats(self) -> Dict[str, int]:
+        return {"queued": self.depth(), "dropped": self.handler.dropped}
+
+    def stop(self):
+        """Flush queued records and stop the writer thread"""
+        if self.listener._thread is not None:
+            self.listener.stop()
+
+
+def configure_logging(
+    level: str = "INFO",
+    fmt: str = "json",
+    sampling: Optional[Dict[str, float]] = None,
+    warning_interval: float = 60.0,
+    queue_size: int = 10000,
+    stream=None,
+) -> LogPipeline:
+    """Route the root logger through a queue to a background writer thread"""
+    log_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+
+    handler = ContextQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter(sampling or {}))
+    handler.addFilter(RateLimitFilter(warning_interval))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+    return LogPipeline(handler, listener, log_queue)
+
+
+# ==================== REQUEST CONTEXT ====================
+
+class RequestContextMiddleware:
+    """ASGI middleware: bind a RequestContext per HTTP request, report logging cost
+
+    An incoming X-Request-ID is reused so IDs line up with the proxy's logs.
+    """
+
+    def __init__(self, app, access_logger: str = "voct.access"):
+        self.app = app
+        self.access_log = logging.getLogger(access_logger)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope.get("headers") or [])
+        request_id = headers.get(b"x-request-id", b"").decode("latin-1")[:64] or uuid.uuid4().hex
+        context = RequestContext(request_id, scope["method"], scope["path"])
+        token = request_context.set(context)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [
+                    (b"x-request-id", request_id.encode("latin-1")),
+                    (b"server-timing",
+                     f'log;dur={context.log_seconds * 1000:.3f};desc="{context.log_records} records"'.encode()),
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            self.access_log.info(
+                "%s %s %s", scope["method"], scope["path"], status,
+                extra={
+                    "status": status,
+                    "duration_ms": round((time.perf_counter() - start) * 1000, 3),
+                    "log_records": context.log_records,
+                    "log_ms": round(context.log_seconds * 1000, 3),
+                }
+            )
+            request_context.reset(token)
@@ -0,0 +1,543 @@
+"""In-memory stand-in for the subset of Motor the backend uses.
+
+Collections hold plain dicts and understand the query operators, update
+operators and cursor methods that server.py and its modules issue, so the
+real request handlers can run without a MongoDB server (simulations,
+benchmarks, local experiments). Unique indexes are enforced so idempotency
+keys behave as they do against Mongo. It is not a general Mongo emulator.
+"""
+import copy
+import re
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+_MISSING = object()
+
+
+# ==================== QUERIES ====================
+
+def _get(doc: Any, path: str) -> Any:
+    """Resolve a dotted path; lists fan out so `a.b` matches any element's `b`"""
+    value = doc
+    for part in path.split("."):
+        if isinstance(value, dict):
+            value = value.get(part, _MISSING)
+        elif isinstance(value, list) and not part.isdigit():
+            values = [_get(v, part) for v in value if isinstance(v, dict)]
+            value = [v for v in values if v is not _MISSING]
+        elif isinstance(value, list):
+            index = int(part)
+            value = value[index] if index < len(value) else _MISSING
+        else:
+            return _MISSING
+        if value is _MISSING:
+            return _MISSING
+    return value
+
+
+def _candidates(value: Any) -> List[Any]:
+    """A field matches if the value itself or any array element matches"""
+    if isinstance(value, list):
+        return [value, *value]
+    return [value]
+
+
+def _compare(op: str, value: Any, operand: Any) -> bool:
+    if value is _MISSING or value is None:
+        return False
+    try:
+        if op == "$gt":
+            return value > operand
+        if op == "$gte":
+            return value >= operand
+        if op == "$lt":
+            return value < operand
+        return value <= operand
+    except TypeError:
+        return False
+
+
+def _match_operator(value: Any, op: str, operand: Any) -> bool:
+    if op == "$eq":
+        return _match_value(value, operand)
+    if op == "$ne":
+        return not _match_value(value, operand)
+    if op == "$in":
+        return any(_match_value(value, o) for o in operand)
+    if op == "$nin":
+        return not any(_match_value(value, o) for o in operand)
+    if op in ("$gt", "$gte", "$lt", "$lte"):
+        return any(_compare(op, v, operand) for v in _candidates(value))
+    if op == "$exists":
+        return (value is not _MISSING) == bool(operand)
+    if op == "$regex":
+        pattern = re.compile(operand) if isinstance(operand, str) else operand
+        return any(isinstance(v, str) and pattern.search(v) for v in _candidates(value))
+    if op == "$size":
+        return isinstance(value, list) and len(value) == operand
+    if op == "$options":
+        return True
+    raise NotImplementedError(f"Query operator {op} is not supported by the memory store")
+
+
+def _match_value(value: Any, condition: Any) -> bool:
+    if isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition):
+        if "$regex" in condition and "i" in condition.get("$options", ""):
+            condition = {**condition, "$regex": re.compile(condition["$regex"], re.IGNORECASE)}
+        return all(_match_operator(value, op, operand) for op, operand in condition.items())
+    if isinstance(condition, re.Pattern):
+        # A compiled pattern (e.g. inside $in) matches as a regex, as in Mongo
+        return any(isinstance(v, str) and condition.search(v) for v in _candidates(value))
+    if value is _MISSING:
+        return condition is None
+    return any(v == condition for v in _candidates(value))
+
+
+def matches(doc: Dict[str, Any], query: Dict[str, Any]) -> bool:
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(matches(doc, q) for q in condition):
+                return False
+        elif key == "$and":
+            if not all(matches(doc, q) for q in condition):
+                return False
+        elif not _match_value(_get(doc, key), condition):
+            return False
+    return True
+
+
+def _project(doc: Dict[str, Any], projection: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    doc = copy.deepcopy(doc)
+    if not projection:
+        return doc
+    include_id = projection.get("_id", 1)
+    fields = {k: v for k, v in projection.items() if k != "_id"}
+    if fields and any(fields.values()):
+        result: Dict[str, Any] = {}
+        for path in fields:
+            value = _get(doc, path)
+            if value is _MISSING:
+                continue
+            target = result
+            parts = path.split(".")
+            for part in parts[:-1]:
+                target = target.setdefault(part, {})
+            target[parts[-1]] = value
+        if include_id and "_id" in doc:
+            result["_id"] = doc["_id"]
+        return result
+    for path in fields:
+        parts = path.split(".")
+        target = doc
+        for part in parts[:-1]:
+            target = target.get(part, {}) if isinstance(target, dict) else {}
+        if isinstance(target, dict):
+            target.pop(parts[-1], None)
+    if not include_id:
+        doc.pop("_id", None)
+    return doc
+
+
+# ==================== UPDATES ====================
+
+def _parent(doc: Dict[str, Any], path: str) -> Tuple[Dict[str, Any], str]:
+    parts = path.split(".")
+    target = doc
+    for part in parts[:-1]:
+        target = target.setdefault(part, {})
+    return target, parts[-1]
+
+
+def _apply_update(doc: Dict[str, Any], update: Dict[str, Any], inserting: bool = False):
+    for op, fields in update.items():
+        for path, value in fields.items():
+            target, key = _parent(doc, path)
+            if op == "$set":
+                target[key] = copy.deepcopy(value)
+            elif op == "$setOnInsert":
+                if inserting:
+                    target[key] = copy.deepcopy(value)
+            elif op == "$unset":
+                target.pop(key, None)
+            elif op == "$inc":
+                target[key] = target.get(key, 0) + value
+            elif op == "$max":
+                if key not in target or value > target[key]:
+                    target[key] = value
+            elif op == "$min":
+                if key not in target or value < target[key]:
+                    target[key] = value
+            elif op in ("$addToSet", "$push"):
+                values = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+                current = target.setdefault(key, [])
+                for v in values:
+                    if op == "$push" or v not in current:
+                        current.append(copy.deepcopy(v))
+            elif op == "$pull":
+                current = target.get(key)
+                if isinstance(current, list):
+                    target[key] = [v for v in current if not _match_value(v, value)]
+            else:
+                raise NotImplementedError(f"Update operator {op} is not supported by the memory store")
+
+
+def _upsert_seed(query: Dict[str, Any]) -> Dict[str, Any]:
+    """Equality conditions of an upsert filter become fields of the new document"""
+    doc: Dict[str, Any] = {}
+    for key, condition in query.items():
+        if key.startswith("$") or (isinstance(condition, dict) and any(k.startswith("$") for k in condition)):
+            continue
+        target, field = _parent(doc, key)
+        target[field] = copy.deepcopy(condition)
+    return doc
+
+
+# ==================== COLLECTIONS ====================
+
+class Result:
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+class MemoryCursor:
+    def __init__(self, docs: List[Dict[str, Any]], projection: Optional[Dict[str, Any]]):
+        self._docs = docs
+        self._projection = projection
+        self._sort: List[Tuple[str, int]] = []
+        self._skip = 0
+        self._limit = 0
+        self._iter = None
+
+    def sort(self, key, direction: int = 1) -> "MemoryCursor":
+        self._sort = list(key) if isinstance(key, (list, tuple)) else [(key, direction)]
+        return self
+
+    def skip(self, count: int) -> "MemoryCursor":
+        self._skip = count
+        return self
+
+    def limit(self, count: int) -> "MemoryCursor":
+        self._limit = count
+        return self
+
+    def batch_size(self, size: int) -> "MemoryCursor":
+        return self
+
+    def _results(self) -> List[Dict[str, Any]]:
+        docs = self._docs
+        for key, direction in reversed(self._sort):
+            present = [d for d in docs if _get(d, key) not in (_MISSING, None)]
+            absent = [d for d in docs if _get(d, key) in (_MISSING, None)]
+            present.sort(key=lambda d: _get(d, key), reverse=direction < 0)
+            # Mongo orders missing/null before any value ascending, after it descending
+            docs = absent + present if direction > 0 else present + absent
+        docs = docs[self._skip:]
+        if self._limit:
+            docs = docs[:self._limit]
+        return [_project(d, self._projection) for d in docs]
+
+    async def to_list(self, length: Optional[int] = None) -> List[Dict[str, Any]]:
+        results = self._results()
+        return results if length is None else results[:length]
+
+    def __aiter__(self):
+        self._iter = iter(self._results())
+        return self
+
+    async def __anext__(self) -> Dict[str, Any]:
+        try:
+            return next(self._iter)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+# ==================== AGGREGATION ====================
+
+def _expression(doc: Dict[str, Any], expr: Any) -> Any:
+    """Evaluate the few expressions the admin analytics use: "$field", literals, $dateToString"""
+    if isinstance(expr, str) and expr.startswith("$"):
+        value = _get(doc, expr[1:])
+        return None if value is _MISSING else value
+    if isinstance(expr, dict) and "$dateToString" in expr:
+        spec = expr["$dateToString"]
+        value = _expression(doc, spec["date"])
+        return value.strftime(spec["format"]) if value is not None else None
+    if isinstance(expr, dict):
+        return {k: _expression(doc, v) for k, v in expr.items()}
+    return expr
+
+
+def _group(docs: List[Dict[str, Any]], spec: Dict[str, Any]) -> List[Dict[str, Any]]:
+    groups: Dict[str, Dict[str, Any]] = {}
+    for doc in docs:
+        key = _expression(doc, spec["_id"])
+        group = groups.setdefault(repr(key), {"_id": key})
+        for field, accumulator in spec.items():
+            if field == "_id":
+                continue
+            (op, operand), = accumulator.items()
+            value = _expression(doc, operand)
+            if op == "$sum":
+                group[field] = group.get(field, 0) + (value if isinstance(value, (int, float)) else 0)
+            elif op in ("$max", "$min") and value is not None:
+                current = group.get(field)
+                if current is None or (value > current if op == "$max" else value < current):
+                    group[field] = value
+            elif op == "$push":
+                group.setdefault(field, []).append(value)
+            else:
+                raise NotImplementedError(f"accumulator {op}")
+    return list(groups.values())
+
+
+def aggregate(docs: List[Dict[str, Any]], pipeline: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Run a pipeline of $match, $group, $sort and $limit stages"""
+    for stage in pipeline:
+        (op, spec), = stage.items()
+        if op == "$match":
+            docs = [d for d in docs if matches(d, spec)]
+        elif op == "$group":
+            docs = _group(docs, spec)
+        elif op == "$sort":
+            docs = MemoryCursor(docs, None).sort(list(spec.items()))._results()
+        elif op == "$limit":
+            docs = docs[:spec]
+        else:
+            raise NotImplementedError(f"pipeline stage {op}")
+    return docs
+
+
+def _index_key(doc: Dict[str, Any], fields: Tuple[str, ...]) -> Optional[tuple]:
+    values = tuple(_get(doc, f) for f in fields)
+    if all(v is _MISSING for v in values):
+        return None
+    return tuple(repr(v) if isinstance(v, (list, dict)) else v for v in values)
+
+
+class MemoryCollection:
+    def __init__(self, name: str):
+        self.name = name
+        self.docs: List[Dict[str, Any]] = []
+        # Unique indexes double as hash lookups for equality queries
+        self.unique: Dict[Tuple[str, ...], Dict[tuple, Dict[str, Any]]] = {("_id",): {}}
+
+    # ---- indexes ----
+
+    async def create_index(self, keys, unique: bool = False, **kwargs) -> str:
+        fields = tuple(k for k, _ in keys) if isinstance(keys, (list, tuple)) else (keys,)
+        if unique and fields not in self.unique:
+            index: Dict[tuple, Dict[str, Any]] = {}
+            for doc in self.docs:
+                key = _index_key(doc, fields)
+                if key is not None:
+                    if key in index:
+                        raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name}")
+                    index[key] = doc
+            self.unique[fields] = index
+        return "_".join(fields)
+
+    def _check_unique(self, doc: Dict[str, Any], ignore: Optional[Dict[str, Any]] = None):
+        for fields, index in self.unique.items():
+            key = _index_key(doc, fields)
+            if key is not None and index.get(key, ignore) is not ignore:
+                raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {'_'.join(fields)}")
+
+    def _index(self, doc: Dict[str, Any]):
+        for fields, index in self.unique.items():
+            key = _index_key(doc, fields)
+            if key is not None:
+                index[key] = doc
+
+    def _unindex(self, doc: Dict[str, Any]):
+        for fields, index in self.unique.items():
+            key = _index_key(doc, fields)
+            if key is not None and index.get(key) is doc:
+                del index[key]
+
+    # ---- reads ----
+
+    def _scan(self, query: Dict[str, Any]) -> Iterable[Dict[str, Any]]:
+        for (field, *rest), index in self.unique.items():
+            value = query.get(field, _MISSING)
+            if not rest and value is not _MISSING and not isinstance(value, (dict, list)):
+                doc = index.get((value,))
+                return [doc] if doc is not None else []
+        return self.docs
+
+    def _matching(self, query: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        query = query or {}
+        return [d for d in self._scan(query) if matches(d, query)]
+
+    def find(self, query: Optional[Dict[str, Any]] = None, projection: Optional[Dict[str, Any]] = None) -> MemoryCursor:
+        return MemoryCursor(self._matching(query), projection)
+
+    async def find_one(self, query: Optional[Dict[str, Any]] = None,
+                       projection: Optional[Dict[str, Any]] = None, sort=None) -> Optional[Dict[str, Any]]:
+        query = query or {}
+        if sort:
+            results = await self.find(query, projection).sort(sort).limit(1).to_list(1)
+            return results[0] if results else None
+        for doc in self._scan(query):
+            if matches(doc, query):
+                return _project(doc, projection)
+        return None
+
+    async def count_documents(self, query: Dict[str, Any], **kwargs) -> int:
+        return len(self._matching(query))
+
+    def aggregate(self, pipeline: List[Dict[str, Any]], **kwargs) -> MemoryCursor:
+        return MemoryCursor(aggregate(self.docs, pipeline), None)
+
+    # ---- writes ----
+
+    def _insert(self, doc: Dict[str, Any]) -> Any:
+        doc.setdefault("_id", ObjectId())
+        stored = copy.deepcopy(doc)
+        self._check_unique(stored)
+        self.docs.append(stored)
+        self._index(stored)
+        return doc["_id"]
+
+    async def insert_one(self, doc: Dict[str, Any]) -> Result:
+        return Result(inserted_id=self._insert(doc))
+
+    async def insert_many(self, docs: Iterable[Dict[str, Any]], ordered: bool = True) -> Result:
+        ids, errors = [], []
+        for index, doc in enumerate(docs):
+            try:
+                ids.append(self._insert(doc))
+            except DuplicateKeyError as e:
+                errors.append({"index": index, "code": 11000, "errmsg": str(e)})
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "nInserted": len(ids)})
+        return Result(inserted_ids=ids)
+
+    def _update_doc(self, doc: Dict[str, Any], update: Dict[str, Any]):
+        updated = copy.deepcopy(doc)
+        _apply_update(updated, update)
+        self._check_unique(updated, ignore=doc)
+        self._unindex(doc)
+        doc.clear()
+        doc.update(updated)
+        self._index(doc)
+
+    def _upsert(self, query: Dict[str, Any], update: Dict[str, Any]) -> Dict[str, Any]:
+        doc = _upsert_seed(query)
+        _apply_update(doc, update, inserting=True)
+        self._insert(doc)
+        return self.docs[-1]
+
+    async def find_one_and_update(self, query: Dict[str, Any], update: Dict[str, Any],
+                                  projection: Optional[Dict[str, Any]] = None, upsert: bool = False,
+                                  return_document: bool = ReturnDocument.BEFORE, **kwargs) -> Optional[Dict[str, Any]]:
+        for doc in self._scan(query):
+            if matches(doc, query):
+                before = _project(doc, projection)
+                self._update_doc(doc, update)
+                return _project(doc, projection) if return_document == ReturnDocument.AFTER else before
+        if upsert:
+            doc = self._upsert(query, update)
+            return _project(doc, projection) if return_document == ReturnDocument.AFTER else None
+        return None
+
+    async def update_one(self, query: Dict[str, Any], update: Dict[str, Any], upsert: bool = False, **kwargs) -> Result:
+        for doc in self._scan(query):
+            if matches(doc, query):
+                self._update_doc(doc, update)
+                return Result(matched_count=1, modified_count=1, upserted_id=None)
+        if upsert:
+            doc = self._upsert(query, update)
+            return Result(matched_count=0, modified_count=0, upserted_id=doc["_id"])
+        return Result(matched_count=0, modified_count=0, upserted_id=None)
+
+    async def replace_one(self, query: Dict[str, Any], replacement: Dict[str, Any], upsert: bool = False,
+                          **kwargs) -> Result:
+        for doc in self._scan(query):
+            if matches(doc, query):
+                replaced = {**copy.deepcopy(replacement), "_id": doc["_id"]}
+                self._check_unique(replaced, ignore=doc)
+                self._unindex(doc)
+                doc.clear()
+                doc.update(replaced)
+                self._index(doc)
+                return Result(matched_count=1, modified_count=1, upserted_id=None)
+        if upsert:
+            doc = {**_upsert_seed(query), **replacement}
+            return Result(matched_count=0, modified_count=0, upserted_id=self._insert(doc))
+        return Result(matched_count=0, modified_count=0, upserted_id=None)
+
+    async def update_many(self, query: Dict[str, Any], update: Dict[str, Any], **kwargs) -> Result:
+        docs = self._matching(query)
+        for doc in docs:
+            self._update_doc(doc, update)
+        return Result(matched_count=len(docs), modified_count=len(docs))
+
+    async def delete_one(self, query: Dict[str, Any]) -> Result:
+        for doc in self._scan(query):
+            if matches(doc, query):
+                self.docs.remove(doc)
+                self._unindex(doc)
+                return Result(deleted_count=1)
+        return Result(deleted_count=0)
+
+    async def find_one_and_delete(self, query: Dict[str, Any],
+                                  projection: Optional[Dict[str, Any]] = None, **kwargs) -> Optional[Dict[str, Any]]:
+        for doc in self._scan(query):
+            if matches(doc, query):
+                self.docs.remove(doc)
+                self._unindex(doc)
+                return _project(doc, projection)
+        return None
+
+    async def delete_many(self, query: Dict[str, Any]) -> Result:
+        keep = []
+        for doc in self.docs:
+            if matches(doc, query):
+                self._unindex(doc)
+            else:
+                keep.append(doc)
+        deleted = len(self.docs) - len(keep)
+        self.docs = keep
+        return Result(deleted_count=deleted)
+
+    async def bulk_write(self, requests: List[Any], ordered: bool = True) -> Result:
+        for request in requests:
+            name = type(request).__name__
+            if name == "InsertOne":
+                self._insert(request._doc)
+            elif name in ("UpdateOne", "UpdateMany"):
+                update = self.update_one if name == "UpdateOne" else self.update_many
+                await update(request._filter, request._doc, upsert=bool(request._upsert))
+            elif name == "ReplaceOne":
+                await self.replace_one(request._filter, request._doc, upsert=bool(request._upsert))
+            elif name == "DeleteOne":
+                await self.delete_one(request._filter)
+            else:
+                raise NotImplementedError(f"{name} is not supported by the memory store")
+        return Result(acknowledged=True)
+
+
+class MemoryDatabase:
+    """Attribute or item access returns a collection, created on first use"""
+
+    def __init__(self, name: str = "memory"):
+        self.name = name
+        self._collections: Dict[str, MemoryCollection] = {}
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        if name not in self._collections:
+            self._collections[name] = MemoryCollection(name)
+        return self._collections[name]
+
+    def __getattr__(self, name: str) -> MemoryCollection:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    async def list_collection_names(self) -> List[str]:
+        return list(self._collections)
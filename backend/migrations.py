@@ -0,0 +1,339 @@
+"""Versioned, resumable document migrations.
+
+A migration selects the documents that are still in the old shape and
+returns the update that brings each one to the new shape. The runner walks
+those documents in `_id` order, a batch at a time. It resumes from the last
+`_id` (the keyset) rather than an offset, so each batch costs the same however
+far along it is. After every batch the runner checkpoints its position and
+counts in the `migrations` collection. A run that stops for any reason picks
+up where it left off. Writes are throttled to `max_per_second` so a backfill
+doesn't crowd out live traffic. A dry run computes the same updates without
+writing anything.
+
+A migration can also delete documents (merging duplicates, say), and can
+prepare before a run and finish after it completes, e.g. to build the
+unique index that the merge made possible.
+
+Until a migration completes, both shapes exist side by side. Each migration's
+`upgrade()` converts an old-shape document as it is read, so handlers can use
+`upgrade(MIGRATIONS, collection, doc)` and see only the new shape.
+"""
+import asyncio
+import logging
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from pymongo import DeleteOne, ReturnDocument, UpdateOne
+
+logger = logging.getLogger(__name__)
+
+# A running migration renews its lease every batch; a lapsed lease means its worker died
+LEASE = timedelta(minutes=5)
+
+# Updates shown from a dry run
+DRY_RUN_SAMPLES = 5
+
+# Returned by migrate() to delete the document instead of updating it
+DELETE = "delete"
+
+
+class MigrationError(Exception):
+    pass
+
+
+class Migration:
+    """One change of document shape; subclasses fill in the hooks"""
+
+    id = ""
+    collection = ""
+    description = ""
+    projection: Optional[Dict[str, Any]] = None
+
+    def pending(self) -> Dict[str, Any]:
+        """Query matching documents still in the old shape"""
+        raise NotImplementedError
+
+    async def migrate(self, doc: Dict[str, Any], dry_run: bool) -> Optional[Dict[str, Any]]:
+        """The update for one old-shape document, DELETE, or None to leave it alone"""
+        raise NotImplementedError
+
+    async def prepare(self):
+        """Called at the start of every run, dry runs included"""
+
+    async def finish(self):
+        """Called once the migration has completed"""
+
+    def upgrade(self, doc: Dict[str, Any]) -> Dict[str, Any]:
+        """Read-time conversion of an old-shape document"""
+        return doc
+
+
+def upgrade(migrations: List[Migration], collection: str, doc: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    if doc is None:
+        return None
+    for migration in migrations:
+        if migration.collection == collection:
+            doc = migration.upgrade(doc)
+    return doc
+
+
+# ==================== MIGRATIONS ====================
+
+class BookingAssignmentStatus(Migration):
+    id = "0001_booking_assignment_status"
+    collection = "bookings"
+    description = "Give bookings created before physio assignment an assignment_status"
+    projection = {"_id": 1, "assigned_physio_id": 1}
+
+    def pending(self) -> Dict[str, Any]:
+        return {"assignment_status": {"$exists": False}}
+
+    @staticmethod
+    def status_for(doc: Dict[str, Any]) -> str:
+        return "assigned" if doc.get("assigned_physio_id") else "unassigned"
+
+    async def migrate(self, doc, dry_run):
+        return {"$set": {"assignment_status": self.status_for(doc)}}
+
+    def upgrade(self, doc):
+        if "assignment_status" not in doc:
+            doc["assignment_status"] = self.status_for(doc)
+        return doc
+
+
+class InlineSessionNotes(Migration):
+    id = "0002_inline_session_notes"
+    collection = "bookings"
+    description = "Move session_notes from the booking into the notes store"
+    projection = {"_id": 1, "id": 1, "session_notes": 1, "assigned_physio_id": 1}
+
+    def __init__(self, notes_store):
+        self.notes = notes_store
+
+    def pending(self) -> Dict[str, Any]:
+        return {"session_notes": {"$exists": True}}
+
+    async def migrate(self, doc, dry_run):
+        notes = doc.get("session_notes")
+        if not notes:
+            return {"$unset": {"session_notes": ""}}
+        if dry_run:
+            return {"$set": {"notes_version": "<next>"}, "$unset": {"session_notes": ""}}
+        content = notes.encode("utf-8")
+        # A rerun after a crash between save and update finds the content already stored
+        latest = await self.notes.load(doc["id"])
+        if latest and latest["content"] == content:
+            version = latest["version"]
+        else:
+            author = f"physio:{doc['assigned_physio_id']}" if doc.get("assigned_physio_id") else "migration"
+            version = (await self.notes.save(doc["id"], content, author=author))["version"]
+        return {"$set": {"notes_version": version}, "$unset": {"session_notes": ""}}
+
+
+class MergeDuplicates(Migration):
+    """Merge documents sharing `key` into one, then make `key` unique.
+
+    Matches are exact, as the unique index compares. The document kept is the
+    first by `rank` (oldest by default). Each duplicate fills in fields the
+    kept document lacks, adds to its lists, has references to it repointed
+    by `repoint(old_id, kept_id)` and is deleted. A duplicate `mergeable`
+    rejects is left for someone to resolve, and the index then fails to build.
+    """
+    projection = None
+
+    def __init__(self, id: str, storage, collection: str, key: str, description: str,
+                 rank: Optional[Callable[[Dict[str, Any]], Any]] = None,
+                 mergeable: Optional[Callable[[Dict[str, Any]], bool]] = None,
+                 repoint: Optional[Callable[[str, str], Awaitable[None]]] = None):
+        self.id = id
+        self.storage = storage
+        self.collection = collection
+        self.key = key
+        self.description = description
+        self.rank = rank or (lambda doc: (doc.get("created_at") or datetime.min, doc["_id"]))
+        self.mergeable = mergeable or (lambda doc: True)
+        self.repoint = repoint
+        self.duplicated: List[Any] = []
+
+    async def prepare(self):
+        groups = await self.storage[self.collection].aggregate([
+            {"$group": {"_id": f"${self.key}", "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": 1}}},
+        ]).to_list(None)
+        self.duplicated = [g["_id"] for g in groups if g["_id"] is not None]
+
+    def pending(self) -> Dict[str, Any]:
+        return {self.key: {"$in": self.duplicated}}
+
+    @staticmethod
+    def merge(keep: Dict[str, Any], doc: Dict[str, Any]) -> Dict[str, Any]:
+        empty = (None, "", [], {})
+        sets = {k: v for k, v in doc.items()
+                if k not in ("_id", "id") and keep.get(k) in empty and v not in empty}
+        adds = {k: {"$each": v} for k, v in doc.items()
+                if isinstance(v, list) and v and isinstance(keep.get(k), list) and keep[k]}
+        update: Dict[str, Any] = {}
+        if sets:
+            update["$set"] = sets
+        if adds:
+            update["$addToSet"] = adds
+        return update
+
+    async def migrate(self, doc, dry_run):
+        collection = self.storage[self.collection]
+        group = await collection.find({self.key: _get(doc, self.key)}).to_list(None)
+        if len(group) < 2:
+            return None
+        keep = min(group, key=self.rank)
+        if keep["_id"] == doc["_id"]:
+            return None
+        if not self.mergeable(doc):
+            logger.warning("Migration %s left %s %s: it can't be merged into %s", self.id, self.collection,
+                           doc.get("id"), keep.get("id"))
+            return None
+        if not dry_run:
+            # Merging again after a crash is harmless: fields are only filled in and lists added to
+            update = self.merge(keep, doc)
+            if update:
+                await collection.update_one({"_id": keep["_id"]}, update)
+            if self.repoint:
+                await self.repoint(doc["id"], keep["id"])
+        return DELETE
+
+    async def finish(self):
+        await self.storage[self.collection].create_index(self.key, unique=True)
+
+
+def _get(doc: Dict[str, Any], path: str) -> Any:
+    for part in path.split("."):
+        doc = doc.get(part) if isinstance(doc, dict) else None
+    return doc
+
+
+# ==================== RUNNER ====================
+
+class MigrationRunner:
+    def __init__(self, storage, state, migrations: List[Migration]):
+        self.storage = storage
+        self.state = state
+        self.migrations = {m.id: m for m in migrations}
+
+    async def status(self) -> List[Dict[str, Any]]:
+        states = {s["id"]: s for s in await self.state.find({}, {"_id": 0, "last_key": 0}).to_list(None)}
+        return [
+            {"id": m.id, "collection": m.collection, "description": m.description,
+             **states.get(m.id, {"status": "pending"})}
+            for m in self.migrations.values()
+        ]
+
+    def get(self, migration_id: str) -> Migration:
+        migration = self.migrations.get(migration_id)
+        if not migration:
+            raise MigrationError(f"Unknown migration {migration_id}")
+        return migration
+
+    async def _claim(self, migration: Migration, owner: str) -> Dict[str, Any]:
+        now = datetime.utcnow()
+        await self.state.update_one(
+            {"id": migration.id},
+            {"$setOnInsert": {"id": migration.id, "status": "pending", "last_key": None, "scanned": 0,
+                              "migrated": 0, "lease_until": None, "created_at": now}},
+            upsert=True
+        )
+        state = await self.state.find_one_and_update(
+            {"id": migration.id, "status": {"$ne": "completed"},
+             "$or": [{"lease_until": None}, {"lease_until": {"$lt": now}}]},
+            {"$set": {"status": "running", "owner": owner, "lease_until": now + LEASE, "error": None,
+                      "started_at": now, "updated_at": now}},
+            return_document=ReturnDocument.AFTER
+        )
+        if not state:
+            current = await self.state.find_one({"id": migration.id}, {"_id": 0, "status": 1})
+            raise MigrationError(f"Migration {migration.id} is {current['status'] if current else 'missing'}")
+        return state
+
+    async def run(
+        self,
+        migration_id: str,
+        dry_run: bool = False,
+        batch_size: int = 500,
+        max_per_second: Optional[float] = None,
+        progress: Optional[Callable[..., Awaitable[None]]] = None,
+    ) -> Dict[str, Any]:
+        """Run (or resume) one migration; a dry run reads everything and writes nothing"""
+        migration = self.get(migration_id)
+        collection = self.storage[migration.collection]
+        owner = uuid.uuid4().hex
+        await migration.prepare()
+        if dry_run:
+            state = {"last_key": None, "scanned": 0, "migrated": 0}
+        else:
+            state = await self._claim(migration, owner)
+        last_key, scanned, migrated = state["last_key"], state["scanned"], state["migrated"]
+        samples: List[Dict[str, Any]] = []
+        started, written = time.monotonic(), 0
+
+        try:
+            while True:
+                query = migration.pending()
+                if last_key is not None:
+                    query = {**query, "_id": {"$gt": last_key}}
+                batch = await collection.find(query, migration.projection).sort("_id", 1) \
+                    .limit(batch_size).to_list(batch_size)
+                if not batch:
+                    break
+
+                ops = []
+                for doc in batch:
+                    update = await migration.migrate(doc, dry_run)
+                    if update is None:
+                        continue
+                    if dry_run and len(samples) < DRY_RUN_SAMPLES:
+                        samples.append({"_id": str(doc["_id"]), "update": update})
+                    # Re-check the old shape so a concurrent handler's write wins
+                    selector = {"_id": doc["_id"], **migration.pending()}
+                    ops.append(DeleteOne(selector) if update is DELETE else UpdateOne(selector, update))
+                scanned += len(batch)
+                migrated += len(ops)
+                last_key = batch[-1]["_id"]
+
+                if not dry_run:
+                    if ops:
+                        await collection.bulk_write(ops, ordered=False)
+                    await self.state.update_one({"id": migration.id, "owner": owner}, {"$set": {
+                        "last_key": last_key, "scanned": scanned, "migrated": migrated,
+                        "lease_until": datetime.utcnow() + LEASE, "updated_at": datetime.utcnow(),
+                    }})
+                if progress:
+                    await progress(scanned=scanned, migrated=migrated)
+
+                written += len(ops)
+                if max_per_second and not dry_run:
+                    # Sleep off any lead over the allowed write rate
+                    ahead = written / max_per_second - (time.monotonic() - started)
+                    if ahead > 0:
+                        await asyncio.sleep(ahead)
+                if len(batch) < batch_size:
+                    break
+            if not dry_run:
+                await migration.finish()
+        except Exception as e:
+            if not dry_run:
+                await self.state.update_one({"id": migration.id, "owner": owner}, {"$set": {
+                    "status": "failed", "error": str(e), "lease_until": None, "updated_at": datetime.utcnow(),
+                }})
+            raise
+
+        result = {"migration": migration.id, "dry_run": dry_run, "scanned": scanned, "migrated": migrated,
+                  "seconds": round(time.monotonic() - started, 3)}
+        if dry_run:
+            result["samples"] = samples
+        else:
+            await self.state.update_one({"id": migration.id, "owner": owner}, {"$set": {
+                "status": "completed", "lease_until": None, "completed_at": datetime.utcnow(),
+                "updated_at": datetime.utcnow(),
+            }})
+            logger.info("Migration %s completed: %d of %d documents migrated", migration.id, migrated, scanned)
+        return result
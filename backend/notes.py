@@ -0,0 +1,124 @@
+"""Clinical session notes (and attachments), stored apart from bookings.
+
+Each save of a session's notes is a new version in `session_notes`, so
+earlier versions stay readable. Content is zlib-compressed when that makes
+it smaller. Compressed content up to CHUNK_SIZE is stored inline in the
+version document; anything larger is split across `session_note_chunks`.
+Bookings only carry `notes_version`, so list and dashboard reads stay
+small, and content is loaded only when a detail view asks for it.
+"""
+import hashlib
+import uuid
+import zlib
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from pymongo.errors import DuplicateKeyError
+
+# Compressed bytes per chunk; well under Mongo's 16MB document limit
+CHUNK_SIZE = 255 * 1024
+
+# Short notes don't shrink under zlib
+MIN_COMPRESS_SIZE = 256
+
+# Version fields returned by listings (no content)
+METADATA = {"_id": 0, "data": 0}
+
+
+def encode(content: bytes) -> Dict[str, Any]:
+    """Compress (when it helps) and chunk `content`"""
+    encoding, stored = "identity", content
+    if len(content) >= MIN_COMPRESS_SIZE:
+        compressed = zlib.compress(content, 6)
+        if len(compressed) < len(content):
+            encoding, stored = "zlib", compressed
+    chunks = [stored[i:i + CHUNK_SIZE] for i in range(0, len(stored), CHUNK_SIZE)] or [b""]
+    return {
+        "encoding": encoding,
+        "size": len(content),
+        "stored_size": len(stored),
+        "sha256": hashlib.sha256(content).hexdigest(),
+        "chunks": chunks,
+    }
+
+
+def decode(encoding: str, chunks: List[bytes]) -> bytes:
+    stored = b"".join(chunks)
+    return zlib.decompress(stored) if encoding == "zlib" else stored
+
+
+class NotesStore:
+    def __init__(self, versions, chunks):
+        self.versions = versions
+        self.chunks = chunks
+
+    async def ensure_indexes(self):
+        await self.versions.create_index([("booking_id", 1), ("kind", 1), ("version", -1)], unique=True)
+        await self.chunks.create_index([("note_id", 1), ("n", 1)], unique=True)
+
+    async def save(self, booking_id: str, content: bytes, author: str, kind: str = "note",
+                   name: Optional[str] = None, content_type: str = "text/plain; charset=utf-8") -> Dict[str, Any]:
+        """Store `content` as the session's next version of `kind`; returns the version's metadata"""
+        encoded = encode(content)
+        chunks = encoded.pop("chunks")
+        note_id = str(uuid.uuid4())
+        # Chunks first, so a version is never visible before its content
+        if len(chunks) > 1:
+            await self.chunks.insert_many(
+                [{"note_id": note_id, "n": n, "data": data} for n, data in enumerate(chunks)], ordered=False
+            )
+
+        # The unique (booking, kind, version) index settles concurrent saves
+        for _ in range(5):
+            latest = await self.latest(booking_id, kind)
+            doc = {
+                "id": note_id,
+                "booking_id": booking_id,
+                "kind": kind,
+                "version": (latest["version"] if latest else 0) + 1,
+                "name": name,
+                "content_type": content_type,
+                "author": author,
+                "created_at": datetime.utcnow(),
+                "chunk_count": len(chunks),
+                **encoded,
+            }
+            if len(chunks) == 1:
+                doc["data"] = chunks[0]
+            try:
+                await self.versions.insert_one(doc)
+            except DuplicateKeyError:
+                continue
+            doc.pop("_id", None)
+            doc.pop("data", None)
+            return doc
+        await self.chunks.delete_many({"note_id": note_id})
+        raise RuntimeError(f"Could not save notes for booking {booking_id}: too many concurrent saves")
+
+    async def latest(self, booking_id: str, kind: str = "note") -> Optional[Dict[str, Any]]:
+        return await self.versions.find_one(
+            {"booking_id": booking_id, "kind": kind}, METADATA, sort=[("version", -1)]
+        )
+
+    async def history(self, booking_id: str, kind: Optional[str] = None) -> List[Dict[str, Any]]:
+        query: Dict[str, Any] = {"booking_id": booking_id}
+        if kind:
+            query["kind"] = kind
+        return await self.versions.find(query, METADATA).sort([("kind", 1), ("version", -1)]).to_list(None)
+
+    async def load(self, booking_id: str, version: Optional[int] = None,
+                   kind: str = "note") -> Optional[Dict[str, Any]]:
+        """A version's metadata plus its `content` bytes; the latest one unless `version` is given"""
+        query: Dict[str, Any] = {"booking_id": booking_id, "kind": kind}
+        if version is not None:
+            query["version"] = version
+        doc = await self.versions.find_one(query, {"_id": 0}, sort=[("version", -1)])
+        if not doc:
+            return None
+        if doc["chunk_count"] == 1:
+            chunks = [doc.pop("data")]
+        else:
+            stored = await self.chunks.find({"note_id": doc["id"]}, {"_id": 0, "data": 1}).sort("n", 1).to_list(None)
+            chunks = [c["data"] for c in stored]
+        doc["content"] = decode(doc["encoding"], chunks)
+        return doc
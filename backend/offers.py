@@ -0,0 +1,56 @@
+"""Broadcast booking offers.
+
+In broadcast mode a paid booking is offered to the top-K matching physios
+at once over their WebSocket connections. Whoever accepts first wins through
+the booking state machine's conditional update; the others are told the
+offer was withdrawn. An offer round that nobody takes within its timeout
+expires and the booking moves on to the next candidates.
+"""
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Iterable, List, NamedTuple
+
+logger = logging.getLogger(__name__)
+
+
+class OfferPolicy(NamedTuple):
+    k: int                   # physios offered the booking at once
+    timeout_seconds: float   # how long a round stays open
+
+
+def policy_for(policies: Dict[str, OfferPolicy], service_type: str) -> OfferPolicy:
+    return policies.get(service_type) or policies["default"]
+
+
+def pick_candidates(physios: List[Dict], online: Iterable[str], k: int) -> List[Dict]:
+    """Top-K physios that can receive the offer right now, in match order"""
+    online = set(online)
+    return [p for p in physios if p["id"] in online][:k]
+
+
+class OfferTimers:
+    """One pending expiry per booking; a new round or an acceptance replaces it"""
+
+    def __init__(self):
+        self.tasks: Dict[str, asyncio.Task] = {}
+
+    def schedule(self, booking_id: str, delay: float, callback: Callable[[], Awaitable[None]]):
+        self.cancel(booking_id)
+
+        async def fire():
+            await asyncio.sleep(delay)
+            self.tasks.pop(booking_id, None)
+            try:
+                await callback()
+            except Exception:
+                logger.exception("Offer expiry for booking %s failed", booking_id)
+
+        self.tasks[booking_id] = asyncio.create_task(fire())
+
+    def cancel(self, booking_id: str):
+        task = self.tasks.pop(booking_id, None)
+        if task and task is not asyncio.current_task():
+            task.cancel()
+
+    def __len__(self) -> int:
+        return len(self.tasks)
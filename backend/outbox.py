@@ -0,0 +1,76 @@
+"""Durable per-recipient outbox for websocket messages.
+
+Every message for a user or physio is stored before it is pushed. Messages
+are numbered per recipient by a counter in `outbox_sequences`, and each one
+is pushed with its `seq`. A client that reconnects with the last `seq` it
+processed is replayed everything after it, so messages sent while it was
+offline are not lost. Messages expire after the TTL through a TTL index.
+A client whose position is older than anything still stored is told there
+is a gap, and reloads its state once instead of replaying.
+"""
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+from pymongo import ReturnDocument
+
+# Messages replayed per reconnect; a client further behind gets a gap notice instead
+REPLAY_LIMIT = 500
+
+
+class Outbox:
+    def __init__(self, messages, sequences, ttl: timedelta):
+        self.messages = messages
+        self.sequences = sequences
+        self.ttl = ttl
+
+    async def ensure_indexes(self):
+        await self.messages.create_index([("recipient", 1), ("seq", 1)], unique=True)
+        await self.messages.create_index("expires_at", expireAfterSeconds=0)
+        await self.sequences.create_index("recipient", unique=True)
+
+    async def append(self, recipient: str, message: Dict[str, Any]) -> int:
+        """Store `message` for `recipient`; returns its sequence number"""
+        counter = await self.sequences.find_one_and_update(
+            {"recipient": recipient},
+            {"$inc": {"seq": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        now = datetime.utcnow()
+        await self.messages.insert_one({
+            "recipient": recipient,
+            "seq": counter["seq"],
+            "message": message,
+            "created_at": now,
+            "expires_at": now + self.ttl,
+        })
+        return counter["seq"]
+
+    async def head(self, recipient: str) -> int:
+        """The last sequence number issued to `recipient` (0 if none)"""
+        counter = await self.sequences.find_one({"recipient": recipient}, {"_id": 0, "seq": 1})
+        return counter["seq"] if counter else 0
+
+    async def since(self, recipient: str, after: int, limit: int = REPLAY_LIMIT) -> List[Dict[str, Any]]:
+        """Unexpired messages after sequence `after`, oldest first, each with its `seq`"""
+        docs = await self.messages.find(
+            {"recipient": recipient, "seq": {"$gt": after}, "expires_at": {"$gt": datetime.utcnow()}},
+            {"_id": 0, "seq": 1, "message": 1}
+        ).sort("seq", 1).limit(limit).to_list(limit)
+        return [{**doc["message"], "seq": doc["seq"]} for doc in docs]
+
+    async def replay(self, recipient: str, after: int) -> List[Dict[str, Any]]:
+        """What a client that has processed up to `after` missed.
+
+        When the message right after `after` has expired, there are more than
+        REPLAY_LIMIT missed messages, or the client is ahead of the server,
+        the result is a single `replay_gap` message carrying the current head.
+        The client should refetch its state and continue from there.
+        """
+        head = await self.head(recipient)
+        if after == head:
+            return []
+        missed = await self.since(recipient, after) if after < head else []
+        if not missed or missed[0]["seq"] != after + 1 or head - after > REPLAY_LIMIT:
+            return [{"type": "replay_gap", "seq": head}]
+        return missed
@@ -0,0 +1,569 @@
+"""City partitioning for bookings and practitioners.
+
+Off unless CITY_PARTITIONS is set. When it is on, each city is mapped to a
+named partition, and every partition has its own `bookings__<name>` and
+`practitioners__<name>` collections. The "default" partition keeps the
+original collection names, so turning partitioning on moves no data. The
+city → partition map lives in the `partition_map` collection so all
+workers route the same way. Each worker re-reads it periodically.
+
+A PartitionedCollection stands in for the collection:
+- A document is inserted into its city's partition.
+- A query that names the city goes to that partition alone. Anything else
+  is scattered to every partition in parallel and the results are merged,
+  honouring sort/skip/limit.
+- Single-document writes by `id` go straight to the partition the id was
+  last seen in, and fall back to trying the others.
+- `move_city` rebalances a city from one partition to another while
+  traffic continues.
+
+On a sharded cluster the same routing applies with a `{city: 1, id: 1}`
+shard key; queries that name the city are then shard-targeted as well.
+"""
+import asyncio
+import hashlib
+import logging
+import re
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import bson
+from pymongo import DeleteOne, InsertOne, ReplaceOne
+
+from memory_store import aggregate as aggregate_in_memory
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PARTITION = "default"
+SEPARATOR = "__"
+
+# Partitioned collections and the field that holds each document's city
+PARTITION_KEYS = {"bookings": "city", "practitioners": "personal_details.city"}
+
+# Document ids whose partition is remembered, per collection
+ID_CACHE_SIZE = 100_000
+
+# Accumulators whose per-partition results can be combined into a global one
+MERGEABLE_ACCUMULATORS = ("$sum", "$min", "$max")
+
+
+def city_key(city: Optional[str]) -> str:
+    return (city or "").strip().lower()
+
+
+def physical_name(collection: str, partition: str) -> str:
+    return collection if partition == DEFAULT_PARTITION else f"{collection}{SEPARATOR}{partition}"
+
+
+def parse_partitions(spec: str) -> Dict[str, str]:
+    """Parse `"Mumbai=west,Pune=west,Bengaluru=south"` into a city → partition map"""
+    cities = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        city, _, partition = item.partition("=")
+        cities[city_key(city)] = partition.strip() or DEFAULT_PARTITION
+    return cities
+
+
+def _get(doc: Any, path: str) -> Any:
+    for part in path.split("."):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+
+class Combined:
+    """Summed write results from several partitions"""
+
+    def __init__(self, results: List[Any]):
+        self.matched_count = sum(getattr(r, "matched_count", 0) or 0 for r in results)
+        self.modified_count = sum(getattr(r, "modified_count", 0) or 0 for r in results)
+        self.deleted_count = sum(getattr(r, "deleted_count", 0) or 0 for r in results)
+        self.upserted_id = next((r.upserted_id for r in results if getattr(r, "upserted_id", None)), None)
+        self.inserted_ids = [i for r in results for i in (getattr(r, "inserted_ids", None) or [])]
+
+
+# ==================== PARTITION MAP ====================
+
+class PartitionMap:
+    """City → partition, shared by all workers through one document"""
+
+    def __init__(self, collection, seed: Dict[str, str], refresh_seconds: float = 30.0):
+        self.collection = collection
+        self.seed = seed
+        self.refresh_seconds = refresh_seconds
+        self.cities: Dict[str, str] = dict(seed)
+        self.known: List[str] = sorted({DEFAULT_PARTITION, *seed.values()})
+        self.version = -1
+
+    async def load(self):
+        """Add seeded cities the stored map doesn't have yet, then read it"""
+        await self.collection.update_one(
+            {"_id": "cities"},
+            {"$setOnInsert": {"cities": {}, "partitions": [DEFAULT_PARTITION], "version": 0}},
+            upsert=True
+        )
+        for city, partition in self.seed.items():
+            await self.collection.update_one(
+                {"_id": "cities", f"cities.{city}": {"$exists": False}},
+                {"$set": {f"cities.{city}": partition}, "$addToSet": {"partitions": partition}, "$inc": {"version": 1}}
+            )
+        await self.refresh()
+
+    async def refresh(self):
+        doc = await self.collection.find_one({"_id": "cities"})
+        if doc and doc["version"] != self.version:
+            self.cities = doc["cities"]
+            # Partitions stay known after their last city moves out, so reads still see stragglers
+            self.known = sorted({DEFAULT_PARTITION, *doc.get("partitions", []), *self.cities.values()})
+            self.version = doc["version"]
+            logger.info("Partition map version %d: %s", self.version, self.cities)
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(self.refresh_seconds)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning("Partition map refresh failed: %s", e)
+
+    def partition_for(self, city: Optional[str]) -> str:
+        return self.cities.get(city_key(city), DEFAULT_PARTITION)
+
+    def partitions(self) -> List[str]:
+        return self.known
+
+    async def assign(self, city: str, partition: str):
+        await self.collection.update_one(
+            {"_id": "cities"},
+            {"$set": {f"cities.{city_key(city)}": partition}, "$addToSet": {"partitions": partition},
+             "$inc": {"version": 1}}
+        )
+        await self.refresh()
+
+    def describe(self) -> Dict[str, Any]:
+        return {"version": self.version, "cities": self.cities, "partitions": self.known}
+
+
+# ==================== SCATTER-GATHER ====================
+
+def _less(a: Any, b: Any) -> bool:
+    # Missing and null sort first, as in Mongo
+    if a is None:
+        return b is not None
+    if b is None:
+        return False
+    try:
+        return a < b
+    except TypeError:
+        return type(a).__name__ < type(b).__name__
+
+
+class _SortKey:
+    __slots__ = ("values", "directions")
+
+    def __init__(self, doc: Dict[str, Any], spec: List[Tuple[str, int]]):
+        self.values = [_get(doc, field) for field, _ in spec]
+        self.directions = [direction for _, direction in spec]
+
+    def __lt__(self, other: "_SortKey") -> bool:
+        for a, b, direction in zip(self.values, other.values, self.directions):
+            if a == b:
+                continue
+            return _less(a, b) if direction > 0 else _less(b, a)
+        return False
+
+
+async def _next(iterator) -> Optional[Dict[str, Any]]:
+    try:
+        return await iterator.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+class ScatterCursor:
+    """A find() over several partitions, merged in sort order"""
+
+    def __init__(self, collection: "PartitionedCollection", query, projection, targets: List[str]):
+        self.collection = collection
+        self.query = query
+        self.projection = projection
+        self.targets = targets
+        self._sort: List[Tuple[str, int]] = []
+        self._skip = 0
+        self._limit = 0
+        self._batch_size = 0
+
+    def sort(self, key, direction: int = 1) -> "ScatterCursor":
+        self._sort = list(key) if isinstance(key, (list, tuple)) else [(key, direction)]
+        return self
+
+    def skip(self, count: int) -> "ScatterCursor":
+        self._skip = count
+        return self
+
+    def limit(self, count: int) -> "ScatterCursor":
+        self._limit = count
+        return self
+
+    def batch_size(self, size: int) -> "ScatterCursor":
+        self._batch_size = size
+        return self
+
+    def _cursor(self, partition: str):
+        cursor = self.collection.partition(partition).find(self.query, self.projection)
+        if self._sort:
+            cursor = cursor.sort(self._sort)
+        if self._limit:
+            # Any partition could supply every document of the merged page
+            cursor = cursor.limit(self._skip + self._limit)
+        if self._batch_size:
+            cursor = cursor.batch_size(self._batch_size)
+        return cursor
+
+    async def _merge(self):
+        iterators = [(p, self._cursor(p).__aiter__()) for p in self.targets]
+        firsts = await asyncio.gather(*(_next(it) for _, it in iterators))
+        heads = [[doc, p, it] for doc, (p, it) in zip(firsts, iterators) if doc is not None]
+        skipped = returned = 0
+        while heads:
+            i = 0
+            if self._sort:
+                i = min(range(len(heads)), key=lambda n: _SortKey(heads[n][0], self._sort))
+            doc, partition, iterator = heads[i]
+            following = await _next(iterator)
+            if following is None:
+                heads.pop(i)
+            else:
+                heads[i][0] = following
+            self.collection.remember(doc.get("id"), partition)
+            if skipped < self._skip:
+                skipped += 1
+                continue
+            yield doc
+            returned += 1
+            if self._limit and returned >= self._limit:
+                return
+
+    def __aiter__(self):
+        return self._merge()
+
+    async def to_list(self, length: Optional[int] = None) -> List[Dict[str, Any]]:
+        docs: List[Dict[str, Any]] = []
+        async for doc in self._merge():
+            docs.append(doc)
+            if length is not None and len(docs) >= length:
+                break
+        return docs
+
+
+class _Results:
+    """Already-computed results behind the cursor interface"""
+
+    def __init__(self, docs: List[Dict[str, Any]]):
+        self.docs = docs
+
+    async def to_list(self, length: Optional[int] = None) -> List[Dict[str, Any]]:
+        return self.docs if length is None else self.docs[:length]
+
+    async def _iterate(self):
+        for doc in self.docs:
+            yield doc
+
+    def __aiter__(self):
+        return self._iterate()
+
+
+# ==================== PARTITIONED COLLECTION ====================
+
+class PartitionedCollection:
+    def __init__(self, storage, name: str, key: str, partition_map: PartitionMap):
+        self.storage = storage
+        self.name = name
+        self.key = key
+        self.map = partition_map
+        self.indexes: List[Tuple[Any, Dict[str, Any]]] = []
+        self.locations: "OrderedDict[str, str]" = OrderedDict()
+
+    def partition(self, partition: str):
+        return self.storage.database[physical_name(self.name, partition)]
+
+    def for_city(self, city: Optional[str]):
+        """The physical collection holding `city`"""
+        return self.partition(self.map.partition_for(city))
+
+    def remember(self, doc_id: Optional[str], partition: str):
+        if not isinstance(doc_id, str):
+            return
+        self.locations[doc_id] = partition
+        self.locations.move_to_end(doc_id)
+        if len(self.locations) > ID_CACHE_SIZE:
+            self.locations.popitem(last=False)
+
+    def targets(self, query: Optional[Dict[str, Any]]) -> List[str]:
+        """Partitions that can hold matches, the last one seen holding the queried id first"""
+        query = query or {}
+        city = query.get(self.key)
+        if isinstance(city, str):
+            return [self.map.partition_for(city)]
+        if isinstance(city, dict) and set(city) == {"$in"}:
+            return sorted({self.map.partition_for(c) for c in city["$in"]})
+        partitions = self.map.partitions()
+        known = self.locations.get(query.get("id")) if isinstance(query.get("id"), str) else None
+        if known in partitions:
+            return [known] + [p for p in partitions if p != known]
+        return partitions
+
+    # ---- indexes ----
+
+    async def create_index(self, keys, **kwargs) -> str:
+        self.indexes.append((keys, kwargs))
+        names = await asyncio.gather(*(self.partition(p).create_index(keys, **kwargs) for p in self.map.partitions()))
+        return names[0]
+
+    async def ensure_partition(self, partition: str):
+        """Give a partition the indexes the others have before it takes documents"""
+        for keys, kwargs in self.indexes:
+            await self.partition(partition).create_index(keys, **kwargs)
+
+    # ---- reads ----
+
+    def find(self, query: Optional[Dict[str, Any]] = None, projection: Optional[Dict[str, Any]] = None):
+        targets = self.targets(query)
+        if len(targets) == 1:
+            return self.partition(targets[0]).find(query, projection)
+        return ScatterCursor(self, query, projection, targets)
+
+    async def find_one(self, query: Optional[Dict[str, Any]] = None,
+                       projection: Optional[Dict[str, Any]] = None, **kwargs) -> Optional[Dict[str, Any]]:
+        targets = self.targets(query)
+        doc_id = (query or {}).get("id")
+        if not kwargs.get("sort") and isinstance(doc_id, str) and doc_id in self.locations:
+            # Likely where it is; only scatter if it has moved
+            doc = await self.partition(targets[0]).find_one(query, projection, **kwargs)
+            if doc is not None:
+                return doc
+            targets = targets[1:]
+        if kwargs.get("sort"):
+            return (await ScatterCursor(self, query, projection, targets).sort(kwargs["sort"]).limit(1).to_list(1)
+                    or [None])[0]
+        found = await asyncio.gather(*(self.partition(p).find_one(query, projection) for p in targets))
+        for partition, doc in zip(targets, found):
+            if doc is not None:
+                self.remember(doc.get("id"), partition)
+                return doc
+        return None
+
+    async def count_documents(self, query: Dict[str, Any], **kwargs) -> int:
+        counts = await asyncio.gather(*(self.partition(p).count_documents(query, **kwargs)
+                                        for p in self.targets(query)))
+        return sum(counts)
+
+    def aggregate(self, pipeline: List[Dict[str, Any]], **kwargs):
+        match = pipeline[0].get("$match", {}) if pipeline else {}
+        targets = self.targets(match)
+        if len(targets) == 1:
+            return self.partition(targets[0]).aggregate(pipeline, **kwargs)
+        return _MergedAggregate(self, pipeline, targets)
+
+    # ---- writes ----
+
+    async def insert_one(self, doc: Dict[str, Any]):
+        partition = self.map.partition_for(_get(doc, self.key))
+        result = await self.partition(partition).insert_one(doc)
+        self.remember(doc.get("id"), partition)
+        return result
+
+    async def insert_many(self, docs, ordered: bool = True):
+        groups: Dict[str, List[Dict[str, Any]]] = {}
+        for doc in docs:
+            groups.setdefault(self.map.partition_for(_get(doc, self.key)), []).append(doc)
+        results = []
+        for partition, group in groups.items():
+            results.append(await self.partition(partition).insert_many(group, ordered=ordered))
+            for doc in group:
+                self.remember(doc.get("id"), partition)
+        return Combined(results)
+
+    async def _first(self, method: str, query: Dict[str, Any], hit: Callable[[Any], bool], *args, **kwargs):
+        """Apply a single-document write to the first partition where it matches"""
+        upsert = kwargs.pop("upsert", False)
+        targets = self.targets(query)
+        result = None
+        for partition in targets:
+            result = await getattr(self.partition(partition), method)(query, *args, **kwargs)
+            if hit(result):
+                self.remember(query.get("id"), partition)
+                return result
+        if upsert:
+            partition = self.map.partition_for(query.get(self.key))
+            result = await getattr(self.partition(partition), method)(query, *args, upsert=True, **kwargs)
+        return result
+
+    async def update_one(self, query, update, **kwargs):
+        return await self._first("update_one", query, lambda r: r.matched_count > 0, update, **kwargs)
+
+    async def find_one_and_update(self, query, update, **kwargs):
+        return await self._first("find_one_and_update", query, lambda r: r is not None, update, **kwargs)
+
+    async def find_one_and_delete(self, query, **kwargs):
+        return await self._first("find_one_and_delete", query, lambda r: r is not None, **kwargs)
+
+    async def delete_one(self, query, **kwargs):
+        return await self._first("delete_one", query, lambda r: r.deleted_count > 0, **kwargs)
+
+    async def update_many(self, query, update, **kwargs):
+        return Combined(await asyncio.gather(*(self.partition(p).update_many(query, update, **kwargs)
+                                               for p in self.targets(query))))
+
+    async def delete_many(self, query, **kwargs):
+        return Combined(await asyncio.gather(*(self.partition(p).delete_many(query, **kwargs)
+                                               for p in self.targets(query))))
+
+    async def bulk_write(self, requests: List[Any], ordered: bool = True):
+        # Inserts go to their city's partition; updates by id only match where the document lives
+        inserts: Dict[str, List[Any]] = {}
+        others = []
+        for request in requests:
+            if isinstance(request, InsertOne):
+                doc = request._doc
+                inserts.setdefault(self.map.partition_for(_get(doc, self.key)), []).append(request)
+            else:
+                others.append(request)
+        calls = [self.partition(p).bulk_write(ops, ordered=ordered) for p, ops in inserts.items()]
+        if others:
+            calls += [self.partition(p).bulk_write(others, ordered=ordered) for p in self.map.partitions()]
+        return Combined(await asyncio.gather(*calls))
+
+    def __getattr__(self, attr: str):
+        raise AttributeError(f"{attr} is not supported on partitioned collection {self.name}")
+
+
+class _MergedAggregate:
+    """Runs a pipeline on each partition and combines the partial results.
+
+    Stages up to the first $group run per partition. The group is then
+    repeated over the partials, which is exact for $sum, $min and $max.
+    Later stages run on the (small) combined output.
+    """
+
+    def __init__(self, collection: PartitionedCollection, pipeline: List[Dict[str, Any]], targets: List[str]):
+        self.collection = collection
+        self.pipeline = pipeline
+        self.targets = targets
+
+    async def _run(self) -> List[Dict[str, Any]]:
+        group_at = next((i for i, stage in enumerate(self.pipeline) if "$group" in stage), None)
+        if group_at is None:
+            partial, rest = self.pipeline, [s for s in self.pipeline if "$sort" in s or "$limit" in s]
+        else:
+            partial, rest = self.pipeline[:group_at + 1], self.pipeline[group_at + 1:]
+            merge: Dict[str, Any] = {"_id": "$_id"}
+            for field, accumulator in self.pipeline[group_at]["$group"].items():
+                if field == "_id":
+                    continue
+                (op, _), = accumulator.items()
+                if op not in MERGEABLE_ACCUMULATORS:
+                    raise NotImplementedError(f"{op} cannot be merged across partitions")
+                merge[field] = {op: f"${field}"}
+            rest = [{"$group": merge}] + rest
+        results = await asyncio.gather(*(
+            self.collection.partition(p).aggregate(partial).to_list(None) for p in self.targets
+        ))
+        return aggregate_in_memory([doc for docs in results for doc in docs], rest)
+
+    async def to_list(self, length: Optional[int] = None) -> List[Dict[str, Any]]:
+        return await _Results(await self._run()).to_list(length)
+
+
+# ==================== REBALANCING ====================
+
+def _fingerprint(doc: Dict[str, Any]) -> bytes:
+    return hashlib.sha1(bson.encode(doc)).digest()
+
+
+async def move_city(
+    collections: List[PartitionedCollection],
+    partition_map: PartitionMap,
+    city: str,
+    destination: str,
+    batch_size: int = 500,
+    settle_seconds: Optional[float] = None,
+    progress: Optional[Callable[..., Awaitable[None]]] = None,
+) -> Dict[str, Any]:
+    """Move every document of `city` to the `destination` partition while traffic continues.
+
+    1. Copy the city's documents to the destination, remembering what was copied.
+    2. Point the city at the destination, then wait until every worker has
+       re-read the map (`settle_seconds`, twice the refresh interval by default).
+    3. Reconcile, then delete from the source. A document that changed in the
+       source after it was copied is re-copied, unless the destination copy
+       has also changed since. In that case the destination's newer write wins,
+       and a warning is logged.
+    """
+    source = partition_map.partition_for(city)
+    if source == destination:
+        return {"city": city_key(city), "source": source, "destination": destination, "copied": 0, "moved": 0}
+    city_filter = {"$regex": f"^\\s*{re.escape(city_key(city))}\\s*$", "$options": "i"}
+    copied: Dict[str, Dict[Any, bytes]] = {}
+    counts = {"copied": 0, "recopied": 0, "conflicts": 0, "moved": 0}
+
+    async def walk(collection: PartitionedCollection, handle):
+        last_id = None
+        while True:
+            query: Dict[str, Any] = {collection.key: city_filter}
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+            batch = await collection.partition(source).find(query).sort("_id", 1).limit(batch_size).to_list(batch_size)
+            if not batch:
+                return
+            await handle(collection, batch)
+            last_id = batch[-1]["_id"]
+            if progress:
+                await progress(**counts)
+
+    async def copy(collection, batch):
+        await collection.partition(destination).bulk_write(
+            [ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in batch], ordered=False
+        )
+        fingerprints = copied.setdefault(collection.name, {})
+        for doc in batch:
+            fingerprints[doc["_id"]] = _fingerprint(doc)
+        counts["copied"] += len(batch)
+
+    async def reconcile(collection, batch):
+        fingerprints = copied.get(collection.name, {})
+        current = {
+            doc["_id"]: doc for doc in await collection.partition(destination).find(
+                {"_id": {"$in": [d["_id"] for d in batch]}}
+            ).to_list(None)
+        }
+        writes = []
+        for doc in batch:
+            snapshot = fingerprints.get(doc["_id"])
+            there = current.get(doc["_id"])
+            if snapshot is None or there is None:
+                writes.append(InsertOne(doc) if there is None else ReplaceOne({"_id": doc["_id"]}, doc))
+                counts["recopied"] += 1
+            elif _fingerprint(doc) != snapshot:
+                if _fingerprint(there) == snapshot:
+                    writes.append(ReplaceOne({"_id": doc["_id"]}, doc))
+                    counts["recopied"] += 1
+                else:
+                    counts["conflicts"] += 1
+                    logger.warning("Partition move kept the destination copy of %s %s", collection.name, doc.get("id"))
+        if writes:
+            await collection.partition(destination).bulk_write(writes, ordered=False)
+        await collection.partition(source).bulk_write([DeleteOne({"_id": d["_id"]}) for d in batch], ordered=False)
+        counts["moved"] += len(batch)
+
+    for collection in collections:
+        await collection.ensure_partition(destination)
+        await walk(collection, copy)
+    await partition_map.assign(city, destination)
+    await asyncio.sleep(partition_map.refresh_seconds * 2 if settle_seconds is None else settle_seconds)
+    for collection in collections:
+        await walk(collection, reconcile)
+
+    logger.info("Moved city %s from partition %s to %s", city_key(city), source, destination, extra=counts)
+    return {"city": city_key(city), "source": source, "destination": destination, **counts}
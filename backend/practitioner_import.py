@@ -0,0 +1,224 @@
+"""Bulk practitioner onboarding from CSV or JSON Lines uploads.
+
+Rows are parsed and validated in a single streaming pass. Valid rows are
+processed in chunks: one `$in` query finds emails that already exist and
+one `insert_many` writes the rest. Every row ends up in the report with
+its outcome, so partner clinics can fix and resend only the failures.
+"""
+import codecs
+import csv
+import io
+import json
+import re
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Set, Tuple, Type
+
+from pydantic import BaseModel, ValidationError
+from pymongo.errors import BulkWriteError
+
+CHUNK_SIZE = 500
+
+FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl"}
+
+
+def detect_format(filename: str) -> Optional[str]:
+    for suffix, fmt in FORMATS.items():
+        if filename.lower().endswith(suffix):
+            return fmt
+    return None
+
+
+def _unflatten(row: Dict[str, str]) -> Dict[str, Any]:
+    """Turn CSV headers like `personal_details.full_name` into nested dicts"""
+    nested: Dict[str, Any] = {}
+    for key, value in row.items():
+        if key is None or value is None or value.strip() == "":
+            continue
+        target = nested
+        parts = key.strip().split(".")
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value.strip()
+    return nested
+
+
+async def _iter_lines(upload, chunk_size: int = 64 * 1024) -> AsyncIterator[str]:
+    # Chunks can end inside a multibyte character, and only the upload's first bytes may be a BOM
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+    while True:
+        chunk = await upload.read(chunk_size)
+        if not chunk:
+            break
+        pending += decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line + "\n"
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+async def iter_records(upload, fmt: str) -> AsyncIterator[Tuple[int, Optional[Dict[str, Any]], Optional[str]]]:
+    """Yield (row number, record, parse error) for each data row of the upload"""
+    if fmt == "jsonl":
+        row = 0
+        async for line in _iter_lines(upload):
+            if not line.strip():
+                continue
+            row += 1
+            try:
+                yield row, json.loads(line), None
+            except json.JSONDecodeError as e:
+                yield row, None, f"Invalid JSON: {e.msg}"
+        return
+
+    header: Optional[List[str]] = None
+    row = 0
+    buffer = ""
+    async for line in _iter_lines(upload):
+        # Quoted fields may span lines; keep reading until the record is complete
+        buffer += line
+        if buffer.count('"') % 2:
+            continue
+        values = next(csv.reader(io.StringIO(buffer)), [])
+        buffer = ""
+        if not any(v.strip() for v in values):
+            continue
+        if header is None:
+            header = values
+            continue
+        row += 1
+        if len(values) > len(header):
+            yield row, None, f"Expected {len(header)} columns, got {len(values)}"
+            continue
+        yield row, _unflatten(dict(zip(header, values))), None
+
+
+def _email(record: BaseModel) -> str:
+    return record.personal_details.email.strip().lower()
+
+
+def _registration(record: BaseModel) -> str:
+    return record.education.registration_no.strip().upper()
+
+
+def _exact(value: str) -> re.Pattern:
+    """Matches `value` whole, ignoring case and surrounding whitespace"""
+    return re.compile(rf"^\s*{re.escape(value)}\s*$", re.IGNORECASE)
+
+
+def normalise_keys(record: BaseModel) -> BaseModel:
+    """Store email and registration number in one form, so the unique indexes see case variants as equal"""
+    record.personal_details.email = _email(record)
+    record.education.registration_no = _registration(record)
+    return record
+
+
+async def import_practitioners(
+    upload,
+    fmt: str,
+    collection,
+    create_model: Type[BaseModel],
+    stored_model: Type[BaseModel],
+    on_created: Optional[Callable[[Dict[str, Any]], None]] = None,
+    progress=None,
+) -> Dict[str, Any]:
+    """Validate, de-duplicate and insert practitioner applications from an upload"""
+    report: List[Dict[str, Any]] = []
+    seen_emails: Set[str] = set()
+    seen_registrations: Set[str] = set()
+    pending: List[Tuple[int, BaseModel]] = []
+    counts = {"created": 0, "invalid": 0, "duplicate": 0}
+
+    async def flush():
+        await _insert_chunk(pending, collection, stored_model, report, counts, on_created)
+        pending.clear()
+        if progress:
+            await progress(rows=len(report), **counts)
+
+    async for row, data, error in iter_records(upload, fmt):
+        if error:
+            report.append({"row": row, "status": "invalid", "errors": [error]})
+            counts["invalid"] += 1
+            continue
+        try:
+            record = create_model(**data)
+        except (ValidationError, TypeError) as e:
+            errors = [f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors()] \
+                if isinstance(e, ValidationError) else [str(e)]
+            report.append({"row": row, "status": "invalid", "errors": errors})
+            counts["invalid"] += 1
+            continue
+
+        email, registration = _email(record), _registration(record)
+        if email in seen_emails or registration in seen_registrations:
+            report.append({"row": row, "status": "duplicate", "reason": "Duplicate within upload", "email": email})
+            counts["duplicate"] += 1
+            continue
+        seen_emails.add(email)
+        seen_registrations.add(registration)
+
+        pending.append((row, record))
+        if len(pending) >= CHUNK_SIZE:
+            await flush()
+
+    if pending:
+        await flush()
+
+    report.sort(key=lambda r: r["row"])
+    return {"summary": {"rows": len(report), **counts}, "rows": report}
+
+
+async def _insert_chunk(pending, collection, stored_model, report, counts, on_created):
+    # Applications stored before keys were normalised may differ in case or
+    # padding, so stored values are matched case-insensitively as well
+    emails = [_exact(v) for v in {_email(r) for _, r in pending}]
+    registrations = [_exact(v) for v in {_registration(r) for _, r in pending}]
+    existing_emails: Set[str] = set()
+    existing_registrations: Set[str] = set()
+    # Without the city in the query this reads every partition
+    async for doc in collection.find(
+        {"$or": [
+            {"personal_details.email": {"$in": emails}},
+            {"education.registration_no": {"$in": registrations}},
+        ]},
+        {"_id": 0, "personal_details.email": 1, "education.registration_no": 1}
+    ):
+        existing_emails.add(str(doc.get("personal_details", {}).get("email", "")).strip().lower())
+        existing_registrations.add(str(doc.get("education", {}).get("registration_no", "")).strip().upper())
+
+    docs: List[Tuple[int, Dict[str, Any]]] = []
+    for row, record in pending:
+        email = _email(record)
+        if email in existing_emails:
+            report.append({"row": row, "status": "duplicate", "reason": "Application already exists", "email": email})
+            counts["duplicate"] += 1
+            continue
+        if _registration(record) in existing_registrations:
+            report.append({"row": row, "status": "duplicate", "reason": "Registration number already registered",
+                           "email": email})
+            counts["duplicate"] += 1
+            continue
+        docs.append((row, stored_model(**normalise_keys(record).dict()).dict()))
+
+    if not docs:
+        return
+
+    failed: Dict[int, str] = {}
+    try:
+        await collection.insert_many([doc for _, doc in docs], ordered=False)
+    except BulkWriteError as e:
+        # Lost a race with a concurrent application (unique index violation)
+        for err in e.details.get("writeErrors", []):
+            failed[err["index"]] = err.get("errmsg", "Write failed")
+
+    for i, (row, doc) in enumerate(docs):
+        if i in failed:
+            report.append({"row": row, "status": "duplicate", "reason": failed[i], "email": doc["personal_details"]["email"]})
+            counts["duplicate"] += 1
+            continue
+        doc.pop("_id", None)
+        report.append({"row": row, "status": "created", "id": doc["id"], "email": doc["personal_details"]["email"]})
+        counts["created"] += 1
+        if on_created:
+            on_created(doc)
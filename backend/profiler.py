@@ -0,0 +1,266 @@
+"""On-demand wall-clock profiler for single API requests.
+
+An admin adds `X-Profile: 1` (or `?profile=1`) to any /api request made
+with their bearer session. While that request runs, a
+sampling thread records the stack of the request's task every few
+milliseconds. When the task is running, the stack is read from the event
+loop thread. When it is suspended, the stack is rebuilt from its await
+chain, so time spent waiting on Motor (or on a busy loop) is attributed to
+the `await` that is waiting. Profiles are saved as speedscope JSON and can
+be exported as collapsed stacks for flamegraph tools.
+
+Requests without the flag pay only for one header scan.
+"""
+import asyncio
+import json
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+Frame = Tuple[str, str, int]  # function, file, first line
+
+# Stacks deeper than this are truncated at the root end
+MAX_DEPTH = 128
+
+
+def _frame_key(frame) -> Frame:
+    code = frame.f_code
+    return code.co_name, code.co_filename, code.co_firstlineno
+
+
+def _suspended_stack(task: asyncio.Task, root_frame) -> List[Frame]:
+    """Stack of a suspended task from `root_frame` inwards, rebuilt from its await chain"""
+    stack: List[Frame] = []
+    awaited, frame = task.get_coro(), None
+    while awaited is not None and len(stack) < MAX_DEPTH:
+        next_frame = getattr(awaited, "cr_frame", None) or getattr(awaited, "gi_frame", None) \
+            or getattr(awaited, "ag_frame", None)
+        if next_frame is None:
+            break
+        frame = next_frame
+        if frame is root_frame:
+            stack.clear()
+        stack.append(_frame_key(frame))
+        awaited = getattr(awaited, "cr_await", None) or getattr(awaited, "gi_yieldfrom", None) \
+            or getattr(awaited, "ag_await", None)
+
+    # The innermost await is on a future (Motor's executor futures, sleeps, queues).
+    # Name the line doing the waiting so the time lands on the Motor call itself.
+    waiter = getattr(task, "_fut_waiter", None)
+    if waiter is None or waiter.done():
+        stack.append(("[ready, waiting for event loop]", "", 0))
+    elif frame is not None:
+        stack.append((f"[await {Path(frame.f_code.co_filename).name}:{frame.f_lineno}]", "", 0))
+    return stack
+
+
+def _running_stack(thread_frame, root_frame) -> Optional[List[Frame]]:
+    """Stack of the task while it runs on the loop thread, cut at `root_frame`"""
+    stack: List[Frame] = []
+    frame = thread_frame
+    while frame is not None:
+        stack.append(_frame_key(frame))
+        if frame is root_frame:
+            stack.reverse()
+            return stack[-MAX_DEPTH:]
+        frame = frame.f_back
+    return None
+
+
+class RequestProfiler:
+    """Samples one asyncio task from a background thread"""
+
+    def __init__(self, task: asyncio.Task, root_frame, interval: float = 0.002):
+        self.task = task
+        self.root_frame = root_frame
+        self.loop = task.get_loop()
+        self.loop_thread = threading.get_ident()
+        self.interval = interval
+        self.samples: List[Tuple[List[Frame], float]] = []
+        self.started = 0.0
+        self.ended = 0.0
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.thread.start()
+
+    def stop(self):
+        self.ended = time.perf_counter()
+        self.stopping.set()
+
+    def join(self, timeout: float = 1.0):
+        """Wait for the sampler thread to exit; blocks, so call it off the event loop"""
+        self.thread.join(timeout)
+
+    def sample(self) -> List[Frame]:
+        if asyncio.current_task(self.loop) is self.task:
+            thread_frame = sys._current_frames().get(self.loop_thread)
+            stack = _running_stack(thread_frame, self.root_frame) if thread_frame is not None else None
+            if stack:
+                return stack
+        return _suspended_stack(self.task, self.root_frame)
+
+    def _run(self):
+        last = time.perf_counter()
+        while not self.stopping.wait(self.interval):
+            now = time.perf_counter()
+            try:
+                stack = self.sample()
+            except Exception:
+                # The task's frames changed under us; skip this tick
+                continue
+            self.samples.append((stack, now - last))
+            last = now
+
+    # ==================== OUTPUT ====================
+
+    def to_speedscope(self, name: str) -> Dict[str, Any]:
+        frames: List[Dict[str, Any]] = []
+        index: Dict[Frame, int] = {}
+        samples, weights = [], []
+        # A copy, in case join() timed out and the sampler is still appending
+        for stack, weight in list(self.samples):
+            row = []
+            for frame in stack:
+                if frame not in index:
+                    index[frame] = len(frames)
+                    fn, file, line = frame
+                    frames.append({"name": fn, **({"file": file, "line": line} if file else {})})
+                row.append(index[frame])
+            samples.append(row)
+            weights.append(round(weight * 1000, 3))
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": name,
+            "exporter": "voct-profiler",
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": name,
+                "unit": "milliseconds",
+                "startValue": 0,
+                "endValue": round((self.ended - self.started) * 1000, 3),
+                "samples": samples,
+                "weights": weights,
+            }],
+        }
+
+
+def to_collapsed(profile: Dict[str, Any]) -> str:
+    """Brendan Gregg's collapsed-stack format (`a;b;c <weight>`), weights in microseconds"""
+    frames = profile["shared"]["frames"]
+    totals: Dict[str, float] = {}
+    data = profile["profiles"][0]
+    for stack, weight in zip(data["samples"], data["weights"]):
+        key = ";".join(frames[i]["name"] for i in stack) or "[idle]"
+        totals[key] = totals.get(key, 0.0) + weight
+    return "".join(f"{stack} {int(weight * 1000)}\n" for stack, weight in sorted(totals.items()))
+
+
+# ==================== STORAGE ====================
+
+class ProfileStore:
+    """Profiles as files in one directory, with an append-only index for listing"""
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.index_path = self.directory / "index.jsonl"
+
+    def path(self, profile_id: str) -> Path:
+        return self.directory / f"{profile_id}.speedscope.json"
+
+    def save(self, profile_id: str, profile: Dict[str, Any], meta: Dict[str, Any]):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.path(profile_id).write_text(json.dumps(profile))
+        with open(self.index_path, "a") as f:
+            f.write(json.dumps({"id": profile_id, **meta}, default=str) + "\n")
+
+    def list(self, limit: int = 50) -> List[Dict[str, Any]]:
+        if not self.index_path.exists():
+            return []
+        entries = [json.loads(line) for line in self.index_path.read_text().splitlines() if line.strip()]
+        entries = [e for e in entries if self.path(e["id"]).exists()]
+        return list(reversed(entries))[:limit]
+
+    def load(self, profile_id: str) -> Optional[Dict[str, Any]]:
+        # IDs are hex; anything else could escape the directory
+        if not profile_id.isalnum():
+            return None
+        path = self.path(profile_id)
+        return json.loads(path.read_text()) if path.exists() else None
+
+
+# ==================== MIDDLEWARE ====================
+
+class ProfilerMiddleware:
+    """Profile /api requests that ask for it, when `authorise` accepts their bearer token"""
+
+    def __init__(self, app, authorise: Callable[[str], Awaitable[bool]], store: ProfileStore,
+                 interval: float = 0.002, prefix: str = "/api", exclude: Tuple[str, ...] = ()):
+        self.app = app
+        self.authorise = authorise
+        self.store = store
+        self.interval = interval
+        self.prefix = prefix
+        self.exclude = exclude
+
+    async def _requested(self, scope) -> bool:
+        wanted, bearer = False, None
+        for name, value in scope.get("headers") or []:
+            if name == b"x-profile":
+                wanted = value == b"1"
+            elif name == b"authorization":
+                bearer = value.decode("latin-1")
+        if not wanted and b"profile" in scope.get("query_string", b""):
+            wanted = parse_qs(scope["query_string"].decode("latin-1")).get("profile") == ["1"]
+        scheme, _, token = (bearer or "").partition(" ")
+        if not wanted or scheme.lower() != "bearer" or not token:
+            return False
+        return await self.authorise(token.strip())
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.prefix) \
+                or scope["path"].startswith(self.exclude) or not await self._requested(scope):
+            return await self.app(scope, receive, send)
+
+        profile_id = uuid.uuid4().hex
+        # Stacks start at this frame, leaving out the server and outer middleware
+        profiler = RequestProfiler(asyncio.current_task(), sys._getframe(), self.interval)
+        status = 500
+
+        async def send_with_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(b"x-profile-id", profile_id.encode())]
+            await send(message)
+
+        profiler.start()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            profiler.stop()
+            # Joining the sampler thread and writing the file both block, so neither runs on the loop
+            name = f"{scope['method']} {scope['path']}"
+            await asyncio.get_running_loop().run_in_executor(
+                None, self._finish, profiler, profile_id, name, status
+            )
+
+    def _finish(self, profiler: RequestProfiler, profile_id: str, name: str, status: int):
+        profiler.join()
+        profile = profiler.to_speedscope(name)
+        meta = {
+            "request": name,
+            "status": status,
+            "created_at": datetime.utcnow().isoformat(),
+            "duration_ms": profile["profiles"][0]["endValue"],
+            "samples": len(profile["profiles"][0]["samples"]),
+        }
+        self.store.save(profile_id, profile, meta)
@@ -0,0 +1,311 @@
+"""Quote engine: package prices per service and city, with promo codes.
+
+The pricing config (service per-session prices, package sizes, city
+multipliers, promos) lives in one `pricing_config` document, seeded from
+the defaults in server.py. Loading it compiles:
+
+- a price table keyed by (service, city, sessions), so a quote is a dict
+  lookup instead of arithmetic over the config
+- promos, with their services, cities and validity window resolved up front
+
+Every worker re-reads the document periodically and recompiles when its
+version changes, so price edits go live without a restart.
+
+Quotes are signed (a JWT with audience "quote", using the session key
+ring), so `create_booking` and `create_payment_order` can trust a quoted
+amount by checking its signature instead of pricing again. Priced rows are
+cached until the next promo starts or ends; every quote still gets its own
+id and signature, and never outlives the promo it applies.
+"""
+import asyncio
+import calendar
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import jwt
+from pymongo import ReturnDocument
+
+from partitions import city_key
+from tokens import ALGORITHM, KeyRing
+
+logger = logging.getLogger(__name__)
+
+AUDIENCE = "quote"
+
+# Cities without their own multiplier are priced as this row
+DEFAULT_CITY = "*"
+
+# Priced rows and verified quote claims remembered per process
+CACHE_SIZE = 10000
+
+
+class QuoteError(Exception):
+    pass
+
+
+class Promo(NamedTuple):
+    code: Optional[str]                  # None: applied automatically when eligible
+    percent_off: float
+    amount_off: int
+    max_off: Optional[int]
+    min_sessions: int
+    services: Optional[frozenset]
+    cities: Optional[frozenset]
+    valid_from: Optional[datetime]
+    valid_until: Optional[datetime]
+
+    def discount(self, service: str, city: str, sessions: int, price: int, now: datetime) -> int:
+        if sessions < self.min_sessions:
+            return 0
+        if self.services is not None and service not in self.services:
+            return 0
+        if self.cities is not None and city not in self.cities:
+            return 0
+        if (self.valid_from and now < self.valid_from) or (self.valid_until and now >= self.valid_until):
+            return 0
+        off = round(price * self.percent_off / 100) + self.amount_off
+        if self.max_off is not None:
+            off = min(off, self.max_off)
+        return min(off, price)
+
+
+def _when(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value else None
+
+
+def _promo(spec: Dict[str, Any]) -> Promo:
+    if not spec.get("percent_off") and not spec.get("amount_off"):
+        raise ValueError(f"Promo {spec.get('code')!r} needs percent_off or amount_off")
+    return Promo(
+        code=spec["code"].strip().upper() if spec.get("code") else None,
+        percent_off=float(spec.get("percent_off", 0)),
+        amount_off=int(spec.get("amount_off", 0)),
+        max_off=int(spec["max_off"]) if spec.get("max_off") is not None else None,
+        min_sessions=int(spec.get("min_sessions", 1)),
+        services=frozenset(spec["services"]) if spec.get("services") else None,
+        cities=frozenset(city_key(c) for c in spec["cities"]) if spec.get("cities") else None,
+        valid_from=_when(spec.get("valid_from")),
+        valid_until=_when(spec.get("valid_until")),
+    )
+
+
+class PriceTables:
+    """A compiled pricing config"""
+
+    def __init__(self, config: Dict[str, Any], version: int):
+        self.version = version
+        self.config = config
+        self.services = services = {sid: int(s["price_per_session"]) for sid, s in config["services"].items()}
+        # Packages are priced for the reference per-session price and scale with each service's price
+        reference = int(config["reference_price"])
+        self.packages = {int(n): int(price) for n, price in config["packages"].items()}
+        cities = {city_key(c): float(m) for c, m in config.get("city_multipliers", {}).items()}
+        cities[DEFAULT_CITY] = 1.0
+
+        # (service, city, sessions) → (list price, package price)
+        self.table: Dict[Tuple[str, str, int], Tuple[int, int]] = {}
+        for sid, per_session in services.items():
+            for city, multiplier in cities.items():
+                for sessions, package in self.packages.items():
+                    self.table[(sid, city, sessions)] = (
+                        round(per_session * sessions * multiplier),
+                        round(package * per_session / reference * multiplier),
+                    )
+        self.cities = frozenset(cities)
+        promos = [_promo(p) for p in config.get("promos", [])]
+        self.codes = {p.code: p for p in promos if p.code}
+        self.automatic = [p for p in promos if not p.code]
+        # Times at which some promo starts or stops applying
+        self.boundaries = sorted({t for p in promos for t in (p.valid_from, p.valid_until) if t})
+
+    def next_change(self, now: datetime) -> datetime:
+        """When a price computed at `now` may next differ"""
+        return next((t for t in self.boundaries if t > now), datetime.max)
+
+    def price(self, service: str, city: str, sessions: int, promo_code: Optional[str],
+              now: datetime) -> Tuple[Dict[str, Any], Optional[Promo]]:
+        """The priced row and the promo it applies"""
+        row = city if city in self.cities else DEFAULT_CITY
+        prices = self.table.get((service, row, sessions))
+        if prices is None:
+            if (service, DEFAULT_CITY, 1) not in self.table:
+                raise QuoteError(f"Unknown service {service!r}")
+            raise QuoteError(f"No package for {sessions} sessions")
+        list_price, package_price = prices
+
+        candidates = list(self.automatic)
+        code = promo_code.strip().upper() if promo_code else None
+        if code:
+            promo = self.codes.get(code)
+            if promo is None:
+                raise QuoteError(f"Unknown promo code {promo_code!r}")
+            if not promo.discount(service, city, sessions, package_price, now):
+                raise QuoteError(f"Promo code {code} does not apply")
+            candidates.append(promo)
+        # Promos don't stack; the best one applies
+        best, discount = None, 0
+        for promo in candidates:
+            off = promo.discount(service, city, sessions, package_price, now)
+            if off > discount:
+                best, discount = promo, off
+
+        return {
+            "service_type": service,
+            "city": city,
+            "session_count": sessions,
+            "list_price": list_price,
+            "package_price": package_price,
+            "discount": discount,
+            "promo_code": best.code if best else None,
+            "amount": package_price - discount,
+            "pricing_version": self.version,
+        }, best
+
+
+class QuoteEngine:
+    """Prices carts from compiled tables and signs the quotes"""
+
+    def __init__(self, collection, ring: KeyRing, defaults: Dict[str, Any], ttl: timedelta,
+                 refresh_seconds: float = 30.0, cache_size: int = CACHE_SIZE):
+        self.collection = collection
+        self.ring = ring
+        self.defaults = defaults
+        self.ttl = ttl
+        self.refresh_seconds = refresh_seconds
+        self.cache_size = cache_size
+        self.tables = PriceTables(defaults, 0)
+        # (service, city, sessions, code) → (row, promo, priced from, priced until)
+        self.priced: "OrderedDict[Tuple, Tuple[Dict[str, Any], Optional[Promo], datetime, datetime]]" = OrderedDict()
+        self.verified: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.cache_version = (self.tables.version, ring.version)
+
+    async def load(self):
+        await self.collection.update_one(
+            {"_id": "pricing"},
+            {"$setOnInsert": {"config": self.defaults, "version": 1, "updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+        await self.refresh()
+
+    async def refresh(self):
+        doc = await self.collection.find_one({"_id": "pricing"})
+        if not doc or doc["version"] == self.tables.version:
+            return
+        try:
+            self.tables = PriceTables(doc["config"], doc["version"])
+        except (KeyError, TypeError, ValueError) as e:
+            # Keep pricing with the tables we have rather than not at all
+            logger.error("Pricing config version %d rejected: %s", doc["version"], e)
+            return
+        logger.info("Pricing config version %d loaded (%d prices)", self.tables.version, len(self.tables.table))
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(self.refresh_seconds)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning("Pricing config refresh failed: %s", e)
+
+    async def update(self, config: Dict[str, Any]) -> int:
+        """Replace the config after checking it compiles; returns the new version"""
+        try:
+            PriceTables(config, 0)
+        except (KeyError, TypeError, ValueError) as e:
+            raise QuoteError(f"Invalid pricing config: {e!r}")
+        doc = await self.collection.find_one_and_update(
+            {"_id": "pricing"},
+            {"$set": {"config": config, "updated_at": datetime.utcnow()}, "$inc": {"version": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        await self.refresh()
+        return doc["version"]
+
+    def _caches(self):
+        version = (self.tables.version, self.ring.version)
+        if version != self.cache_version:
+            self.priced.clear()
+            self.verified.clear()
+            self.cache_version = version
+
+    def quote(self, service: str, city: Optional[str], sessions: int, promo_code: Optional[str] = None,
+              now: Optional[datetime] = None) -> Dict[str, Any]:
+        """A signed quote; raises QuoteError"""
+        self._caches()
+        now = now or datetime.utcnow()
+        key = (service, city_key(city), sessions, promo_code)
+        cached = self.priced.get(key)
+        if cached and cached[2] <= now < cached[3]:
+            self.priced.move_to_end(key)
+            row, promo = cached[0], cached[1]
+        else:
+            row, promo = self.tables.price(service, city_key(city), sessions, promo_code, now)
+            self.priced[key] = (row, promo, now, self.tables.next_change(now))
+            if len(self.priced) > self.cache_size:
+                self.priced.popitem(last=False)
+
+        # Each caller gets its own quote id, bound to one booking, and a quote can't outlive its promo
+        expires = int(time.time() + self.ttl.total_seconds())
+        if promo and promo.valid_until:
+            expires = min(expires, calendar.timegm(promo.valid_until.utctimetuple()))
+        quote = {**row, "quote_id": uuid.uuid4().hex}
+        quote["signature"] = jwt.encode(
+            {**quote, "aud": AUDIENCE, "exp": expires},
+            self.ring.keys[self.ring.active],
+            algorithm=ALGORITHM,
+            headers={"kid": self.ring.active}
+        )
+        quote["expires_at"] = datetime.utcfromtimestamp(expires)
+        return quote
+
+    def quote_cart(self, items: List[Dict[str, Any]], promo_code: Optional[str] = None) -> Dict[str, Any]:
+        """Quotes for every item; an item's own promo code wins over the cart's"""
+        now = datetime.utcnow()
+        quotes = []
+        for i, item in enumerate(items):
+            try:
+                quotes.append(self.quote(item["service_type"], item.get("city"), int(item["session_count"]),
+                                         item.get("promo_code") or promo_code, now))
+            except QuoteError as e:
+                raise QuoteError(f"items[{i}]: {e}")
+        return {
+            "quotes": quotes,
+            "total": sum(q["amount"] for q in quotes),
+            "pricing_version": self.tables.version,
+        }
+
+    async def verify(self, signature: str) -> Dict[str, Any]:
+        """The claims of a quote this service signed; raises QuoteError"""
+        self._caches()
+        claims = self.verified.get(signature)
+        if claims is not None:
+            if claims["exp"] < time.time():
+                raise QuoteError("Quote expired; request a new one")
+            return claims
+        try:
+            kid = jwt.get_unverified_header(signature).get("kid")
+            # The quote may come from a worker that has already rotated keys
+            if kid not in self.ring.keys and not await self.ring.reload_for(kid):
+                raise QuoteError("Invalid quote")
+            claims = jwt.decode(signature, self.ring.keys[kid], algorithms=[ALGORITHM], audience=AUDIENCE)
+        except jwt.ExpiredSignatureError:
+            raise QuoteError("Quote expired; request a new one")
+        except jwt.InvalidTokenError:
+            raise QuoteError("Invalid quote")
+        self.verified[signature] = claims
+        if len(self.verified) > self.cache_size:
+            self.verified.popitem(last=False)
+        return claims
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "version": self.tables.version,
+            "config": self.tables.config,
+            "prices": len(self.tables.table),
+            "cached_prices": len(self.priced),
+        }
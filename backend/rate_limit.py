@@ -0,0 +1,249 @@
+"""Rate limiting for OTP and public write endpoints.
+
+Two policies are supported: token buckets (burst + steady refill) and
+sliding windows (weighted two-window counters). State lives either in
+process memory or in a shared MongoDB collection for multi-worker setups.
+"""
+import math
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Union
+
+from fastapi import HTTPException, Request
+from pymongo import ReturnDocument
+
+
+class TokenBucket(NamedTuple):
+    capacity: float
+    refill_per_second: float
+
+
+class SlidingWindow(NamedTuple):
+    limit: int
+    window_seconds: float
+
+
+Policy = Union[TokenBucket, SlidingWindow]
+
+
+class Rule(NamedTuple):
+    name: str
+    scope: str  # 'ip', 'key' or 'global'
+    policy: Policy
+
+
+# ==================== STORES ====================
+
+class InMemoryRateLimitStore:
+    """Per-process limiter state. Each check is a couple of dict operations.
+
+    At `max_keys` the least recently used key is evicted, so a flood of new
+    keys can't reset the limits of the clients being throttled.
+    """
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        self.buckets: "OrderedDict[str, List[float]]" = OrderedDict()
+        self.windows: "OrderedDict[str, List[float]]" = OrderedDict()
+
+    async def take_token(self, key: str, policy: TokenBucket, now: float) -> float:
+        """Consume one token; return 0 if allowed, else seconds until one is available"""
+        state = self.buckets.get(key)
+        if state is None:
+            if len(self.buckets) >= self.max_keys:
+                self.buckets.popitem(last=False)
+            state = self.buckets[key] = [policy.capacity, now]
+        else:
+            self.buckets.move_to_end(key)
+
+        tokens = min(policy.capacity, state[0] + (now - state[1]) * policy.refill_per_second)
+        state[1] = now
+        if tokens >= 1:
+            state[0] = tokens - 1
+            return 0.0
+        state[0] = tokens
+        return (1 - tokens) / policy.refill_per_second
+
+    async def hit_window(self, key: str, policy: SlidingWindow, now: float) -> float:
+        """Count one hit; return 0 if allowed, else seconds until the window admits one"""
+        index = int(now // policy.window_seconds)
+        state = self.windows.get(key)
+        if state is None:
+            if len(self.windows) >= self.max_keys:
+                self.windows.popitem(last=False)
+            state = self.windows[key] = [index, 0, 0]
+        else:
+            self.windows.move_to_end(key)
+
+        if state[0] != index:
+            state[2] = state[1] if state[0] == index - 1 else 0
+            state[1] = 0
+            state[0] = index
+
+        elapsed = now - index * policy.window_seconds
+        weight = 1 - elapsed / policy.window_seconds
+        if state[2] * weight + state[1] < policy.limit:
+            state[1] += 1
+            return 0.0
+        return _window_retry_after(policy, state[1], state[2], elapsed)
+
+    async def give_token(self, key: str, policy: TokenBucket, now: float):
+        """Return a token taken for a request another rule then rejected"""
+        state = self.buckets.get(key)
+        if state is not None:
+            state[0] = min(policy.capacity, state[0] + 1)
+
+    async def unhit_window(self, key: str, policy: SlidingWindow, now: float):
+        """Take back a hit counted for a request another rule then rejected"""
+        state = self.windows.get(key)
+        if state is not None and state[0] == int(now // policy.window_seconds) and state[1] > 0:
+            state[1] -= 1
+
+
+class MongoRateLimitStore:
+    """Shared limiter state in a MongoDB collection.
+
+    Every check is a single atomic pipeline update, so several workers can
+    enforce the same limits without a separate cache server.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def ensure_indexes(self):
+        await self.collection.create_index("expire_at", expireAfterSeconds=0)
+
+    async def take_token(self, key: str, policy: TokenBucket, now: float) -> float:
+        capacity, rate = policy.capacity, policy.refill_per_second
+        doc = await self.collection.find_one_and_update(
+            {"_id": f"b:{key}"},
+            [
+                {"$set": {
+                    "tokens": {"$min": [capacity, {"$add": [
+                        {"$ifNull": ["$tokens", capacity]},
+                        {"$multiply": [{"$subtract": [now, {"$ifNull": ["$ts", now]}]}, rate]}
+                    ]}]},
+                    "ts": now,
+                    "expire_at": _expire_at(now, capacity / rate),
+                }},
+                {"$set": {"allowed": {"$gte": ["$tokens", 1]}}},
+                {"$set": {"tokens": {"$cond": ["$allowed", {"$subtract": ["$tokens", 1]}, "$tokens"]}}},
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        if doc["allowed"]:
+            return 0.0
+        return (1 - doc["tokens"]) / rate
+
+    async def hit_window(self, key: str, policy: SlidingWindow, now: float) -> float:
+        index = int(now // policy.window_seconds)
+        elapsed = now - index * policy.window_seconds
+        weight = 1 - elapsed / policy.window_seconds
+        doc = await self.collection.find_one_and_update(
+            {"_id": f"w:{key}"},
+            [
+                {"$set": {
+                    "prev": {"$cond": [
+                        {"$eq": ["$idx", index]}, "$prev",
+                        {"$cond": [{"$eq": ["$idx", index - 1]}, "$cur", 0]}
+                    ]},
+                    "cur": {"$cond": [{"$eq": ["$idx", index]}, "$cur", 0]},
+                    "idx": index,
+                    "expire_at": _expire_at(now, 2 * policy.window_seconds),
+                }},
+                {"$set": {"allowed": {"$lt": [
+                    {"$add": [{"$multiply": ["$prev", weight]}, "$cur"]}, policy.limit
+                ]}}},
+                {"$set": {"cur": {"$cond": ["$allowed", {"$add": ["$cur", 1]}, "$cur"]}}},
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        if doc["allowed"]:
+            return 0.0
+        return _window_retry_after(policy, doc["cur"], doc["prev"], elapsed)
+
+    async def give_token(self, key: str, policy: TokenBucket, now: float):
+        await self.collection.update_one(
+            {"_id": f"b:{key}"},
+            [{"$set": {"tokens": {"$min": [policy.capacity, {"$add": ["$tokens", 1]}]}}}],
+        )
+
+    async def unhit_window(self, key: str, policy: SlidingWindow, now: float):
+        await self.collection.update_one(
+            {"_id": f"w:{key}", "idx": int(now // policy.window_seconds), "cur": {"$gt": 0}},
+            {"$inc": {"cur": -1}},
+        )
+
+
+def _expire_at(now: float, ttl: float) -> datetime:
+    return datetime.utcfromtimestamp(now + ttl)
+
+
+def _window_retry_after(policy: SlidingWindow, current: float, previous: float, elapsed: float) -> float:
+    """Seconds until the weighted count drops below the limit"""
+    if current >= policy.limit or previous == 0:
+        return policy.window_seconds - elapsed
+    # previous * (1 - t / window) + current < limit  =>  solve for t
+    t = policy.window_seconds * (1 - (policy.limit - current) / previous)
+    return max(t - elapsed, 0.001)
+
+
+# ==================== LIMITER ====================
+
+class RateLimiter:
+    def __init__(self, store, rules: Dict[str, List[Rule]], trust_proxy: bool = False):
+        self.store = store
+        self.rules = rules
+        self.trust_proxy = trust_proxy
+
+    def client_ip(self, request: Request) -> str:
+        if self.trust_proxy:
+            forwarded = request.headers.get("x-forwarded-for")
+            if forwarded:
+                return forwarded.split(",")[0].strip()
+        return request.client.host if request.client else "unknown"
+
+    async def check(self, endpoint: str, keys: Dict[str, str]):
+        """Apply the endpoint's rules, in order, for the scopes in `keys` (scope → key).
+
+        Raises 429 with Retry-After at the first exhausted rule. A rejected
+        request is handed back to the rules it had already passed, so it only
+        counts against the limit that refused it.
+        """
+        now = time.time()
+        passed: List[Rule] = []
+        for rule in self.rules.get(endpoint, ()):
+            if rule.scope not in keys:
+                continue
+            bucket_key = f"{endpoint}:{rule.name}:{keys[rule.scope]}"
+            if isinstance(rule.policy, TokenBucket):
+                wait = await self.store.take_token(bucket_key, rule.policy, now)
+            else:
+                wait = await self.store.hit_window(bucket_key, rule.policy, now)
+            if wait > 0:
+                for done in passed:
+                    done_key = f"{endpoint}:{done.name}:{keys[done.scope]}"
+                    if isinstance(done.policy, TokenBucket):
+                        await self.store.give_token(done_key, done.policy, now)
+                    else:
+                        await self.store.unhit_window(done_key, done.policy, now)
+                raise HTTPException(
+                    status_code=429,
+                    detail="Too many requests. Please try again later.",
+                    headers={"Retry-After": str(max(1, math.ceil(wait)))},
+                )
+            passed.append(rule)
+
+    def dependency(self, endpoint: str, key: Optional[Callable[[Request], Awaitable[str]]] = None):
+        """FastAPI dependency enforcing an endpoint's rules; `key` reads the 'key' scope from the request"""
+        async def _limit(request: Request):
+            keys = {"ip": self.client_ip(request), "global": "*"}
+            value = await key(request) if key else None
+            if value:
+                # Requests without one skip the per-key rules rather than sharing a bucket
+                keys["key"] = value
+            await self.check(endpoint, keys)
+        return _limit
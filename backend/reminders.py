@@ -0,0 +1,332 @@
+"""Reminders for upcoming sessions, dispatched from a hierarchical timing wheel.
+
+Each confirmed booking gets reminders at fixed offsets before its session
+(`preferred_date` + `preferred_time`, local time): one for the patient and,
+once a physio is assigned, one for the physio. Reminders are persisted in
+the `reminders` collection and kept in memory in a TimingWheel. Adding or
+cancelling one is O(1) however many are pending, and each tick only touches
+the reminders that expire on it. When a booking's date, time, status or
+physio changes, its pending reminders are replaced.
+
+Every worker loads the pending reminders at startup and sweeps for ones
+scheduled elsewhere that are coming due. Before a reminder is delivered its
+document is claimed with a pending → sending update, so only one worker
+sends it, and a reminder cancelled or moved since it was queued is skipped.
+"""
+import asyncio
+import logging
+import time
+import uuid
+from datetime import datetime, timedelta, timezone, tzinfo
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+# A booking change touching any of these replaces its reminders
+RESCHEDULE_FIELDS = ("status", "preferred_date", "preferred_time", "assigned_physio_id")
+
+# Reminders this overdue (the service was down) are dropped rather than sent late
+STALE_AFTER = timedelta(hours=1)
+
+# A claimed reminder whose worker died is released after this long
+CLAIM_LEASE = timedelta(minutes=5)
+
+# Fields kept in memory per queued reminder
+WHEEL_FIELDS = {"_id": 0, "id": 1, "booking_id": 1, "due_at": 1}
+
+
+class TimingWheel:
+    """Hierarchical timing wheel.
+
+    Level 0 has `slots` buckets one tick wide. Each level above has `slots`
+    buckets as wide as the whole level below it. A timer goes in the lowest
+    level whose range covers its expiry. It moves down a level each time the
+    clock reaches its bucket, until it fires from level 0. Timers beyond
+    the top level wait in an overflow bucket that is re-sorted each time the
+    top level wraps around.
+    """
+
+    def __init__(self, tick: float = 1.0, slots: int = 64, levels: int = 4, now: Optional[float] = None):
+        self.tick = tick
+        self.slots = slots
+        # Ticks covered by one bucket of each level (and by the whole top level)
+        self.spans = [slots ** level for level in range(levels + 1)]
+        self.levels: List[List[Dict[str, Tuple[int, Any]]]] = [[{} for _ in range(slots)] for _ in range(levels)]
+        self.overflow: Dict[str, Tuple[int, Any]] = {}
+        self.ready: Dict[str, Tuple[int, Any]] = {}
+        self.buckets: Dict[str, Dict[str, Tuple[int, Any]]] = {}
+        self.current = int((time.time() if now is None else now) // tick)
+
+    def __len__(self) -> int:
+        return len(self.buckets)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.buckets
+
+    def _place(self, key: str, expiry: int, payload: Any):
+        delta = expiry - self.current
+        bucket = self.overflow
+        if delta <= 0:
+            bucket = self.ready
+        else:
+            for level, buckets in enumerate(self.levels):
+                if delta < self.spans[level + 1]:
+                    bucket = buckets[(expiry // self.spans[level]) % self.slots]
+                    break
+        bucket[key] = (expiry, payload)
+        self.buckets[key] = bucket
+
+    def add(self, key: str, at: float, payload: Any = None):
+        """Fire `key` at epoch time `at`, replacing any timer already under `key`"""
+        self.cancel(key)
+        self._place(key, int(at // self.tick), payload)
+
+    def cancel(self, key: str) -> bool:
+        bucket = self.buckets.pop(key, None)
+        if bucket is None:
+            return False
+        del bucket[key]
+        return True
+
+    def _cascade(self, bucket: Dict[str, Tuple[int, Any]]):
+        entries = list(bucket.items())
+        bucket.clear()
+        for key, (expiry, payload) in entries:
+            self._place(key, expiry, payload)
+
+    def advance(self, now: Optional[float] = None) -> List[Tuple[str, Any]]:
+        """Move the clock to `now`; returns the (key, payload) of every timer that expired"""
+        target = int((time.time() if now is None else now) // self.tick)
+        expired = self._take(self.ready)
+        while self.current < target:
+            self.current += 1
+            if self.current % self.spans[-1] == 0:
+                self._cascade(self.overflow)
+            for level in range(len(self.levels) - 1, 0, -1):
+                if self.current % self.spans[level] == 0:
+                    self._cascade(self.levels[level][(self.current // self.spans[level]) % self.slots])
+            expired += self._take(self.levels[0][self.current % self.slots])
+            expired += self._take(self.ready)
+        return expired
+
+    def _take(self, bucket: Dict[str, Tuple[int, Any]]) -> List[Tuple[str, Any]]:
+        if not bucket:
+            return []
+        entries = [(key, payload) for key, (_, payload) in bucket.items()]
+        for key, _ in entries:
+            del self.buckets[key]
+        bucket.clear()
+        return entries
+
+
+def epoch(at: datetime) -> float:
+    """Epoch seconds of a naive UTC datetime"""
+    return at.replace(tzinfo=timezone.utc).timestamp()
+
+
+def session_start(booking: Dict[str, Any], tz: tzinfo) -> Optional[datetime]:
+    """A booking's session start as naive UTC, or None if its date or time doesn't parse"""
+    try:
+        local = datetime.strptime(f"{booking['preferred_date']} {booking['preferred_time']}", "%Y-%m-%d %H:%M")
+    except (KeyError, TypeError, ValueError):
+        return None
+    return local.replace(tzinfo=tz).astimezone(timezone.utc).replace(tzinfo=None)
+
+
+class ReminderScheduler:
+    def __init__(
+        self,
+        collection,
+        deliver: Callable[[List[Dict[str, Any]]], Awaitable[None]],
+        offsets_minutes: List[int],
+        tz: tzinfo,
+        tick: float = 1.0,
+        sweep_seconds: float = 60.0,
+        batch_size: int = 500,
+    ):
+        self.collection = collection
+        self.deliver = deliver
+        self.offsets = sorted(set(offsets_minutes), reverse=True)
+        self.tz = tz
+        self.sweep_seconds = sweep_seconds
+        self.batch_size = batch_size
+        self.wheel = TimingWheel(tick=tick)
+        self.by_booking: Dict[str, Set[str]] = {}
+        self.owner = uuid.uuid4().hex
+        self.task: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.failures = 0
+
+    async def ensure_indexes(self):
+        await self.collection.create_index("id", unique=True)
+        await self.collection.create_index([("status", 1), ("due_at", 1)])
+        await self.collection.create_index([("booking_id", 1), ("status", 1)])
+
+    def stats(self) -> Dict[str, Any]:
+        return {"queued": len(self.wheel), "bookings": len(self.by_booking), "sent": self.sent,
+                "failures": self.failures}
+
+    # ==================== SCHEDULING ====================
+
+    def plan(self, booking: Dict[str, Any], now: Optional[datetime] = None) -> List[Dict[str, Any]]:
+        """The reminders `booking` should have right now"""
+        if booking.get("status") != "confirmed":
+            return []
+        start = session_start(booking, self.tz)
+        if start is None:
+            return []
+        now = now or datetime.utcnow()
+        recipients = [("user", booking.get("user_id"))]
+        if booking.get("assigned_physio_id"):
+            recipients.append(("physio", booking["assigned_physio_id"]))
+        reminders = []
+        for minutes in self.offsets:
+            due_at = start - timedelta(minutes=minutes)
+            if due_at < now:
+                continue
+            for recipient, recipient_id in recipients:
+                reminders.append({
+                    # The due time is part of the id, so a moved session gets fresh reminders
+                    "id": f"{booking['id']}:{recipient}:{recipient_id}:{minutes}:{due_at:%Y%m%dT%H%M}",
+                    "booking_id": booking["id"],
+                    "recipient": recipient,
+                    "recipient_id": recipient_id,
+                    "minutes_before": minutes,
+                    "due_at": due_at,
+                    "status": "pending",
+                    "created_at": now,
+                })
+        return reminders
+
+    def _queue(self, reminder: Dict[str, Any]):
+        self.wheel.add(reminder["id"], epoch(reminder["due_at"]), reminder["booking_id"])
+        self.by_booking.setdefault(reminder["booking_id"], set()).add(reminder["id"])
+
+    def _forget(self, reminder_id: str, booking_id: str):
+        self.wheel.cancel(reminder_id)
+        queued = self.by_booking.get(booking_id)
+        if queued is not None:
+            queued.discard(reminder_id)
+            if not queued:
+                del self.by_booking[booking_id]
+
+    async def booking_changed(self, booking: Dict[str, Any]):
+        """Replace the pending reminders of `booking` (its current state) with the ones it should have"""
+        try:
+            wanted = self.plan(booking)
+            ids = [r["id"] for r in wanted]
+            await self.collection.update_many(
+                {"booking_id": booking["id"], "status": "pending", "id": {"$nin": ids}},
+                {"$set": {"status": "cancelled", "updated_at": datetime.utcnow()}}
+            )
+            if wanted:
+                # Reminders already sent keep their status
+                await self.collection.bulk_write(
+                    [UpdateOne({"id": r["id"]}, {"$setOnInsert": r}, upsert=True) for r in wanted], ordered=False
+                )
+            for reminder_id in self.by_booking.get(booking["id"], set()) - set(ids):
+                self._forget(reminder_id, booking["id"])
+            for reminder in wanted:
+                self._queue(reminder)
+        except Exception:
+            # A booking write must never fail over its reminders; the next change retries
+            logger.exception("Rescheduling reminders for booking %s failed", booking.get("id"))
+
+    async def load(self) -> int:
+        """Queue every pending reminder from the database"""
+        loaded = 0
+        cursor = self.collection.find(
+            {"status": "pending", "due_at": {"$gte": datetime.utcnow() - STALE_AFTER}}, WHEEL_FIELDS
+        ).batch_size(5000)
+        async for reminder in cursor:
+            if reminder["id"] not in self.wheel:
+                self._queue(reminder)
+                loaded += 1
+        logger.info("Loaded %d pending reminders", loaded)
+        return loaded
+
+    async def sweep(self):
+        """Drop stale reminders, release dead claims and queue reminders other workers scheduled"""
+        now = datetime.utcnow()
+        await self.collection.update_many(
+            {"status": "pending", "due_at": {"$lt": now - STALE_AFTER}},
+            {"$set": {"status": "missed", "updated_at": now}}
+        )
+        await self.collection.update_many(
+            {"status": "sending", "claimed_at": {"$lt": now - CLAIM_LEASE}},
+            {"$set": {"status": "pending"}, "$unset": {"owner": ""}}
+        )
+        horizon = now + timedelta(seconds=self.sweep_seconds * 2)
+        async for reminder in self.collection.find({"status": "pending", "due_at": {"$lte": horizon}}, WHEEL_FIELDS):
+            if reminder["id"] not in self.wheel:
+                self._queue(reminder)
+
+    # ==================== DISPATCH ====================
+
+    async def fire(self, expired: List[Tuple[str, str]]):
+        for start in range(0, len(expired), self.batch_size):
+            batch = expired[start:start + self.batch_size]
+            for reminder_id, booking_id in batch:
+                self._forget(reminder_id, booking_id)
+            await self._send([reminder_id for reminder_id, _ in batch])
+
+    async def _send(self, ids: List[str]):
+        now = datetime.utcnow()
+        await self.collection.update_many(
+            {"id": {"$in": ids}, "status": "pending"},
+            {"$set": {"status": "sending", "owner": self.owner, "claimed_at": now}}
+        )
+        claimed = await self.collection.find(
+            {"id": {"$in": ids}, "status": "sending", "owner": self.owner}, {"_id": 0}
+        ).to_list(None)
+        if not claimed:
+            return
+        claimed_ids = [r["id"] for r in claimed]
+        try:
+            await self.deliver(claimed)
+        except Exception:
+            self.failures += len(claimed)
+            logger.exception("Delivering %d reminders failed", len(claimed))
+            # Back to pending; the next sweep queues them again
+            await self.collection.update_many(
+                {"id": {"$in": claimed_ids}, "owner": self.owner},
+                {"$set": {"status": "pending"}, "$unset": {"owner": ""}}
+            )
+            return
+        await self.collection.update_many(
+            {"id": {"$in": claimed_ids}, "owner": self.owner},
+            {"$set": {"status": "sent", "sent_at": datetime.utcnow()}}
+        )
+        self.sent += len(claimed)
+
+    async def _run(self):
+        try:
+            await self.load()
+        except Exception as e:
+            logger.warning("Loading pending reminders failed: %s", e)
+        next_sweep = 0.0
+        while True:
+            try:
+                if time.monotonic() >= next_sweep:
+                    next_sweep = time.monotonic() + self.sweep_seconds
+                    await self.sweep()
+                expired = self.wheel.advance()
+                if expired:
+                    await self.fire(expired)
+            except Exception as e:
+                logger.warning("Reminder dispatch failed: %s", e)
+            await asyncio.sleep(self.wheel.tick)
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
@@ -0,0 +1,236 @@
+"""In-process inverted index for admin typeahead search.
+
+Users, bookings and practitioners are tokenised into a shared index on
+startup and kept current as the API writes them. Each query term is matched
+as a prefix against a sorted token list (bisect), so lookups never touch
+the database and stay in the microsecond-to-millisecond range.
+
+A full build adds documents unsorted and sorts the token list once at the
+end, and the tokenising runs in an executor thread so the event loop keeps
+serving requests. Writes made while a rebuild is in progress are journaled
+by the live index and replayed onto the new one before it is swapped in.
+"""
+import asyncio
+import bisect
+import re
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+# Field weights per document kind; identifiers rank above free text
+SEARCH_FIELDS = {
+    "users": {"name": 2.0, "phone": 3.0},
+    "bookings": {"customer_name": 2.0, "customer_phone": 3.0, "pincode": 1.0, "id": 3.0},
+    "practitioners": {"full_name": 2.0, "registration_no": 3.0, "email": 2.5},
+}
+
+PHONE_FIELDS = {"phone", "customer_phone"}
+
+# Upper bound on distinct tokens expanded for one short prefix like "a"
+MAX_PREFIX_EXPANSION = 2000
+
+DocKey = Tuple[str, str]
+
+
+def tokenize(value: Any, phone: bool = False) -> List[str]:
+    if value is None:
+        return []
+    text = str(value).lower()
+    if phone:
+        digits = "".join(ch for ch in text if ch.isdigit())
+        # Match both "+91 98765..." and the bare national number
+        return [t for t in {digits, digits[-10:]} if t]
+    return TOKEN_RE.findall(text)
+
+
+def search_fields(kind: str, doc: Dict[str, Any]) -> Dict[str, Any]:
+    """Pull the searchable fields out of a stored document"""
+    if kind == "practitioners":
+        personal = doc.get("personal_details", {})
+        education = doc.get("education", {})
+        return {
+            "full_name": personal.get("full_name"),
+            "email": personal.get("email"),
+            "registration_no": education.get("registration_no"),
+        }
+    return {field: doc.get(field) for field in SEARCH_FIELDS[kind]}
+
+
+def search_summary(kind: str, doc: Dict[str, Any]) -> Dict[str, Any]:
+    """Small payload returned with each hit so results need no extra lookup"""
+    if kind == "users":
+        return {"id": doc.get("id"), "name": doc.get("name"), "phone": doc.get("phone")}
+    if kind == "bookings":
+        return {
+            "id": doc.get("id"),
+            "customer_name": doc.get("customer_name"),
+            "customer_phone": doc.get("customer_phone"),
+            "city": doc.get("city"),
+            "pincode": doc.get("pincode"),
+            "service_type": doc.get("service_type"),
+            "preferred_date": doc.get("preferred_date"),
+            "status": doc.get("status"),
+        }
+    personal = doc.get("personal_details", {})
+    return {
+        "id": doc.get("id"),
+        "full_name": personal.get("full_name"),
+        "email": personal.get("email"),
+        "city": personal.get("city"),
+        "registration_no": doc.get("education", {}).get("registration_no"),
+        "status": doc.get("status"),
+    }
+
+
+class SearchIndex:
+    def __init__(self):
+        self.tokens: List[str] = []                                 # sorted, unique
+        self.postings: Dict[str, Dict[DocKey, float]] = {}          # token -> doc -> weight
+        self.doc_tokens: Dict[DocKey, Set[str]] = {}
+        self.summaries: Dict[DocKey, Dict[str, Any]] = {}
+        self.order: Dict[DocKey, int] = {}                          # insertion order for tie-breaks
+        self._seq = 0
+        # Writes recorded while a replacement index is being built
+        self.journal: Optional[List[Tuple[str, tuple]]] = None
+
+    def __len__(self):
+        return len(self.doc_tokens)
+
+    def add(self, kind: str, doc: Dict[str, Any], sort: bool = True):
+        """Index (or re-index) a stored document.
+
+        With sort=False new tokens are not placed in the token list; a bulk
+        load does that once with finish().
+        """
+        if self.journal is not None:
+            self.journal.append(("add", (kind, doc)))
+        key = (kind, doc["id"])
+        self._drop(key)
+
+        weights: Dict[str, float] = {}
+        for field, value in search_fields(kind, doc).items():
+            weight = SEARCH_FIELDS[kind][field]
+            for token in tokenize(value, phone=field in PHONE_FIELDS):
+                weights[token] = max(weights.get(token, 0.0), weight)
+
+        for token, weight in weights.items():
+            posting = self.postings.get(token)
+            if posting is None:
+                posting = self.postings[token] = {}
+                if sort:
+                    bisect.insort(self.tokens, token)
+            posting[key] = weight
+
+        self._seq += 1
+        self.doc_tokens[key] = set(weights)
+        self.summaries[key] = search_summary(kind, doc)
+        self.order[key] = self._seq
+
+    def add_many(self, kind: str, docs: Iterable[Dict[str, Any]]):
+        """Index a batch without sorting; call finish() after the last batch"""
+        for doc in docs:
+            if doc.get("id"):
+                self.add(kind, doc, sort=False)
+
+    def finish(self):
+        """Sort the token list once after bulk adds"""
+        self.tokens = sorted(self.postings)
+
+    def remove(self, kind: str, doc_id: str):
+        if self.journal is not None:
+            self.journal.append(("remove", (kind, doc_id)))
+        self._drop((kind, doc_id))
+
+    def _drop(self, key: DocKey):
+        for token in self.doc_tokens.pop(key, ()):
+            posting = self.postings[token]
+            posting.pop(key, None)
+            if not posting:
+                del self.postings[token]
+                i = bisect.bisect_left(self.tokens, token)
+                # Absent during a bulk load, until finish() sorts the list
+                if i < len(self.tokens) and self.tokens[i] == token:
+                    del self.tokens[i]
+        self.summaries.pop(key, None)
+        self.order.pop(key, None)
+
+    def update_summary(self, kind: str, doc_id: str, changes: Dict[str, Any]):
+        """Refresh displayed fields (e.g. status) that are not themselves searchable"""
+        if self.journal is not None:
+            self.journal.append(("update_summary", (kind, doc_id, changes)))
+        summary = self.summaries.get((kind, doc_id))
+        if summary is not None:
+            for field in summary.keys() & changes.keys():
+                summary[field] = changes[field]
+
+    def _match_term(self, term: str, kinds: Set[str]) -> Dict[DocKey, float]:
+        """Score every document matching one query term as a token prefix"""
+        scores: Dict[DocKey, float] = {}
+        start = bisect.bisect_left(self.tokens, term)
+        for token in self.tokens[start:start + MAX_PREFIX_EXPANSION]:
+            if not token.startswith(term):
+                break
+            # Exact hits beat prefix hits; longer coverage of the token ranks higher
+            closeness = 1.0 if token == term else 0.5 * len(term) / len(token)
+            for key, weight in self.postings[token].items():
+                if key[0] in kinds:
+                    score = weight * closeness
+                    if score > scores.get(key, 0.0):
+                        scores[key] = score
+        return scores
+
+    def search(self, query: str, kinds: Optional[Iterable[str]] = None, limit: int = 20) -> List[Dict[str, Any]]:
+        kinds = set(kinds or SEARCH_FIELDS)
+        terms = TOKEN_RE.findall(query.lower())
+        if not terms:
+            return []
+
+        # Every term must match; rarest-first keeps the intersection small
+        matches = sorted((self._match_term(t, kinds) for t in terms), key=len)
+        scores = matches[0]
+        for other in matches[1:]:
+            scores = {k: s + other[k] for k, s in scores.items() if k in other}
+            if not scores:
+                return []
+
+        ranked = sorted(scores.items(), key=lambda kv: (-kv[1], -self.order[kv[0]]))[:limit]
+        return [
+            {"type": key[0], "score": round(score, 3), **self.summaries[key]}
+            for key, score in ranked
+        ]
+
+
+async def build_index(db, index: SearchIndex, batch_size: int = 1000):
+    """Load every searchable document with a projected, batched scan.
+
+    Each batch is tokenised in an executor thread; the token list is sorted
+    once at the end.
+    """
+    loop = asyncio.get_running_loop()
+    projections = {
+        "users": {"_id": 0, "id": 1, "name": 1, "phone": 1},
+        "bookings": {
+            "_id": 0, "id": 1, "customer_name": 1, "customer_phone": 1, "pincode": 1,
+            "city": 1, "service_type": 1, "preferred_date": 1, "status": 1,
+        },
+        "practitioners": {
+            "_id": 0, "id": 1, "status": 1,
+            "personal_details.full_name": 1, "personal_details.email": 1, "personal_details.city": 1,
+            "education.registration_no": 1,
+        },
+    }
+    for kind, projection in projections.items():
+        batch = []
+        async for doc in db[kind].find({}, projection).batch_size(batch_size):
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                await loop.run_in_executor(None, index.add_many, kind, batch)
+                batch = []
+        await loop.run_in_executor(None, index.add_many, kind, batch)
+    await loop.run_in_executor(None, index.finish)
+
+
+def replay(index: SearchIndex, journal: List[Tuple[str, tuple]]):
+    """Apply writes journaled by the live index while `index` was being built"""
+    for op, args in journal:
+        getattr(index, op)(*args)
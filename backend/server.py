@@ -1,44 +1,98 @@
-from fastapi import FastAPI, APIRouter, HTTPException, WebSocket, WebSocketDisconnect, UploadFile, File, Form
+import time
+IMPORT_STARTED = time.perf_counter()
+
+from fastapi import FastAPI, APIRouter, HTTPException, WebSocket, WebSocketDisconnect, UploadFile, File, Form, Depends, Request, Query
+from fastapi.encoders import jsonable_encoder
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from starlette.responses import StreamingResponse, FileResponse, PlainTextResponse
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from contextlib import asynccontextmanager
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 import uuid
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import json
 import asyncio
 import aiofiles
 import random
 import string
+import tempfile
+import re
+
+from rate_limit import RateLimiter, Rule, TokenBucket, SlidingWindow, InMemoryRateLimitStore, MongoRateLimitStore
+import events
+from events import EventBus
+from search import SearchIndex, SEARCH_FIELDS, build_index, replay
+import exports
+from exports import ExportError
+from jobs import JobRunner
+import practitioner_import
+import ledger
+from ledger import Ledger, LedgerError
+import booking_state
+from booking_state import TransitionRejected
+from offers import OfferPolicy, OfferTimers, policy_for, pick_candidates
+import workload
+from log_pipeline import configure_logging, parse_rates, RequestContextMiddleware
+from tracing import tracer_from_env, MongoCommandTracer, TracingMiddleware
+from profiler import ProfileStore, ProfilerMiddleware, to_collapsed
+from storage import Storage, StorageSettings, NO_ID, duplicate_key
+from writebehind import WriteBehindBuffer
+from notes import NotesStore
+import migrations
+from migrations import MigrationRunner, MigrationError
+import partitions
+from partitions import PartitionMap, PartitionedCollection, parse_partitions
+import reminders
+from reminders import ReminderScheduler
+from outbox import Outbox
+from wire import WireSocket
+from tokens import KeyRing, SessionTokens, InvalidToken, KeyRingError, parse_keys
+from quotes import QuoteEngine, QuoteError
+from zoneinfo import ZoneInfo
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ.get('DB_NAME', 'voct_database')]
-
-# Create the main app
-app = FastAPI(title="VOCT Healthcare API")
+# Tracing is off unless TRACING_EXPORTER is set (file or otlp)
+tracer = tracer_from_env(ROOT_DIR / "traces" / "spans.jsonl")
+
+# Collections are reached through repositories; the backend (MongoDB, or the
+# in-memory store with STORAGE_BACKEND=memory) is opened in the app lifespan
+db = Storage()
+
+# Multi-city scale-out: CITY_PARTITIONS="Mumbai=west,Pune=west,Bengaluru=south"
+# gives each partition its own bookings and practitioners collections, routed
+# by city. Unlisted cities stay in the original ("default") collections.
+partition_map: Optional[PartitionMap] = None
+if os.environ.get('CITY_PARTITIONS'):
+    partition_map = PartitionMap(
+        db.partition_map,
+        parse_partitions(os.environ['CITY_PARTITIONS']),
+        refresh_seconds=float(os.environ.get('PARTITION_MAP_REFRESH_SECONDS', '30'))
+    )
+    for name, key in partitions.PARTITION_KEYS.items():
+        db.partition(name, PartitionedCollection(db, name, key, partition_map))
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# WebSocket routes live outside /api
+ws_router = APIRouter()
+
 logger = logging.getLogger(__name__)
 
 # Upload directory
 UPLOAD_DIR = ROOT_DIR / "uploads"
-UPLOAD_DIR.mkdir(exist_ok=True)
+
+# Export job output directory
+EXPORT_DIR = ROOT_DIR / "exports"
 
 # ==================== MODELS ====================
 
@@ -51,7 +105,15 @@ class UserBase(BaseModel):
     email: Optional[str] = None
 
 class UserCreate(UserBase):
-    pass
+    phone: Optional[str] = None  # taken from the signup token
+
+# What a user may change about themselves; the phone is theirs by OTP and stays put
+class UserUpdate(BaseModel):
+    name: Optional[str] = None
+    age: Optional[int] = None
+    gender: Optional[str] = None
+    email: Optional[str] = None
+    addresses: Optional[List[Dict[str, Any]]] = None
 
 class User(UserBase):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -71,6 +133,12 @@ class OTPResponse(BaseModel):
     success: bool
     message: str
     user_id: Optional[str] = None
+    token: Optional[str] = None
+    token_expires_at: Optional[datetime] = None
+
+class UserSession(User):
+    token: str
+    token_expires_at: datetime
 
 # Assessment Models
 class BasicDetails(BaseModel):
@@ -109,6 +177,10 @@ class BookingCreate(BaseModel):
     physio_gender_preference: Optional[str] = None
     assessment_id: Optional[str] = None
 
+class BookingRequest(BookingCreate):
+    user_id: Optional[str] = None  # the patient's own bookings come from their session
+    quote: Optional[str] = None  # a signature from /quotes; without one the booking is priced without promos
+
 class Booking(BookingCreate):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     created_at: datetime = Field(default_factory=datetime.utcnow)
@@ -117,11 +189,22 @@ class Booking(BookingCreate):
     payment_status: str = "pending"
     assigned_physio_id: Optional[str] = None
     assignment_status: str = "unassigned"
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+    sync_version: int = 0
+    quote_id: Optional[str] = None
+    promo_code: Optional[str] = None
+    discount: int = 0
+
+class BookingDelta(BaseModel):
+    bookings: List[Booking]
+    deleted: List[str]
+    cursor: int
 
 # Payment Models
 class PaymentOrderCreate(BaseModel):
     booking_id: str
     amount: int
+    quote: Optional[str] = None
 
 class PaymentOrder(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -132,6 +215,19 @@ class PaymentOrder(BaseModel):
     status: str = "created"
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
+class ExportRequest(BaseModel):
+    dataset: str  # 'bookings', 'payments' or 'payouts'
+    format: str = "csv"  # 'csv' or 'parquet'
+    status: Optional[str] = None
+    city: Optional[str] = None
+    date_from: Optional[str] = None  # YYYY-MM-DD
+    date_to: Optional[str] = None
+
+class PayoutRunRequest(BaseModel):
+    min_amount: int = 1
+    practitioner_ids: Optional[List[str]] = None
+    dry_run: bool = False
+
 class PaymentVerify(BaseModel):
     order_id: str
     payment_id: str
@@ -198,6 +294,16 @@ class Practitioner(PractitionerCreate):
     degree_certificate: Optional[str] = None
 
 # Service Models
+class QuoteItem(BaseModel):
+    service_type: str
+    session_count: int
+    city: Optional[str] = None
+    promo_code: Optional[str] = None
+
+class QuoteRequest(BaseModel):
+    items: List[QuoteItem]
+    promo_code: Optional[str] = None
+
 class Service(BaseModel):
     id: str
     name: str
@@ -301,39 +407,351 @@ PRICING = {
 
 # ==================== WEBSOCKET MANAGER ====================
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
-        self.physio_connections: Dict[str, WebSocket] = {}
-    
-    async def connect_user(self, user_id: str, websocket: WebSocket):
+    """Live sockets per user and physio; every message also goes to the recipient's outbox"""
+    
+    def __init__(self, outbox: Outbox):
+        self.outbox = outbox
+        self.active_connections: Dict[str, WireSocket] = {}
+        self.physio_connections: Dict[str, WireSocket] = {}
+        # Last outbox seq pushed down each live socket, by recipient key ("user:<id>")
+        self.delivered: Dict[str, int] = {}
+        # Outbox head when a socket connected without last_seq: it was never sent anything up to here
+        self.skipped: Dict[str, int] = {}
+        # Highest seq a send is waiting to push after an earlier one lands
+        self.waiting: Dict[str, int] = {}
+        self.locks: Dict[str, asyncio.Lock] = {}
+    
+    async def connect_user(self, user_id: str, websocket: WireSocket, last_seq: Optional[int] = None):
         await websocket.accept()
         self.active_connections[user_id] = websocket
+        await self._resume("user", user_id, websocket, last_seq)
     
-    async def connect_physio(self, physio_id: str, websocket: WebSocket):
+    async def connect_physio(self, physio_id: str, websocket: WireSocket, last_seq: Optional[int] = None):
         await websocket.accept()
         self.physio_connections[physio_id] = websocket
-    
-    def disconnect_user(self, user_id: str):
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
-    
-    def disconnect_physio(self, physio_id: str):
-        if physio_id in self.physio_connections:
-            del self.physio_connections[physio_id]
-    
-    async def send_to_user(self, user_id: str, message: dict):
-        if user_id in self.active_connections:
-            await self.active_connections[user_id].send_json(message)
-    
-    async def send_to_physio(self, physio_id: str, message: dict):
-        if physio_id in self.physio_connections:
-            await self.physio_connections[physio_id].send_json(message)
+        await self._resume("physio", physio_id, websocket, last_seq)
+    
+    def disconnect_user(self, user_id: str, websocket: Optional[WireSocket] = None):
+        self._drop("user", user_id, self.active_connections, websocket)
+    
+    def disconnect_physio(self, physio_id: str, websocket: Optional[WireSocket] = None):
+        self._drop("physio", physio_id, self.physio_connections, websocket)
+    
+    def _drop(self, channel: str, recipient_id: str, connections: Dict[str, WireSocket],
+              websocket: Optional[WireSocket]):
+        # A reconnect may already have replaced the socket that is going away
+        if recipient_id in connections and websocket in (None, connections[recipient_id]):
+            del connections[recipient_id]
+            key = f"{channel}:{recipient_id}"
+            self.delivered.pop(key, None)
+            self.skipped.pop(key, None)
+            self.waiting.pop(key, None)
+            self.locks.pop(key, None)
+    
+    async def _resume(self, channel: str, recipient_id: str, websocket: WireSocket, last_seq: Optional[int]):
+        """Replay what the client missed since `last_seq`; clients that don't send one start from now"""
+        key = f"{channel}:{recipient_id}"
+        async with self.locks.setdefault(key, asyncio.Lock()):
+            if last_seq is None:
+                self.delivered[key] = self.skipped[key] = await self.outbox.head(key)
+                return
+            self.skipped.pop(key, None)
+            self.delivered[key] = last_seq
+            await self._push(key, websocket, await self.outbox.replay(key, last_seq))
+    
+    async def _push(self, key: str, websocket: WireSocket, messages: List[Dict[str, Any]]):
+        """Send messages in seq order, stopping at a hole another send is still filling"""
+        last = self.delivered[key]
+        ready = []
+        for message in messages:
+            if message["type"] != "replay_gap" and message["seq"] != last + 1:
+                break
+            ready.append(message)
+            last = message["seq"]
+        if ready:
+            # Clients on a voct.* subprotocol get these batched into few frames
+            await websocket.send_messages(ready)
+        self.delivered[key] = last
+    
+    async def _send(self, channel: str, recipient_id: str, connections: Dict[str, WireSocket], message: dict) -> bool:
+        key = f"{channel}:{recipient_id}"
+        seq = await self.outbox.append(key, message)
+        if recipient_id not in connections:
+            return False
+        async with self.locks.setdefault(key, asyncio.Lock()):
+            websocket = connections.get(recipient_id)
+            if websocket is None:
+                return False
+            last = self.delivered.get(key, 0)
+            if seq <= last:
+                # A replay or a later send already pushed it, unless it was queued
+                # before this socket connected and so skipped
+                return seq > self.skipped.get(key, 0)
+            waiting = max(self.waiting.get(key, 0), seq)
+            if seq == last + 1 and waiting == seq:
+                pending = [{**message, "seq": seq}]
+            else:
+                # Sends finished out of order; push everything up to the first hole
+                pending = await self.outbox.since(key, last)
+            try:
+                with tracer.span("ws.send", "producer", {"ws.channel": channel, "ws.recipient": recipient_id,
+                                                         "ws.message_type": message.get("type")}):
+                    await self._push(key, websocket, pending)
+            except Exception as e:
+                # The message stays in the outbox for the client's next connect
+                logger.info("Dropping dead %s socket for %s: %s", channel, recipient_id, e)
+                self._drop(channel, recipient_id, connections, websocket)
+                return False
+            if waiting > self.delivered[key]:
+                self.waiting[key] = waiting
+            else:
+                self.waiting.pop(key, None)
+            return seq <= self.delivered[key]
+    
+    async def send_to_user(self, user_id: str, message: dict) -> bool:
+        """Queue a message for a user; True if it was also pushed to a live socket"""
+        return await self._send("user", user_id, self.active_connections, message)
+    
+    async def send_to_physio(self, physio_id: str, message: dict) -> bool:
+        """Queue a message for a physio; True if it was also pushed to a live socket"""
+        return await self._send("physio", physio_id, self.physio_connections, message)
+
+# Websocket messages are kept for OUTBOX_TTL_HOURS so reconnecting clients can catch up
+outbox = Outbox(
+    db.outbox_messages,
+    db.outbox_sequences,
+    ttl=timedelta(hours=float(os.environ.get('OUTBOX_TTL_HOURS', '72')))
+)
+manager = ConnectionManager(outbox)
+
+# Live admin dashboard updates; set ADMIN_EVENTS_SOURCE=change_stream on a
+# replica set so every worker sees writes made by the others
+admin_events = EventBus(source=os.environ.get('ADMIN_EVENTS_SOURCE', 'local'))
+
+# Admin typeahead index, kept current by this worker's writes and rebuilt
+# periodically so writes from other workers show up (0: build once at startup)
+search_index = SearchIndex()
+SEARCH_REBUILD_SECONDS = int(os.environ.get('SEARCH_REBUILD_SECONDS', '300'))
+
+# Long-running admin work (exports, imports)
+job_runner = JobRunner(db.jobs)
+
+# Earnings, commission and payouts
+earnings_ledger = Ledger(db.ledger_entries, db.ledger_balances, db.ledger_locks)
+
+# Clinical notes live outside the booking, versioned and compressed
+session_notes = NotesStore(db.session_notes, db.session_note_chunks)
+
+# Bookings pre-dating the notes store may still carry notes inline; lists never need them
+BOOKING_LIST_FIELDS = {"_id": 0, "session_notes": 0}
+
+async def merge_user_references(old_id: str, new_id: str):
+    """Hand a merged duplicate user's bookings and assessments to the user kept"""
+    async with booking_stamp() as stamp:
+        await db.bookings.update_many({"user_id": old_id}, {"$set": {"user_id": new_id, **stamp}})
+    await db.assessments.update_many({"user_id": old_id}, {"$set": {"user_id": new_id}})
+
+# Signup and applications rely on these being unique; the merge migrations build them.
+# With CITY_PARTITIONS on, a partitioned collection gets one index per partition,
+# which only keeps a key unique within that partition's cities; unique_value_taken
+# covers the other partitions by hand.
+UNIQUE_KEYS = [
+    ("users", "phone"),
+    ("practitioners", "personal_details.email"),
+    ("practitioners", "education.registration_no"),
+]
 
-manager = ConnectionManager()
+# Unique indexes ensure_indexes couldn't build because duplicates exist, with
+# when to try again. Until they are built, writes look for a duplicate first.
+unique_keys_missing: Dict[Tuple[str, str], float] = {}
+UNIQUE_INDEX_RETRY_SECONDS = 60.0
+
+async def unique_value_taken(name: str, key: str, value: Any) -> bool:
+    """Whether `value` is already used, checked by hand where no unique index covers every document"""
+    if value is None:
+        return False
+    retry_at = unique_keys_missing.get((name, key))
+    if retry_at is None:
+        if not (partition_map and name in partitions.PARTITION_KEYS):
+            return False
+    elif time.monotonic() >= retry_at:
+        # The merge migration may have built it since, on this worker or another
+        try:
+            await db[name].create_index(key, unique=True)
+        except OperationFailure:
+            unique_keys_missing[(name, key)] = time.monotonic() + UNIQUE_INDEX_RETRY_SECONDS
+        else:
+            del unique_keys_missing[(name, key)]
+            logger.info("Unique index on %s.%s is in place", name, key)
+            if not (partition_map and name in partitions.PARTITION_KEYS):
+                return False
+    # Without the city in the query, this reads every partition
+    return await db[name].find_one({key: value}, {"_id": 1}) is not None
+
+def practitioner_merge(migration_id: str, key: str, label: str) -> migrations.MergeDuplicates:
+    # A verified practitioner is kept over an application; two verified duplicates need a person
+    return migrations.MergeDuplicates(
+        migration_id, db, "practitioners", key,
+        f"Merge practitioner applications sharing a {label}, then make it unique",
+        rank=lambda doc: (not doc.get("is_verified"), doc.get("created_at") or datetime.min, doc["_id"]),
+        mergeable=lambda doc: not doc.get("is_verified")
+    )
+
+# Document shape changes, backfilled in the background from the admin API.
+# Append new migrations; never reorder or rename shipped ones.
+MIGRATIONS = [
+    migrations.BookingAssignmentStatus(),
+    migrations.InlineSessionNotes(session_notes),
+    migrations.MergeDuplicates(
+        "0003_merge_duplicate_users", db, "users", "phone",
+        "Merge users sharing a phone number into the oldest, then make phone unique",
+        repoint=merge_user_references
+    ),
+    practitioner_merge("0004_merge_duplicate_practitioner_emails", "personal_details.email", "email"),
+    practitioner_merge("0005_merge_duplicate_practitioner_registrations", "education.registration_no",
+                       "registration number"),
+]
+migration_runner = MigrationRunner(db, db.migrations, MIGRATIONS)
+
+def upgrade_bookings(bookings: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Present bookings in their current shape while a migration is still backfilling"""
+    return [migrations.upgrade(MIGRATIONS, "bookings", b) for b in bookings]
+
+# Low-priority inserts (contact messages, assessments) are spilled to disk and
+# written in batches off the request path
+write_buffer = WriteBehindBuffer(
+    db,
+    ROOT_DIR / "spill",
+    max_batch=int(os.environ.get('WRITE_BEHIND_BATCH', '500')),
+    max_delay=float(os.environ.get('WRITE_BEHIND_DELAY_MS', '1000')) / 1000
+)
+
+# Physio assignment: "serial" assigns one physio at a time, "broadcast" offers
+# the booking to the top-K online physios at once and the first to accept wins
+ASSIGNMENT_MODE = os.environ.get('ASSIGNMENT_MODE', 'serial')
+OFFER_POLICIES = {
+    "default": OfferPolicy(k=3, timeout_seconds=60),
+    "neurological": OfferPolicy(k=2, timeout_seconds=120),
+    "geriatric": OfferPolicy(k=3, timeout_seconds=90),
+    "sports": OfferPolicy(k=5, timeout_seconds=45),
+}
+offer_timers = OfferTimers()
 
 # OTP Storage (in-memory for demo, use Redis in production)
 otp_storage: Dict[str, Dict[str, Any]] = {}
 
+# ==================== RATE LIMITING ====================
+
+# Narrowest scope is checked first so a single abuser exhausts their own
+# bucket before eating into the global budget (which caps SMS spend).
+RATE_LIMITS = {
+    "send_otp": [
+        Rule("phone_burst", "key", TokenBucket(capacity=3, refill_per_second=1 / 60)),
+        Rule("phone_hourly", "key", SlidingWindow(limit=10, window_seconds=3600)),
+        Rule("ip_burst", "ip", TokenBucket(capacity=10, refill_per_second=1 / 30)),
+        Rule("ip_hourly", "ip", SlidingWindow(limit=60, window_seconds=3600)),
+        Rule("global", "global", TokenBucket(capacity=100, refill_per_second=5)),
+    ],
+    "contact": [
+        Rule("ip_burst", "ip", TokenBucket(capacity=5, refill_per_second=1 / 60)),
+        Rule("ip_hourly", "ip", SlidingWindow(limit=20, window_seconds=3600)),
+        Rule("global", "global", TokenBucket(capacity=200, refill_per_second=10)),
+    ],
+    "practitioner_apply": [
+        Rule("ip_burst", "ip", TokenBucket(capacity=3, refill_per_second=1 / 300)),
+        Rule("ip_daily", "ip", SlidingWindow(limit=20, window_seconds=86400)),
+        Rule("global", "global", TokenBucket(capacity=100, refill_per_second=2)),
+    ],
+}
+
+# Use RATE_LIMIT_STORE=mongo when running several workers so they share state
+if os.environ.get('RATE_LIMIT_STORE', 'memory') == 'mongo':
+    rate_limit_store = MongoRateLimitStore(db.rate_limits)
+else:
+    rate_limit_store = InMemoryRateLimitStore()
+
+rate_limiter = RateLimiter(
+    rate_limit_store,
+    RATE_LIMITS,
+    trust_proxy=os.environ.get('RATE_LIMIT_TRUST_PROXY', 'false').lower() == 'true'
+)
+
+# ==================== SESSION TOKENS ====================
+
+SESSION_TTLS = {
+    "patient": timedelta(days=int(os.environ.get('PATIENT_SESSION_DAYS', '30'))),
+    "practitioner": timedelta(hours=int(os.environ.get('INTERNAL_SESSION_HOURS', '12'))),
+    "admin": timedelta(hours=int(os.environ.get('INTERNAL_SESSION_HOURS', '12'))),
+    # Proof of a verified OTP for a number with no account yet, spent by /auth/signup
+    "signup": timedelta(minutes=10),
+    # Lets a new applicant upload certificates for the application just submitted
+    "applicant": timedelta(hours=1),
+}
+
+# AUTH_SIGNING_KEYS="kid:secret,..." pins the keys (the first one signs); without
+# it they live in auth_keys and are rotated from /internal/admin/auth/keys/rotate
+signing_keys = KeyRing(
+    db.auth_keys,
+    max_token_ttl=max(SESSION_TTLS.values()),
+    static=parse_keys(os.environ.get('AUTH_SIGNING_KEYS', '')),
+    refresh_seconds=float(os.environ.get('AUTH_KEYS_REFRESH_SECONDS', '60'))
+)
+session_tokens = SessionTokens(signing_keys, SESSION_TTLS)
+bearer = HTTPBearer(auto_error=False)
+
+def issue_session(subject: str, role: str, **claims) -> Dict[str, Any]:
+    session = session_tokens.issue(subject, role, **claims)
+    return {"token": session["token"], "token_expires_at": session["expires_at"]}
+
+async def current_session(credentials: Optional[HTTPAuthorizationCredentials] = Depends(bearer)) -> Dict[str, Any]:
+    """Claims of the request's bearer token"""
+    if credentials is None:
+        raise HTTPException(status_code=401, detail="Not authenticated", headers={"WWW-Authenticate": "Bearer"})
+    try:
+        return await session_tokens.authenticate(credentials.credentials)
+    except InvalidToken as e:
+        raise HTTPException(status_code=401, detail=str(e), headers={"WWW-Authenticate": "Bearer"})
+
+async def require_admin(session: Dict[str, Any] = Depends(current_session)) -> Dict[str, Any]:
+    if session["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return session
+
+# Admins may act on any practitioner or patient
+async def require_practitioner(practitioner_id: str, session: Dict[str, Any] = Depends(current_session)) -> Dict[str, Any]:
+    if session["role"] != "admin" and (session["role"] != "practitioner" or session["sub"] != practitioner_id):
+        raise HTTPException(status_code=403, detail="Not allowed for this practitioner")
+    return session
+
+async def require_applicant(practitioner_id: str, session: Dict[str, Any] = Depends(current_session)) -> Dict[str, Any]:
+    if session["role"] == "applicant" and session["sub"] == practitioner_id:
+        return session
+    return await require_practitioner(practitioner_id, session)
+
+async def require_user(user_id: str, session: Dict[str, Any] = Depends(current_session)) -> Dict[str, Any]:
+    if session["role"] != "admin" and (session["role"] != "patient" or session["sub"] != user_id):
+        raise HTTPException(status_code=403, detail="Not allowed for this user")
+    return session
+
+async def session_booking(booking_id: str, session: Dict[str, Any]) -> Dict[str, Any]:
+    """The booking, if the session is its patient or an admin"""
+    booking = await db.bookings.get(booking_id)
+    if not booking:
+        raise HTTPException(status_code=404, detail="Booking not found")
+    if session["role"] != "admin" and (session["role"] != "patient" or session["sub"] != booking.get("user_id")):
+        raise HTTPException(status_code=403, detail="Not allowed for this booking")
+    return booking
+
+async def websocket_session(token: Optional[str], role: str, subject: Optional[str] = None) -> bool:
+    """Browsers can't set headers on websockets, so their token comes in the query string"""
+    if not token:
+        return False
+    try:
+        session = await session_tokens.authenticate(token)
+    except InvalidToken:
+        return False
+    return session["role"] == "admin" or (session["role"] == role and subject in (None, session["sub"]))
+
 # ==================== API ENDPOINTS ====================
 
 # Health Check
@@ -343,7 +761,17 @@ async def root():
 
 # ==================== AUTH ENDPOINTS ====================
 
-@api_router.post("/auth/send-otp", response_model=OTPResponse)
+async def otp_phone(request: Request) -> str:
+    """The phone an OTP request is for, so its limits apply before the IP and global ones"""
+    try:
+        body = await request.json()
+    except ValueError:
+        # Not JSON; the IP and global limits still apply and validation answers 422
+        return ""
+    return str(body.get("phone", "")) if isinstance(body, dict) else ""
+
+@api_router.post("/auth/send-otp", response_model=OTPResponse,
+                 dependencies=[Depends(rate_limiter.dependency("send_otp", key=otp_phone))])
 async def send_otp(request: OTPRequest):
     """Send OTP to phone number (MOCKED for demo)"""
     phone = request.phone
@@ -363,7 +791,7 @@ async def send_otp(request: OTPRequest):
     # client = Client(os.getenv("TWILIO_ACCOUNT_SID"), os.getenv("TWILIO_AUTH_TOKEN"))
     # client.verify.services(os.getenv("TWILIO_VERIFY_SERVICE")).verifications.create(to=phone, channel="sms")
     
-    logger.info(f"MOCKED OTP for {phone}: {otp}")
+    logger.info("MOCKED OTP for %s: %s", phone, otp, extra={"phone": phone})
     
     return OTPResponse(
         success=True,
@@ -396,76 +824,145 @@ async def verify_otp(request: OTPVerify):
     del otp_storage[phone]
     
     # Check if user exists
-    existing_user = await db.users.find_one({"phone": phone})
+    existing_user = await db.users.by_phone(phone)
     
     if existing_user:
         return OTPResponse(
             success=True,
             message="Login successful",
-            user_id=existing_user["id"]
+            user_id=existing_user["id"],
+            **issue_session(existing_user["id"], "patient")
         )
     else:
-        # Return success but no user_id - frontend will show signup form
+        # No user_id - frontend will show signup form, which sends back the signup token
         return OTPResponse(
             success=True,
             message="OTP verified. Please complete registration.",
-            user_id=None
+            user_id=None,
+            **issue_session(phone, "signup")
         )
 
-@api_router.post("/auth/signup", response_model=User)
-async def signup(user: UserCreate):
+@api_router.post("/auth/signup", response_model=UserSession)
+async def signup(user: UserCreate, session: Dict[str, Any] = Depends(current_session)):
     """Complete user registration after OTP verification"""
-    # Check if user already exists
-    existing = await db.users.find_one({"phone": user.phone})
-    if existing:
-        raise HTTPException(status_code=400, detail="User already exists")
-    
-    new_user = User(**user.dict())
+    # The phone is the one the OTP was verified for, never the one in the body
+    if session["role"] != "signup":
+        raise HTTPException(status_code=403, detail="Verify your phone number before signing up")
+    new_user = User(**{**user.dict(), "phone": session["sub"]})
     new_user.is_verified = True
     
-    await db.users.insert_one(new_user.dict())
-    return new_user
+    # The unique phone index turns a repeat or concurrent signup into a duplicate key error
+    if await unique_value_taken("users", "phone", new_user.phone):
+        raise HTTPException(status_code=400, detail="User already exists")
+    try:
+        await db.users.add(new_user.dict())
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="User already exists")
+    admin_events.emit_local(events.user_created(new_user.dict()))
+    search_index.add("users", new_user.dict())
+    return UserSession(**new_user.dict(), **issue_session(new_user.id, "patient"))
 
-@api_router.get("/auth/user/{user_id}", response_model=User)
+@api_router.get("/auth/user/{user_id}", response_model=User, dependencies=[Depends(require_user)])
 async def get_user(user_id: str):
     """Get user by ID"""
-    user = await db.users.find_one({"id": user_id})
+    user = await db.users.get(user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     return User(**user)
 
-@api_router.put("/auth/user/{user_id}", response_model=User)
-async def update_user(user_id: str, updates: Dict[str, Any]):
+@api_router.put("/auth/user/{user_id}", response_model=User, dependencies=[Depends(require_user)])
+async def update_user(user_id: str, updates: UserUpdate):
     """Update user details"""
-    result = await db.users.update_one(
-        {"id": user_id},
-        {"$set": updates}
-    )
+    changes = updates.dict(exclude_unset=True)
+    if not changes:
+        raise HTTPException(status_code=400, detail="No changes given")
+    try:
+        result = await db.users.update_one(
+            {"id": user_id},
+            {"$set": changes}
+        )
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="User already exists")
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
     
-    user = await db.users.find_one({"id": user_id})
+    user = await db.users.get(user_id)
+    search_index.add("users", user)
     return User(**user)
 
 # ==================== SERVICES ENDPOINTS ====================
 
+def priced_service(service: Dict[str, Any]) -> Dict[str, Any]:
+    """The service with its per-session price from the live pricing config"""
+    return {**service, "price_per_session": quote_engine.tables.services.get(service["id"], service["price_per_session"])}
+
 @api_router.get("/services", response_model=List[Service])
 async def get_services():
     """Get all available services"""
-    return SERVICES
+    return [priced_service(service) for service in SERVICES]
 
 @api_router.get("/services/{service_id}", response_model=Service)
 async def get_service(service_id: str):
     """Get service by ID"""
     for service in SERVICES:
         if service["id"] == service_id:
-            return service
+            return priced_service(service)
     raise HTTPException(status_code=404, detail="Service not found")
 
 @api_router.get("/pricing")
 async def get_pricing():
     """Get session pricing"""
-    return PRICING
+    return quote_engine.tables.packages
+
+# ==================== QUOTES ====================
+
+# Seed for the pricing_config document; edit prices through /internal/admin/pricing
+PRICING_DEFAULTS = {
+    "reference_price": 999,
+    "services": {s["id"]: {"price_per_session": s["price_per_session"]} for s in SERVICES},
+    "packages": {str(sessions): price for sessions, price in PRICING.items()},
+    "city_multipliers": {},
+    "promos": [],
+}
+MAX_QUOTE_ITEMS = 50
+
+quote_engine = QuoteEngine(
+    db.pricing_config,
+    signing_keys,
+    PRICING_DEFAULTS,
+    ttl=timedelta(minutes=int(os.environ.get('QUOTE_TTL_MINUTES', '30'))),
+    refresh_seconds=float(os.environ.get('PRICING_REFRESH_SECONDS', '30'))
+)
+
+async def verify_quote(signature: str) -> Dict[str, Any]:
+    try:
+        return await quote_engine.verify(signature)
+    except QuoteError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@api_router.post("/quotes")
+async def create_quotes(request: QuoteRequest):
+    """Price a cart; each quote's signature can be passed to /booking"""
+    if not request.items or len(request.items) > MAX_QUOTE_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Quote between 1 and {MAX_QUOTE_ITEMS} items")
+    try:
+        return quote_engine.quote_cart([item.dict() for item in request.items], request.promo_code)
+    except QuoteError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@api_router.get("/internal/admin/pricing", dependencies=[Depends(require_admin)])
+async def get_pricing_config():
+    """The live pricing config and its version"""
+    return quote_engine.describe()
+
+@api_router.put("/internal/admin/pricing", dependencies=[Depends(require_admin)])
+async def update_pricing_config(config: Dict[str, Any]):
+    """Replace the pricing config; every worker picks it up within PRICING_REFRESH_SECONDS"""
+    try:
+        version = await quote_engine.update(config)
+    except QuoteError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"success": True, "version": version}
 
 # ==================== ASSESSMENT ENDPOINTS ====================
 
@@ -489,64 +986,278 @@ async def create_assessment(assessment: AssessmentCreate):
         recommended_service=recommended
     )
     
-    await db.assessments.insert_one(new_assessment.dict())
+    write_buffer.add("assessments", new_assessment.dict())
     return new_assessment
 
 @api_router.get("/assessment/{assessment_id}", response_model=Assessment)
 async def get_assessment(assessment_id: str):
     """Get assessment by ID"""
-    assessment = await db.assessments.find_one({"id": assessment_id})
+    # Fresh assessments may still be waiting in the write-behind buffer
+    assessment = await db.assessments.get(assessment_id) or write_buffer.find("assessments", assessment_id)
     if not assessment:
         raise HTTPException(status_code=404, detail="Assessment not found")
     return Assessment(**assessment)
 
+# ==================== BOOKING SYNC ====================
+
+# Versions are allocated before the write that carries them commits, so N+1 can
+# land before N. Each allocation registers itself in the counter document in
+# the same update, with a floor below its version, and readers only serve
+# versions under the lowest floor still in flight. A writer that dies without
+# clearing its entry stops holding readers back after this long.
+SYNC_INFLIGHT_TIMEOUT = timedelta(seconds=60)
+
+# The last version this worker allocated; the next one is always above it
+booking_sync_seen = 0
+
+@asynccontextmanager
+async def booking_stamp():
+    """Fields every booking write must $set so delta sync picks the change up.
+
+    Hold it open around the write: the version stays invisible to sync until
+    the block exits.
+    """
+    global booking_sync_seen
+    token = uuid.uuid4().hex
+    now = datetime.utcnow()
+    counter = await db.counters.find_one_and_update(
+        {"_id": "booking_sync"},
+        {"$inc": {"seq": 1}, "$set": {f"inflight.{token}": {"floor": booking_sync_seen, "at": now}}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    booking_sync_seen = max(booking_sync_seen, counter["seq"])
+    try:
+        yield {"updated_at": now, "sync_version": counter["seq"]}
+    finally:
+        await db.counters.update_one({"_id": "booking_sync"}, {"$unset": {f"inflight.{token}": ""}})
+
+async def visible_booking_version() -> int:
+    """The highest version below which every booking write has committed"""
+    counter = await db.counters.find_one({"_id": "booking_sync"})
+    if not counter:
+        return 0
+    cutoff = datetime.utcnow() - SYNC_INFLIGHT_TIMEOUT
+    inflight = counter.get("inflight") or {}
+    stale = [token for token, entry in inflight.items() if entry["at"] < cutoff]
+    if stale:
+        logger.warning("Dropping %d abandoned booking sync versions", len(stale))
+        await db.counters.update_one({"_id": "booking_sync"}, {"$unset": {f"inflight.{t}": "" for t in stale}})
+    return min((entry["floor"] for entry in inflight.values() if entry["at"] >= cutoff), default=counter["seq"])
+
+async def update_booking(
+    query: Dict[str, Any],
+    changes: Dict[str, Any],
+    extra: Optional[Dict[str, Any]] = None
+) -> Optional[Dict[str, Any]]:
+    """Apply a $set to one booking, stamp it for sync and notify admin listeners.
+
+    Returns the booking as it was before the update, or None if nothing matched.
+    """
+    async with booking_stamp() as stamp:
+        changes = {**changes, **stamp}
+        before = await db.bookings.find_one_and_update(
+            query,
+            {"$set": changes, **(extra or {})},
+            return_document=ReturnDocument.BEFORE
+        )
+    if before:
+        admin_events.emit_local(events.booking_updated(before, changes))
+        search_index.update_summary("bookings", before["id"], changes)
+        if changes.keys() & set(reminders.RESCHEDULE_FIELDS):
+            await reminder_scheduler.booking_changed({**before, **changes})
+    return before
+
+async def transition_booking(
+    booking_id: str,
+    name: str,
+    actor: str = "system",
+    changes: Optional[Dict[str, Any]] = None,
+    **params
+) -> Dict[str, Any]:
+    """Apply a state machine transition as a single compare-and-set update.
+
+    Raises TransitionRejected if the booking is missing or not in a state
+    the transition may start from (e.g. a concurrent writer got there first).
+    """
+    with tracer.span("booking.transition", attributes={"booking.id": booking_id, "booking.transition": name}):
+        return await _transition_booking(booking_id, name, actor, changes, params)
+
+async def _transition_booking(booking_id, name, actor, changes, params) -> Dict[str, Any]:
+    query, sets, extra = booking_state.build(name, booking_id, params)
+    before = await update_booking(query, {**sets, **(changes or {})}, extra)
+    if not before:
+        # Only the failure path pays for a read, to explain the rejection
+        current = await db.bookings.find_one({"id": booking_id}, {"_id": 0, "id": 1, **{f: 1 for f in booking_state.STATE_FIELDS}})
+        raise TransitionRejected(name, booking_id, current)
+    
+    await db.booking_transitions.insert_one({
+        **booking_state.history_entry(name, before, sets, actor),
+        "at": datetime.utcnow()
+    })
+    await workload.apply_transition(db.practitioners, before, sets)
+    return before
+
+def transition_http_error(e: TransitionRejected) -> HTTPException:
+    if e.not_found:
+        return HTTPException(status_code=404, detail="Booking not found")
+    return HTTPException(status_code=409, detail=str(e))
+
 # ==================== BOOKING ENDPOINTS ====================
 
 @api_router.post("/booking", response_model=Booking)
-async def create_booking(booking: BookingCreate):
+async def create_booking(booking: BookingRequest, session: Dict[str, Any] = Depends(current_session)):
     """Create a new booking"""
-    # Calculate amount based on session count
-    calculated_amount = PRICING.get(booking.session_count, booking.session_count * 999)
-    
-    # Update the booking data with calculated amount
-    booking_data = booking.dict()
-    booking_data['amount'] = calculated_amount
-    
-    new_booking = Booking(**booking_data)
+    # Patients book for themselves; only admins book on someone's behalf
+    if session["role"] == "patient":
+        booking.user_id = session["sub"]
+    elif session["role"] != "admin" or not booking.user_id:
+        raise HTTPException(status_code=403, detail="Not allowed to create bookings")
+    
+    # The amount comes from a signed quote, or is priced now; the client's amount is never trusted
+    if booking.quote:
+        quote = await verify_quote(booking.quote)
+        if (quote["service_type"], quote["session_count"], quote["city"]) != (
+                booking.service_type, booking.session_count, partitions.city_key(booking.city)):
+            raise HTTPException(status_code=400, detail="Quote does not match the booking")
+    else:
+        try:
+            quote = quote_engine.quote(booking.service_type, booking.city, booking.session_count)
+        except QuoteError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    
+    booking_data = booking.dict(exclude={"quote"})
+    booking_data.update(
+        amount=quote["amount"],
+        quote_id=quote["quote_id"],
+        promo_code=quote["promo_code"],
+        discount=quote["discount"]
+    )
     
-    await db.bookings.insert_one(new_booking.dict())
+    async with booking_stamp() as stamp:
+        new_booking = Booking(**booking_data, **stamp)
+        await db.bookings.add(new_booking.dict())
+    admin_events.emit_local(events.booking_created(new_booking.dict()))
+    search_index.add("bookings", new_booking.dict())
     return new_booking
 
 @api_router.get("/booking/{booking_id}", response_model=Booking)
-async def get_booking(booking_id: str):
+async def get_booking(booking_id: str, session: Dict[str, Any] = Depends(current_session)):
     """Get booking by ID"""
-    booking = await db.bookings.find_one({"id": booking_id})
-    if not booking:
-        raise HTTPException(status_code=404, detail="Booking not found")
-    return Booking(**booking)
+    return Booking(**await session_booking(booking_id, session))
 
-@api_router.get("/bookings/user/{user_id}", response_model=List[Booking])
+@api_router.get("/bookings/user/{user_id}", response_model=List[Booking], dependencies=[Depends(require_user)])
 async def get_user_bookings(user_id: str):
     """Get all bookings for a user"""
-    bookings = await db.bookings.find({"user_id": user_id}).to_list(100)
+    bookings = await db.bookings.for_user(user_id)
     return [Booking(**b) for b in bookings]
 
-@api_router.put("/booking/{booking_id}/status")
+@api_router.get("/bookings/user/{user_id}/changes", response_model=BookingDelta, dependencies=[Depends(require_user)])
+async def get_user_booking_changes(user_id: str, since: str = "0", limit: int = Query(100, ge=1, le=500)):
+    """Get bookings created or changed after the `since` cursor, plus deleted booking IDs"""
+    # `since` is a cursor from a previous call, or an ISO timestamp for clients that haven't got one yet
+    after = None
+    try:
+        since_version = int(since)
+    except ValueError:
+        try:
+            after = datetime.fromisoformat(since.replace("Z", "+00:00"))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="since must be a sync cursor or an ISO timestamp")
+        if after.tzinfo:
+            after = after.astimezone(timezone.utc).replace(tzinfo=None)
+        since_version = 0
+    
+    # Versions still being written are held back, so nothing below the cursor can appear later
+    visible = await visible_booking_version()
+    query: Dict[str, Any] = {"user_id": user_id, "sync_version": {"$gt": since_version, "$lte": visible}}
+    if since_version <= 0:
+        # A first sync also takes bookings written before versions existed
+        query = {"user_id": user_id, "$or": [{"sync_version": {"$lte": visible}}, {"sync_version": {"$exists": False}}]}
+    if after:
+        query["updated_at"] = {"$gt": after}
+    
+    bookings = await db.bookings.find(query, {"_id": 0}).sort("sync_version", 1).to_list(limit)
+    
+    # When the page is full the cursor stops at its last entry, so the
+    # client picks up the rest (and any later deletions) on its next call
+    upper = bookings[-1].get("sync_version", 0) if len(bookings) == limit else visible
+    tombstone_query: Dict[str, Any] = {"user_id": user_id, "sync_version": {"$gt": since_version, "$lte": upper}}
+    if after:
+        tombstone_query["deleted_at"] = {"$gt": after}
+    tombstones = await db.booking_tombstones.find(tombstone_query, {"_id": 0}).to_list(None)
+    
+    return BookingDelta(
+        bookings=[Booking(**b) for b in bookings],
+        deleted=[t["booking_id"] for t in tombstones],
+        cursor=max(upper, since_version)
+    )
+
+@api_router.put("/booking/{booking_id}/status", dependencies=[Depends(require_admin)])
 async def update_booking_status(booking_id: str, status: str):
     """Update booking status"""
-    result = await db.bookings.update_one(
-        {"id": booking_id},
-        {"$set": {"status": status}}
-    )
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Booking not found")
+    transition = booking_state.STATUS_TRANSITIONS.get(status)
+    if not transition:
+        raise HTTPException(status_code=400, detail=f"Cannot set status to '{status}'")
+    
+    try:
+        booking = await transition_booking(booking_id, transition, actor="admin")
+    except TransitionRejected as e:
+        raise transition_http_error(e)
+    
+    if transition == "pay":
+        await earnings_ledger.record_payment(booking)
+        # A payment confirmed by hand still needs a physio, as in verify_payment
+        asyncio.create_task(assign_physio(booking_id))
+    elif transition == "cancel":
+        await earnings_ledger.record_cancellation(booking)
+    if booking.get("assignment_status") == "offered":
+        offer_timers.cancel(booking_id)
+        await withdraw_offer(booking_id, booking.get("offered_physio_ids", []), status)
+    return {"success": True}
+
+@api_router.get("/booking/{booking_id}/history", dependencies=[Depends(require_admin)])
+async def get_booking_history(booking_id: str):
+    """Get the audit trail of state transitions for a booking"""
+    transitions = await db.booking_transitions.find({"booking_id": booking_id}, {"_id": 0}).sort("at", 1).to_list(200)
+    return {"transitions": transitions}
+
+@api_router.delete("/booking/{booking_id}")
+async def delete_booking(booking_id: str, session: Dict[str, Any] = Depends(current_session)):
+    """Discard an unpaid booking (abandoned checkout)"""
+    await session_booking(booking_id, session)
+    booking = await db.bookings.find_one_and_delete({"id": booking_id, "payment_status": "pending"})
+    if not booking:
+        raise HTTPException(status_code=400, detail="Booking not found or already paid")
+    
+    # Leave a tombstone so syncing clients drop their local copy
+    async with booking_stamp() as stamp:
+        await db.booking_tombstones.insert_one({
+            "booking_id": booking_id,
+            "user_id": booking.get("user_id"),
+            "deleted_at": stamp["updated_at"],
+            "sync_version": stamp["sync_version"]
+        })
+    admin_events.emit_local(events.booking_deleted(booking))
+    search_index.remove("bookings", booking_id)
     return {"success": True}
 
 # ==================== PAYMENT ENDPOINTS ====================
 
 @api_router.post("/payment/create-order")
-async def create_payment_order(order: PaymentOrderCreate):
+async def create_payment_order(order: PaymentOrderCreate, session: Dict[str, Any] = Depends(current_session)):
     """Create Razorpay order (MOCKED for demo)"""
+    booking = await session_booking(order.booking_id, session)
+    amount = booking["amount"]
+    if order.quote:
+        # A signed quote settles the amount without pricing again
+        quote = await verify_quote(order.quote)
+        if quote["quote_id"] != booking.get("quote_id"):
+            raise HTTPException(status_code=400, detail="Quote is for a different booking")
+        amount = quote["amount"]
+    if order.amount != amount:
+        raise HTTPException(status_code=400, detail="Amount does not match the booking")
+    
     # Generate mock order ID
     order_id = f"order_{uuid.uuid4().hex[:16]}"
     
@@ -554,7 +1265,7 @@ async def create_payment_order(order: PaymentOrderCreate):
     # import razorpay
     # client = razorpay.Client(auth=(os.getenv('RAZORPAY_KEY_ID'), os.getenv('RAZORPAY_KEY_SECRET')))
     # razor_order = client.order.create({
-    #     "amount": order.amount * 100,  # Amount in paise
+    #     "amount": amount * 100,  # Amount in paise
     #     "currency": "INR",
     #     "payment_capture": 1
     # })
@@ -562,26 +1273,23 @@ async def create_payment_order(order: PaymentOrderCreate):
     payment_order = PaymentOrder(
         booking_id=order.booking_id,
         order_id=order_id,
-        amount=order.amount
+        amount=amount
     )
     
-    await db.payments.insert_one(payment_order.dict())
+    await db.payments.add(payment_order.dict())
     
     # Update booking with payment order
-    await db.bookings.update_one(
-        {"id": order.booking_id},
-        {"$set": {"payment_id": payment_order.id}}
-    )
+    await update_booking({"id": order.booking_id}, {"payment_id": payment_order.id})
     
     return {
         "id": order_id,
-        "amount": order.amount * 100,  # Return in paise for Razorpay
+        "amount": amount * 100,  # Return in paise for Razorpay
         "currency": "INR",
         "key": os.getenv("RAZORPAY_KEY_ID", "rzp_test_demo_key")
     }
 
 @api_router.post("/payment/verify")
-async def verify_payment(payment: PaymentVerify):
+async def verify_payment(payment: PaymentVerify, session: Dict[str, Any] = Depends(current_session)):
     """Verify Razorpay payment (MOCKED for demo)"""
     # In production, verify signature:
     # import razorpay
@@ -592,21 +1300,25 @@ async def verify_payment(payment: PaymentVerify):
     #     'razorpay_signature': payment.signature
     # })
     
+    # Get payment to find booking
+    payment_doc = await db.payments.by_order(payment.order_id)
+    if not payment_doc:
+        raise HTTPException(status_code=404, detail="Payment order not found")
+    await session_booking(payment_doc["booking_id"], session)
+    
     # Update payment status
     await db.payments.update_one(
         {"order_id": payment.order_id},
         {"$set": {"status": "paid", "razorpay_payment_id": payment.payment_id}}
     )
     
-    # Get payment to find booking
-    payment_doc = await db.payments.find_one({"order_id": payment.order_id})
-    
-    if payment_doc:
-        # Update booking status
-        await db.bookings.update_one(
-            {"id": payment_doc["booking_id"]},
-            {"$set": {"status": "confirmed", "payment_status": "paid"}}
-        )
+    # Update booking status; a repeated callback finds it already confirmed
+    try:
+        booking = await transition_booking(payment_doc["booking_id"], "pay", actor="payment")
+    except TransitionRejected as e:
+        logger.info("Payment verify for booking %s ignored: %s", payment_doc["booking_id"], e)
+    else:
+        await earnings_ledger.record_payment(booking)
         
         # Trigger physio assignment
         asyncio.create_task(assign_physio(payment_doc["booking_id"]))
@@ -614,13 +1326,15 @@ async def verify_payment(payment: PaymentVerify):
     return {"success": True, "message": "Payment verified successfully"}
 
 @api_router.post("/payment/mock-success/{booking_id}")
-async def mock_payment_success(booking_id: str):
+async def mock_payment_success(booking_id: str, session: Dict[str, Any] = Depends(current_session)):
     """Mock payment success for demo"""
+    await session_booking(booking_id, session)
     # Update booking status
-    await db.bookings.update_one(
-        {"id": booking_id},
-        {"$set": {"status": "confirmed", "payment_status": "paid"}}
-    )
+    try:
+        booking = await transition_booking(booking_id, "pay", actor="payment")
+    except TransitionRejected as e:
+        raise transition_http_error(e)
+    await earnings_ledger.record_payment(booking)
     
     # Trigger physio assignment
     asyncio.create_task(assign_physio(booking_id))
@@ -629,9 +1343,10 @@ async def mock_payment_success(booking_id: str):
 
 # ==================== PHYSIO ASSIGNMENT ====================
 
+@tracer.traced()
 async def assign_physio(booking_id: str):
     """Assign physiotherapist to booking with 5-minute acceptance window"""
-    booking = await db.bookings.find_one({"id": booking_id})
+    booking = await db.bookings.get(booking_id)
     if not booking:
         return
     
@@ -642,58 +1357,298 @@ async def assign_physio(booking_id: str):
     if booking.get("physio_gender_preference"):
         query["personal_details.gender"] = booking["physio_gender_preference"]
     
-    physios = await db.practitioners.find(query).to_list(10)
+    # Skip physios who already turned this booking down
+    if booking.get("rejected_physio_ids"):
+        query["id"] = {"$nin": booking["rejected_physio_ids"]}
     
-    if not physios:
-        # No physios available - notify admin
-        logger.warning(f"No physios available for booking {booking_id}")
-        await db.bookings.update_one(
-            {"id": booking_id},
-            {"$set": {"assignment_status": "no_physio_available"}}
-        )
-        return
+    # Only physios in the booking's city; cities are stored as typed, so match them like city_key does
+    city = partitions.city_key(booking.get("city"))
+    if city:
+        query["personal_details.city"] = {"$regex": rf"^\s*{re.escape(city)}\s*$", "$options": "i"}
     
-    # For demo: auto-assign first available physio
-    assigned_physio = physios[0]
+    # Least-loaded physios first, straight from the counters on their profiles.
+    # With city partitioning only the booking's own partition is searched.
+    physios = await db.practitioners.for_city(booking.get("city")).find(query).sort(workload.CANDIDATE_SORT).to_list(50)
+    physios = workload.rank(physios)
     
-    await db.bookings.update_one(
-        {"id": booking_id},
-        {
-            "$set": {
-                "assigned_physio_id": assigned_physio["id"],
-                "assignment_status": "assigned"
-            }
-        }
-    )
+    try:
+        if not physios:
+            # No physios available - notify admin
+            logger.warning("No physios available for booking %s", booking_id, extra={"booking_id": booking_id})
+            await transition_booking(booking_id, "no_physio_available")
+            return
+        
+        if ASSIGNMENT_MODE == "broadcast":
+            policy = policy_for(OFFER_POLICIES, booking.get("service_type"))
+            candidates = pick_candidates(physios, manager.physio_connections, policy.k)
+            # Nobody online to offer it to: fall back to a direct assignment
+            if candidates:
+                await offer_booking(booking, candidates, policy)
+                return
+        
+        # Assign the least busy available physio
+        assigned_physio = physios[0]
+        
+        await transition_booking(booking_id, "assign", physio_id=assigned_physio["id"])
+    except TransitionRejected as e:
+        # Cancelled, or another assignment won the race
+        logger.info("Assignment for booking %s skipped: %s", booking_id, e)
+        return
+    
+    # Ask the physio to accept or reject
+    await manager.send_to_physio(assigned_physio["id"], {
+        "type": "booking_assigned",
+        "booking_id": booking_id,
+        "service_type": booking.get("service_type"),
+        "city": booking.get("city"),
+        "pincode": booking.get("pincode"),
+        "preferred_date": booking.get("preferred_date"),
+        "preferred_time": booking.get("preferred_time"),
+        "session_count": booking.get("session_count")
+    })
     
     # Notify user via WebSocket
-    if booking.get("user_id") and booking["user_id"] in manager.active_connections:
+    if booking.get("user_id"):
         await manager.send_to_user(booking["user_id"], {
             "type": "physio_assigned",
             "booking_id": booking_id,
             "physio_name": assigned_physio["personal_details"]["full_name"]
         })
     
-    logger.info(f"Physio {assigned_physio['id']} assigned to booking {booking_id}")
+    logger.info("Physio %s assigned to booking %s", assigned_physio["id"], booking_id,
+                extra={"physio_id": assigned_physio["id"], "booking_id": booking_id})
+
+@tracer.traced()
+async def offer_booking(booking: Dict[str, Any], physios: List[Dict[str, Any]], policy: OfferPolicy):
+    """Offer a booking to several physios at once; the round expires after the policy timeout"""
+    booking_id = booking["id"]
+    physio_ids = [p["id"] for p in physios]
+    offer_round = booking.get("offer_round", 0) + 1
+    expires_at = datetime.utcnow() + timedelta(seconds=policy.timeout_seconds)
+    
+    await transition_booking(booking_id, "offer", physio_ids=physio_ids, round=offer_round, expires_at=expires_at)
+    offer_timers.schedule(
+        booking_id, policy.timeout_seconds,
+        lambda: expire_offer(booking_id, offer_round, physio_ids)
+    )
+    
+    message = {
+        "type": "booking_offer",
+        "booking_id": booking_id,
+        "offer_round": offer_round,
+        "expires_at": expires_at.isoformat(),
+        "service_type": booking.get("service_type"),
+        "city": booking.get("city"),
+        "pincode": booking.get("pincode"),
+        "preferred_date": booking.get("preferred_date"),
+        "preferred_time": booking.get("preferred_time"),
+        "session_count": booking.get("session_count")
+    }
+    await asyncio.gather(*[manager.send_to_physio(pid, message) for pid in physio_ids], return_exceptions=True)
+    logger.info("Booking %s offered to %d physios (round %d)", booking_id, len(physio_ids), offer_round,
+                extra={"booking_id": booking_id, "physio_ids": physio_ids})
+
+@tracer.traced()
+async def answer_offer(booking_id: str, physio_id: str, accepted: bool):
+    """Handle a physio's answer to a broadcast offer"""
+    actor = f"physio:{physio_id}"
+    if accepted:
+        # Conditional on the offer still being open, so only the first accept matches
+        booking = await transition_booking(booking_id, "accept_offer", actor=actor, physio_id=physio_id)
+        offer_timers.cancel(booking_id)
+        
+        losers = [p for p in booking.get("offered_physio_ids", []) if p != physio_id]
+        await withdraw_offer(booking_id, losers, "accepted_by_another")
+        await manager.send_to_physio(physio_id, {"type": "offer_confirmed", "booking_id": booking_id})
+        if booking.get("user_id"):
+            await manager.send_to_user(booking["user_id"], {
+                "type": "physio_confirmed",
+                "booking_id": booking_id
+            })
+        logger.info("Physio %s won booking %s", physio_id, booking_id,
+                    extra={"physio_id": physio_id, "booking_id": booking_id})
+        return
+    
+    booking = await transition_booking(booking_id, "decline_offer", actor=actor, physio_id=physio_id)
+    # Last physio holding the offer declined: move on without waiting for the timeout
+    if booking.get("offered_physio_ids") == [physio_id]:
+        await expire_offer(booking_id, booking["offer_round"], [physio_id])
+
+@tracer.traced()
+async def expire_offer(booking_id: str, offer_round: int, physio_ids: List[str]):
+    """Close an offer round nobody accepted and look for the next candidates"""
+    try:
+        booking = await transition_booking(booking_id, "expire_offer", round=offer_round, physio_ids=physio_ids)
+    except TransitionRejected:
+        # Accepted, cancelled or already moved on
+        return
+    offer_timers.cancel(booking_id)
+    await withdraw_offer(booking_id, booking.get("offered_physio_ids", []), "expired")
+    await assign_physio(booking_id)
+
+async def withdraw_offer(booking_id: str, physio_ids: List[str], reason: str):
+    message = {"type": "offer_withdrawn", "booking_id": booking_id, "reason": reason}
+    await asyncio.gather(*[manager.send_to_physio(pid, message) for pid in physio_ids], return_exceptions=True)
+
+# Offer timers only live in the process that made the offer; the sweep closes
+# rounds whose timer was lost to a restart or crash. expire_offer is conditional
+# on the round, so racing a live timer (or another worker's sweep) is harmless.
+OFFER_SWEEP_SECONDS = float(os.environ.get('OFFER_SWEEP_SECONDS', '30'))
+
+async def sweep_expired_offers() -> int:
+    """Expire every offer round past its deadline; returns how many were found"""
+    overdue = await db.bookings.find(
+        {"assignment_status": "offered", "offer_expires_at": {"$lt": datetime.utcnow()}},
+        {"_id": 0, "id": 1, "offer_round": 1, "offered_physio_ids": 1}
+    ).to_list(None)
+    for booking in overdue:
+        try:
+            await expire_offer(booking["id"], booking["offer_round"], booking.get("offered_physio_ids", []))
+        except Exception:
+            logger.exception("Expiring overdue offer for booking %s failed", booking["id"])
+    return len(overdue)
+
+async def watch_expired_offers():
+    while True:
+        try:
+            overdue = await sweep_expired_offers()
+            if overdue:
+                logger.info("Expired %d overdue offer rounds", overdue)
+        except Exception as e:
+            logger.warning("Offer expiry sweep failed: %s", e)
+        await asyncio.sleep(OFFER_SWEEP_SECONDS)
+
+# ==================== SESSION REMINDERS ====================
+
+async def send_sms(phone: str, text: str):
+    """Send an SMS (MOCKED for demo)"""
+    # In production, send via Twilio:
+    # client.messages.create(to=phone, from_=os.getenv("TWILIO_FROM_NUMBER"), body=text)
+    logger.info("MOCKED SMS to %s: %s", phone, text, extra={"phone": phone})
+
+def reminder_text(reminder: Dict[str, Any], booking: Dict[str, Any]) -> str:
+    when = f"{booking['preferred_date']} at {booking['preferred_time']}"
+    if reminder["recipient"] == "physio":
+        return f"VOCT reminder: session with {booking['customer_name']} on {when}, {booking['address']}, {booking['city']}."
+    return f"VOCT reminder: your physiotherapy session is on {when}."
+
+async def deliver_reminders(batch: List[Dict[str, Any]]):
+    """Push reminders to connected clients; SMS the rest (it is in their outbox for later too)"""
+    booking_ids = list({r["booking_id"] for r in batch})
+    bookings = {b["id"]: b for b in await db.bookings.find({"id": {"$in": booking_ids}}, BOOKING_LIST_FIELDS).to_list(None)}
+    physio_ids = list({r["recipient_id"] for r in batch if r["recipient"] == "physio"})
+    phones = {}
+    if physio_ids:
+        physios = await db.practitioners.find(
+            {"id": {"$in": physio_ids}}, {"_id": 0, "id": 1, "personal_details.contact_number": 1}
+        ).to_list(None)
+        phones = {p["id"]: p["personal_details"]["contact_number"] for p in physios}
+    
+    for reminder in batch:
+        booking = bookings.get(reminder["booking_id"])
+        if not booking:
+            continue
+        message = {
+            "type": "session_reminder",
+            "booking_id": booking["id"],
+            "minutes_before": reminder["minutes_before"],
+            "service_type": booking.get("service_type"),
+            "preferred_date": booking.get("preferred_date"),
+            "preferred_time": booking.get("preferred_time"),
+        }
+        recipient_id = reminder["recipient_id"]
+        if reminder["recipient"] == "physio":
+            pushed = await manager.send_to_physio(recipient_id, {
+                **message, "customer_name": booking.get("customer_name"), "address": booking.get("address")
+            })
+        else:
+            pushed = await manager.send_to_user(recipient_id, message)
+        if pushed:
+            continue
+        phone = phones.get(recipient_id) if reminder["recipient"] == "physio" else booking.get("customer_phone")
+        if phone:
+            await send_sms(phone, reminder_text(reminder, booking))
+
+# REMINDER_OFFSETS_MINUTES before the session, in the clinic's local time
+reminder_scheduler = ReminderScheduler(
+    db.reminders,
+    deliver_reminders,
+    offsets_minutes=[int(m) for m in os.environ.get('REMINDER_OFFSETS_MINUTES', '1440,60').split(',')],
+    tz=ZoneInfo(os.environ.get('REMINDER_TIMEZONE', 'Asia/Kolkata'))
+)
+
+@api_router.get("/internal/admin/reminders", dependencies=[Depends(require_admin)])
+async def get_reminder_stats():
+    """Queued, sent and failed reminder counts for this worker"""
+    return reminder_scheduler.stats()
 
 # ==================== PRACTITIONER ENDPOINTS ====================
 
-@api_router.post("/practitioner/apply")
+@api_router.post("/practitioner/apply", dependencies=[Depends(rate_limiter.dependency("practitioner_apply"))])
 async def apply_as_practitioner(practitioner: PractitionerCreate):
     """Submit practitioner application"""
-    # Check if already applied
-    existing = await db.practitioners.find_one({
-        "personal_details.email": practitioner.personal_details.email
-    })
-    if existing:
+    new_practitioner = Practitioner(**practitioner_import.normalise_keys(practitioner).dict())
+    # Unique indexes on email and registration number catch repeat and concurrent submissions
+    if await unique_value_taken("practitioners", "personal_details.email", new_practitioner.personal_details.email):
         raise HTTPException(status_code=400, detail="Application already submitted with this email")
+    if await unique_value_taken("practitioners", "education.registration_no", new_practitioner.education.registration_no):
+        raise HTTPException(status_code=400, detail="Application already submitted with this registration number")
+    try:
+        await db.practitioners.add(new_practitioner.dict())
+    except DuplicateKeyError as e:
+        if duplicate_key(e) == "education.registration_no":
+            raise HTTPException(status_code=400, detail="Application already submitted with this registration number")
+        raise HTTPException(status_code=400, detail="Application already submitted with this email")
+    admin_events.emit_local(events.practitioner_created(new_practitioner.dict()))
+    search_index.add("practitioners", new_practitioner.dict())
     
-    new_practitioner = Practitioner(**practitioner.dict())
-    await db.practitioners.insert_one(new_practitioner.dict())
-    
-    return {"success": True, "id": new_practitioner.id, "message": "Application submitted successfully"}
+    return {
+        "success": True,
+        "id": new_practitioner.id,
+        "message": "Application submitted successfully",
+        **issue_session(new_practitioner.id, "applicant")
+    }
+
+def practitioner_imported(doc: Dict[str, Any]):
+    admin_events.emit_local(events.practitioner_created(doc))
+    search_index.add("practitioners", doc)
 
-@api_router.post("/practitioner/{practitioner_id}/upload-certificate")
+# Uploads larger than this are always imported as a background job
+IMPORT_INLINE_MAX_BYTES = 512 * 1024
+
+@api_router.post("/internal/admin/practitioners/import", dependencies=[Depends(require_admin)])
+async def import_practitioners(file: UploadFile = File(...), background: bool = False):
+    """Bulk-import practitioner applications from a CSV or JSON Lines file"""
+    fmt = practitioner_import.detect_format(file.filename or "")
+    if not fmt:
+        raise HTTPException(status_code=400, detail="Only .csv and .jsonl files are supported")
+    
+    if not background and (file.size or 0) <= IMPORT_INLINE_MAX_BYTES:
+        return await practitioner_import.import_practitioners(
+            file, fmt, db.practitioners, PractitionerCreate, Practitioner, practitioner_imported
+        )
+    
+    # The upload is gone once this request ends, so spool it to disk for the job
+    spool = tempfile.NamedTemporaryFile(prefix="practitioner_import_", delete=False)
+    async with aiofiles.open(spool.name, 'wb') as f:
+        while chunk := await file.read(1024 * 1024):
+            await f.write(chunk)
+    spool.close()
+    
+    async def run(job_id, progress):
+        try:
+            async with aiofiles.open(spool.name, 'rb') as upload:
+                return await practitioner_import.import_practitioners(
+                    upload, fmt, db.practitioners, PractitionerCreate, Practitioner,
+                    practitioner_imported, progress
+                )
+        finally:
+            os.unlink(spool.name)
+    
+    job = await job_runner.submit("practitioner_import", {"filename": file.filename, "format": fmt}, run)
+    return {"success": True, "job_id": job["id"], "status": job["status"]}
+
+@api_router.post("/practitioner/{practitioner_id}/upload-certificate", dependencies=[Depends(require_applicant)])
 async def upload_certificate(
     practitioner_id: str,
     file: UploadFile = File(...),
@@ -732,63 +1687,102 @@ async def upload_certificate(
     
     return {"success": True, "filename": filename}
 
-@api_router.get("/practitioner/{practitioner_id}")
+@api_router.get("/practitioner/{practitioner_id}", dependencies=[Depends(require_practitioner)])
 async def get_practitioner(practitioner_id: str):
     """Get practitioner details"""
-    practitioner = await db.practitioners.find_one({"id": practitioner_id})
+    practitioner = await db.practitioners.get(practitioner_id)
     if not practitioner:
         raise HTTPException(status_code=404, detail="Practitioner not found")
     return practitioner
 
 # ==================== WEBSOCKET ENDPOINTS ====================
 
-@app.websocket("/ws/user/{user_id}")
-async def websocket_user(websocket: WebSocket, user_id: str):
-    """WebSocket connection for user notifications"""
-    await manager.connect_user(user_id, websocket)
+@ws_router.websocket("/ws/user/{user_id}")
+async def websocket_user(websocket: WebSocket, user_id: str, last_seq: Optional[int] = None,
+                         token: Optional[str] = None):
+    """WebSocket connection for user notifications; pass the last `seq` processed to receive what was missed"""
+    if not await websocket_session(token, "patient", user_id):
+        await websocket.close(code=1008)
+        return
+    wire = WireSocket(websocket)
+    await manager.connect_user(user_id, wire, last_seq)
     try:
         while True:
-            data = await websocket.receive_text()
+            data = await wire.receive_messages()
             # Handle incoming messages if needed
     except WebSocketDisconnect:
-        manager.disconnect_user(user_id)
+        manager.disconnect_user(user_id, wire)
+
+@tracer.traced()
+async def handle_booking_response(physio_id: str, data: Dict[str, Any]):
+    """Apply a physio's accept/reject of an assigned booking or a broadcast offer"""
+    booking_id = data.get("booking_id")
+    accepted = data.get("accepted", False)
+    
+    try:
+        if "offer_round" in data:
+            await answer_offer(booking_id, physio_id, accepted)
+        elif accepted:
+            booking = await transition_booking(booking_id, "accept", actor=f"physio:{physio_id}", physio_id=physio_id)
+            # Notify user
+            if booking.get("user_id"):
+                await manager.send_to_user(booking["user_id"], {
+                    "type": "physio_confirmed",
+                    "booking_id": booking_id
+                })
+        else:
+            await transition_booking(booking_id, "reject", actor=f"physio:{physio_id}", physio_id=physio_id)
+            # Rejected - try next physio
+            asyncio.create_task(assign_physio(booking_id))
+    except TransitionRejected as e:
+        # The offer is no longer this physio's to answer
+        await manager.send_to_physio(physio_id, {
+            "type": "offer_withdrawn" if "offer_round" in data else "booking_response_rejected",
+            "booking_id": booking_id,
+            "reason": str(e)
+        })
 
-@app.websocket("/ws/physio/{physio_id}")
-async def websocket_physio(websocket: WebSocket, physio_id: str):
-    """WebSocket connection for physio notifications"""
-    await manager.connect_physio(physio_id, websocket)
+@ws_router.websocket("/ws/physio/{physio_id}")
+async def websocket_physio(websocket: WebSocket, physio_id: str, last_seq: Optional[int] = None,
+                           token: Optional[str] = None):
+    """WebSocket connection for physio notifications; pass the last `seq` processed to receive what was missed"""
+    if not await websocket_session(token, "practitioner", physio_id):
+        await websocket.close(code=1008)
+        return
+    wire = WireSocket(websocket)
+    await manager.connect_physio(physio_id, wire, last_seq)
     try:
         while True:
-            data = await websocket.receive_json()
-            
-            # Handle booking acceptance/rejection
-            if data.get("type") == "booking_response":
-                booking_id = data.get("booking_id")
-                accepted = data.get("accepted", False)
-                
-                if accepted:
-                    await db.bookings.update_one(
-                        {"id": booking_id},
-                        {
-                            "$set": {
-                                "assigned_physio_id": physio_id,
-                                "assignment_status": "accepted"
-                            }
-                        }
-                    )
-                    # Notify user
-                    booking = await db.bookings.find_one({"id": booking_id})
-                    if booking and booking.get("user_id"):
-                        await manager.send_to_user(booking["user_id"], {
-                            "type": "physio_confirmed",
-                            "booking_id": booking_id
-                        })
-                else:
-                    # Rejected - try next physio
-                    asyncio.create_task(assign_physio(booking_id))
+            for data in await wire.receive_messages():
+                # Handle booking acceptance/rejection
+                if data.get("type") == "booking_response":
+                    await handle_booking_response(physio_id, data)
                     
     except WebSocketDisconnect:
-        manager.disconnect_physio(physio_id)
+        manager.disconnect_physio(physio_id, wire)
+
+@ws_router.websocket("/ws/admin")
+async def websocket_admin(websocket: WebSocket, token: Optional[str] = None):
+    """WebSocket pushing incremental admin dashboard updates"""
+    if not await websocket_session(token, "admin"):
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    subscription = admin_events.subscribe()
+    
+    async def forward():
+        while True:
+            await websocket.send_json(jsonable_encoder(await subscription.get()))
+    
+    sender = asyncio.create_task(forward())
+    try:
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sender.cancel()
+        subscription.close()
 
 # ==================== CONTACT/SUPPORT ENDPOINTS ====================
 
@@ -798,7 +1792,7 @@ class ContactMessage(BaseModel):
     phone: Optional[str] = None
     message: str
 
-@api_router.post("/contact")
+@api_router.post("/contact", dependencies=[Depends(rate_limiter.dependency("contact"))])
 async def submit_contact(message: ContactMessage):
     """Submit contact/support message"""
     msg_doc = {
@@ -807,7 +1801,7 @@ async def submit_contact(message: ContactMessage):
         "created_at": datetime.utcnow(),
         "status": "new"
     }
-    await db.contact_messages.insert_one(msg_doc)
+    write_buffer.add("contact_messages", msg_doc)
     return {"success": True, "message": "Message received. We'll get back to you soon!"}
 
 # ==================== INTERNAL DASHBOARD MODELS ====================
@@ -833,10 +1827,7 @@ async def internal_login(credentials: InternalLogin):
     """Login for practitioners and company members"""
     if credentials.role == 'practitioner':
         # Check practitioner by email
-        practitioner = await db.practitioners.find_one({
-            "personal_details.email": credentials.email,
-            "is_verified": True
-        })
+        practitioner = await db.practitioners.by_email(credentials.email, verified_only=True)
         if not practitioner:
             raise HTTPException(status_code=401, detail="Invalid credentials or not verified")
         
@@ -850,7 +1841,7 @@ async def internal_login(credentials: InternalLogin):
             "user_type": "practitioner",
             "user_id": practitioner["id"],
             "name": practitioner["personal_details"]["full_name"],
-            "token": f"prac_{practitioner['id']}_{uuid.uuid4().hex[:8]}"
+            **issue_session(practitioner["id"], "practitioner")
         }
     
     elif credentials.role == 'admin':
@@ -883,17 +1874,42 @@ async def internal_login(credentials: InternalLogin):
             "user_id": admin["id"],
             "name": admin["name"],
             "role": admin["role"],
-            "token": f"admin_{admin['id']}_{uuid.uuid4().hex[:8]}"
+            **issue_session(admin["id"], "admin", admin_role=admin["role"])
         }
     
     raise HTTPException(status_code=400, detail="Invalid role")
 
+@api_router.get("/internal/admin/auth/keys", dependencies=[Depends(require_admin)])
+async def get_signing_keys():
+    """Signing keys (without secrets) and this worker's verification cache"""
+    return {"keys": await signing_keys.describe(), "verification": session_tokens.stats()}
+
+@api_router.post("/internal/admin/auth/keys/rotate", dependencies=[Depends(require_admin)])
+async def rotate_signing_key():
+    """Sign new tokens with a fresh key; tokens signed with older keys stay valid until they expire"""
+    try:
+        kid = await signing_keys.rotate()
+    except KeyRingError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"success": True, "active": kid}
+
+@api_router.post("/internal/admin/auth/keys/{kid}/retire", dependencies=[Depends(require_admin)])
+async def retire_signing_key(kid: str):
+    """Revoke every token signed with `kid`"""
+    try:
+        retired = await signing_keys.retire(kid)
+    except KeyRingError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if not retired:
+        raise HTTPException(status_code=404, detail="Key not found")
+    return {"success": True}
+
 # ==================== PRACTITIONER DASHBOARD ENDPOINTS ====================
 
-@api_router.get("/internal/practitioner/{practitioner_id}/dashboard")
+@api_router.get("/internal/practitioner/{practitioner_id}/dashboard", dependencies=[Depends(require_practitioner)])
 async def get_practitioner_dashboard(practitioner_id: str):
     """Get practitioner dashboard data"""
-    practitioner = await db.practitioners.find_one({"id": practitioner_id})
+    practitioner = await db.practitioners.get(practitioner_id)
     if not practitioner:
         raise HTTPException(status_code=404, detail="Practitioner not found")
     
@@ -905,13 +1921,13 @@ async def get_practitioner_dashboard(practitioner_id: str):
         "assigned_physio_id": practitioner_id,
         "preferred_date": today.strftime("%Y-%m-%d"),
         "status": "confirmed"
-    }).to_list(20)
+    }, BOOKING_LIST_FIELDS).to_list(20)
     
     # Get upcoming bookings (7 days)
     upcoming_bookings = await db.bookings.find({
         "assigned_physio_id": practitioner_id,
         "status": "confirmed"
-    }).sort("preferred_date", 1).to_list(50)
+    }, BOOKING_LIST_FIELDS).sort("preferred_date", 1).to_list(50)
     
     # Get stats
     total_sessions = await db.bookings.count_documents({
@@ -924,74 +1940,129 @@ async def get_practitioner_dashboard(practitioner_id: str):
         "status": "completed"
     })
     
-    # Calculate earnings (demo)
-    earnings_pipeline = [
-        {"$match": {"assigned_physio_id": practitioner_id, "payment_status": "paid"}},
-        {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
-    ]
-    earnings_result = await db.bookings.aggregate(earnings_pipeline).to_list(1)
-    total_earnings = earnings_result[0]["total"] if earnings_result else 0
-    
-    # Practitioner gets 70% of booking amount
-    practitioner_earnings = int(total_earnings * 0.7)
+    # Earnings are a running balance kept by the ledger
+    balance = await earnings_ledger.balance(ledger.practitioner_account(practitioner_id))
     
     return {
         "practitioner": {
             "id": practitioner["id"],
             "name": practitioner["personal_details"]["full_name"],
             "specialization": practitioner["education"].get("mpth_specialization", "General"),
-            "is_available": practitioner.get("is_available", True)
+            "is_available": practitioner.get("is_available", True),
+            "workload": workload.summary(practitioner)
         },
-        "todays_schedule": todays_bookings,
-        "upcoming_bookings": upcoming_bookings[:10],
+        "todays_schedule": upgrade_bookings(todays_bookings),
+        "upcoming_bookings": upgrade_bookings(upcoming_bookings[:10]),
         "stats": {
             "total_sessions": total_sessions,
             "completed_sessions": completed_sessions,
             "active_clients": len(set(b.get("user_id") for b in upcoming_bookings if b.get("user_id"))),
-            "total_earnings": practitioner_earnings,
-            "pending_payout": int(practitioner_earnings * 0.2)  # Demo: 20% pending
+            "total_earnings": balance.get("earned", 0),
+            "pending_payout": balance.get("pending", 0),
+            "paid_out": balance.get("paid_out", 0)
         }
     }
 
-@api_router.get("/internal/practitioner/{practitioner_id}/bookings")
+@api_router.get("/internal/practitioner/{practitioner_id}/bookings", dependencies=[Depends(require_practitioner)])
 async def get_practitioner_bookings(practitioner_id: str, status: Optional[str] = None):
     """Get practitioner's bookings"""
     query = {"assigned_physio_id": practitioner_id}
     if status:
         query["status"] = status
     
-    bookings = await db.bookings.find(query).sort("preferred_date", -1).to_list(100)
-    return {"bookings": bookings}
+    bookings = await db.bookings.find(query, BOOKING_LIST_FIELDS).sort("preferred_date", -1).to_list(100)
+    return {"bookings": upgrade_bookings(bookings)}
 
-@api_router.post("/internal/practitioner/{practitioner_id}/session/{booking_id}/complete")
+@api_router.post("/internal/practitioner/{practitioner_id}/session/{booking_id}/complete", dependencies=[Depends(require_practitioner)])
 async def complete_session(practitioner_id: str, booking_id: str, notes: Optional[str] = None):
     """Mark session as completed"""
-    booking = await db.bookings.find_one({"id": booking_id, "assigned_physio_id": practitioner_id})
-    if not booking:
-        raise HTTPException(status_code=404, detail="Booking not found")
-    
     update_data = {
-        "status": "completed",
         "completed_at": datetime.utcnow()
     }
-    if notes:
-        update_data["session_notes"] = notes
     
-    await db.bookings.update_one({"id": booking_id}, {"$set": update_data})
+    try:
+        booking = await transition_booking(
+            booking_id, "complete", actor=f"physio:{practitioner_id}", changes=update_data, physio_id=practitioner_id
+        )
+    except TransitionRejected as e:
+        if e.not_found or e.current.get("assigned_physio_id") != practitioner_id:
+            raise HTTPException(status_code=404, detail="Booking not found")
+        raise transition_http_error(e)
+    
+    await earnings_ledger.record_completion(booking)
+    if notes:
+        await save_session_notes(booking_id, practitioner_id, notes)
     return {"success": True, "message": "Session marked as completed"}
 
-@api_router.put("/internal/practitioner/{practitioner_id}/availability")
+class SessionNotesUpdate(BaseModel):
+    notes: str
+
+async def practitioner_booking(practitioner_id: str, booking_id: str, projection: Dict[str, Any]) -> Dict[str, Any]:
+    booking = await db.bookings.find_one({"id": booking_id, "assigned_physio_id": practitioner_id}, projection)
+    if not booking:
+        raise HTTPException(status_code=404, detail="Booking not found")
+    return booking
+
+async def save_session_notes(booking_id: str, practitioner_id: str, notes: str) -> Dict[str, Any]:
+    saved = await session_notes.save(booking_id, notes.encode("utf-8"), author=f"physio:{practitioner_id}")
+    await update_booking({"id": booking_id}, {"notes_version": saved["version"]})
+    return saved
+
+@api_router.put("/internal/practitioner/{practitioner_id}/session/{booking_id}/notes", dependencies=[Depends(require_practitioner)])
+async def update_session_notes(practitioner_id: str, booking_id: str, update: SessionNotesUpdate):
+    """Save a new version of the session's notes"""
+    await practitioner_booking(practitioner_id, booking_id, {"_id": 0, "id": 1})
+    saved = await save_session_notes(booking_id, practitioner_id, update.notes)
+    return {"success": True, "version": saved["version"]}
+
+@api_router.get("/internal/practitioner/{practitioner_id}/session/{booking_id}/notes", dependencies=[Depends(require_practitioner)])
+async def get_session_notes(practitioner_id: str, booking_id: str, version: Optional[int] = None):
+    """Session notes for the detail view: the latest version unless `version` is given"""
+    booking = await practitioner_booking(practitioner_id, booking_id, {"_id": 0, "id": 1, "session_notes": 1})
+    note = await session_notes.load(booking_id, version)
+    if note:
+        return {
+            "booking_id": booking_id,
+            "version": note["version"],
+            "author": note["author"],
+            "created_at": note["created_at"],
+            "notes": note["content"].decode("utf-8"),
+        }
+    # Notes written inline before the notes store existed (until migration 0002 has run)
+    if booking.get("session_notes") and not version:
+        return {"booking_id": booking_id, "version": 0, "author": None, "created_at": None,
+                "notes": booking["session_notes"]}
+    raise HTTPException(status_code=404, detail="No notes for this session")
+
+@api_router.get("/internal/practitioner/{practitioner_id}/session/{booking_id}/notes/history", dependencies=[Depends(require_practitioner)])
+async def get_session_notes_history(practitioner_id: str, booking_id: str):
+    """Versions of the session's notes and attachments, without their content"""
+    await practitioner_booking(practitioner_id, booking_id, {"_id": 0, "id": 1})
+    return {"versions": await session_notes.history(booking_id)}
+
+@api_router.get("/internal/practitioner/{practitioner_id}/ledger", dependencies=[Depends(require_practitioner)])
+async def get_practitioner_ledger(practitioner_id: str, limit: int = 50, before: Optional[datetime] = None):
+    """Get practitioner earnings balance and ledger entries, newest first"""
+    account = ledger.practitioner_account(practitioner_id)
+    return {
+        "balance": await earnings_ledger.balance(account),
+        "entries": await earnings_ledger.history(account, min(limit, 200), before)
+    }
+
+@api_router.put("/internal/practitioner/{practitioner_id}/availability", dependencies=[Depends(require_practitioner)])
 async def update_practitioner_availability(practitioner_id: str, is_available: bool):
     """Update practitioner availability"""
-    await db.practitioners.update_one(
+    before = await db.practitioners.find_one_and_update(
         {"id": practitioner_id},
         {"$set": {"is_available": is_available}}
     )
+    if before:
+        admin_events.emit_local(events.practitioner_updated(before, {"is_available": is_available}))
     return {"success": True, "is_available": is_available}
 
 # ==================== ADMIN DASHBOARD ENDPOINTS ====================
 
-@api_router.get("/internal/admin/dashboard")
+@api_router.get("/internal/admin/dashboard", dependencies=[Depends(require_admin)])
 async def get_admin_dashboard():
     """Get admin dashboard overview"""
     # Total bookings
@@ -999,13 +2070,9 @@ async def get_admin_dashboard():
     confirmed_bookings = await db.bookings.count_documents({"status": "confirmed"})
     completed_bookings = await db.bookings.count_documents({"status": "completed"})
     
-    # Revenue
-    revenue_pipeline = [
-        {"$match": {"payment_status": "paid"}},
-        {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
-    ]
-    revenue_result = await db.bookings.aggregate(revenue_pipeline).to_list(1)
-    total_revenue = revenue_result[0]["total"] if revenue_result else 0
+    # Revenue and commission are running totals kept by the ledger
+    platform = await earnings_ledger.balance(ledger.PLATFORM_ACCOUNT)
+    total_revenue = platform.get("revenue", 0)
     
     # Practitioners
     total_practitioners = await db.practitioners.count_documents({})
@@ -1016,7 +2083,7 @@ async def get_admin_dashboard():
     total_users = await db.users.count_documents({})
     
     # Recent bookings
-    recent_bookings = await db.bookings.find({}).sort("created_at", -1).to_list(10)
+    recent_bookings = await db.bookings.find({}, BOOKING_LIST_FIELDS).sort("created_at", -1).to_list(10)
     
     # Cancellation rate
     cancelled_bookings = await db.bookings.count_documents({"status": "cancelled"})
@@ -1028,14 +2095,15 @@ async def get_admin_dashboard():
             "confirmed_bookings": confirmed_bookings,
             "completed_bookings": completed_bookings,
             "total_revenue": total_revenue,
-            "platform_commission": int(total_revenue * 0.3),  # 30% commission
+            "platform_commission": platform.get("commission", 0),
             "total_practitioners": total_practitioners,
             "verified_practitioners": verified_practitioners,
             "pending_practitioners": pending_practitioners,
             "total_clients": total_users,
+            "cancelled_bookings": cancelled_bookings,
             "cancellation_rate": round(cancellation_rate, 2)
         },
-        "recent_bookings": recent_bookings,
+        "recent_bookings": upgrade_bookings(recent_bookings),
         "growth_indicators": {
             "bookings_this_month": await db.bookings.count_documents({
                 "created_at": {"$gte": datetime.utcnow().replace(day=1, hour=0, minute=0, second=0)}
@@ -1046,17 +2114,17 @@ async def get_admin_dashboard():
         }
     }
 
-@api_router.get("/internal/admin/practitioners")
+@api_router.get("/internal/admin/practitioners", dependencies=[Depends(require_admin)])
 async def get_all_practitioners(status: Optional[str] = None):
     """Get all practitioners for admin"""
     query = {}
     if status:
         query["status"] = status
     
-    practitioners = await db.practitioners.find(query).sort("created_at", -1).to_list(100)
+    practitioners = await db.practitioners.find(query, NO_ID).sort("created_at", -1).to_list(100)
     return {"practitioners": practitioners}
 
-@api_router.put("/internal/admin/practitioner/{practitioner_id}/verify")
+@api_router.put("/internal/admin/practitioner/{practitioner_id}/verify", dependencies=[Depends(require_admin)])
 async def verify_practitioner(practitioner_id: str, approve: bool):
     """Approve or reject practitioner"""
     update_data = {
@@ -1065,20 +2133,198 @@ async def verify_practitioner(practitioner_id: str, approve: bool):
         "verified_at": datetime.utcnow()
     }
     
-    await db.practitioners.update_one({"id": practitioner_id}, {"$set": update_data})
+    before = await db.practitioners.find_one_and_update({"id": practitioner_id}, {"$set": update_data})
+    if before:
+        admin_events.emit_local(events.practitioner_updated(before, update_data))
+        search_index.update_summary("practitioners", practitioner_id, update_data)
     return {"success": True, "status": "approved" if approve else "rejected"}
 
-@api_router.get("/internal/admin/bookings")
+@api_router.get("/internal/admin/bookings", dependencies=[Depends(require_admin)])
 async def get_all_bookings(status: Optional[str] = None, limit: int = 50):
     """Get all bookings for admin"""
     query = {}
     if status:
         query["status"] = status
     
-    bookings = await db.bookings.find(query).sort("created_at", -1).to_list(limit)
-    return {"bookings": bookings}
+    bookings = await db.bookings.find(query, BOOKING_LIST_FIELDS).sort("created_at", -1).to_list(limit)
+    return {"bookings": upgrade_bookings(bookings)}
+
+@api_router.get("/internal/admin/search", dependencies=[Depends(require_admin)])
+async def admin_search(q: str, types: Optional[str] = None, limit: int = 20):
+    """Typeahead search across users, bookings and practitioners"""
+    kinds = [t for t in types.split(",") if t in SEARCH_FIELDS] if types else None
+    return {"results": search_index.search(q, kinds, min(limit, 100))}
+
+# ==================== ADMIN PAYOUTS ====================
+
+@api_router.post("/internal/admin/payouts/run", dependencies=[Depends(require_admin)])
+async def run_payouts(request: PayoutRunRequest):
+    """Settle pending practitioner balances in one batch"""
+    try:
+        return await earnings_ledger.run_payouts(request.min_amount, request.practitioner_ids, request.dry_run)
+    except LedgerError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@api_router.post("/internal/admin/ledger/reconcile", dependencies=[Depends(require_admin)])
+async def reconcile_ledger():
+    """Backfill entries for bookings that predate the ledger and recompute balances"""
+    backfilled = await earnings_ledger.backfill(db.bookings)
+    accounts = await earnings_ledger.rebuild_balances()
+    return {"success": True, "backfilled": backfilled, "accounts": accounts}
+
+@api_router.post("/internal/admin/workload/rebuild", dependencies=[Depends(require_admin)])
+async def rebuild_workload():
+    """Recompute every practitioner's workload counters from their bookings"""
+    practitioners = await workload.rebuild(db.bookings, db.practitioners)
+    return {"success": True, "practitioners": practitioners}
+
+@api_router.get("/internal/admin/write-buffer", dependencies=[Depends(require_admin)])
+async def get_write_buffer_stats():
+    """Depth and flush counters of the write-behind buffer"""
+    return write_buffer.stats()
+
+# ==================== ADMIN MIGRATIONS ====================
+
+class MigrationRunRequest(BaseModel):
+    dry_run: bool = False
+    batch_size: int = 500
+    max_per_second: Optional[float] = 200  # document writes; None for unthrottled
+
+@api_router.get("/internal/admin/migrations", dependencies=[Depends(require_admin)])
+async def list_migrations():
+    """Registered migrations with their progress"""
+    return {"migrations": await migration_runner.status()}
+
+@api_router.post("/internal/admin/migrations/{migration_id}/run", dependencies=[Depends(require_admin)])
+async def run_migration(migration_id: str, request: MigrationRunRequest):
+    """Run, resume or dry-run a migration in the background; poll the job for progress"""
+    try:
+        migration_runner.get(migration_id)
+    except MigrationError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    if not 1 <= request.batch_size <= 5000:
+        raise HTTPException(status_code=400, detail="batch_size must be between 1 and 5000")
+    
+    async def run(job_id, progress):
+        return await migration_runner.run(
+            migration_id, request.dry_run, request.batch_size, request.max_per_second, progress
+        )
+    
+    job = await job_runner.submit("migration", {"migration": migration_id, **request.dict()}, run)
+    return {"success": True, "job_id": job["id"], "status": job["status"]}
 
-@api_router.get("/internal/admin/analytics")
+# ==================== ADMIN PARTITIONS ====================
+
+class PartitionMoveRequest(BaseModel):
+    city: str
+    partition: str
+    batch_size: int = 500
+
+def require_partitioning() -> PartitionMap:
+    if partition_map is None:
+        raise HTTPException(status_code=400, detail="City partitioning is not enabled (set CITY_PARTITIONS)")
+    return partition_map
+
+@api_router.get("/internal/admin/partitions", dependencies=[Depends(require_admin)])
+async def get_partitions():
+    """The city → partition map and how many documents each partition holds"""
+    current = require_partitioning()
+    await current.refresh()
+    pairs = [(name, p) for name in partitions.PARTITION_KEYS for p in current.partitions()]
+    counts = await asyncio.gather(*(db.collection(name).partition(p).count_documents({}) for name, p in pairs))
+    sizes: Dict[str, Dict[str, int]] = {p: {} for p in current.partitions()}
+    for (name, p), count in zip(pairs, counts):
+        sizes[p][name] = count
+    return {**current.describe(), "sizes": sizes}
+
+@api_router.post("/internal/admin/partitions/move", dependencies=[Depends(require_admin)])
+async def move_partition_city(request: PartitionMoveRequest):
+    """Move a city's bookings and practitioners to another partition in the background"""
+    current = require_partitioning()
+    if not re.fullmatch(r"[a-z0-9]+(-[a-z0-9]+)*", request.partition):
+        raise HTTPException(status_code=400, detail="Partition names are lowercase letters, digits and hyphens")
+    if not 1 <= request.batch_size <= 5000:
+        raise HTTPException(status_code=400, detail="batch_size must be between 1 and 5000")
+    
+    async def run(job_id, progress):
+        return await partitions.move_city(
+            [db.collection(name) for name in partitions.PARTITION_KEYS], current,
+            request.city, request.partition, batch_size=request.batch_size, progress=progress
+        )
+    
+    job = await job_runner.submit("partition_move", request.dict(), run)
+    return {"success": True, "job_id": job["id"], "status": job["status"]}
+
+# ==================== ADMIN EXPORTS ====================
+
+EXPORT_MEDIA_TYPES = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+
+@api_router.get("/internal/admin/export/{dataset}", dependencies=[Depends(require_admin)])
+async def export_dataset(
+    dataset: str,
+    format: str = "csv",
+    status: Optional[str] = None,
+    city: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None
+):
+    """Stream bookings, payments or payouts as CSV or Parquet"""
+    filters = {"status": status, "city": city, "date_from": date_from, "date_to": date_to}
+    try:
+        body = exports.stream_export(db, dataset, format, filters)
+    except ExportError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    filename = f"{dataset}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.{format}"
+    return StreamingResponse(
+        body,
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@api_router.post("/internal/admin/exports", dependencies=[Depends(require_admin)])
+async def create_export_job(request: ExportRequest):
+    """Run a large export in the background; poll the job and download the file when done"""
+    filters = request.dict(exclude={"dataset", "format"})
+    try:
+        exports.encode_export(db, request.dataset, request.format, filters)
+    except ExportError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    async def run(job_id, progress):
+        path = EXPORT_DIR / f"{job_id}.{request.format}"
+        return await exports.write_export(db, request.dataset, request.format, filters, path, progress)
+    
+    job = await job_runner.submit("export", request.dict(), run)
+    return {"success": True, "job_id": job["id"], "status": job["status"]}
+
+@api_router.get("/internal/admin/jobs/{job_id}", dependencies=[Depends(require_admin)])
+async def get_job(job_id: str):
+    """Get background job status and result"""
+    job = await job_runner.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@api_router.get("/internal/admin/exports/{job_id}/download", dependencies=[Depends(require_admin)])
+async def download_export(job_id: str):
+    """Download the output of a completed export job"""
+    job = await job_runner.get(job_id)
+    if not job or job["kind"] != "export":
+        raise HTTPException(status_code=404, detail="Export not found")
+    if job["status"] != "completed":
+        raise HTTPException(status_code=400, detail=f"Export is {job['status']}")
+    
+    path = EXPORT_DIR / job["result"]["file"]
+    if not path.exists():
+        raise HTTPException(status_code=404, detail="Export file no longer available")
+    return FileResponse(
+        path,
+        media_type=EXPORT_MEDIA_TYPES[job["result"]["format"]],
+        filename=f"{job['params']['dataset']}_{job_id[:8]}.{job['result']['format']}"
+    )
+
+@api_router.get("/internal/admin/analytics", dependencies=[Depends(require_admin)])
 async def get_admin_analytics():
     """Get detailed analytics for admin"""
     # Bookings by service type
@@ -1112,24 +2358,213 @@ async def get_admin_analytics():
         "daily_trend": daily_stats
     }
 
-@api_router.get("/internal/admin/users")
+@api_router.get("/internal/admin/users", dependencies=[Depends(require_admin)])
 async def get_all_users(limit: int = 50):
     """Get all users/customers for admin"""
-    users = await db.users.find({}).sort("created_at", -1).to_list(limit)
+    users = await db.users.find({}, NO_ID).sort("created_at", -1).to_list(limit)
     return {"users": users}
 
-# Include the router
-app.include_router(api_router)
+# ==================== REQUEST PROFILER ====================
 
-# CORS Middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# Off unless PROFILER_ENABLED=true; an admin sends X-Profile: 1 (or ?profile=1)
+# with their session on any /api request to capture a profile of that request
+PROFILER_ENABLED = os.environ.get('PROFILER_ENABLED', 'false').lower() == 'true'
+profile_store = ProfileStore(ROOT_DIR / "profiles")
+
+async def admin_token(token: str) -> bool:
+    try:
+        return (await session_tokens.authenticate(token))["role"] == "admin"
+    except InvalidToken:
+        return False
+
+@api_router.get("/internal/admin/profiles", dependencies=[Depends(require_admin)])
+async def list_profiles(limit: int = 50):
+    """List captured request profiles, newest first"""
+    return {"profiles": profile_store.list(limit)}
+
+@api_router.get("/internal/admin/profiles/{profile_id}", dependencies=[Depends(require_admin)])
+async def get_profile(profile_id: str, format: str = "speedscope"):
+    """Download a profile as speedscope JSON or collapsed stacks (for flamegraph.pl)"""
+    profile = profile_store.load(profile_id)
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if format == "collapsed":
+        return PlainTextResponse(to_collapsed(profile))
+    if format != "speedscope":
+        raise HTTPException(status_code=400, detail="format must be speedscope or collapsed")
+    return FileResponse(
+        profile_store.path(profile_id),
+        media_type="application/json",
+        filename=f"{profile_id}.speedscope.json"
+    )
+
+# ==================== APP FACTORY ====================
+
+@api_router.get("/internal/admin/startup", dependencies=[Depends(require_admin)])
+async def get_startup_timings(request: Request):
+    """How long the process took to import and each startup step took, in milliseconds"""
+    return {"backend": db.backend, "timings": request.app.state.startup_timings}
+
+async def ensure_indexes():
+    await db.bookings.create_index([("user_id", 1), ("sync_version", 1)])
+    await db.bookings.create_index("created_at")
+    await db.bookings.create_index([("assignment_status", 1), ("offer_expires_at", 1)])
+    await db.payments.create_index("created_at")
+    await db.jobs.create_index("id", unique=True)
+    await db.bookings.create_index("id", unique=True)
+    await db.booking_transitions.create_index([("booking_id", 1), ("at", 1)])
+    await db.practitioners.create_index([("is_available", 1), ("is_verified", 1), *workload.CANDIDATE_SORT])
+    await job_runner.fail_interrupted()
+    await earnings_ledger.ensure_indexes()
+    await session_notes.ensure_indexes()
+    await db.migrations.create_index("id", unique=True)
+    await reminder_scheduler.ensure_indexes()
+    await outbox.ensure_indexes()
+    await db.auth_keys.create_index("kid", unique=True)
+    await db.booking_tombstones.create_index([("user_id", 1), ("sync_version", 1)])
+    # Write-behind replays after a crash rely on these to skip documents already written
+    await db.assessments.create_index("id", unique=True)
+    await db.contact_messages.create_index("id", unique=True)
+    if isinstance(rate_limit_store, MongoRateLimitStore):
+        await rate_limit_store.ensure_indexes()
+    for name, key in UNIQUE_KEYS:
+        try:
+            await db[name].create_index(key, unique=True)
+        except OperationFailure as e:
+            logger.error("Unique index on %s.%s not built, duplicates exist; run the merge migrations: %s",
+                         name, key, e, extra={"collection": name, "key": key})
+            unique_keys_missing[(name, key)] = time.monotonic() + UNIQUE_INDEX_RETRY_SECONDS
+
+async def rebuild_search_index():
+    """Build the admin search index, then rebuild it in the background"""
+    global search_index
+    while True:
+        live = search_index
+        # Writes during the scan go to the live index and are replayed onto the new one
+        live.journal = []
+        try:
+            fresh = SearchIndex()
+            await build_index(db, fresh)
+            replay(fresh, live.journal)
+            search_index = fresh
+            logger.info("Admin search index built with %d documents", len(fresh))
+        except Exception as e:
+            logger.warning("Admin search index rebuild failed: %s", e)
+        finally:
+            live.journal = None
+        if SEARCH_REBUILD_SECONDS <= 0:
+            return
+        await asyncio.sleep(SEARCH_REBUILD_SECONDS)
+
+class StartupTimer:
+    """Collects the duration of each startup step, in milliseconds"""
+    
+    def __init__(self):
+        self.timings: Dict[str, float] = {"import_ms": (IMPORT_FINISHED - IMPORT_STARTED) * 1000}
+        self.started = time.perf_counter()
+    
+    async def step(self, name: str, coro):
+        start = time.perf_counter()
+        result = await coro
+        self.timings[f"{name}_ms"] = (time.perf_counter() - start) * 1000
+        return result
+    
+    def finish(self) -> Dict[str, float]:
+        self.timings["startup_ms"] = (time.perf_counter() - self.started) * 1000
+        return {name: round(ms, 3) for name, ms in self.timings.items()}
+
+def create_app(settings: Optional[StorageSettings] = None) -> FastAPI:
+    """Build the API; storage, directories and background tasks are set up when it starts"""
+    settings = settings or StorageSettings.from_env()
+    
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        # Handlers only enqueue, a background thread writes JSON lines.
+        # LOG_SAMPLING thins out high-volume INFO loggers, e.g. "voct.access=0.1".
+        log_pipeline = configure_logging(
+            level=os.environ.get('LOG_LEVEL', 'INFO'),
+            fmt=os.environ.get('LOG_FORMAT', 'json'),
+            sampling=parse_rates(os.environ.get('LOG_SAMPLING', 'voct.access=0.1')),
+            warning_interval=float(os.environ.get('LOG_WARNING_INTERVAL', '60'))
+        )
+        timer = StartupTimer()
+        UPLOAD_DIR.mkdir(exist_ok=True)
+        EXPORT_DIR.mkdir(exist_ok=True)
+        timer.timings.update(await db.connect(
+            settings,
+            event_listeners=[MongoCommandTracer(tracer)] if tracer.enabled else []
+        ))
+        if partition_map:
+            # Indexes are created on every partition, so the map comes first
+            await timer.step("partition_map", partition_map.load())
+        await timer.step("ensure_indexes", ensure_indexes())
+        await timer.step("signing_keys", signing_keys.load())
+        # Quotes are signed, so pricing loads after the keys
+        await timer.step("pricing", quote_engine.load())
+        write_buffer.start()
+        reminder_scheduler.start()
+        
+        background = [
+            asyncio.create_task(rebuild_search_index()),
+            asyncio.create_task(signing_keys.watch()),
+            asyncio.create_task(quote_engine.watch()),
+            # The first sweep runs at startup, for rounds this process's predecessor left open
+            asyncio.create_task(watch_expired_offers()),
+        ]
+        if partition_map:
+            background.append(asyncio.create_task(partition_map.watch()))
+        if admin_events.source == "change_stream":
+            background.append(asyncio.create_task(events.watch_changes(
+                db.database, admin_events, ["bookings", "practitioners", "users"]
+            )))
+        
+        app.state.startup_timings = timer.finish()
+        logger.info("Startup finished in %.1f ms (%s storage)", app.state.startup_timings["startup_ms"], db.backend,
+                    extra={"timings": app.state.startup_timings})
+        try:
+            yield
+        finally:
+            for task in background:
+                task.cancel()
+            await reminder_scheduler.close()
+            await write_buffer.close()
+            db.close()
+            tracer.shutdown()
+            log_pipeline.stop()
+    
+    app = FastAPI(title="VOCT Healthcare API", lifespan=lifespan)
+    app.state.startup_timings = {}
+    app.include_router(api_router)
+    app.include_router(ws_router)
+    
+    # Innermost middleware, so profiles cover just the route handler
+    if PROFILER_ENABLED:
+        app.add_middleware(
+            ProfilerMiddleware,
+            authorise=admin_token,
+            store=profile_store,
+            interval=float(os.environ.get('PROFILER_INTERVAL_MS', '2')) / 1000,
+            exclude=("/api/internal/admin/profiles",)
+        )
+    
+    # Request IDs and per-request logging cost
+    app.add_middleware(RequestContextMiddleware)
+    
+    # CORS Middleware
+    app.add_middleware(
+        CORSMiddleware,
+        allow_credentials=True,
+        allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    
+    # Server span per request; added last so it is outermost and covers the
+    # other middleware, including CORS preflights answered without the router
+    app.add_middleware(TracingMiddleware, tracer=tracer)
+    return app
+
+IMPORT_FINISHED = time.perf_counter()
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
+# `uvicorn server:app`
+app = create_app()
@@ -0,0 +1,447 @@
+"""Discrete-event simulator and benchmark for physio assignment.
+
+Generates a synthetic city (practitioners with home locations, genders,
+shifts and accept/reject behaviour, plus a Poisson stream of bookings) and
+drives the real booking handlers and `assign_physio` against the in-memory
+store. Time is virtual: the event loop jumps straight to the next timer, so
+a simulated day takes seconds and offer timeouts behave exactly as they
+would in production. Everything random comes from one seed, so two runs
+with the same arguments produce the same assignments.
+
+    python simulator.py --seed 7 --physios 150 --bookings 2000 --mode broadcast
+    python simulator.py --seed 7 --compare          # serial vs broadcast side by side
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import random
+import selectors
+import sys
+import time
+from collections import Counter
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import server
+from events import EventBus
+from memory_store import MemoryDatabase
+from offers import OfferPolicy, OfferTimers
+
+HOUR = 3600.0
+
+SERVICE_MIX = [("orthopaedic", 0.35), ("neurological", 0.15), ("geriatric", 0.2),
+               ("womens_health", 0.1), ("lifestyle", 0.1), ("sports", 0.1)]
+
+
+class SimConfig(NamedTuple):
+    seed: int = 1
+    mode: str = "serial"
+    physios: int = 100
+    bookings: int = 1000
+    hours: float = 24.0            # bookings arrive uniformly at random over this window
+    city_km: float = 20.0
+    hotspots: int = 4              # demand clusters (business districts, hospitals)
+    female_share: float = 0.55
+    gender_preference_rate: float = 0.25
+    shift_hours: float = 8.0
+    shifts_per_day: float = 1.2    # average shifts a physio works in 24h
+    no_response_rate: float = 0.05  # chance a physio ignores an offer entirely
+    mean_response_seconds: float = 45.0
+    session_minutes: float = 60.0
+    drain_hours: float = 2.0       # simulated time allowed after the last arrival
+    k: Optional[int] = None        # overrides OFFER_POLICIES for every service type
+    timeout_seconds: Optional[float] = None
+
+
+# ==================== VIRTUAL TIME ====================
+
+class _VirtualSelector(selectors.BaseSelector):
+    """Never blocks: when the loop would wait for a timer, advance the clock instead"""
+
+    def __init__(self, clock: "VirtualClockLoop"):
+        self.clock = clock
+        self.real = selectors.DefaultSelector()
+
+    def register(self, fileobj, events, data=None):
+        return self.real.register(fileobj, events, data)
+
+    def unregister(self, fileobj):
+        return self.real.unregister(fileobj)
+
+    def modify(self, fileobj, events, data=None):
+        return self.real.modify(fileobj, events, data)
+
+    def get_map(self):
+        return self.real.get_map()
+
+    def close(self):
+        self.real.close()
+
+    def select(self, timeout=None):
+        ready = self.real.select(0)
+        if not ready and timeout:
+            self.clock.now += timeout
+        return ready
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    def __init__(self):
+        self.now = 0.0
+        super().__init__(_VirtualSelector(self))
+
+    def time(self) -> float:
+        return self.now
+
+
+# ==================== SYNTHETIC CITY ====================
+
+class SimPhysio(NamedTuple):
+    id: str
+    gender: str
+    location: Tuple[float, float]
+    accept_rate: float
+    shifts: List[Tuple[float, float]]
+
+
+def _distance(a: Tuple[float, float], b: Tuple[float, float]) -> float:
+    return math.hypot(a[0] - b[0], a[1] - b[1])
+
+
+def _weighted(rng: random.Random, choices: List[Tuple[str, float]]) -> str:
+    return rng.choices([c for c, _ in choices], weights=[w for _, w in choices])[0]
+
+
+def generate_city(config: SimConfig, rng: random.Random):
+    horizon = config.hours + config.drain_hours
+    physios = []
+    for i in range(config.physios):
+        shifts = []
+        start = rng.uniform(-config.shift_hours, 24.0 / config.shifts_per_day)
+        while start < horizon:
+            shifts.append((max(start, 0.0) * HOUR, (start + config.shift_hours) * HOUR))
+            start += config.shift_hours + rng.expovariate(config.shifts_per_day / 24.0)
+        physios.append(SimPhysio(
+            id=f"sim-physio-{i:04d}",
+            gender="female" if rng.random() < config.female_share else "male",
+            location=(rng.uniform(0, config.city_km), rng.uniform(0, config.city_km)),
+            accept_rate=rng.uniform(0.4, 0.95),
+            shifts=shifts,
+        ))
+
+    hotspots = [(rng.uniform(0, config.city_km), rng.uniform(0, config.city_km)) for _ in range(config.hotspots)]
+    bookings = []
+    for i in range(config.bookings):
+        if rng.random() < 0.7:
+            cx, cy = rng.choice(hotspots)
+            location = (min(max(rng.gauss(cx, 2.0), 0), config.city_km), min(max(rng.gauss(cy, 2.0), 0), config.city_km))
+        else:
+            location = (rng.uniform(0, config.city_km), rng.uniform(0, config.city_km))
+        preference = None
+        if rng.random() < config.gender_preference_rate:
+            preference = "female" if rng.random() < 0.8 else "male"
+        bookings.append({
+            "arrival": rng.uniform(0, config.hours * HOUR),
+            "location": location,
+            "data": server.BookingRequest(
+                user_id=f"sim-user-{i:05d}",
+                service_type=_weighted(rng, SERVICE_MIX),
+                session_count=rng.choice([1, 1, 3, 7, 15]),
+                amount=0,
+                customer_name=f"Sim Patient {i}",
+                customer_phone=f"+9190000{i:05d}",
+                address="Simulated address",
+                city="Simcity",
+                pincode="400001",
+                preferred_date="2026-01-01",
+                preferred_time="10:00",
+                physio_gender_preference=preference,
+            ),
+        })
+    bookings.sort(key=lambda b: b["arrival"])
+    return physios, bookings
+
+
+def practitioner_doc(physio: SimPhysio) -> Dict[str, Any]:
+    return {
+        "id": physio.id,
+        "status": "approved",
+        "is_verified": True,
+        "is_available": False,
+        "created_at": server.datetime.utcnow(),
+        "personal_details": {
+            "full_name": f"Sim Physio {physio.id[-4:]}",
+            "gender": physio.gender,
+            "city": "Simcity",
+        },
+        "location": {"x_km": physio.location[0], "y_km": physio.location[1]},
+    }
+
+
+# ==================== SIMULATION ====================
+
+class FakePhysioSocket:
+    """Stands in for a physio's WebSocket and answers the way the physio would"""
+
+    def __init__(self, sim: "Simulation", physio: SimPhysio):
+        self.sim = sim
+        self.physio = physio
+
+    async def accept(self):
+        pass
+
+    async def send_messages(self, messages: List[Dict[str, Any]]):
+        for message in messages:
+            self.sim.messages[message["type"]] += 1
+            if message["type"] in ("booking_assigned", "booking_offer"):
+                self.sim.loop.create_task(self.sim.respond(self.physio, message))
+
+
+class Simulation:
+    def __init__(self, config: SimConfig):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.loop = asyncio.get_running_loop()
+        self.physios, self.bookings = generate_city(config, self.rng)
+        self.physio_by_id = {p.id: p for p in self.physios}
+        self.booking_locations: Dict[str, Tuple[float, float]] = {}
+        self.paid_at: Dict[str, float] = {}
+        self.accepted: Dict[str, Tuple[float, str]] = {}
+        self.busy_until: Dict[str, float] = {}
+        self.messages: Counter = Counter()
+        self.responses = Counter()
+
+    def install(self):
+        """Point the server's module-level state at the in-memory store and fake sockets"""
+        self.db = MemoryDatabase("simulation")
+        server.db.bind(self.db, backend="memory")
+        server.manager = server.ConnectionManager(server.outbox)
+        server.admin_events = EventBus(queue_size=10 ** 7)
+        server.search_index = server.SearchIndex()
+        server.offer_timers = OfferTimers()
+        server.ASSIGNMENT_MODE = self.config.mode
+        if self.config.k or self.config.timeout_seconds:
+            server.OFFER_POLICIES = {
+                name: OfferPolicy(self.config.k or p.k, self.config.timeout_seconds or p.timeout_seconds)
+                for name, p in server.OFFER_POLICIES.items()
+            }
+
+    async def run(self) -> Dict[str, Any]:
+        self.install()
+        await self.db.bookings.create_index("id", unique=True)
+        await self.db.practitioners.create_index("id", unique=True)
+        await self.db.practitioners.insert_many([practitioner_doc(p) for p in self.physios])
+        # Bookings are priced by the quote engine, which signs with the session keys
+        await server.signing_keys.load()
+        await server.quote_engine.load()
+
+        events = server.admin_events.subscribe()
+        watcher = self.loop.create_task(self.watch(events))
+        for physio in self.physios:
+            for start, end in physio.shifts:
+                self.loop.call_at(start, lambda p=physio: self.loop.create_task(self.set_on_shift(p, True)))
+                self.loop.call_at(end, lambda p=physio: self.loop.create_task(self.set_on_shift(p, False)))
+
+        wall_start = time.perf_counter()
+        for booking in self.bookings:
+            await asyncio.sleep(max(0.0, booking["arrival"] - self.loop.time()))
+            await self.place(booking)
+        await asyncio.sleep(self.config.drain_hours * HOUR)
+        wall_seconds = time.perf_counter() - wall_start
+
+        watcher.cancel()
+        for task in list(server.offer_timers.tasks.values()):
+            task.cancel()
+        return await self.report(wall_seconds)
+
+    async def set_on_shift(self, physio: SimPhysio, on_shift: bool):
+        await self.db.practitioners.update_one({"id": physio.id}, {"$set": {"is_available": on_shift}})
+        if on_shift:
+            await server.manager.connect_physio(physio.id, FakePhysioSocket(self, physio))
+        else:
+            server.manager.disconnect_physio(physio.id)
+
+    async def place(self, booking: Dict[str, Any]):
+        """What the app does for a patient: create the booking, then pay for it"""
+        session = {"sub": booking["data"].user_id, "role": "patient"}
+        created = await server.create_booking(booking["data"], session)
+        self.booking_locations[created.id] = booking["location"]
+        self.paid_at[created.id] = self.loop.time()
+        await server.mock_payment_success(created.id, session)
+
+    async def respond(self, physio: SimPhysio, message: Dict[str, Any]):
+        rng = self.rng
+        if rng.random() < self.config.no_response_rate:
+            self.responses["ignored"] += 1
+            return
+        await asyncio.sleep(rng.expovariate(1.0 / self.config.mean_response_seconds))
+
+        distance = _distance(physio.location, self.booking_locations[message["booking_id"]])
+        chance = physio.accept_rate * math.exp(-distance / 10.0)
+        if self.busy_until.get(physio.id, 0.0) > self.loop.time():
+            chance *= 0.15
+        accepted = rng.random() < chance
+        self.responses["accepted" if accepted else "rejected"] += 1
+
+        response = {"type": "booking_response", "booking_id": message["booking_id"], "accepted": accepted}
+        if "offer_round" in message:
+            response["offer_round"] = message["offer_round"]
+        await server.handle_booking_response(physio.id, response)
+
+    async def watch(self, events):
+        """Record acceptances from the admin event stream, as a dashboard would see them"""
+        while True:
+            event = await events.get()
+            changes = event.get("changes", {})
+            if event.get("type") == "booking_updated" and changes.get("assignment_status") == "accepted":
+                booking_id = event["booking_id"]
+                physio_id = changes.get("assigned_physio_id") or (
+                    await self.db.bookings.find_one({"id": booking_id}, {"assigned_physio_id": 1}))["assigned_physio_id"]
+                now = self.loop.time()
+                self.accepted[booking_id] = (now, physio_id)
+                travel = _distance(self.physio_by_id[physio_id].location, self.booking_locations[booking_id]) / 25.0 * HOUR
+                self.busy_until[physio_id] = max(self.busy_until.get(physio_id, now), now) + travel \
+                    + self.config.session_minutes * 60
+                self.loop.call_at(self.busy_until[physio_id], lambda b=booking_id, p=physio_id:
+                                  self.loop.create_task(server.complete_session(p, b)))
+
+    # ==================== REPORT ====================
+
+    async def report(self, wall_seconds: float) -> Dict[str, Any]:
+        bookings = await self.db.bookings.find({}, {"id": 1, "assignment_status": 1}).to_list(None)
+        outcomes = Counter(b["assignment_status"] for b in bookings)
+        waits = sorted(self.accepted[b][0] - self.paid_at[b] for b in self.accepted)
+
+        load = Counter(physio_id for _, physio_id in self.accepted.values())
+        worked = [p.id for p in self.physios if p.shifts]
+        counts = [load.get(p, 0) for p in worked]
+        distances = [_distance(self.physio_by_id[pid].location, self.booking_locations[bid])
+                     for bid, (_, pid) in self.accepted.items()]
+        transitions = await self.db.booking_transitions.count_documents({})
+
+        return {
+            "config": self.config._asdict(),
+            "bookings": len(bookings),
+            "assigned": len(self.accepted),
+            "assignment_rate": round(len(self.accepted) / len(bookings), 4) if bookings else 0.0,
+            "outcomes": dict(outcomes),
+            "time_to_assign_seconds": {
+                "mean": round(sum(waits) / len(waits), 1) if waits else None,
+                "p50": _percentile(waits, 50),
+                "p90": _percentile(waits, 90),
+                "p99": _percentile(waits, 99),
+            },
+            "fairness": {
+                "physios_on_shift": len(worked),
+                "physios_used": len(load),
+                "max_load": max(counts, default=0),
+                "mean_load": round(sum(counts) / len(counts), 2) if counts else 0.0,
+                "jain_index": _jain(counts),
+                "gini": _gini(counts),
+            },
+            "mean_distance_km": round(sum(distances) / len(distances), 2) if distances else None,
+            "physio_messages": dict(self.messages),
+            "physio_responses": dict(self.responses),
+            "throughput": {
+                "wall_seconds": round(wall_seconds, 3),
+                "bookings_per_second": round(len(bookings) / wall_seconds, 1) if wall_seconds else None,
+                "transitions": transitions,
+                "transitions_per_second": round(transitions / wall_seconds, 1) if wall_seconds else None,
+            },
+        }
+
+
+def _percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, math.ceil(pct / 100 * len(values)) - 1))
+    return round(values[index], 1)
+
+
+def _jain(counts: List[int]) -> Optional[float]:
+    """Jain's fairness index: 1.0 when every physio carries the same load"""
+    total = sum(counts)
+    if not total:
+        return None
+    return round(total ** 2 / (len(counts) * sum(c * c for c in counts)), 4)
+
+
+def _gini(counts: List[int]) -> Optional[float]:
+    total = sum(counts)
+    if not total:
+        return None
+    ordered = sorted(counts)
+    n = len(ordered)
+    weighted = sum((i + 1) * c for i, c in enumerate(ordered))
+    return round((2 * weighted) / (n * total) - (n + 1) / n, 4)
+
+
+def simulate(config: SimConfig) -> Dict[str, Any]:
+    """Run one simulation on a fresh virtual-clock loop"""
+    loop = VirtualClockLoop()
+    try:
+        return loop.run_until_complete(_run(config))
+    finally:
+        loop.close()
+
+
+async def _run(config: SimConfig) -> Dict[str, Any]:
+    return await Simulation(config).run()
+
+
+# ==================== CLI ====================
+
+def _print_report(report: Dict[str, Any]):
+    config = report["config"]
+    tta = report["time_to_assign_seconds"]
+    print(f"\nmode={config['mode']} seed={config['seed']} physios={config['physios']} bookings={report['bookings']}")
+    print(f"  assigned        {report['assigned']} ({report['assignment_rate']:.1%})  outcomes={report['outcomes']}")
+    print(f"  time to assign  mean={tta['mean']}s p50={tta['p50']}s p90={tta['p90']}s p99={tta['p99']}s")
+    fairness = report["fairness"]
+    print(f"  fairness        jain={fairness['jain_index']} gini={fairness['gini']} "
+          f"max={fairness['max_load']} mean={fairness['mean_load']} used={fairness['physios_used']}/{fairness['physios_on_shift']}")
+    print(f"  distance        mean={report['mean_distance_km']}km")
+    print(f"  messages        {report['physio_messages']}")
+    throughput = report["throughput"]
+    print(f"  throughput      {throughput['bookings_per_second']} bookings/s, "
+          f"{throughput['transitions_per_second']} transitions/s ({throughput['wall_seconds']}s wall)")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    defaults = SimConfig()
+    parser = argparse.ArgumentParser(description="Simulate physio assignment against an in-memory store")
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument("--mode", choices=["serial", "broadcast"], default=defaults.mode)
+    parser.add_argument("--compare", action="store_true", help="run serial and broadcast on the same city")
+    parser.add_argument("--physios", type=int, default=defaults.physios)
+    parser.add_argument("--bookings", type=int, default=defaults.bookings)
+    parser.add_argument("--hours", type=float, default=defaults.hours)
+    parser.add_argument("--no-response-rate", type=float, default=defaults.no_response_rate)
+    parser.add_argument("--k", type=int, help="offer fan-out for every service type (broadcast mode)")
+    parser.add_argument("--timeout", type=float, help="offer round timeout in seconds (broadcast mode)")
+    parser.add_argument("--json", action="store_true", help="print the full report as JSON")
+    parser.add_argument("--verbose", action="store_true", help="keep the server's assignment logs")
+    args = parser.parse_args(argv)
+
+    if not args.verbose:
+        logging.getLogger("server").setLevel(logging.ERROR)
+        logging.getLogger("offers").setLevel(logging.ERROR)
+
+    config = SimConfig(
+        seed=args.seed, mode=args.mode, physios=args.physios, bookings=args.bookings, hours=args.hours,
+        no_response_rate=args.no_response_rate, k=args.k, timeout_seconds=args.timeout,
+    )
+    modes = ["serial", "broadcast"] if args.compare else [args.mode]
+    reports = [simulate(config._replace(mode=mode)) for mode in modes]
+
+    if args.json:
+        json.dump(reports if args.compare else reports[0], sys.stdout, indent=2, default=str)
+        print()
+    else:
+        for report in reports:
+            _print_report(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,227 @@
+"""Storage backends and the repositories handlers read and write through.
+
+`Storage` resolves collections against whichever backend is bound to it:
+a Motor database for production, or the in-memory store (memory_store.py)
+so the whole API can run, be tested and be benchmarked without MongoDB.
+Nothing is opened at import time; the app's lifespan calls `connect()`.
+
+The domain collections (users, bookings, payments, practitioners,
+assessments, contact messages) get repositories with their common lookups.
+Any other attribute is passed through to the bound collection, so modules
+that take a collection (jobs, ledger, rate limits) can be handed a
+repository and keep working when the backend changes.
+
+With city partitioning on (partitions.py), bookings and practitioners
+resolve to a PartitionedCollection that routes by city instead of a
+single collection.
+"""
+import os
+import re
+import time
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import DuplicateKeyError
+
+from memory_store import MemoryDatabase
+
+# Lookups return documents without Mongo's ObjectId so they can go straight into responses
+NO_ID = {"_id": 0}
+
+
+def duplicate_key(error: DuplicateKeyError) -> Optional[str]:
+    """The field whose unique index `error` violated, when it says"""
+    pattern = (error.details or {}).get("keyPattern")
+    if pattern:
+        return next(iter(pattern))
+    match = re.search(r"index: ([\w.]+?)(?:_-?1)?(?:\s|$)", str(error))
+    return match.group(1) if match else None
+
+
+class StorageSettings(NamedTuple):
+    backend: str                       # "mongo" or "memory"
+    mongo_url: Optional[str]
+    db_name: str
+    max_pool_size: int = 100
+    min_pool_size: int = 0
+    max_idle_time_ms: Optional[int] = None
+    wait_queue_timeout_ms: Optional[int] = None
+    connect_timeout_ms: int = 20000
+    server_selection_timeout_ms: int = 30000
+
+    @classmethod
+    def from_env(cls, environ=os.environ) -> "StorageSettings":
+        def optional_int(name):
+            value = environ.get(name)
+            return int(value) if value else None
+
+        return cls(
+            backend=environ.get('STORAGE_BACKEND', 'mongo'),
+            mongo_url=environ.get('MONGO_URL'),
+            db_name=environ.get('DB_NAME', 'voct_database'),
+            max_pool_size=int(environ.get('MONGO_MAX_POOL_SIZE', '100')),
+            min_pool_size=int(environ.get('MONGO_MIN_POOL_SIZE', '0')),
+            max_idle_time_ms=optional_int('MONGO_MAX_IDLE_TIME_MS'),
+            wait_queue_timeout_ms=optional_int('MONGO_WAIT_QUEUE_TIMEOUT_MS'),
+            connect_timeout_ms=int(environ.get('MONGO_CONNECT_TIMEOUT_MS', '20000')),
+            server_selection_timeout_ms=int(environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', '30000')),
+        )
+
+    def client_options(self) -> Dict[str, Any]:
+        options = {
+            "maxPoolSize": self.max_pool_size,
+            "minPoolSize": self.min_pool_size,
+            "connectTimeoutMS": self.connect_timeout_ms,
+            "serverSelectionTimeoutMS": self.server_selection_timeout_ms,
+        }
+        if self.max_idle_time_ms is not None:
+            options["maxIdleTimeMS"] = self.max_idle_time_ms
+        if self.wait_queue_timeout_ms is not None:
+            options["waitQueueTimeoutMS"] = self.wait_queue_timeout_ms
+        return options
+
+
+# ==================== REPOSITORIES ====================
+
+class Repository:
+    """One collection of the bound backend"""
+
+    def __init__(self, storage: "Storage", name: str):
+        self.storage = storage
+        self.name = name
+
+    @property
+    def collection(self):
+        return self.storage.collection(self.name)
+
+    def for_city(self, city: Optional[str]):
+        """The physical collection holding `city`'s documents; the whole collection when unpartitioned"""
+        return self.storage.collection(self.name, city)
+
+    def __getattr__(self, attr: str):
+        # find, update_one, bulk_write, ... on whichever backend is bound right now
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        return getattr(self.collection, attr)
+
+    async def get(self, doc_id: str) -> Optional[Dict[str, Any]]:
+        return await self.collection.find_one({"id": doc_id}, NO_ID)
+
+    async def add(self, doc: Dict[str, Any]) -> Dict[str, Any]:
+        await self.collection.insert_one(doc)
+        return doc
+
+
+class UserRepository(Repository):
+    async def by_phone(self, phone: str) -> Optional[Dict[str, Any]]:
+        return await self.collection.find_one({"phone": phone}, NO_ID)
+
+
+class BookingRepository(Repository):
+    async def for_user(self, user_id: str, limit: int = 100) -> List[Dict[str, Any]]:
+        return await self.collection.find({"user_id": user_id}, NO_ID).to_list(limit)
+
+
+class PaymentRepository(Repository):
+    async def by_order(self, order_id: str) -> Optional[Dict[str, Any]]:
+        return await self.collection.find_one({"order_id": order_id}, NO_ID)
+
+
+class PractitionerRepository(Repository):
+    async def by_email(self, email: str, verified_only: bool = False) -> Optional[Dict[str, Any]]:
+        query: Dict[str, Any] = {"personal_details.email": email}
+        if verified_only:
+            query["is_verified"] = True
+        return await self.collection.find_one(query, NO_ID)
+
+
+REPOSITORIES = {
+    "users": UserRepository,
+    "bookings": BookingRepository,
+    "payments": PaymentRepository,
+    "practitioners": PractitionerRepository,
+    "assessments": Repository,
+    "contact_messages": Repository,
+}
+
+
+# ==================== STORAGE ====================
+
+class Storage:
+    """Repositories by attribute or item (`storage.bookings`, `storage["jobs"]`)"""
+
+    def __init__(self):
+        self.client = None
+        self.backend: Optional[str] = None
+        self._database = None
+        self._repositories: Dict[str, Repository] = {}
+        self._partitioned: Dict[str, Any] = {}
+
+    @property
+    def connected(self) -> bool:
+        return self._database is not None
+
+    @property
+    def database(self):
+        if self._database is None:
+            raise RuntimeError("Storage is not connected; it is opened by the app lifespan")
+        return self._database
+
+    def bind(self, database, client=None, backend: str = "custom"):
+        """Point every repository at `database` (tests and simulations bind their own)"""
+        self._database = database
+        self.client = client
+        self.backend = backend
+
+    async def connect(self, settings: StorageSettings, event_listeners=()) -> Dict[str, float]:
+        """Open the configured backend; returns how long each step took, in milliseconds"""
+        timings: Dict[str, float] = {}
+        start = time.perf_counter()
+        if settings.backend == "memory":
+            self.bind(MemoryDatabase(settings.db_name), backend="memory")
+            timings["storage_connect_ms"] = (time.perf_counter() - start) * 1000
+            return timings
+        if settings.backend != "mongo":
+            raise ValueError(f"Unknown STORAGE_BACKEND {settings.backend!r}")
+        if not settings.mongo_url:
+            raise ValueError("MONGO_URL is required for the mongo storage backend")
+
+        client = AsyncIOMotorClient(settings.mongo_url, event_listeners=list(event_listeners),
+                                    **settings.client_options())
+        self.bind(client[settings.db_name], client=client, backend="mongo")
+        timings["storage_connect_ms"] = (time.perf_counter() - start) * 1000
+        # The client connects lazily; ping so startup fails fast and the first request doesn't pay for it
+        start = time.perf_counter()
+        await client.admin.command("ping")
+        timings["storage_ping_ms"] = (time.perf_counter() - start) * 1000
+        return timings
+
+    def partition(self, name: str, partitioned):
+        """Route `name` through a PartitionedCollection"""
+        self._partitioned[name] = partitioned
+
+    def collection(self, name: str, city: Optional[str] = None):
+        partitioned = self._partitioned.get(name)
+        if partitioned is None:
+            return self.database[name]
+        return partitioned if city is None else partitioned.for_city(city)
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+        self.client = None
+        self._database = None
+
+    def __getitem__(self, name: str) -> Repository:
+        repository = self._repositories.get(name)
+        if repository is None:
+            repository = self._repositories[name] = REPOSITORIES.get(name, Repository)(self, name)
+        return repository
+
+    def __getattr__(self, name: str) -> Repository:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    async def list_collection_names(self) -> List[str]:
+        return await self.database.list_collection_names()
@@ -0,0 +1,25 @@
+import os
+import sys
+from pathlib import Path
+
+# server.py reads its settings at import time
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import pytest
+
+from memory_store import MemoryDatabase
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def server():
+    """The app module with its storage bound to a fresh in-memory database"""
+    import server
+    server.db.bind(MemoryDatabase("test"), backend="memory")
+    return server
@@ -0,0 +1,77 @@
+import pytest
+
+from booking_state import TransitionRejected
+
+pytestmark = pytest.mark.anyio
+
+
+async def add_booking(server, booking_id="b1", **fields):
+    await server.db.bookings.insert_one({
+        "id": booking_id,
+        "user_id": "u1",
+        "status": "pending_payment",
+        "payment_status": "pending",
+        "assignment_status": "unassigned",
+        "assigned_physio_id": None,
+        **fields,
+    })
+
+
+async def test_transition_returns_previous_state_and_applies_new_one(server):
+    await add_booking(server)
+    before = await server.transition_booking("b1", "pay", actor="payment")
+    assert before["status"] == "pending_payment"
+    booking = await server.db.bookings.get("b1")
+    assert (booking["status"], booking["payment_status"]) == ("confirmed", "paid")
+
+
+async def test_repeated_transition_is_rejected_with_current_state(server):
+    await add_booking(server)
+    await server.transition_booking("b1", "pay")
+    with pytest.raises(TransitionRejected) as e:
+        await server.transition_booking("b1", "pay")
+    assert not e.value.not_found
+    assert e.value.current["status"] == "confirmed"
+
+
+async def test_missing_booking_is_not_found(server):
+    with pytest.raises(TransitionRejected) as e:
+        await server.transition_booking("nope", "pay")
+    assert e.value.not_found
+
+
+async def test_stale_assign_after_cancel_changes_nothing(server):
+    await add_booking(server, status="confirmed", payment_status="paid")
+    await server.transition_booking("b1", "cancel")
+    with pytest.raises(TransitionRejected):
+        await server.transition_booking("b1", "assign", physio_id="p1")
+    booking = await server.db.bookings.get("b1")
+    assert (booking["status"], booking["assigned_physio_id"]) == ("cancelled", None)
+
+
+async def test_expiry_of_an_old_offer_round_is_ignored(server):
+    await add_booking(server, status="confirmed", assignment_status="offered", offer_round=2,
+                      offered_physio_ids=["p2"])
+    with pytest.raises(TransitionRejected):
+        await server.transition_booking("b1", "expire_offer", round=1, physio_ids=["p1"])
+    booking = await server.db.bookings.get("b1")
+    assert (booking["assignment_status"], booking["offered_physio_ids"]) == ("offered", ["p2"])
+
+
+async def test_only_an_offered_physio_can_accept(server):
+    await add_booking(server, status="confirmed", assignment_status="offered", offer_round=1,
+                      offered_physio_ids=["p1", "p2"])
+    with pytest.raises(TransitionRejected):
+        await server.transition_booking("b1", "accept_offer", physio_id="p3")
+    await server.transition_booking("b1", "accept_offer", physio_id="p2")
+    with pytest.raises(TransitionRejected):
+        await server.transition_booking("b1", "accept_offer", physio_id="p1")
+    assert (await server.db.bookings.get("b1"))["assigned_physio_id"] == "p2"
+
+
+async def test_transitions_are_recorded_in_history(server):
+    await add_booking(server)
+    await server.transition_booking("b1", "pay", actor="payment")
+    await server.transition_booking("b1", "cancel", actor="admin")
+    history = await server.db.booking_transitions.find({"booking_id": "b1"}, {"_id": 0}).sort("at", 1).to_list(None)
+    assert [(h["transition"], h["actor"]) for h in history] == [("pay", "payment"), ("cancel", "admin")]
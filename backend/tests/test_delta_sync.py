@@ -0,0 +1,104 @@
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+
+pytestmark = pytest.mark.anyio
+
+PATIENT = {"sub": "u1", "role": "patient"}
+
+
+@pytest.fixture
+async def sync(server, monkeypatch):
+    # Versions allocated against an earlier test's database must not hold this one back
+    monkeypatch.setattr(server, "booking_sync_seen", 0)
+    await server.signing_keys.load()
+    return server
+
+
+async def book(server, session=PATIENT, **fields):
+    request = server.BookingRequest(
+        service_type="orthopaedic", session_count=1, amount=1, customer_name="Asha",
+        customer_phone="9000000001", address="1 Main St", city="Pune", pincode="411001",
+        preferred_date="2026-11-02", preferred_time="10:00", **fields
+    )
+    return await server.create_booking(request, session)
+
+
+async def changes(server, since="0", limit=100, user_id="u1"):
+    return await server.get_user_booking_changes(user_id, since, limit)
+
+
+async def test_changes_since_a_cursor(sync):
+    first, second = await book(sync), await book(sync)
+    await book(sync, session={"sub": "admin", "role": "admin"}, user_id="u2")
+
+    delta = await changes(sync)
+    assert [b.id for b in delta.bookings] == [first.id, second.id]
+    assert delta.deleted == []
+    cursor = delta.cursor
+    assert (await changes(sync, str(cursor))).bookings == []
+
+    await sync.update_booking({"id": first.id}, {"preferred_time": "11:00"})
+    await sync.delete_booking(second.id, PATIENT)
+    delta = await changes(sync, str(cursor))
+    assert [(b.id, b.preferred_time) for b in delta.bookings] == [(first.id, "11:00")]
+    assert delta.deleted == [second.id]
+    assert delta.cursor > cursor
+    assert (await changes(sync, str(delta.cursor))).deleted == []
+
+
+async def test_versions_are_hidden_until_every_lower_write_commits(sync):
+    await book(sync)
+    cursor = (await changes(sync)).cursor
+
+    async with sync.booking_stamp() as slow:
+        # A later write commits first, but handing it out now would let the
+        # client's cursor skip the slower one
+        fast = await book(sync)
+        assert fast.sync_version > slow["sync_version"]
+        delta = await changes(sync, str(cursor))
+        assert delta.bookings == [] and delta.cursor == cursor
+    assert [b.id for b in (await changes(sync, str(cursor))).bookings] == [fast.id]
+
+
+async def test_abandoned_writes_stop_holding_versions_back(sync, monkeypatch):
+    await book(sync)
+    async with sync.booking_stamp():
+        monkeypatch.setattr(sync, "SYNC_INFLIGHT_TIMEOUT", timedelta(seconds=-1))
+        later = await book(sync)
+        assert (await changes(sync)).cursor == later.sync_version
+
+
+async def test_full_pages_stop_the_cursor_at_their_last_booking(sync):
+    created = [await book(sync) for _ in range(5)]
+    await sync.delete_booking(created[0].id, PATIENT)
+
+    seen, deleted, cursor = [], [], "0"
+    while True:
+        delta = await changes(sync, cursor, limit=2)
+        seen += [b.id for b in delta.bookings]
+        deleted += delta.deleted
+        if not delta.bookings and str(delta.cursor) == cursor:
+            break
+        cursor = str(delta.cursor)
+    assert seen == [b.id for b in created[1:]]
+    assert deleted == [created[0].id]
+
+
+async def test_first_sync_includes_bookings_from_before_versions(sync):
+    legacy = {**(await book(sync)).dict(), "id": "legacy"}
+    del legacy["sync_version"]
+    await sync.db.bookings.insert_one(legacy)
+    assert "legacy" in [b.id for b in (await changes(sync)).bookings]
+
+
+async def test_iso_timestamp_since(sync):
+    old = await book(sync)
+    await sync.db.bookings.update_one({"id": old.id}, {"$set": {"updated_at": datetime(2020, 1, 1)}})
+    new = await book(sync)
+    delta = await changes(sync, "2021-01-01T00:00:00Z")
+    assert [b.id for b in delta.bookings] == [new.id]
+    with pytest.raises(HTTPException) as e:
+        await changes(sync, "yesterday")
+    assert e.value.status_code == 400
@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+
+import events
+from events import EventBus
+from ledger import Ledger, PLATFORM_ACCOUNT
+from memory_store import MemoryDatabase
+
+pytestmark = pytest.mark.anyio
+
+
+def paid_booking(**fields):
+    return {"id": "b1", "status": "confirmed", "payment_status": "paid", "amount": 1999, **fields}
+
+
+def test_status_change_moves_counters_between_statuses():
+    event = events.booking_updated(paid_booking(), {"status": "completed"})
+    assert event["counters"] == {"confirmed_bookings": -1, "completed_bookings": 1}
+    assert event["transition"] == {"from": "confirmed", "to": "completed"}
+    assert events.booking_updated(paid_booking(), {"notes": "x"}) is None
+
+
+async def test_revenue_deltas_track_the_ledger_through_pay_and_cancel():
+    db = MemoryDatabase("events")
+    ledger = Ledger(db.ledger_entries, db.ledger_balances, db.ledger_locks)
+    live = {"total_revenue": 0, "platform_commission": 0}
+
+    def apply(event):
+        for name in live:
+            live[name] += event["counters"].get(name, 0)
+
+    pending = paid_booking(status="pending_payment", payment_status="pending")
+    apply(events.booking_updated(pending, {"status": "confirmed", "payment_status": "paid"}))
+    await ledger.record_payment(paid_booking())
+    platform = await ledger.balance(PLATFORM_ACCOUNT)
+    assert live == {"total_revenue": platform["revenue"], "platform_commission": platform["commission"]}
+
+    apply(events.booking_updated(paid_booking(), {"status": "cancelled"}))
+    await ledger.record_cancellation(paid_booking())
+    platform = await ledger.balance(PLATFORM_ACCOUNT)
+    assert live == {"total_revenue": platform["revenue"], "platform_commission": platform["commission"]} == \
+        {"total_revenue": 0, "platform_commission": 0}
+
+
+def test_cancelling_an_unpaid_booking_leaves_revenue_alone():
+    event = events.booking_updated(paid_booking(status="pending_payment", payment_status="pending"),
+                                   {"status": "cancelled"})
+    assert event["counters"] == {"cancelled_bookings": 1}
+
+
+def test_created_and_deleted_bookings_adjust_totals():
+    assert events.booking_created(paid_booking())["counters"] == {"total_bookings": 1, "confirmed_bookings": 1}
+    assert events.booking_deleted(paid_booking(status="cancelled"))["counters"] == \
+        {"total_bookings": -1, "cancelled_bookings": -1}
+
+
+def test_practitioner_verification_counters():
+    before = {"id": "p1", "status": "pending_review", "is_verified": False}
+    event = events.practitioner_updated(before, {"status": "approved", "is_verified": True})
+    assert event["counters"] == {"pending_practitioners": -1, "verified_practitioners": 1}
+
+
+def test_change_stream_events_use_the_pre_image_when_there_is_one():
+    change = {
+        "operationType": "update",
+        "ns": {"coll": "bookings__west"},
+        "updateDescription": {"updatedFields": {"status": "cancelled"}},
+        "fullDocumentBeforeChange": paid_booking(),
+        "fullDocument": paid_booking(status="cancelled"),
+    }
+    assert events.change_to_event(change)["counters"]["total_revenue"] == -1999
+
+    # Without one the deltas are unknown, so clients are told to refresh
+    del change["fullDocumentBeforeChange"]
+    event = events.change_to_event(change)
+    assert event["counters"] == {} and event["refresh_counters"]
+    assert event["changes"] == {"status": "cancelled"}
+
+
+async def test_slow_subscriber_is_told_to_resync():
+    bus = EventBus(queue_size=2)
+    fast, slow = bus.subscribe(), bus.subscribe()
+    for i in range(3):
+        bus.publish({"type": "booking_created", "n": i})
+        await fast.get()
+    assert (await slow.get()) == {"type": "resync"}
+    bus.publish({"type": "user_created"})
+    assert (await slow.get())["type"] == "user_created"
+    slow.close()
+    assert bus.subscribers == {fast}
+
+
+async def test_local_events_are_dropped_when_a_change_stream_feeds_the_bus():
+    bus = EventBus(source="change_stream")
+    sub = bus.subscribe()
+    bus.emit_local({"type": "user_created"})
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(sub.get(), 0.01)
@@ -0,0 +1,87 @@
+import csv
+import io
+from datetime import datetime
+
+import pytest
+
+import exports
+from exports import ExportError
+from memory_store import MemoryDatabase
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def db():
+    db = MemoryDatabase("exports")
+    await db.bookings.insert_many([
+        {"id": f"b{i}", "created_at": datetime(2026, 3, 1 + i % 3, 12), "city": "Pune" if i % 2 else "Mumbai",
+         "status": "confirmed" if i % 4 else "cancelled", "amount": 1000 + i, "customer_name": f"Name, {i}",
+         "session_count": 1, "payment_status": "paid", "secret_field": "x"}
+        for i in range(7)
+    ])
+    return db
+
+
+async def read_csv(db, dataset, filters):
+    body = b"".join([c.encode() async for c in exports.stream_export(db, dataset, "csv", filters)])
+    return list(csv.DictReader(io.StringIO(body.decode())))
+
+
+def test_filters_become_the_cursor_query():
+    assert exports.build_query("bookings", {"status": "confirmed", "city": "Pune",
+                                            "date_from": "2026-03-01", "date_to": "2026-03-02"}) == {
+        "status": "confirmed", "city": "Pune",
+        "created_at": {"$gte": datetime(2026, 3, 1), "$lt": datetime(2026, 3, 3)},
+    }
+    for dataset, filters in [("nope", {}), ("payments", {"city": "Pune"}), ("bookings", {"date_from": "03/01/2026"})]:
+        with pytest.raises(ExportError):
+            exports.build_query(dataset, filters)
+
+
+async def test_csv_rows_follow_the_filters_in_created_order(db, monkeypatch):
+    # Small batches, so rows span several encoded chunks
+    monkeypatch.setattr(exports, "BATCH_SIZE", 2)
+    rows = await read_csv(db, "bookings", {"city": "Pune", "date_to": "2026-03-02"})
+    assert [r["id"] for r in rows] == ["b3", "b1"]
+    assert list(rows[0]) == exports.DATASETS["bookings"].columns
+    assert rows[1]["customer_name"] == "Name, 1"
+    assert rows[1]["created_at"] == "2026-03-02T12:00:00"
+    assert rows[0]["preferred_date"] == ""
+
+
+async def test_empty_export_still_has_a_header(db):
+    chunks = [c async for c in exports.encode_csv(db, "payments", {})]
+    assert chunks == [(",".join(exports.DATASETS["payments"].columns) + "\r\n", 0)]
+
+
+async def test_rows_are_encoded_batch_by_batch(db, monkeypatch):
+    monkeypatch.setattr(exports, "BATCH_SIZE", 3)
+    counts = [count async for _, count in exports.encode_csv(db, "bookings", {})]
+    assert counts == [3, 3, 1]
+
+
+async def test_background_export_reports_progress(db, tmp_path):
+    progress = []
+
+    async def report(**fields):
+        progress.append(fields["rows"])
+
+    result = await exports.write_export(db, "bookings", "csv", {"status": "cancelled"}, tmp_path / "out.csv", report)
+    assert (result["rows"], result["format"], progress) == (2, "csv", [2])
+    assert result["bytes"] == (tmp_path / "out.csv").stat().st_size
+
+
+@pytest.mark.skipif(not exports.parquet_available(), reason="pyarrow is not installed")
+async def test_parquet_row_groups_match_the_csv(db, monkeypatch):
+    import pyarrow.parquet as pq
+    monkeypatch.setattr(exports, "BATCH_SIZE", 4)
+    body = b"".join([c async for c in exports.stream_export(db, "bookings", "parquet", {})])
+    table = pq.read_table(io.BytesIO(body))
+    assert table.column("id").to_pylist() == [r["id"] for r in await read_csv(db, "bookings", {})]
+    assert pq.ParquetFile(io.BytesIO(body)).num_row_groups == 2
+
+
+async def test_unknown_format_is_rejected(db):
+    with pytest.raises(ExportError):
+        exports.encode_export(db, "bookings", "xlsx", {})
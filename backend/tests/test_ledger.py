@@ -0,0 +1,119 @@
+from datetime import datetime
+
+import pytest
+
+import exports
+from ledger import PLATFORM_ACCOUNT, Ledger, LedgerError, practitioner_account
+from memory_store import MemoryDatabase
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def db():
+    db = MemoryDatabase("ledger")
+    await Ledger(db.ledger_entries, db.ledger_balances, db.ledger_locks).ensure_indexes()
+    return db
+
+
+@pytest.fixture
+def ledger(db):
+    return Ledger(db.ledger_entries, db.ledger_balances, db.ledger_locks)
+
+
+def booking(booking_id, amount=1000, physio="p1", **fields):
+    return {"id": booking_id, "amount": amount, "payment_status": "paid", "assigned_physio_id": physio, **fields}
+
+
+async def test_replayed_events_are_recorded_once(ledger):
+    assert await ledger.record_payment(booking("b1"))
+    assert not await ledger.record_payment(booking("b1"))
+    assert await ledger.record_completion(booking("b1"))
+    assert not await ledger.record_completion(booking("b1"))
+
+    platform = await ledger.balance(PLATFORM_ACCOUNT)
+    assert (platform["revenue"], platform["commission"], platform["paid_bookings"]) == (1000, 300, 1)
+    assert platform["entry_count"] == 1
+    practitioner = await ledger.balance(practitioner_account("p1"))
+    assert (practitioner["earned"], practitioner["pending"], practitioner["entry_count"]) == (700, 700, 1)
+
+
+async def test_cancelling_a_paid_booking_reverses_its_payment(ledger):
+    await ledger.record_payment(booking("b1", 1000))
+    await ledger.record_payment(booking("b2", 500))
+    assert await ledger.record_cancellation(booking("b1", 1000))
+    assert not await ledger.record_cancellation(booking("b1", 1000))
+    # Unpaid bookings have nothing to reverse
+    assert not await ledger.record_cancellation(booking("b3", payment_status="pending"))
+
+    platform = await ledger.balance(PLATFORM_ACCOUNT)
+    assert platform["revenue"] == 500
+    assert platform["commission"] == 150
+    assert platform["paid_bookings"] == 1
+    assert (platform["refunded"], platform["refunded_bookings"]) == (1000, 1)
+
+
+async def test_completion_needs_a_paid_booking_with_a_physio(ledger):
+    assert not await ledger.record_completion(booking("b1", payment_status="pending"))
+    assert not await ledger.record_completion(booking("b2", physio=None))
+    assert await ledger.balance(practitioner_account("p1")) == {}
+
+
+async def test_payout_run_settles_pending_balances(ledger):
+    await ledger.record_completion(booking("b1", 1000, "p1"))
+    await ledger.record_completion(booking("b2", 100, "p2"))
+
+    preview = await ledger.run_payouts(min_amount=100, dry_run=True)
+    assert (preview["count"], preview["total"]) == (1, 700)
+
+    run = await ledger.run_payouts(min_amount=1)
+    assert sorted((p["practitioner_id"], p["amount"]) for p in run["payouts"]) == [("p1", 700), ("p2", 70)]
+    p1 = await ledger.balance(practitioner_account("p1"))
+    assert (p1["earned"], p1["pending"], p1["paid_out"]) == (700, 0, 700)
+    assert (await ledger.run_payouts())["count"] == 0
+
+
+async def test_payout_runs_do_not_overlap(ledger, db):
+    await db.ledger_locks.insert_one({"_id": "payout_run", "run_id": "other", "started_at": datetime.utcnow()})
+    await ledger.record_completion(booking("b1"))
+    with pytest.raises(LedgerError):
+        await ledger.run_payouts()
+
+
+async def test_rebuild_and_backfill_agree_with_recorded_entries(ledger, db):
+    await db.bookings.insert_many([
+        booking("b1", 1000, status="completed"),
+        booking("b2", 600, status="cancelled"),
+        booking("b3", 400, status="confirmed"),
+        booking("b4", 900, payment_status="pending", status="pending_payment"),
+    ])
+    assert await ledger.backfill(db.bookings) == {"payments": 3, "cancellations": 1, "completions": 1}
+    assert await ledger.backfill(db.bookings) == {"payments": 0, "cancellations": 0, "completions": 0}
+    before = await ledger.balance(PLATFORM_ACCOUNT)
+    await db.ledger_balances.update_one({"_id": PLATFORM_ACCOUNT}, {"$set": {"revenue": 0}})
+    assert await ledger.rebuild_balances() == 2
+    after = await ledger.balance(PLATFORM_ACCOUNT)
+    assert {k: after[k] for k in ("revenue", "commission", "paid_bookings", "refunded")} == \
+        {k: before[k] for k in ("revenue", "commission", "paid_bookings", "refunded")} == \
+        {"revenue": 1400, "commission": 420, "paid_bookings": 2, "refunded": 600}
+
+
+async def test_payouts_export_lists_ledger_earnings_and_payouts(ledger, db):
+    await db.bookings.insert_many([
+        booking("b1", 1000, status="completed"),
+        booking("b2", 600, status="cancelled"),
+        booking("b3", 400, status="confirmed"),
+    ])
+    await ledger.backfill(db.bookings)
+    run = await ledger.run_payouts()
+
+    rows = [row for batch in [b async for b in exports.iter_batches(db, "payouts", {})] for row in batch]
+    # Cancelled and not-yet-completed bookings earn nothing, so they are not exported
+    assert [(r["type"], r.get("booking_id"), r["amount"]) for r in rows] == [("completion", "b1", 700), ("payout", None, 700)]
+    assert rows[1]["run_id"] == run["run_id"]
+    assert all(r["practitioner_id"] == "p1" for r in rows)
+
+    only_payouts = [r async for b in exports.iter_batches(db, "payouts", {"status": "payout"}) for r in b]
+    assert [r["type"] for r in only_payouts] == ["payout"]
+    with pytest.raises(exports.ExportError):
+        exports.build_query("payouts", {"city": "Pune"})
@@ -0,0 +1,170 @@
+import io
+import json
+import logging
+import queue
+import random
+import sys
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from log_pipeline import (
+    ContextQueueHandler,
+    JsonFormatter,
+    RateLimitFilter,
+    RequestContext,
+    RequestContextMiddleware,
+    SamplingFilter,
+    configure_logging,
+    parse_rates,
+    request_context,
+)
+from tracing import Tracer
+
+
+def record(name="server.assign", level=logging.INFO, msg="assigned %s", args=("b1",)):
+    return logging.LogRecord(name, level, __file__, 1, msg, args, None)
+
+
+@pytest.fixture
+def bound_context():
+    context = RequestContext("req-1", "POST", "/api/bookings")
+    token = request_context.set(context)
+    yield context
+    request_context.reset(token)
+
+
+def test_parse_rates_reads_comma_separated_logger_rates():
+    assert parse_rates(" server.assign=0.1, voct.access=0.05 ,") == {
+        "server.assign": 0.1, "voct.access": 0.05,
+    }
+
+
+def test_sampling_uses_the_nearest_configured_parent_logger():
+    sampler = SamplingFilter({"server": 0.5, "server.assign": 0.1})
+    assert sampler.rate_for("server.assign.offers") == 0.1
+    assert sampler.rate_for("server.ws") == 0.5
+    assert sampler.rate_for("voct.access") == 1.0
+
+
+def test_sampling_keeps_the_configured_share_and_tags_it():
+    sampler = SamplingFilter({"server.assign": 0.25}, rng=random.Random(7))
+    kept = [r for r in (record() for _ in range(4000)) if sampler.filter(r)]
+    assert 800 < len(kept) < 1200
+    assert all(r.sample_rate == 0.25 for r in kept)
+
+
+def test_warnings_are_never_sampled_out():
+    sampler = SamplingFilter({"server.assign": 0.0})
+    assert not sampler.filter(record())
+    assert all(sampler.filter(record(level=logging.WARNING)) for _ in range(100))
+
+
+def test_repeated_warnings_collapse_and_report_the_suppressed_count(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("log_pipeline.time.monotonic", lambda: now[0])
+    limiter = RateLimitFilter(interval=60)
+    warning = lambda: record(level=logging.WARNING, msg="slow query on %s")  # noqa: E731
+
+    assert limiter.filter(warning())
+    assert [limiter.filter(warning()) for _ in range(3)] == [False] * 3
+    # A different template is tracked separately
+    assert limiter.filter(record(level=logging.WARNING, msg="other"))
+
+    now[0] += 61
+    resumed = warning()
+    assert limiter.filter(resumed)
+    assert resumed.suppressed == 3
+    # Only the configured level is limited
+    assert all(limiter.filter(record()) for _ in range(3))
+
+
+def test_queue_handler_attaches_context_and_trace_and_resolves_args(bound_context):
+    class Collector:
+        def submit(self, span):
+            pass
+
+    log_queue = queue.Queue()
+    handler = ContextQueueHandler(log_queue)
+    payload = {"state": "pending"}
+    with Tracer(Collector()).span("POST /api/bookings", "server") as span:
+        handler.handle(record(msg="booking %s", args=(payload,)))
+    payload["state"] = "confirmed"
+
+    queued = log_queue.get_nowait()
+    assert queued.context == {"request_id": "req-1", "method": "POST", "path": "/api/bookings"}
+    assert (queued.trace_id, queued.span_id) == (span.trace_id, span.span_id)
+    assert queued.msg == "booking {'state': 'pending'}" and queued.args is None
+    assert queued.template == "booking %s"
+    assert bound_context.log_records == 1 and bound_context.log_seconds > 0
+
+
+def test_queue_handler_drops_instead_of_blocking_when_full():
+    handler = ContextQueueHandler(queue.Queue(maxsize=2))
+    for _ in range(5):
+        handler.handle(record())
+    assert handler.queue.qsize() == 2
+    assert handler.dropped == 3
+
+
+def test_json_formatter_includes_context_extras_and_exception(bound_context):
+    handler = ContextQueueHandler(queue.Queue())
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        failure = logging.LogRecord("server", logging.ERROR, __file__, 1, "failed %s", ("b1",),
+                                    sys.exc_info())
+    failure.booking_id = "b1"
+    entry = json.loads(JsonFormatter().format(handler.prepare(failure)))
+
+    assert entry["level"] == "ERROR" and entry["logger"] == "server"
+    assert entry["message"] == "failed b1" and entry["template"] == "failed %s"
+    assert entry["context"]["request_id"] == "req-1"
+    assert entry["booking_id"] == "b1"
+    assert "ValueError: boom" in entry["exception"]
+
+
+def test_configure_logging_writes_json_from_the_listener_thread():
+    stream = io.StringIO()
+    root = logging.getLogger()
+    saved = (list(root.handlers), root.level)
+    pipeline = configure_logging("INFO", "json", stream=stream)
+    try:
+        logging.getLogger("voct.test").info("hello %s", "world")
+    finally:
+        pipeline.stop()
+        root.handlers[:] = saved[0]
+        root.setLevel(saved[1])
+    line = json.loads(stream.getvalue().splitlines()[-1])
+    assert (line["logger"], line["message"]) == ("voct.test", "hello world")
+    assert pipeline.stats() == {"queued": 0, "dropped": 0}
+
+
+def test_middleware_reuses_request_id_and_reports_logging_time():
+    app = FastAPI()
+    seen = {}
+
+    @app.get("/ping")
+    async def ping():
+        context = request_context.get()
+        seen["request_id"] = context.request_id
+        context.log_records += 2
+        context.log_seconds += 0.0015
+        return {}
+
+    app.add_middleware(RequestContextMiddleware)
+    response = TestClient(app).get("/ping", headers={"X-Request-ID": "proxy-42"})
+
+    assert seen["request_id"] == "proxy-42"
+    assert response.headers["x-request-id"] == "proxy-42"
+    assert response.headers["server-timing"] == 'log;dur=1.500;desc="2 records"'
+    assert request_context.get() is None
+
+
+def test_middleware_generates_a_request_id_when_none_is_sent():
+    app = FastAPI()
+    app.add_middleware(RequestContextMiddleware)
+    response = TestClient(app).get("/missing")
+    assert response.status_code == 404
+    assert len(response.headers["x-request-id"]) == 32
@@ -0,0 +1,160 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import migrations
+from memory_store import MemoryDatabase
+from migrations import (
+    BookingAssignmentStatus,
+    InlineSessionNotes,
+    MigrationError,
+    MigrationRunner,
+    upgrade,
+)
+from notes import NotesStore
+from storage import Storage
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def storage():
+    storage = Storage()
+    storage.bind(MemoryDatabase("test"), backend="memory")
+    await storage.bookings.insert_many([
+        {"id": f"b{n}", "assigned_physio_id": "p1" if n % 2 else None} for n in range(10)
+    ])
+    return storage
+
+
+def runner(storage, *extra):
+    return MigrationRunner(storage, storage.migrations, [BookingAssignmentStatus(), *extra])
+
+
+async def statuses(storage):
+    return {doc["id"]: doc["assignment_status"] for doc in await storage.bookings.find({}).to_list(None)}
+
+
+class FailingOnce(BookingAssignmentStatus):
+    """Fails on one booking the first time it is seen"""
+
+    projection = None
+
+    def __init__(self, booking_id):
+        self.booking_id = booking_id
+
+    async def migrate(self, doc, dry_run):
+        if self.booking_id is not None and doc.get("id") == self.booking_id:
+            self.booking_id = None
+            raise RuntimeError("connection reset")
+        return await super().migrate(doc, dry_run)
+
+
+async def test_a_dry_run_reports_samples_and_writes_nothing(storage):
+    result = await runner(storage).run("0001_booking_assignment_status", dry_run=True, batch_size=3)
+    assert (result["scanned"], result["migrated"]) == (10, 10)
+    assert len(result["samples"]) == migrations.DRY_RUN_SAMPLES
+    assert result["samples"][0]["update"] == {"$set": {"assignment_status": "unassigned"}}
+    assert await storage.bookings.count_documents({"assignment_status": {"$exists": True}}) == 0
+    assert await storage.migrations.count_documents({}) == 0
+
+
+async def test_a_run_migrates_in_keyset_batches_and_completes_once(storage):
+    seen = []
+
+    async def progress(scanned, migrated):
+        seen.append(scanned)
+
+    run = runner(storage)
+    result = await run.run("0001_booking_assignment_status", batch_size=4, progress=progress)
+    assert (result["scanned"], result["migrated"]) == (10, 10)
+    assert seen == [4, 8, 10]
+    assert set((await statuses(storage)).values()) == {"assigned", "unassigned"}
+    assert (await statuses(storage))["b1"] == "assigned"
+
+    [status] = await run.status()
+    assert status["status"] == "completed" and "last_key" not in status
+    with pytest.raises(MigrationError, match="is completed"):
+        await run.run("0001_booking_assignment_status")
+    with pytest.raises(MigrationError, match="Unknown migration"):
+        await run.run("0999_missing")
+
+
+async def test_a_failed_run_resumes_after_its_last_checkpoint(storage):
+    failing = FailingOnce("b5")
+    run = MigrationRunner(storage, storage.migrations, [failing])
+
+    with pytest.raises(RuntimeError, match="connection reset"):
+        await run.run(failing.id, batch_size=2)
+    state = await storage.migrations.find_one({"id": failing.id})
+    assert (state["status"], state["scanned"], state["error"]) == ("failed", 4, "connection reset")
+    assert await storage.bookings.count_documents({"assignment_status": {"$exists": True}}) == 4
+
+    result = await run.run(failing.id, batch_size=2)
+    # Counts carry on from the checkpoint instead of rescanning
+    assert (result["scanned"], result["migrated"]) == (10, 10)
+    assert len(await statuses(storage)) == 10
+
+
+async def test_a_live_lease_keeps_a_second_worker_out(storage):
+    await storage.migrations.insert_one({
+        "id": "0001_booking_assignment_status", "status": "running", "last_key": None, "scanned": 0,
+        "migrated": 0, "lease_until": datetime.utcnow() + timedelta(minutes=1),
+    })
+    with pytest.raises(MigrationError, match="is running"):
+        await runner(storage).run("0001_booking_assignment_status")
+
+    # Once the lease lapses the worker is presumed dead and the run is taken over
+    await storage.migrations.update_one({"id": "0001_booking_assignment_status"},
+                                        {"$set": {"lease_until": datetime.utcnow() - timedelta(seconds=1)}})
+    assert (await runner(storage).run("0001_booking_assignment_status"))["migrated"] == 10
+
+
+async def test_a_handlers_concurrent_write_wins_over_the_migration(storage):
+    class Racing(BookingAssignmentStatus):
+        async def migrate(self, doc, dry_run):
+            # A handler assigns b0 between the read and the bulk write
+            if doc.get("_id") == first["_id"]:
+                await storage.bookings.update_one({"id": "b0"}, {"$set": {"assignment_status": "offered"}})
+            return await super().migrate(doc, dry_run)
+
+    first = await storage.bookings.find_one({"id": "b0"})
+    await MigrationRunner(storage, storage.migrations, [Racing()]).run("0001_booking_assignment_status")
+    assert (await statuses(storage))["b0"] == "offered"
+
+
+async def test_writes_are_throttled_to_the_configured_rate(storage, monkeypatch):
+    slept = []
+
+    async def sleep(seconds):
+        slept.append(seconds)
+
+    monkeypatch.setattr(migrations.asyncio, "sleep", sleep)
+    await runner(storage).run("0001_booking_assignment_status", batch_size=5, max_per_second=10)
+    # 5 writes at 10/s should take half a second, 10 writes a second
+    assert len(slept) == 2 and 0.4 < slept[0] <= 0.5 and 0.9 < slept[1] <= 1.0
+
+
+def test_old_shape_documents_are_upgraded_as_they_are_read():
+    migration_list = [BookingAssignmentStatus()]
+    assert upgrade(migration_list, "bookings", {"id": "b1", "assigned_physio_id": "p1"})["assignment_status"] \
+        == "assigned"
+    assert upgrade(migration_list, "bookings", {"id": "b2", "assignment_status": "offered"})["assignment_status"] \
+        == "offered"
+    assert "assignment_status" not in upgrade(migration_list, "users", {"id": "u1"})
+    assert upgrade(migration_list, "bookings", None) is None
+
+
+async def test_inline_session_notes_move_to_the_notes_store_once(storage):
+    store = NotesStore(storage.session_notes, storage.session_note_chunks)
+    await storage.bookings.update_one({"id": "b1"}, {"$set": {"session_notes": "Ice twice daily"}})
+    await storage.bookings.update_one({"id": "b2"}, {"$set": {"session_notes": ""}})
+    # A previous run saved b1's notes and crashed before updating the booking
+    await store.save("b1", b"Ice twice daily", author="physio:p1")
+
+    run = MigrationRunner(storage, storage.migrations, [InlineSessionNotes(store)])
+    result = await run.run("0002_inline_session_notes")
+    assert result["migrated"] == 2
+    assert await storage.bookings.count_documents({"session_notes": {"$exists": True}}) == 0
+    assert (await storage.bookings.get("b1"))["notes_version"] == 1
+    assert [v["version"] for v in await store.history("b1")] == [1]
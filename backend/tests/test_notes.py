@@ -0,0 +1,106 @@
+import os
+
+import pytest
+from pymongo.errors import DuplicateKeyError
+
+import notes
+from memory_store import MemoryDatabase
+from notes import NotesStore, decode, encode
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def store():
+    database = MemoryDatabase("test")
+    store = NotesStore(database.session_notes, database.session_note_chunks)
+    await store.ensure_indexes()
+    return store
+
+
+def test_short_or_incompressible_content_is_stored_as_is():
+    short = encode(b"Knee ROM improved")
+    assert (short["encoding"], short["chunks"]) == ("identity", [b"Knee ROM improved"])
+    noise = os.urandom(4096)
+    assert encode(noise)["encoding"] == "identity"
+    assert encode(b"")["chunks"] == [b""]
+
+
+def test_compressible_content_round_trips_through_zlib():
+    content = b"Patient reports reduced pain on flexion. " * 200
+    encoded = encode(content)
+    assert encoded["encoding"] == "zlib" and encoded["stored_size"] < encoded["size"] == len(content)
+    assert decode(encoded["encoding"], encoded["chunks"]) == content
+
+
+async def test_saves_are_versioned_and_listed_without_content(store):
+    first = await store.save("b1", b"Initial assessment", author="physio:p1")
+    second = await store.save("b1", b"Follow-up", author="physio:p1")
+    await store.save("b1", b"%PDF-1.7", author="physio:p1", kind="attachment", name="xray.pdf",
+                     content_type="application/pdf")
+
+    assert (first["version"], second["version"]) == (1, 2)
+    assert "data" not in second and "chunks" not in second
+    assert (await store.load("b1"))["content"] == b"Follow-up"
+    assert (await store.load("b1", version=1))["content"] == b"Initial assessment"
+    assert (await store.load("b1", kind="attachment"))["name"] == "xray.pdf"
+    assert await store.load("b2") is None
+
+    history = await store.history("b1")
+    assert [(v["kind"], v["version"]) for v in history] == [("attachment", 1), ("note", 2), ("note", 1)]
+    assert all("data" not in v for v in history)
+
+
+async def test_large_content_is_split_into_chunks(store, monkeypatch):
+    monkeypatch.setattr(notes, "CHUNK_SIZE", 1024)
+    content = os.urandom(3000)
+    saved = await store.save("b1", content, author="physio:p1")
+
+    assert saved["chunk_count"] == 3
+    assert await store.chunks.count_documents({"note_id": saved["id"]}) == 3
+    assert "data" not in await store.versions.find_one({"id": saved["id"]})
+    assert (await store.load("b1"))["content"] == content
+
+
+async def test_a_concurrent_save_takes_the_next_version(store, monkeypatch):
+    await store.save("b1", b"first", author="physio:p1")
+    stale = [{"version": 0}]
+    latest = store.latest
+
+    async def racing_latest(booking_id, kind="note"):
+        # The first read is from before another save landed
+        return stale.pop() if stale else await latest(booking_id, kind)
+
+    monkeypatch.setattr(store, "latest", racing_latest)
+    saved = await store.save("b1", b"second", author="physio:p2")
+    assert saved["version"] == 2
+
+
+async def test_giving_up_on_contention_removes_the_orphaned_chunks(store, monkeypatch):
+    monkeypatch.setattr(notes, "CHUNK_SIZE", 1024)
+
+    async def always_taken(doc):
+        raise DuplicateKeyError("E11000")
+
+    monkeypatch.setattr(store.versions, "insert_one", always_taken)
+    with pytest.raises(RuntimeError, match="too many concurrent saves"):
+        await store.save("b1", os.urandom(3000), author="physio:p1")
+    assert await store.chunks.count_documents({}) == 0
+
+
+async def test_notes_routes_keep_only_the_version_on_the_booking(server):
+    await server.session_notes.ensure_indexes()
+    await server.db.bookings.insert_one({"id": "b1", "assigned_physio_id": "p1", "status": "completed"})
+
+    update = server.SessionNotesUpdate(notes="Reduced swelling")
+    assert (await server.update_session_notes("p1", "b1", update))["version"] == 1
+    booking = await server.db.bookings.get("b1")
+    assert booking["notes_version"] == 1 and "session_notes" not in booking
+
+    note = await server.get_session_notes("p1", "b1")
+    assert (note["notes"], note["author"]) == ("Reduced swelling", "physio:p1")
+    history = await server.get_session_notes_history("p1", "b1")
+    assert [v["version"] for v in history["versions"]] == [1]
+    with pytest.raises(server.HTTPException) as e:
+        await server.get_session_notes("p2", "b1")
+    assert e.value.status_code == 404
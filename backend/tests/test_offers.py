@@ -0,0 +1,139 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from booking_state import TransitionRejected
+from offers import OfferPolicy, OfferTimers, pick_candidates, policy_for
+
+pytestmark = pytest.mark.anyio
+
+
+def physio(physio_id, active=0, city="Pune"):
+    return {
+        "id": physio_id, "is_available": True, "is_verified": True,
+        "personal_details": {"full_name": physio_id.upper(), "city": city, "gender": "female"},
+        "workload": {"active_bookings": active},
+    }
+
+
+@pytest.fixture
+async def broadcast(server, monkeypatch):
+    """Broadcast assignment with p1-p3 online; messages are recorded instead of sent"""
+    sent = []
+
+    async def send_to_physio(physio_id, message):
+        sent.append((physio_id, message["type"]))
+        return True
+
+    async def send_to_user(user_id, message):
+        sent.append((user_id, message["type"]))
+        return True
+
+    monkeypatch.setattr(server, "ASSIGNMENT_MODE", "broadcast")
+    monkeypatch.setattr(server, "OFFER_POLICIES", {"default": OfferPolicy(k=2, timeout_seconds=60)})
+    monkeypatch.setattr(server, "offer_timers", OfferTimers())
+    monkeypatch.setattr(server.manager, "physio_connections", {"p1": object(), "p2": object(), "p3": object()})
+    monkeypatch.setattr(server.manager, "send_to_physio", send_to_physio)
+    monkeypatch.setattr(server.manager, "send_to_user", send_to_user)
+
+    await server.db.practitioners.insert_many([physio("p1", 0), physio("p2", 1), physio("p3", 2), physio("p4", 0),
+                                               physio("p5", 0, city="Delhi")])
+    await server.db.bookings.insert_one({
+        "id": "b1", "user_id": "u1", "city": " pune", "service_type": "orthopaedic", "session_count": 1,
+        "status": "confirmed", "payment_status": "paid", "assignment_status": "unassigned",
+        "assigned_physio_id": None,
+    })
+    # Handed to the tests along with the module
+    monkeypatch.setattr(server, "sent", sent, raising=False)
+    yield server
+    for task in list(server.offer_timers.tasks.values()):
+        task.cancel()
+
+
+def test_candidates_are_the_top_k_online_physios():
+    physios = [{"id": p} for p in ("a", "b", "c", "d")]
+    assert [p["id"] for p in pick_candidates(physios, {"d", "b", "a"}, 2)] == ["a", "b"]
+    policies = {"default": OfferPolicy(3, 60), "sports": OfferPolicy(5, 45)}
+    assert policy_for(policies, "sports").k == 5 and policy_for(policies, "other").k == 3
+
+
+async def test_timers_fire_once_and_are_replaced_or_cancelled():
+    timers, fired = OfferTimers(), []
+
+    async def record(name):
+        fired.append(name)
+
+    timers.schedule("b1", 0.01, lambda: record("first"))
+    timers.schedule("b1", 0.01, lambda: record("second"))
+    timers.schedule("b2", 0.01, lambda: record("cancelled"))
+    timers.cancel("b2")
+    await asyncio.sleep(0.05)
+    assert fired == ["second"] and len(timers) == 0
+
+
+async def test_booking_is_offered_to_the_least_busy_online_physios_in_its_city(broadcast):
+    await broadcast.assign_physio("b1")
+    booking = await broadcast.db.bookings.get("b1")
+    # p4 is idle but offline, p5 is in another city
+    assert (booking["assignment_status"], booking["offered_physio_ids"], booking["offer_round"]) == \
+        ("offered", ["p1", "p2"], 1)
+    assert broadcast.sent == [("p1", "booking_offer"), ("p2", "booking_offer")]
+    assert "b1" in broadcast.offer_timers.tasks
+
+
+async def test_first_accept_wins_and_the_others_are_withdrawn(broadcast):
+    await broadcast.assign_physio("b1")
+    broadcast.sent.clear()
+
+    await asyncio.gather(
+        broadcast.answer_offer("b1", "p2", True),
+        broadcast.answer_offer("b1", "p1", True),
+        return_exceptions=True,
+    )
+    booking = await broadcast.db.bookings.get("b1")
+    winner = booking["assigned_physio_id"]
+    loser = {"p1", "p2"} - {winner}
+    assert booking["assignment_status"] == "accepted" and booking["offered_physio_ids"] == []
+    assert (winner, "offer_confirmed") in broadcast.sent
+    assert (loser.pop(), "offer_withdrawn") in broadcast.sent
+    assert "b1" not in broadcast.offer_timers.tasks
+    # The winner's workload counter is bumped
+    assert (await broadcast.db.practitioners.find_one({"id": winner}))["workload"]["active_bookings"] >= 1
+
+
+async def test_physios_outside_the_round_cannot_accept(broadcast):
+    await broadcast.assign_physio("b1")
+    with pytest.raises(TransitionRejected):
+        await broadcast.answer_offer("b1", "p3", True)
+
+
+async def test_when_everyone_declines_the_next_round_starts_at_once(broadcast):
+    await broadcast.assign_physio("b1")
+    await broadcast.answer_offer("b1", "p1", False)
+    assert (await broadcast.db.bookings.get("b1"))["offer_round"] == 1
+    await broadcast.answer_offer("b1", "p2", False)
+
+    booking = await broadcast.db.bookings.get("b1")
+    assert (booking["offer_round"], booking["offered_physio_ids"]) == (2, ["p3"])
+    assert set(booking["rejected_physio_ids"]) == {"p1", "p2"}
+
+
+async def test_sweep_expires_rounds_whose_timer_was_lost(broadcast):
+    await broadcast.assign_physio("b1")
+    broadcast.offer_timers.cancel("b1")
+    assert await broadcast.sweep_expired_offers() == 0
+
+    await broadcast.db.bookings.update_one({"id": "b1"}, {"$set": {"offer_expires_at": datetime.utcnow() - timedelta(seconds=1)}})
+    assert await broadcast.sweep_expired_offers() == 1
+    booking = await broadcast.db.bookings.get("b1")
+    assert (booking["offer_round"], booking["offered_physio_ids"]) == (2, ["p3"])
+    # An expiry for the closed round (a late timer, another worker's sweep) is ignored
+    await broadcast.expire_offer("b1", 1, ["p1", "p2"])
+    assert (await broadcast.db.bookings.get("b1"))["offer_round"] == 2
+
+
+async def test_no_candidates_left_marks_the_booking(broadcast):
+    await broadcast.db.bookings.update_one({"id": "b1"}, {"$set": {"rejected_physio_ids": ["p1", "p2", "p3", "p4"]}})
+    await broadcast.assign_physio("b1")
+    assert (await broadcast.db.bookings.get("b1"))["assignment_status"] == "no_physio_available"
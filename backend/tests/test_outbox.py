@@ -0,0 +1,126 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import outbox as outbox_module
+from memory_store import MemoryDatabase
+from outbox import Outbox
+
+pytestmark = pytest.mark.anyio
+
+
+class Socket:
+    """Records what the manager pushes; with `fail` every send raises"""
+
+    def __init__(self, fail=False):
+        self.sent = []
+        self.fail = fail
+
+    async def accept(self):
+        pass
+
+    async def send_messages(self, messages):
+        if self.fail:
+            raise ConnectionResetError("socket closed")
+        self.sent.extend(messages)
+
+    def seqs(self):
+        return [m["seq"] for m in self.sent]
+
+
+@pytest.fixture
+async def outbox():
+    database = MemoryDatabase("test")
+    outbox = Outbox(database.outbox_messages, database.outbox_sequences, ttl=timedelta(hours=1))
+    await outbox.ensure_indexes()
+    return outbox
+
+
+@pytest.fixture
+def manager(server, outbox):
+    return server.ConnectionManager(outbox)
+
+
+async def test_messages_are_numbered_per_recipient(outbox):
+    assert [await outbox.append("user:u1", {"type": "ping"}) for _ in range(3)] == [1, 2, 3]
+    assert await outbox.append("user:u2", {"type": "ping"}) == 1
+    assert await outbox.head("user:u1") == 3 and await outbox.head("user:u3") == 0
+    assert await outbox.since("user:u1", 1) == [{"type": "ping", "seq": 2}, {"type": "ping", "seq": 3}]
+
+
+async def test_replay_returns_what_the_client_missed(outbox):
+    for n in range(4):
+        await outbox.append("user:u1", {"type": "booking_update", "n": n})
+    assert [m["seq"] for m in await outbox.replay("user:u1", 2)] == [3, 4]
+    assert await outbox.replay("user:u1", 4) == []
+
+
+@pytest.mark.parametrize("after", [0, 9])
+async def test_an_expired_position_or_one_ahead_of_the_server_is_a_gap(outbox, after):
+    for _ in range(3):
+        await outbox.append("user:u1", {"type": "ping"})
+    await outbox.messages.update_one({"seq": 1}, {"$set": {"expires_at": datetime.utcnow() - timedelta(seconds=1)}})
+    assert await outbox.replay("user:u1", after) == [{"type": "replay_gap", "seq": 3}]
+
+
+async def test_falling_too_far_behind_is_a_gap(outbox, monkeypatch):
+    monkeypatch.setattr(outbox_module, "REPLAY_LIMIT", 2)
+    for _ in range(3):
+        await outbox.append("user:u1", {"type": "ping"})
+    assert await outbox.replay("user:u1", 0) == [{"type": "replay_gap", "seq": 3}]
+    assert len(await outbox.replay("user:u1", 1)) == 2
+
+
+async def test_messages_sent_while_offline_are_replayed_on_reconnect(manager):
+    assert not await manager.send_to_user("u1", {"type": "booking_update", "status": "assigned"})
+    assert not await manager.send_to_user("u1", {"type": "booking_update", "status": "en_route"})
+
+    socket = Socket()
+    await manager.connect_user("u1", socket, last_seq=0)
+    assert [(m["seq"], m["status"]) for m in socket.sent] == [(1, "assigned"), (2, "en_route")]
+
+    assert await manager.send_to_user("u1", {"type": "booking_update", "status": "arrived"})
+    assert socket.seqs() == [1, 2, 3]
+
+
+async def test_a_client_without_last_seq_starts_from_now(manager):
+    await manager.send_to_physio("p1", {"type": "new_booking"})
+    socket = Socket()
+    await manager.connect_physio("p1", socket)
+    assert socket.sent == []
+    assert await manager.send_to_physio("p1", {"type": "new_booking"})
+    assert socket.seqs() == [2]
+
+
+async def test_a_dead_socket_is_dropped_and_the_message_kept(manager):
+    await manager.connect_user("u1", Socket(fail=True), last_seq=0)
+    assert not await manager.send_to_user("u1", {"type": "booking_update"})
+    assert "u1" not in manager.active_connections
+
+    socket = Socket()
+    await manager.connect_user("u1", socket, last_seq=0)
+    assert socket.seqs() == [1]
+
+
+async def test_closing_a_replaced_socket_keeps_the_new_one(manager):
+    old, new = Socket(), Socket()
+    await manager.connect_user("u1", old, last_seq=0)
+    await manager.connect_user("u1", new, last_seq=0)
+    manager.disconnect_user("u1", old)
+    assert manager.active_connections["u1"] is new
+    assert await manager.send_to_user("u1", {"type": "ping"})
+    assert new.seqs() == [1] and old.sent == []
+
+
+async def test_out_of_order_sends_push_up_to_the_first_hole(manager, outbox):
+    socket = Socket()
+    await manager.connect_user("u1", socket, last_seq=0)
+    # Seq 1 is taken by a send whose message isn't stored yet
+    await outbox.sequences.update_one({"recipient": "user:u1"}, {"$inc": {"seq": 1}}, upsert=True)
+    assert not await manager.send_to_user("u1", {"type": "second"})
+    assert socket.sent == []
+
+    await outbox.messages.insert_one({"recipient": "user:u1", "seq": 1, "message": {"type": "first"},
+                                      "expires_at": datetime.utcnow() + timedelta(hours=1)})
+    assert await manager.send_to_user("u1", {"type": "third"})
+    assert [(m["seq"], m["type"]) for m in socket.sent] == [(1, "first"), (2, "second"), (3, "third")]
@@ -0,0 +1,126 @@
+import pytest
+
+import partitions
+from memory_store import MemoryDatabase
+from partitions import PartitionedCollection, PartitionMap, move_city, parse_partitions, physical_name
+from storage import Storage
+
+pytestmark = pytest.mark.anyio
+
+CITIES = {"mumbai": "west", "pune": "west", "bengaluru": "south"}
+
+
+@pytest.fixture
+async def storage():
+    storage = Storage()
+    storage.bind(MemoryDatabase("test"), backend="memory")
+    return storage
+
+
+@pytest.fixture
+async def partition_map(storage):
+    partition_map = PartitionMap(storage.partition_map, CITIES)
+    await partition_map.load()
+    return partition_map
+
+
+@pytest.fixture
+async def bookings(storage, partition_map):
+    bookings = PartitionedCollection(storage, "bookings", "city", partition_map)
+    storage.partition("bookings", bookings)
+    await bookings.insert_many([
+        {"id": "b1", "city": "Mumbai", "amount": 500, "created_at": 3},
+        {"id": "b2", "city": "Pune", "amount": 700, "created_at": 1},
+        {"id": "b3", "city": "Bengaluru", "amount": 600, "created_at": 2},
+        {"id": "b4", "city": "Delhi", "amount": 800, "created_at": 4},
+    ])
+    return bookings
+
+
+def physical(storage, partition):
+    return storage.database[physical_name("bookings", partition)]
+
+
+def test_parse_partitions_normalises_city_names():
+    assert parse_partitions(" Mumbai=west, Pune = west,Delhi=") == {
+        "mumbai": "west", "pune": "west", "delhi": "default",
+    }
+    assert physical_name("bookings", "default") == "bookings"
+    assert physical_name("bookings", "west") == "bookings__west"
+
+
+async def test_the_stored_map_keeps_earlier_assignments_over_the_seed(storage, partition_map):
+    await partition_map.assign("Pune", "central")
+    restarted = PartitionMap(storage.partition_map, CITIES)
+    await restarted.load()
+    assert restarted.partition_for(" PUNE ") == "central"
+    assert restarted.partition_for("Delhi") == "default"
+    assert restarted.partitions() == ["central", "default", "south", "west"]
+
+
+async def test_documents_are_stored_in_their_citys_partition(storage, bookings):
+    assert sorted(d["id"] for d in await physical(storage, "west").find({}).to_list(None)) == ["b1", "b2"]
+    assert [d["id"] for d in await physical(storage, "south").find({}).to_list(None)] == ["b3"]
+    assert [d["id"] for d in await physical(storage, "default").find({}).to_list(None)] == ["b4"]
+    # Repositories route through the partitioned collection
+    assert (await storage.bookings.get("b3"))["city"] == "Bengaluru"
+    assert storage.bookings.for_city("pune") is physical(storage, "west")
+
+
+async def test_queries_naming_the_city_target_one_partition(bookings):
+    assert bookings.targets({"city": "Mumbai"}) == ["west"]
+    assert bookings.targets({"city": {"$in": ["Pune", "Bengaluru"]}}) == ["south", "west"]
+    assert bookings.targets({"status": "pending"}) == ["default", "south", "west"]
+    assert bookings.targets({"id": "b3"})[0] == "south"
+
+
+async def test_scattered_finds_merge_in_sort_order_with_skip_and_limit(bookings):
+    docs = await bookings.find({}, {"_id": 0}).sort("created_at", -1).skip(1).limit(2).to_list(None)
+    assert [d["id"] for d in docs] == ["b1", "b3"]
+    assert await bookings.count_documents({"amount": {"$gte": 600}}) == 3
+    newest = await bookings.find_one({"amount": {"$lt": 800}}, {"_id": 0}, sort=[("created_at", -1)])
+    assert newest["id"] == "b1"
+
+
+async def test_writes_by_id_fall_back_when_the_cached_partition_is_stale(storage, bookings):
+    # b4 moved out of default behind this worker's back
+    doc = await physical(storage, "default").find_one_and_delete({"id": "b4"})
+    await physical(storage, "south").insert_one(doc)
+
+    result = await bookings.update_one({"id": "b4"}, {"$set": {"status": "confirmed"}})
+    assert result.matched_count == 1
+    assert bookings.locations["b4"] == "south"
+    assert (await bookings.find_one({"id": "b4"}))["status"] == "confirmed"
+
+
+async def test_grouped_aggregates_combine_across_partitions(bookings):
+    totals = await bookings.aggregate([
+        {"$match": {"amount": {"$gt": 0}}},
+        {"$group": {"_id": None, "revenue": {"$sum": "$amount"}, "largest": {"$max": "$amount"}}},
+    ]).to_list(None)
+    assert totals == [{"_id": None, "revenue": 2600, "largest": 800}]
+    with pytest.raises(NotImplementedError, match=r"\$avg"):
+        await bookings.aggregate([{"$group": {"_id": None, "mean": {"$avg": "$amount"}}}]).to_list(None)
+
+
+async def test_moving_a_city_copies_reconciles_and_repoints(storage, partition_map, bookings, monkeypatch):
+    await bookings.create_index("id", unique=True)
+    await bookings.insert_one({"id": "b5", "city": "pune", "amount": 100, "created_at": 5})
+
+    async def traffic_while_settling(seconds):
+        # Written to the source after the copy, by a worker still on the old map
+        await physical(storage, "west").update_one({"id": "b2"}, {"$set": {"status": "confirmed"}})
+        await physical(storage, "west").insert_one({"id": "b6", "city": "Pune", "amount": 50})
+
+    monkeypatch.setattr(partitions.asyncio, "sleep", traffic_while_settling)
+    result = await move_city([bookings], partition_map, "Pune", "central", batch_size=1)
+
+    assert (result["source"], result["destination"]) == ("west", "central")
+    assert (result["copied"], result["recopied"], result["moved"], result["conflicts"]) == (2, 2, 3, 0)
+    assert partition_map.partition_for("pune") == "central"
+    central = await physical(storage, "central").find({}, {"_id": 0}).sort("id", 1).to_list(None)
+    assert [d["id"] for d in central] == ["b2", "b5", "b6"]
+    assert central[0]["status"] == "confirmed"
+    assert [d["id"] for d in await physical(storage, "west").find({}).to_list(None)] == ["b1"]
+    # The new partition got the same indexes before taking documents
+    assert ("id",) in physical(storage, "central").unique
@@ -0,0 +1,136 @@
+import json
+
+import pytest
+
+import practitioner_import
+
+pytestmark = pytest.mark.anyio
+
+RECORD = {
+    "personal_details": {
+        "full_name": "José Müller", "age": 31, "gender": "male", "contact_number": "9000000001",
+        "email": "jose@example.com", "mothers_name": "Zoë", "permanent_address": "12 Ring Rd",
+        "pin_code": "411001", "city": "Pune",
+    },
+    "education": {
+        "institution_name": "Institute", "location": "Pune", "degree": "BPT",
+        "aggregate_percentage": 72.5, "year_of_graduation": 2015, "registration_no": "MH-1",
+    },
+    "bank_details": {
+        "bank_name": "Bank", "branch_name": "Main", "branch_address": "1 Main St", "account_number": "1",
+        "ifsc_code": "IFSC0001", "pan_card_number": "PAN1", "aadhar_number": "1111",
+    },
+    "joining_details": {
+        "years_of_experience": 5, "has_electrotherapy_equipment": True, "travel_distance": "10km",
+        "emergency_availability": "yes", "unique_practice": "manual therapy", "standout_quality": "patience",
+    },
+}
+
+
+def record(n, **personal):
+    return {
+        **RECORD,
+        "personal_details": {**RECORD["personal_details"], "email": f"p{n}@example.com", **personal},
+        "education": {**RECORD["education"], "registration_no": f"MH-{n}"},
+    }
+
+
+def flatten(doc, prefix=""):
+    flat = {}
+    for key, value in doc.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        else:
+            flat[f"{prefix}{key}"] = str(value)
+    return flat
+
+
+class Upload:
+    """Hands out a few bytes per read, so multibyte characters straddle chunks"""
+
+    def __init__(self, data: bytes, size: int = 3):
+        self.data = data
+        self.size = size
+
+    async def read(self, _n):
+        chunk, self.data = self.data[:self.size], self.data[self.size:]
+        return chunk
+
+
+async def run_import(server, data, fmt, size=3):
+    return await practitioner_import.import_practitioners(
+        Upload(data, size), fmt, server.db.practitioners, server.PractitionerCreate, server.Practitioner
+    )
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7])
+async def test_csv_with_bom_and_multibyte_text_split_across_chunks(server, size):
+    rows = [flatten(record(1)), flatten(record(2, full_name="Zoë Ærø")), flatten(record(1))]
+    header = list(rows[0])
+    lines = [",".join(header)] + [",".join(row[h] for h in header) for row in rows]
+    data = "﻿".encode() + "\n".join(lines).encode("utf-8")
+
+    report = await run_import(server, data, "csv", size)
+
+    assert report["summary"] == {"rows": 3, "created": 2, "invalid": 0, "duplicate": 1}
+    assert [r["status"] for r in report["rows"]] == ["created", "created", "duplicate"]
+    stored = await server.db.practitioners.by_email("p2@example.com")
+    assert stored["personal_details"]["full_name"] == "Zoë Ærø"
+    assert stored["personal_details"]["mothers_name"] == "Zoë"
+
+
+async def test_jsonl_reports_each_row(server):
+    await server.db.practitioners.insert_one(server.Practitioner(**record(3)).dict())
+    missing_email = record(4)
+    del missing_email["personal_details"]["email"]
+    lines = [json.dumps(record(1), ensure_ascii=False), "{not json", json.dumps(missing_email),
+             json.dumps(record(3)), "", json.dumps(record(5, full_name="Ünal"), ensure_ascii=False)]
+    report = await run_import(server, "\n".join(lines).encode("utf-8"), "jsonl")
+
+    statuses = {r["row"]: r["status"] for r in report["rows"]}
+    assert statuses == {1: "created", 2: "invalid", 3: "invalid", 4: "duplicate", 5: "created"}
+    assert report["rows"][1]["errors"][0].startswith("Invalid JSON")
+    assert any("email" in e for e in report["rows"][2]["errors"])
+    assert (await server.db.practitioners.by_email("p5@example.com"))["personal_details"]["full_name"] == "Ünal"
+
+
+async def test_bom_is_only_stripped_at_the_start(server):
+    lines = [json.dumps(record(1, full_name="﻿Leading"), ensure_ascii=False)]
+    # The chunk boundary falls right before the U+FEFF inside the row
+    data = "\n".join(lines).encode("utf-8")
+    size = data.index("﻿".encode())
+    report = await run_import(server, data, "jsonl", size)
+    assert report["summary"]["created"] == 1
+    assert (await server.db.practitioners.by_email("p1@example.com"))["personal_details"]["full_name"] == "﻿Leading"
+
+
+async def test_stored_applications_are_matched_on_either_key_ignoring_case(server):
+    # No unique indexes are built here, as when ensure_indexes found duplicates
+    legacy = record(1, email="Legacy@Example.com")
+    legacy["education"]["registration_no"] = "mh-100"
+    await server.db.practitioners.insert_one(server.Practitioner(**legacy).dict())
+
+    same_registration = record(2)
+    same_registration["education"]["registration_no"] = " MH-100 "
+    lines = [json.dumps(r) for r in (record(3, email="LEGACY@example.com "), same_registration, record(4))]
+    report = await run_import(server, "\n".join(lines).encode(), "jsonl", size=4096)
+
+    assert [(r["status"], r.get("reason")) for r in report["rows"]] == [
+        ("duplicate", "Application already exists"),
+        ("duplicate", "Registration number already registered"),
+        ("created", None),
+    ]
+    # Imported keys are stored normalised, so the next upload matches them by either form
+    stored = await server.db.practitioners.find_one({"personal_details.email": "p4@example.com"})
+    assert stored["education"]["registration_no"] == "MH-4"
+    again = record(5, email="P4@EXAMPLE.COM")
+    report = await run_import(server, json.dumps(again).encode(), "jsonl", size=4096)
+    assert report["rows"][0]["status"] == "duplicate"
+
+
+async def test_applications_are_stored_with_normalised_keys(server):
+    application = record(6, email=" Mixed@Example.COM")
+    application["education"]["registration_no"] = "mh-6 "
+    saved = server.Practitioner(**server.practitioner_import.normalise_keys(
+        server.PractitionerCreate(**application)).dict())
+    assert (saved.personal_details.email, saved.education.registration_no) == ("mixed@example.com", "MH-6")
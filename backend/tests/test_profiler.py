@@ -0,0 +1,83 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import profiler
+from profiler import ProfileStore, ProfilerMiddleware, to_collapsed
+
+pytestmark = pytest.mark.anyio
+
+
+async def slow_handler():
+    await asyncio.sleep(0.02)
+    sum(range(200_000))
+
+
+async def app(scope, receive, send):
+    await slow_handler()
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"ok"})
+
+
+async def authorise(token):
+    return token == "admin"
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ProfileStore(tmp_path)
+
+
+@pytest.fixture
+def client(store):
+    middleware = ProfilerMiddleware(app, authorise, store, interval=0.001)
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=middleware), base_url="http://test")
+
+
+async def test_admin_request_is_profiled_and_saved(client, store):
+    async with client:
+        response = await client.get("/api/bookings", headers={"X-Profile": "1", "Authorization": "Bearer admin"})
+    profile_id = response.headers["x-profile-id"]
+    [entry] = store.list()
+    assert (entry["id"], entry["request"], entry["status"]) == (profile_id, "GET /api/bookings", 200)
+    assert entry["samples"] > 0
+    assert "slow_handler" in to_collapsed(store.load(profile_id))
+
+
+@pytest.mark.parametrize("headers, path", [
+    ({"X-Profile": "1"}, "/api/bookings"),
+    ({"X-Profile": "1", "Authorization": "Bearer patient"}, "/api/bookings"),
+    ({"Authorization": "Bearer admin"}, "/api/bookings"),
+    ({"X-Profile": "1", "Authorization": "Bearer admin"}, "/health"),
+])
+async def test_other_requests_are_not_profiled(client, store, headers, path):
+    async with client:
+        response = await client.get(path, headers=headers)
+    assert "x-profile-id" not in response.headers
+    assert store.list() == []
+
+
+async def test_query_flag_requests_a_profile(client, store):
+    async with client:
+        response = await client.get("/api/bookings?profile=1", headers={"Authorization": "Bearer admin"})
+    assert "x-profile-id" in response.headers
+
+
+async def test_waiting_for_the_sampler_does_not_block_the_loop(client, monkeypatch):
+    # A sampler stuck in sys._current_frames() keeps join() waiting
+    monkeypatch.setattr(profiler.RequestProfiler, "join", lambda self, timeout=1.0: time.sleep(0.2))
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    ticker = asyncio.create_task(tick())
+    async with client:
+        await client.get("/api/bookings", headers={"X-Profile": "1", "Authorization": "Bearer admin"})
+    ticker.cancel()
+    assert ticks >= 10
@@ -0,0 +1,98 @@
+import time
+from datetime import datetime, timedelta
+
+import jwt
+import pytest
+
+from quotes import AUDIENCE, QuoteEngine, QuoteError
+from tokens import ALGORITHM, KeyRing
+
+pytestmark = pytest.mark.anyio
+
+NOW = datetime(2026, 5, 1, 12, 0)
+
+CONFIG = {
+    "reference_price": 1000,
+    "services": {"physio": {"price_per_session": 1000}, "yoga": {"price_per_session": 500}},
+    "packages": {"1": 1000, "5": 4500},
+    "city_multipliers": {"Mumbai": 1.2},
+    "promos": [
+        {"percent_off": 5},
+        {"code": "BIG", "percent_off": 20, "max_off": 600, "min_sessions": 5},
+        {"code": "FLAT", "amount_off": 100, "services": ["physio"]},
+        {"code": "MAY", "percent_off": 50, "valid_from": "2026-05-01T00:00:00", "valid_until": "2026-05-02T00:00:00"},
+    ],
+}
+
+
+@pytest.fixture
+async def engine():
+    ring = KeyRing(None, timedelta(hours=1), static={"k1": "secret"})
+    await ring.load()
+    return QuoteEngine(None, ring, CONFIG, timedelta(minutes=15))
+
+
+async def test_prices_scale_with_service_and_city(engine):
+    quote = engine.quote("yoga", "mumbai", 5, now=NOW)
+    assert (quote["list_price"], quote["package_price"]) == (3000, 2700)
+    # Cities without a multiplier use the default row
+    assert engine.quote("physio", "Pune", 1, now=NOW)["package_price"] == 1000
+
+
+async def test_best_promo_applies_without_stacking(engine):
+    # FLAT's 100 off beats the automatic 5% (50)
+    assert engine.quote("physio", None, 1, "flat", NOW)["promo_code"] == "FLAT"
+    quote = engine.quote("physio", None, 5, "BIG", NOW)
+    assert (quote["discount"], quote["promo_code"], quote["amount"]) == (600, "BIG", 3900)
+    # Without a code the automatic promo applies
+    quote = engine.quote("yoga", None, 1, None, NOW)
+    assert (quote["discount"], quote["promo_code"]) == (25, None)
+
+
+async def test_codes_that_do_not_apply_are_rejected(engine):
+    with pytest.raises(QuoteError, match="Unknown promo code"):
+        engine.quote("physio", None, 1, "NOPE", NOW)
+    with pytest.raises(QuoteError, match="does not apply"):
+        engine.quote("physio", None, 1, "BIG", NOW)      # below min_sessions
+    with pytest.raises(QuoteError, match="does not apply"):
+        engine.quote("yoga", None, 1, "FLAT", NOW)       # other service
+    with pytest.raises(QuoteError, match="does not apply"):
+        engine.quote("physio", None, 1, "MAY", NOW + timedelta(days=1))
+    with pytest.raises(QuoteError, match="No package"):
+        engine.quote("physio", None, 3, now=NOW)
+
+
+async def test_cached_row_is_repriced_when_a_promo_ends(engine):
+    assert engine.quote("physio", None, 1, now=NOW - timedelta(hours=1))["discount"] == 50
+    # MAY starts at midnight, so the row cached before it does not hide it
+    assert engine.quote("physio", None, 1, "MAY", NOW)["discount"] == 500
+    assert engine.quote("physio", None, 1, now=NOW)["discount"] == 50
+    assert engine.describe()["cached_prices"] == 2
+
+
+async def test_every_quote_is_signed_separately_and_capped_at_the_promo_end(engine):
+    now = datetime.utcnow()
+    promo_end = now + timedelta(minutes=5)
+    engine.tables.codes["MAY"] = engine.tables.codes["MAY"]._replace(valid_from=None, valid_until=promo_end)
+
+    first = engine.quote("physio", None, 1, "MAY", now)
+    second = engine.quote("physio", None, 1, "MAY", now)
+    assert first["quote_id"] != second["quote_id"]
+    assert first["signature"] != second["signature"]
+    assert first["expires_at"] == promo_end.replace(microsecond=0)
+
+    claims = await engine.verify(first["signature"])
+    assert (claims["quote_id"], claims["amount"]) == (first["quote_id"], 500)
+    assert engine.quote("physio", None, 1, now=now)["expires_at"] > first["expires_at"]
+
+
+async def test_verify_rejects_tampered_and_expired_quotes(engine):
+    quote = engine.quote("physio", None, 1, now=NOW)
+    claims = jwt.decode(quote["signature"], "secret", algorithms=[ALGORITHM], audience=AUDIENCE)
+    forged = jwt.encode({**claims, "amount": 1}, "other", algorithm=ALGORITHM, headers={"kid": "k1"})
+    with pytest.raises(QuoteError, match="Invalid quote"):
+        await engine.verify(forged)
+    expired = jwt.encode({**claims, "exp": int(time.time()) - 60}, "secret", algorithm=ALGORITHM,
+                         headers={"kid": "k1"})
+    with pytest.raises(QuoteError, match="expired"):
+        await engine.verify(expired)
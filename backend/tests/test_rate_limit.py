@@ -0,0 +1,118 @@
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import rate_limit
+from rate_limit import InMemoryRateLimitStore, RateLimiter, Rule, SlidingWindow, TokenBucket
+
+pytestmark = pytest.mark.anyio
+
+
+class Clock:
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limit, "time", clock)
+    return clock
+
+
+async def test_bucket_allows_a_burst_then_refills():
+    store, policy = InMemoryRateLimitStore(), TokenBucket(capacity=2, refill_per_second=0.1)
+    assert await store.take_token("k", policy, 0.0) == 0
+    assert await store.take_token("k", policy, 0.0) == 0
+    assert await store.take_token("k", policy, 0.0) == pytest.approx(10.0)
+    # Half a token has refilled, so half the wait remains
+    assert await store.take_token("k", policy, 5.0) == pytest.approx(5.0)
+    assert await store.take_token("k", policy, 10.0) == 0
+    # Refill stops at capacity
+    assert [await store.take_token("k", policy, 1000.0) for _ in range(3)] == [0, 0, pytest.approx(10.0)]
+
+
+async def test_sliding_window_weighs_the_previous_window():
+    store, policy = InMemoryRateLimitStore(), SlidingWindow(limit=4, window_seconds=60)
+    for _ in range(4):
+        assert await store.hit_window("k", policy, 0.0) == 0
+    assert await store.hit_window("k", policy, 30.0) == pytest.approx(30.0)
+    # At 75s the previous window counts 4 * 0.75 = 3, so one more hit fits
+    assert await store.hit_window("k", policy, 75.0) == 0
+    # Then 3 + 1 >= 4 until the previous window weighs under 3: 4 * (1 - t/60) + 1 < 4 at t > 15s
+    assert await store.hit_window("k", policy, 75.0) == pytest.approx(0.001)
+    assert await store.hit_window("k", policy, 90.0) == 0
+
+
+async def test_lru_eviction_keeps_recently_used_keys():
+    store, policy = InMemoryRateLimitStore(max_keys=2), TokenBucket(capacity=1, refill_per_second=0.01)
+    await store.take_token("a", policy, 0.0)
+    await store.take_token("b", policy, 0.0)
+    assert await store.take_token("a", policy, 1.0) > 0      # touches "a"
+    await store.take_token("c", policy, 1.0)                 # evicts "b", not "a"
+    assert list(store.buckets) == ["a", "c"]
+    assert await store.take_token("a", policy, 2.0) > 0
+
+
+async def test_rejection_raises_429_with_retry_after(clock):
+    limiter = RateLimiter(InMemoryRateLimitStore(), {
+        "send_otp": [Rule("phone", "key", TokenBucket(capacity=1, refill_per_second=1 / 30))],
+    })
+    await limiter.check("send_otp", {"key": "9000000001"})
+    with pytest.raises(HTTPException) as e:
+        await limiter.check("send_otp", {"key": "9000000001"})
+    assert e.value.status_code == 429
+    assert e.value.headers == {"Retry-After": "30"}
+    # Other keys have their own bucket
+    await limiter.check("send_otp", {"key": "9000000002"})
+    clock.now += 30
+    await limiter.check("send_otp", {"key": "9000000001"})
+
+
+async def test_rejected_request_is_refunded_to_the_rules_it_passed(clock):
+    store = InMemoryRateLimitStore()
+    ip_rule = Rule("ip", "ip", TokenBucket(capacity=5, refill_per_second=0.001))
+    window_rule = Rule("ip-minute", "ip", SlidingWindow(limit=5, window_seconds=60))
+    key_rule = Rule("phone", "key", TokenBucket(capacity=1, refill_per_second=0.001))
+    limiter = RateLimiter(store, {"send_otp": [ip_rule, window_rule, key_rule]})
+
+    await limiter.check("send_otp", {"ip": "1.2.3.4", "key": "p"})
+    for _ in range(3):
+        with pytest.raises(HTTPException):
+            await limiter.check("send_otp", {"ip": "1.2.3.4", "key": "p"})
+    # Only the first request counts against the per-IP rules
+    assert store.buckets["send_otp:ip:1.2.3.4"][0] == pytest.approx(4, abs=0.01)
+    assert store.windows["send_otp:ip-minute:1.2.3.4"][1] == 1
+    # Rules for scopes without a key are skipped
+    await limiter.check("send_otp", {"ip": "1.2.3.4"})
+
+
+@pytest.fixture
+def client(server, monkeypatch):
+    monkeypatch.setattr(server.rate_limiter, "store", InMemoryRateLimitStore())
+    return TestClient(server.app)
+
+
+@pytest.mark.parametrize("body, content_type", [
+    (b"not json", "text/plain"),
+    (b"[1, 2]", "application/json"),
+    (b"", "application/json"),
+])
+def test_malformed_otp_request_is_a_validation_error(client, body, content_type):
+    response = client.post("/api/auth/send-otp", content=body, headers={"Content-Type": content_type})
+    assert response.status_code == 422
+
+
+def test_otp_requests_are_limited_per_phone_before_per_ip(client):
+    for _ in range(3):
+        assert client.post("/api/auth/send-otp", json={"phone": "9000000001"}).status_code == 200
+    response = client.post("/api/auth/send-otp", json={"phone": "9000000001"})
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) == 60
+    # Malformed bodies don't share a per-phone bucket, and the rejected request above cost the IP nothing
+    for _ in range(5):
+        assert client.post("/api/auth/send-otp", content=b"x").status_code == 422
+    assert client.post("/api/auth/send-otp", json={"phone": "9000000002"}).status_code == 200
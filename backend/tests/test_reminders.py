@@ -0,0 +1,63 @@
+import pytest
+
+from reminders import TimingWheel
+
+
+def fire_ticks(wheel, until):
+    """Advance one tick at a time; returns key → the tick it fired on"""
+    fired = {}
+    for tick in range(1, until + 1):
+        for key, _ in wheel.advance(tick):
+            fired[key] = tick
+    return fired
+
+
+def test_timers_fire_on_their_tick_at_every_level():
+    # slots=4, levels=3: level 0 covers 4 ticks, level 1 16, level 2 64; beyond that is overflow
+    wheel = TimingWheel(tick=1.0, slots=4, levels=3, now=0)
+    delays = [1, 3, 4, 5, 15, 16, 17, 63, 64, 65, 130, 257]
+    for delay in delays:
+        wheel.add(f"t{delay}", delay)
+    assert fire_ticks(wheel, 300) == {f"t{delay}": delay for delay in delays}
+    assert len(wheel) == 0
+
+
+def test_timer_cascades_down_from_a_higher_level():
+    wheel = TimingWheel(tick=1.0, slots=4, levels=3, now=0)
+    wheel.add("t", 37)
+    assert wheel.buckets["t"] in wheel.levels[2]
+    assert fire_ticks(wheel, 36) == {}
+    assert wheel.buckets["t"] in wheel.levels[0]
+    assert wheel.advance(37) == [("t", None)]
+
+
+def test_large_jump_fires_everything_due():
+    wheel = TimingWheel(tick=1.0, slots=4, levels=2, now=0)
+    for delay in (2, 9, 40, 100):
+        wheel.add(f"t{delay}", delay, payload=delay)
+    assert sorted(payload for _, payload in wheel.advance(50)) == [2, 9, 40]
+    assert "t100" in wheel
+
+
+def test_timer_in_the_past_fires_on_next_advance():
+    wheel = TimingWheel(tick=1.0, slots=4, levels=2, now=10)
+    wheel.add("late", 5)
+    assert wheel.advance(10) == [("late", None)]
+
+
+def test_add_replaces_and_cancel_removes():
+    wheel = TimingWheel(tick=1.0, slots=4, levels=2, now=0)
+    wheel.add("t", 20)
+    wheel.add("t", 3)
+    wheel.add("gone", 2)
+    assert wheel.cancel("gone")
+    assert not wheel.cancel("gone")
+    assert fire_ticks(wheel, 30) == {"t": 3}
+
+
+@pytest.mark.parametrize("tick", [0.5, 60.0])
+def test_tick_width_rounds_expiry_down(tick):
+    wheel = TimingWheel(tick=tick, slots=8, levels=2, now=0)
+    wheel.add("t", tick * 5 + tick / 2)
+    assert wheel.advance(tick * 4.9) == []
+    assert wheel.advance(tick * 5) == [("t", None)]
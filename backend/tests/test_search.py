@@ -0,0 +1,94 @@
+import pytest
+
+from memory_store import MemoryDatabase
+from search import SearchIndex, build_index, replay
+
+pytestmark = pytest.mark.anyio
+
+
+def practitioner(doc_id, name, email, registration_no):
+    return {"id": doc_id, "personal_details": {"full_name": name, "email": email},
+            "education": {"registration_no": registration_no}, "status": "pending"}
+
+
+def ids(results):
+    return [r["id"] for r in results]
+
+
+def test_identifiers_outrank_names_and_exact_hits_outrank_prefixes():
+    index = SearchIndex()
+    index.add("users", {"id": "u1", "name": "Asha 9876", "phone": "+91 98765 43210"})
+    index.add("users", {"id": "u2", "name": "Ashaki", "phone": "9123456789"})
+    index.add("users", {"id": "u3", "name": "Asha", "phone": "9000000000"})
+    # Phone (weight 3) beats name (weight 2); the national number matches without the prefix
+    assert ids(index.search("9876543210")) == ["u1"]
+    assert ids(index.search("9876")) == ["u1"]
+    # Exact "asha" beats prefix "ashaki"; ties go to the most recent document
+    assert ids(index.search("asha")) == ["u3", "u1", "u2"]
+
+
+def test_every_term_must_match_and_kinds_filter():
+    index = SearchIndex()
+    index.add("users", {"id": "u1", "name": "Ravi Kumar", "phone": "9000000001"})
+    index.add("bookings", {"id": "b1", "customer_name": "Ravi Shah", "customer_phone": "9000000002",
+                           "pincode": "411001"})
+    index.add("practitioners", practitioner("p1", "Ravi Kumar", "ravi@example.com", "MH-77"))
+    assert ids(index.search("ravi kum")) == ["p1", "u1"]
+    assert ids(index.search("ravi kum", kinds=["users"])) == ["u1"]
+    assert ids(index.search("ravi 411")) == ["b1"]
+    assert index.search("ravi nobody") == []
+    assert index.search("  ") == []
+
+
+def test_reindexing_and_removal_drop_old_tokens():
+    index = SearchIndex()
+    index.add("users", {"id": "u1", "name": "Old Name", "phone": None})
+    index.add("users", {"id": "u1", "name": "New Name", "phone": None})
+    assert index.search("old") == []
+    assert ids(index.search("new")) == ["u1"]
+    index.remove("users", "u1")
+    assert len(index) == 0 and index.tokens == [] and index.postings == {}
+
+
+def test_summary_updates_show_in_results():
+    index = SearchIndex()
+    index.add("bookings", {"id": "b1", "customer_name": "Meera", "status": "pending_payment"})
+    index.update_summary("bookings", "b1", {"status": "confirmed", "customer_name_ignored": "x"})
+    assert index.search("meera")[0]["status"] == "confirmed"
+
+
+def test_bulk_load_sorts_once_and_matches_incremental_adds():
+    docs = [{"id": f"u{i}", "name": f"name{i % 7} person{i}", "phone": f"98{i:08d}"} for i in range(200)]
+    incremental, bulk = SearchIndex(), SearchIndex()
+    for doc in docs:
+        incremental.add("users", doc)
+    # A re-indexed document inside one batch must not leave stale tokens behind
+    bulk.add_many("users", docs[:100] + [{**docs[0], "name": "renamed"}] + docs[100:])
+    bulk.finish()
+    incremental.add("users", {**docs[0], "name": "renamed"})
+    assert bulk.tokens == incremental.tokens == sorted(incremental.postings)
+    assert ids(bulk.search("name3", limit=100)) == ids(incremental.search("name3", limit=100))
+
+
+async def test_build_index_then_replay_writes_made_during_the_build():
+    db = MemoryDatabase("search")
+    await db.users.insert_many([{"id": f"u{i}", "name": f"User{i}", "phone": f"90000{i:05d}"} for i in range(2500)])
+    await db.practitioners.insert_one(practitioner("p1", "Kavya Rao", "kavya@example.com", "KA-1"))
+
+    live = SearchIndex()
+    live.journal = []
+    fresh = SearchIndex()
+    await build_index(db, fresh, batch_size=1000)
+    assert len(fresh) == 2501
+    assert fresh.tokens == sorted(fresh.postings)
+
+    # Writes the scan may have missed reach the live index's journal
+    live.add("users", {"id": "u9999", "name": "Late Signup", "phone": "9111111111"})
+    live.remove("users", "u1")
+    live.add("users", {"id": "u2", "name": "Renamed", "phone": "9000000002"})
+    replay(fresh, live.journal)
+
+    assert ids(fresh.search("late")) == ["u9999"]
+    assert "u1" not in ids(fresh.search("user1", limit=5000))
+    assert ids(fresh.search("renamed")) == ["u2"]
+    assert ids(fresh.search("ka 1")) == ["p1"]
@@ -0,0 +1,90 @@
+import logging
+
+import pytest
+from fastapi.testclient import TestClient
+from pymongo.errors import DuplicateKeyError
+
+from memory_store import MemoryDatabase
+from storage import Storage, StorageSettings, UserRepository, duplicate_key
+
+pytestmark = pytest.mark.anyio
+
+MEMORY = StorageSettings(backend="memory", mongo_url=None, db_name="lifespan")
+
+
+def test_settings_read_pool_options_from_the_environment():
+    settings = StorageSettings.from_env({
+        "STORAGE_BACKEND": "mongo",
+        "MONGO_URL": "mongodb://db:27017",
+        "MONGO_MAX_POOL_SIZE": "20",
+        "MONGO_WAIT_QUEUE_TIMEOUT_MS": "500",
+    })
+    assert (settings.backend, settings.db_name) == ("mongo", "voct_database")
+    assert settings.client_options() == {
+        "maxPoolSize": 20,
+        "minPoolSize": 0,
+        "connectTimeoutMS": 20000,
+        "serverSelectionTimeoutMS": 30000,
+        "waitQueueTimeoutMS": 500,
+    }
+
+
+async def test_connect_rejects_unknown_backends_and_mongo_without_a_url():
+    with pytest.raises(ValueError, match="Unknown STORAGE_BACKEND"):
+        await Storage().connect(MEMORY._replace(backend="sqlite"))
+    with pytest.raises(ValueError, match="MONGO_URL"):
+        await Storage().connect(MEMORY._replace(backend="mongo"))
+
+
+async def test_repositories_follow_the_bound_backend():
+    storage = Storage()
+    with pytest.raises(RuntimeError, match="not connected"):
+        storage.users.collection
+    users = storage.users
+    assert isinstance(users, UserRepository) and storage["users"] is users
+
+    timings = await storage.connect(MEMORY)
+    assert storage.backend == "memory" and set(timings) == {"storage_connect_ms"}
+    await users.add({"id": "u1", "phone": "+919800000001"})
+    assert await users.by_phone("+919800000001") == {"id": "u1", "phone": "+919800000001"}
+
+    # Rebinding moves existing repositories along; other methods pass through
+    storage.bind(MemoryDatabase("other"), backend="memory")
+    assert await users.get("u1") is None
+    assert await users.count_documents({}) == 0
+    storage.close()
+    assert not storage.connected
+
+
+def test_duplicate_key_names_the_violated_field():
+    assert duplicate_key(DuplicateKeyError("dup", 11000, {"keyPattern": {"phone": 1}})) == "phone"
+    message = "E11000 duplicate key error collection: voct.users index: phone_1 dup key: { phone: \"1\" }"
+    assert duplicate_key(DuplicateKeyError(message, 11000)) == "phone"
+    assert duplicate_key(DuplicateKeyError("E11000", 11000)) is None
+
+
+@pytest.fixture
+def lifespan_app(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "UPLOAD_DIR", tmp_path / "uploads")
+    monkeypatch.setattr(server, "EXPORT_DIR", tmp_path / "exports")
+    root = logging.getLogger()
+    saved = (list(root.handlers), root.level)
+    yield server.create_app(MEMORY)
+    root.handlers[:] = saved[0]
+    root.setLevel(saved[1])
+
+
+def test_lifespan_opens_memory_storage_and_reports_startup_timings(server, lifespan_app, tmp_path):
+    # Importing the module opened nothing; storage is bound when the app starts
+    with TestClient(lifespan_app) as client:
+        assert server.db.backend == "memory" and server.db.connected
+        assert (tmp_path / "uploads").is_dir() and (tmp_path / "exports").is_dir()
+        token = server.issue_session("admin", "admin")["token"]
+        response = client.get("/api/internal/admin/startup", headers={"Authorization": f"Bearer {token}"})
+        assert client.get("/api/internal/admin/startup").status_code == 401
+
+    body = response.json()
+    assert body["backend"] == "memory"
+    assert {"import_ms", "storage_connect_ms", "ensure_indexes_ms", "signing_keys_ms",
+            "pricing_ms", "startup_ms"} <= set(body["timings"])
+    assert not server.db.connected
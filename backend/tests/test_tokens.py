@@ -0,0 +1,163 @@
+import time
+from datetime import datetime, timedelta
+
+import jwt
+import pytest
+from fastapi.testclient import TestClient
+
+import tokens
+from memory_store import MemoryDatabase
+from tokens import InvalidToken, KeyRing, KeyRingError, SessionTokens, parse_keys
+
+pytestmark = pytest.mark.anyio
+
+TTLS = {"patient": timedelta(hours=1), "admin": timedelta(minutes=10)}
+
+
+@pytest.fixture
+async def ring():
+    ring = KeyRing(MemoryDatabase("test").auth_keys, max_token_ttl=max(TTLS.values()))
+    await ring.load()
+    return ring
+
+
+@pytest.fixture
+def sessions(ring):
+    return SessionTokens(ring, TTLS)
+
+
+def test_parse_keys_keeps_order_and_skips_malformed_entries():
+    assert list(parse_keys("2026b:s2, 2026a:s1,broken,:x")) == ["2026b", "2026a"]
+
+
+async def test_issued_tokens_verify_and_are_then_served_from_the_cache(ring, sessions):
+    session = sessions.issue("u1", "patient", device="ios")
+    claims = await sessions.authenticate(session["token"])
+    assert (claims["sub"], claims["role"], claims["device"]) == ("u1", "patient", "ios")
+    assert jwt.get_unverified_header(session["token"])["kid"] == ring.active
+
+    await sessions.authenticate(session["token"])
+    assert (sessions.hits, sessions.misses) == (1, 1)
+    with pytest.raises(ValueError, match="Unknown role"):
+        sessions.issue("u1", "superuser")
+
+
+@pytest.mark.parametrize("token, reason", [
+    ("not-a-jwt", "Malformed token"),
+    (jwt.encode({"sub": "u1", "role": "patient", "exp": int(time.time()) + 60}, "guess",
+                algorithm="HS256", headers={"kid": "forged"}), "Invalid token"),
+])
+async def test_malformed_and_unknown_key_tokens_are_rejected(sessions, token, reason, monkeypatch):
+    monkeypatch.setattr(tokens, "UNKNOWN_KID_RELOAD_SECONDS", 0)
+    with pytest.raises(InvalidToken, match=reason):
+        await sessions.authenticate(token)
+
+
+async def test_tampered_and_expired_tokens_are_rejected(ring, sessions):
+    key = ring.keys[ring.active]
+    tampered = jwt.encode({"sub": "u1", "role": "admin", "exp": int(time.time()) + 60}, b"x" + key,
+                          algorithm="HS256", headers={"kid": ring.active})
+    with pytest.raises(InvalidToken, match="Invalid token"):
+        sessions.verify(tampered)
+    expired = jwt.encode({"sub": "u1", "role": "patient", "exp": int(time.time()) - 120}, key,
+                         algorithm="HS256", headers={"kid": ring.active})
+    with pytest.raises(InvalidToken, match="expired"):
+        sessions.verify(expired)
+
+
+async def test_rotation_keeps_older_tokens_valid_until_they_could_have_expired(ring, sessions):
+    old_kid = ring.active
+    old_token = sessions.issue("u1", "patient")["token"]
+    new_kid = await ring.rotate()
+
+    assert ring.active == new_kid != old_kid
+    assert jwt.get_unverified_header(sessions.issue("u1", "patient")["token"])["kid"] == new_kid
+    assert (await sessions.authenticate(old_token))["sub"] == "u1"
+
+    # Once the longest TTL has passed since it was superseded, the old key is dropped
+    await ring.collection.update_one(
+        {"kid": old_kid}, {"$set": {"superseded_at": datetime.utcnow() - timedelta(hours=2)}}
+    )
+    await ring.refresh()
+    assert old_kid not in ring.keys
+    with pytest.raises(InvalidToken):
+        sessions.verify(old_token)
+
+
+async def test_retiring_a_key_revokes_its_cached_tokens(ring, sessions):
+    old_kid = ring.active
+    token = sessions.issue("u1", "patient")["token"]
+    sessions.verify(token)
+    with pytest.raises(KeyRingError, match="Rotate before retiring"):
+        await ring.retire(old_kid)
+
+    await ring.rotate()
+    assert await ring.retire(old_kid)
+    assert not await ring.retire(old_kid)
+    with pytest.raises(InvalidToken):
+        sessions.verify(token)
+    described = {k["kid"]: k for k in await ring.describe()}
+    assert described[old_kid]["verifying"] is False and "secret" not in described[old_kid]
+
+
+async def test_another_workers_new_key_is_picked_up_on_first_use(ring, sessions, monkeypatch):
+    other = KeyRing(ring.collection, max_token_ttl=ring.max_token_ttl)
+    await other.load()
+    await other.rotate()
+    token = SessionTokens(other, TTLS).issue("u1", "patient")["token"]
+
+    monkeypatch.setattr(tokens, "UNKNOWN_KID_RELOAD_SECONDS", 0)
+    assert (await sessions.authenticate(token))["sub"] == "u1"
+    assert ring.active == other.active
+
+
+async def test_pinned_keys_cannot_be_rotated_or_retired():
+    ring = KeyRing(None, max_token_ttl=timedelta(hours=1), static=parse_keys("k2:second,k1:first"))
+    await ring.load()
+    assert ring.active == "k2" and set(ring.keys) == {"k1", "k2"}
+    with pytest.raises(KeyRingError, match="pinned"):
+        await ring.rotate()
+    with pytest.raises(KeyRingError, match="pinned"):
+        await ring.retire("k1")
+
+
+@pytest.fixture
+async def client(server):
+    await server.signing_keys.load()
+    return TestClient(server.app)
+
+
+def bearer(server, subject, role):
+    return {"Authorization": f"Bearer {server.issue_session(subject, role)['token']}"}
+
+
+async def test_routes_require_a_session_for_the_right_subject(server, client):
+    await server.db.users.insert_one({"id": "u1", "phone": "+919800000001", "name": "Asha", "age": 34,
+                                      "gender": "female", "created_at": datetime.utcnow()})
+    path = "/api/auth/user/u1"
+
+    missing = client.get(path)
+    assert missing.status_code == 401 and missing.headers["www-authenticate"] == "Bearer"
+    assert client.get(path, headers={"Authorization": "Bearer junk"}).status_code == 401
+    assert client.get(path, headers=bearer(server, "u2", "patient")).status_code == 403
+    assert client.get(path, headers=bearer(server, "u1", "practitioner")).status_code == 403
+    assert client.get(path, headers=bearer(server, "u1", "patient")).json()["id"] == "u1"
+    assert client.get(path, headers=bearer(server, "ops", "admin")).status_code == 200
+
+
+async def test_admins_rotate_and_retire_keys_over_the_api(server, client):
+    admin = bearer(server, "ops", "admin")
+    patient = bearer(server, "u1", "patient")
+    old_kid = server.signing_keys.active
+
+    assert client.post("/api/internal/admin/auth/keys/rotate", headers=patient).status_code == 403
+    rotated = client.post("/api/internal/admin/auth/keys/rotate", headers=admin).json()
+    assert rotated["active"] != old_kid
+    assert client.post(f"/api/internal/admin/auth/keys/{rotated['active']}/retire", headers=admin).status_code == 409
+
+    assert client.post(f"/api/internal/admin/auth/keys/{old_kid}/retire",
+                       headers=bearer(server, "ops", "admin")).status_code == 200
+    # Sessions signed with the retired key are revoked
+    assert client.get("/api/internal/admin/auth/keys", headers=admin).status_code == 401
+    assert client.post("/api/internal/admin/auth/keys/missing/retire",
+                       headers=bearer(server, "ops", "admin")).status_code == 404
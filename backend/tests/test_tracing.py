@@ -0,0 +1,107 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from fastapi.testclient import TestClient
+
+from tracing import MongoCommandTracer, Tracer, TracingMiddleware, current_span
+
+pytestmark = pytest.mark.anyio
+
+
+class Collector:
+    """Stands in for the batch processor and keeps every submitted span"""
+
+    def __init__(self):
+        self.spans = []
+
+    def submit(self, span):
+        self.spans.append(span)
+
+    def shutdown(self):
+        pass
+
+
+@pytest.fixture
+def collector():
+    return Collector()
+
+
+@pytest.fixture
+def tracer(collector):
+    return Tracer(collector)
+
+
+def test_child_spans_share_the_trace_and_nest_under_the_current_span(tracer, collector):
+    with tracer.span("outer") as outer:
+        with tracer.span("inner", "client") as inner:
+            assert current_span.get() is inner
+        assert current_span.get() is outer
+    assert current_span.get() is None
+    inner_span, outer_span = collector.spans
+    assert inner_span.trace_id == outer_span.trace_id
+    assert inner_span.parent_id == outer_span.span_id and outer_span.parent_id is None
+
+
+async def test_spawned_tasks_join_the_trace_of_the_request(tracer, collector):
+    @tracer.traced("background")
+    async def job():
+        await asyncio.sleep(0)
+
+    with tracer.span("request", "server"):
+        await asyncio.create_task(job())
+    background, request = collector.spans
+    assert (background.name, background.parent_id) == ("background", request.span_id)
+
+
+def test_incoming_traceparent_is_continued(tracer, collector):
+    incoming = "00-" + "a" * 32 + "-" + "b" * 16 + "-01"
+    with tracer.span("GET /api", "server", traceparent=incoming) as span:
+        assert span.traceparent().startswith("00-" + "a" * 32 + "-")
+    assert collector.spans[0].parent_id == "b" * 16
+
+
+def test_unsampled_traces_are_kept_only_when_slow(collector):
+    tracer = Tracer(collector, sample_ratio=0.0, slow_ms=10_000)
+    with tracer.span("fast"):
+        with tracer.span("child"):
+            pass
+    assert collector.spans == []
+
+    slow = Tracer(collector, sample_ratio=0.0, slow_ms=0.001)
+    with slow.span("slow"):
+        with slow.span("child"):
+            sum(range(10_000))
+    assert [s.name for s in collector.spans] == ["child", "slow"]
+    assert collector.spans[1].attributes["sampling.reason"] == "slow"
+
+
+def test_mongo_commands_become_client_spans_of_the_caller(tracer, collector):
+    listener = MongoCommandTracer(tracer)
+    find = SimpleNamespace(command_name="find", command={"find": "bookings"}, database_name="voct",
+                           connection_id=("db", 1), request_id=7)
+    # Commands issued outside any span (e.g. heartbeats) are not traced
+    listener.started(find)
+    assert listener.pending == {}
+
+    with tracer.span("GET /api/bookings", "server") as request:
+        listener.started(find)
+    listener.failed(SimpleNamespace(**vars(find), failure={"codeName": "NotPrimary", "errmsg": "stepped down"}))
+    mongo = next(s for s in collector.spans if s.name == "mongo.find")
+    assert mongo.parent_id == request.span_id
+    assert mongo.attributes["db.mongodb.collection"] == "bookings"
+    assert mongo.error == "NotPrimary: stepped down"
+
+
+def test_server_span_covers_cors_preflights(server, monkeypatch, collector):
+    monkeypatch.setattr(server, "tracer", Tracer(collector))
+    app = server.create_app()
+    assert app.user_middleware[0].cls is TracingMiddleware
+
+    response = TestClient(app).options("/api/auth/send-otp", headers={
+        "Origin": "https://example.com", "Access-Control-Request-Method": "POST",
+    })
+    assert response.status_code == 200
+    assert "traceparent" in response.headers
+    [span] = collector.spans
+    assert (span.name, span.kind, span.attributes["http.status_code"]) == ("OPTIONS /api/auth/send-otp", "server", 200)
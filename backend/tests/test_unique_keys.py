@@ -0,0 +1,143 @@
+from datetime import datetime, timedelta
+
+import pytest
+from pymongo.errors import DuplicateKeyError
+
+from migrations import MergeDuplicates
+
+pytestmark = pytest.mark.anyio
+
+APPLICATION = {
+    "personal_details": {
+        "full_name": "Meera Rao", "age": 29, "gender": "female", "contact_number": "9000000002",
+        "email": "meera@example.com", "mothers_name": "Lata", "permanent_address": "4 Hill Rd",
+        "pin_code": "560001", "city": "Bengaluru",
+    },
+    "education": {
+        "institution_name": "Institute", "location": "Bengaluru", "degree": "MPT",
+        "aggregate_percentage": 81.0, "year_of_graduation": 2018, "registration_no": "KA-77",
+    },
+    "bank_details": {
+        "bank_name": "Bank", "branch_name": "Main", "branch_address": "1 Main St", "account_number": "2",
+        "ifsc_code": "IFSC0002", "pan_card_number": "PAN2", "aadhar_number": "2222",
+    },
+    "joining_details": {
+        "years_of_experience": 3, "has_electrotherapy_equipment": False, "travel_distance": "5km",
+        "emergency_availability": "no", "unique_practice": "sports rehab", "standout_quality": "clarity",
+    },
+}
+
+
+def application(email="meera@example.com", registration_no="KA-77"):
+    return {
+        **APPLICATION,
+        "personal_details": {**APPLICATION["personal_details"], "email": email},
+        "education": {**APPLICATION["education"], "registration_no": registration_no},
+    }
+
+
+@pytest.fixture
+async def indexed(server, monkeypatch):
+    await server.signing_keys.load()
+    monkeypatch.setattr(server, "unique_keys_missing", {})
+    for name, key in server.UNIQUE_KEYS:
+        await server.db[name].create_index(key, unique=True)
+    return server
+
+
+async def sign_up(server, phone):
+    return await server.signup(server.UserCreate(name="Asha", age=34, gender="female"),
+                               {"sub": phone, "role": "signup"})
+
+
+async def apply(server, **keys):
+    return await server.apply_as_practitioner(server.PractitionerCreate(**application(**keys)))
+
+
+async def test_a_repeat_signup_is_refused_by_the_unique_phone_index(indexed):
+    user = await sign_up(indexed, "+919800000001")
+    with pytest.raises(indexed.HTTPException) as e:
+        await sign_up(indexed, "+919800000001")
+    assert (e.value.status_code, e.value.detail) == (400, "User already exists")
+    assert await indexed.db.users.count_documents({}) == 1
+    assert user.phone == "+919800000001"
+
+
+@pytest.mark.parametrize("keys, detail", [
+    ({"email": " MEERA@example.com", "registration_no": "KA-78"}, "this email"),
+    ({"email": "other@example.com", "registration_no": "ka-77 "}, "this registration number"),
+])
+async def test_a_repeat_application_is_refused_on_either_key(indexed, keys, detail):
+    await apply(indexed)
+    with pytest.raises(indexed.HTTPException) as e:
+        await apply(indexed, **keys)
+    assert e.value.status_code == 400 and e.value.detail.endswith(detail)
+    assert await indexed.db.practitioners.count_documents({}) == 1
+
+
+async def test_without_the_index_writes_check_for_a_duplicate_first(server, monkeypatch):
+    # Duplicates already stored kept ensure_indexes from building it
+    missing = {("users", "phone"): float("inf")}
+    monkeypatch.setattr(server, "unique_keys_missing", missing)
+    await server.db.users.insert_many([{"id": "u1", "phone": "+919800000001"},
+                                       {"id": "u2", "phone": "+919800000001"}])
+    assert await server.unique_value_taken("users", "phone", "+919800000001")
+    assert not await server.unique_value_taken("users", "phone", "+919800000002")
+    with pytest.raises(server.HTTPException):
+        await sign_up(server, "+919800000001")
+
+    # Once the duplicates are merged the next due check builds the index and stops looking
+    await server.db.users.delete_one({"id": "u2"})
+    missing[("users", "phone")] = 0.0
+    assert not await server.unique_value_taken("users", "phone", "+919800000001")
+    assert missing == {}
+    with pytest.raises(DuplicateKeyError):
+        await server.db.users.insert_one({"id": "u3", "phone": "+919800000001"})
+
+
+def test_merging_fills_gaps_and_adds_to_lists_without_overwriting():
+    keep = {"_id": 1, "id": "u1", "name": "Asha", "email": None, "addresses": [{"line": "A"}]}
+    duplicate = {"_id": 2, "id": "u2", "name": "Asha R", "email": "asha@example.com",
+                 "addresses": [{"line": "B"}], "age": 34}
+    assert MergeDuplicates.merge(keep, duplicate) == {
+        "$set": {"email": "asha@example.com", "age": 34},
+        "$addToSet": {"addresses": {"$each": [{"line": "B"}]}},
+    }
+
+
+async def test_duplicate_users_merge_into_the_oldest_and_keep_their_bookings(server):
+    now = datetime.utcnow()
+    await server.db.users.insert_many([
+        {"id": "new", "phone": "+919800000001", "email": "asha@example.com", "created_at": now},
+        {"id": "old", "phone": "+919800000001", "email": None, "created_at": now - timedelta(days=30)},
+        {"id": "other", "phone": "+919800000002", "created_at": now},
+    ])
+    await server.db.bookings.insert_one({"id": "b1", "user_id": "new", "sync_version": 0})
+
+    result = await server.migration_runner.run("0003_merge_duplicate_users")
+    assert result["migrated"] == 1
+    assert sorted(u["id"] for u in await server.db.users.find({}).to_list(None)) == ["old", "other"]
+    assert (await server.db.users.get("old"))["email"] == "asha@example.com"
+    assert (await server.db.bookings.get("b1"))["user_id"] == "old"
+    with pytest.raises(DuplicateKeyError):
+        await server.db.users.insert_one({"id": "again", "phone": "+919800000002"})
+
+
+async def test_verified_practitioners_are_kept_and_never_merged_away(server):
+    now = datetime.utcnow()
+    await server.db.practitioners.insert_many([
+        {"id": "applied", "personal_details": {"email": "meera@example.com"}, "is_verified": False,
+         "created_at": now - timedelta(days=9)},
+        {"id": "verified", "personal_details": {"email": "meera@example.com"}, "is_verified": True,
+         "created_at": now},
+        {"id": "v1", "personal_details": {"email": "ravi@example.com"}, "is_verified": True, "created_at": now},
+        {"id": "v2", "personal_details": {"email": "ravi@example.com"}, "is_verified": True, "created_at": now},
+    ])
+    # Two verified practitioners share an email: someone has to resolve it, so the index can't be built
+    with pytest.raises(DuplicateKeyError):
+        await server.migration_runner.run("0004_merge_duplicate_practitioner_emails")
+    remaining = sorted(p["id"] for p in await server.db.practitioners.find({}).to_list(None))
+    assert remaining == ["v1", "v2", "verified"]
+    [status] = [s for s in await server.migration_runner.status()
+                if s["id"] == "0004_merge_duplicate_practitioner_emails"]
+    assert status["status"] == "failed"
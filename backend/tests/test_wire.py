@@ -0,0 +1,116 @@
+import json
+
+import cbor2
+import msgpack
+import pytest
+from fastapi.testclient import TestClient
+
+import wire
+from wire import JSON, WireSocket, frames, negotiate, unpack
+
+pytestmark = pytest.mark.anyio
+
+
+def messages(count):
+    return [{"type": "booking_update", "booking_id": f"b{n}"} for n in range(count)]
+
+
+def test_negotiation_follows_the_clients_preference():
+    assert negotiate(["voct.cbor", "voct.msgpack"]).name == "cbor"
+    assert negotiate(["graphql-ws", " voct.msgpack"]).name == "msgpack"
+    assert negotiate(["graphql-ws"]) is JSON
+    assert negotiate([]).subprotocol is None
+
+
+def test_clients_without_a_subprotocol_get_one_json_text_frame_per_message():
+    encoded = frames(JSON, messages(3))
+    assert [json.loads(frame) for frame in encoded] == messages(3)
+
+
+@pytest.mark.parametrize("subprotocol, loads", [
+    ("voct.json", json.loads),
+    ("voct.msgpack", msgpack.unpackb),
+    ("voct.cbor", cbor2.loads),
+])
+def test_negotiated_codecs_batch_messages_into_few_frames(subprotocol, loads, monkeypatch):
+    monkeypatch.setattr(wire, "MAX_BATCH", 2)
+    codec = negotiate([subprotocol])
+    encoded = frames(codec, messages(5))
+    assert len(encoded) == 3
+    assert isinstance(encoded[0], bytes) == codec.binary
+    decoded = [loads(frame) for frame in encoded]
+    assert decoded[0] == {"type": "batch", "messages": messages(2)}
+    # A lone message isn't wrapped
+    assert decoded[2] == messages(5)[4]
+    assert [m for frame in decoded for m in unpack(frame)] == messages(5)
+
+
+class FakeWebSocket:
+    def __init__(self, subprotocols, incoming=()):
+        self.scope = {"subprotocols": subprotocols}
+        self.incoming = list(incoming)
+        self.accepted = None
+        self.sent = []
+
+    async def accept(self, subprotocol=None):
+        self.accepted = subprotocol
+
+    async def send_bytes(self, data):
+        self.sent.append(data)
+
+    async def send_text(self, data):
+        self.sent.append(data)
+
+    async def receive(self):
+        return self.incoming.pop(0)
+
+
+async def test_wire_socket_accepts_the_negotiated_protocol_and_reads_batches():
+    batch = msgpack.packb({"type": "batch", "messages": [{"type": "ping"}, {"type": "booking_response"}]})
+    socket = WireSocket(FakeWebSocket(["voct.msgpack"], [
+        {"type": "websocket.receive", "bytes": batch},
+        # Text frames are JSON whatever was negotiated
+        {"type": "websocket.receive", "text": '{"type": "ping"}'},
+        {"type": "websocket.disconnect", "code": 1001},
+    ]))
+    await socket.accept()
+    assert socket.websocket.accepted == "voct.msgpack"
+
+    assert [m["type"] for m in await socket.receive_messages()] == ["ping", "booking_response"]
+    assert await socket.receive_messages() == [{"type": "ping"}]
+    with pytest.raises(wire.WebSocketDisconnect):
+        await socket.receive_messages()
+
+    await socket.send_json({"type": "ping"})
+    assert msgpack.unpackb(socket.websocket.sent[0]) == {"type": "ping"}
+
+
+@pytest.fixture
+async def signed_in(server, monkeypatch):
+    await server.signing_keys.load()
+    monkeypatch.setattr(server, "manager", server.ConnectionManager(server.outbox))
+    return server
+
+
+async def test_a_reconnect_replay_arrives_as_one_binary_batch_frame(signed_in):
+    server = signed_in
+    await server.manager.send_to_user("u1", {"type": "booking_update", "status": "assigned"})
+    await server.manager.send_to_user("u1", {"type": "booking_update", "status": "en_route"})
+    token = server.issue_session("u1", "patient")["token"]
+
+    client = TestClient(server.app)
+    with client.websocket_connect(f"/ws/user/u1?token={token}&last_seq=0", subprotocols=["voct.cbor"]) as ws:
+        assert ws.accepted_subprotocol == "voct.cbor"
+        frame = cbor2.loads(ws.receive_bytes())
+    assert frame["type"] == "batch"
+    assert [(m["seq"], m["status"]) for m in frame["messages"]] == [(1, "assigned"), (2, "en_route")]
+
+
+async def test_legacy_clients_still_get_json_text_frames(signed_in):
+    server = signed_in
+    await server.manager.send_to_user("u1", {"type": "booking_update"})
+    token = server.issue_session("u1", "patient")["token"]
+
+    with TestClient(server.app).websocket_connect(f"/ws/user/u1?token={token}&last_seq=0") as ws:
+        assert ws.accepted_subprotocol is None
+        assert ws.receive_json() == {"type": "booking_update", "seq": 1}
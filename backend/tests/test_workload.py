@@ -0,0 +1,84 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import workload
+from memory_store import MemoryDatabase
+
+pytestmark = pytest.mark.anyio
+
+NOW = datetime(2026, 10, 21, 12)  # a Wednesday
+
+
+@pytest.fixture
+def practitioners():
+    return MemoryDatabase("workload").practitioners
+
+
+def test_counters_from_an_earlier_week_read_as_zero():
+    doc = {"workload": {"active_bookings": 2, "sessions_this_week": 9, "week": workload.week_of(NOW - timedelta(days=7))}}
+    assert workload.summary(doc, NOW) == {"active_bookings": 2, "sessions_this_week": 0, "last_assigned_at": None}
+    assert workload.summary({}, NOW)["active_bookings"] == 0
+
+
+def test_rank_prefers_fewer_active_bookings_then_fewer_sessions_then_longest_idle():
+    week = workload.week_of(NOW)
+    physios = [
+        {"id": "busy", "workload": {"active_bookings": 3}},
+        {"id": "recent", "workload": {"active_bookings": 1, "last_assigned_at": NOW}},
+        {"id": "idle", "workload": {"active_bookings": 1, "last_assigned_at": NOW - timedelta(days=3)}},
+        {"id": "full_week", "workload": {"active_bookings": 1, "sessions_this_week": 15, "week": week}},
+        {"id": "new"},
+    ]
+    assert [p["id"] for p in workload.rank(physios, NOW)] == ["new", "idle", "recent", "full_week", "busy"]
+
+
+async def test_taking_a_booking_bumps_the_counters_and_rolls_the_week(practitioners):
+    await practitioners.insert_one({"id": "p1", "workload": {"active_bookings": 1, "sessions_this_week": 20,
+                                                             "week": workload.week_of(NOW - timedelta(days=7))}})
+    await workload.booking_taken(practitioners, "p1", 3, NOW)
+    await workload.booking_taken(practitioners, "p1", 5, NOW)
+    counters = (await practitioners.find_one({"id": "p1"}))["workload"]
+    assert (counters["active_bookings"], counters["sessions_this_week"], counters["week"]) == \
+        (3, 8, workload.week_of(NOW))
+    assert counters["last_assigned_at"] == NOW
+
+
+async def test_releasing_never_goes_below_zero(practitioners):
+    await practitioners.insert_one({"id": "p1", "workload": {"active_bookings": 1}})
+    await workload.booking_released(practitioners, "p1")
+    await workload.booking_released(practitioners, "p1")
+    assert (await practitioners.find_one({"id": "p1"}))["workload"]["active_bookings"] == 0
+
+
+async def test_transitions_take_and_release_once(practitioners):
+    await practitioners.insert_one({"id": "p1"})
+    before = {"assignment_status": "offered", "session_count": 2}
+    await workload.apply_transition(practitioners, before, {"assignment_status": "accepted", "assigned_physio_id": "p1"})
+    # Re-applying an accept, or completing a booking that was never accepted, changes nothing
+    await workload.apply_transition(practitioners, {"assignment_status": "accepted", "assigned_physio_id": "p1"},
+                                    {"assignment_status": "accepted"})
+    await workload.apply_transition(practitioners, {"assignment_status": "assigned", "assigned_physio_id": "p1"},
+                                    {"status": "cancelled"})
+    assert (await practitioners.find_one({"id": "p1"}))["workload"]["active_bookings"] == 1
+
+    await workload.apply_transition(practitioners, {"assignment_status": "accepted", "assigned_physio_id": "p1"},
+                                    {"status": "completed"})
+    assert (await practitioners.find_one({"id": "p1"}))["workload"]["active_bookings"] == 0
+
+
+async def test_rebuild_recomputes_counters_from_bookings(practitioners):
+    bookings = MemoryDatabase("workload").bookings
+    await bookings.insert_many([
+        {"assigned_physio_id": "p1", "assignment_status": "accepted", "status": "confirmed", "session_count": 3,
+         "created_at": NOW - timedelta(days=1)},
+        {"assigned_physio_id": "p1", "assignment_status": "accepted", "status": "completed", "session_count": 2,
+         "created_at": NOW - timedelta(days=10)},
+        {"assigned_physio_id": "p2", "assignment_status": "assigned", "status": "confirmed", "session_count": 1,
+         "created_at": NOW},
+    ])
+    await practitioners.insert_many([{"id": "p1", "workload": {"active_bookings": 9}}, {"id": "p2"}])
+    await workload.rebuild(bookings, practitioners, NOW)
+    p1 = (await practitioners.find_one({"id": "p1"}))["workload"]
+    assert (p1["active_bookings"], p1["sessions_this_week"], p1["last_assigned_at"]) == (1, 3, NOW - timedelta(days=1))
+    assert (await practitioners.find_one({"id": "p2"}))["workload"]["active_bookings"] == 0
@@ -0,0 +1,112 @@
+import asyncio
+
+import pytest
+
+from memory_store import MemoryDatabase
+from storage import Storage
+from writebehind import WriteBehindBuffer
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def storage():
+    storage = Storage()
+    storage.bind(MemoryDatabase("test"), backend="memory")
+    return storage
+
+
+def message(n):
+    return {"id": f"m{n}", "name": "Asha", "message": f"hello {n}"}
+
+
+async def stored_ids(storage, name="contact_messages"):
+    return sorted(doc["id"] for doc in await storage[name].find({}).to_list(None))
+
+
+async def test_queued_documents_are_spilled_readable_and_flushed_in_batches(storage, tmp_path):
+    buffer = WriteBehindBuffer(storage, tmp_path, max_batch=2)
+    buffer.recover()
+    for n in range(3):
+        buffer.add("contact_messages", message(n))
+    buffer.add("assessments", {"id": "a1", "score": 4})
+
+    assert len(list(tmp_path.glob("*.jsonl"))) == 1
+    assert buffer.find("contact_messages", "m1") == message(1)
+    assert await stored_ids(storage) == []
+
+    await buffer.flush()
+    assert await stored_ids(storage) == ["m0", "m1", "m2"]
+    assert await stored_ids(storage, "assessments") == ["a1"]
+    # Three messages in batches of two, plus one assessment batch
+    assert (buffer.flushed, buffer.batches, buffer.depth()) == (4, 3, 0)
+    assert buffer.find("contact_messages", "m1") is None
+    assert list(tmp_path.glob("*.jsonl")) == []
+
+
+async def test_a_failed_flush_keeps_documents_and_segments_for_the_retry(storage, tmp_path, monkeypatch):
+    buffer = WriteBehindBuffer(storage, tmp_path)
+    buffer.add("contact_messages", message(1))
+    collection = storage.database["contact_messages"]
+    original = collection.insert_many
+
+    async def unavailable(docs, ordered=True):
+        raise ConnectionError("primary stepped down")
+
+    monkeypatch.setattr(collection, "insert_many", unavailable)
+    await buffer.flush()
+    assert buffer.stats()["failures"] == 1 and buffer.depth() == 1
+    assert len(list(tmp_path.glob("*.jsonl"))) == 1
+
+    buffer.add("contact_messages", message(2))
+    monkeypatch.setattr(collection, "insert_many", original)
+    await buffer.flush()
+    assert await stored_ids(storage) == ["m1", "m2"]
+    assert list(tmp_path.glob("*.jsonl")) == []
+
+
+async def test_segments_left_by_a_crash_are_replayed_without_duplicates(storage, tmp_path):
+    await storage.contact_messages.create_index("id", unique=True)
+    crashed = WriteBehindBuffer(storage, tmp_path)
+    crashed.add("contact_messages", message(1))
+    crashed.add("contact_messages", message(2))
+    # m1 reached the database just before the process died; a torn line follows
+    await storage.contact_messages.insert_one(message(1))
+    crashed.segment.file.write('{"c": "contact_mess')
+    crashed.segment.file.close()
+
+    restarted = WriteBehindBuffer(storage, tmp_path)
+    assert restarted.recover() == 2
+    await restarted.flush()
+    assert await stored_ids(storage) == ["m1", "m2"]
+    assert restarted.failures == 0
+    assert list(tmp_path.glob("*.jsonl")) == []
+
+
+async def test_a_live_workers_segment_is_not_replayed(storage, tmp_path):
+    live = WriteBehindBuffer(storage, tmp_path)
+    live.add("contact_messages", message(1))
+
+    other = WriteBehindBuffer(storage, tmp_path)
+    assert other.recover() == 0
+    await live.close()
+    assert await stored_ids(storage) == ["m1"]
+
+
+async def test_the_flusher_writes_when_a_batch_fills_or_the_oldest_waits_too_long(storage, tmp_path):
+    buffer = WriteBehindBuffer(storage, tmp_path, max_batch=2, max_delay=0.05)
+    buffer.start()
+    try:
+        buffer.add("contact_messages", message(1))
+        buffer.add("contact_messages", message(2))
+        await asyncio.sleep(0.01)
+        assert await stored_ids(storage) == ["m1", "m2"]
+
+        buffer.add("contact_messages", message(3))
+        await asyncio.sleep(0.01)
+        assert buffer.depth() == 1
+        await asyncio.sleep(0.1)
+        assert await stored_ids(storage) == ["m1", "m2", "m3"]
+    finally:
+        await buffer.close()
+    assert buffer.task is None
@@ -0,0 +1,237 @@
+"""Stateless signed session tokens for patients, practitioners and admins.
+
+A token is a JWT (HS256) carrying the subject id, its role and an expiry,
+signed with the active key of a key ring. The ring is held in process, so
+checking a token is a signature check with no database round trip, and a
+token that has already been verified is answered from a small cache until
+it expires.
+
+Keys come from AUTH_SIGNING_KEYS ("kid:secret,kid:secret", the first one
+signs) or, when that is unset, from the `auth_keys` collection, which every
+worker re-reads periodically. Rotating adds a new signing key. The keys it
+replaces keep verifying until every token they signed has expired, and a key
+can be retired early to revoke its tokens.
+"""
+import asyncio
+import logging
+import secrets
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+import jwt
+
+logger = logging.getLogger(__name__)
+
+ALGORITHM = "HS256"
+
+# Verified tokens remembered per process
+CACHE_SIZE = 10000
+
+# A token signed with a kid we don't know reloads the ring at most this often
+UNKNOWN_KID_RELOAD_SECONDS = 5.0
+
+
+class InvalidToken(Exception):
+    pass
+
+
+class UnknownKey(InvalidToken):
+    def __init__(self, kid: Optional[str]):
+        super().__init__("Unknown signing key")
+        self.kid = kid
+
+
+class KeyRingError(Exception):
+    pass
+
+
+def parse_keys(spec: str) -> Dict[str, str]:
+    """"2026b:secret,2026a:secret" → {kid: secret}, in order (the first one signs)"""
+    keys = {}
+    for item in spec.split(","):
+        kid, _, secret = item.strip().partition(":")
+        if kid and secret:
+            keys[kid] = secret
+    return keys
+
+
+class KeyRing:
+    """Signing keys by kid; the newest one signs"""
+
+    def __init__(self, collection, max_token_ttl: timedelta, static: Optional[Dict[str, str]] = None,
+                 refresh_seconds: float = 60.0):
+        self.collection = collection
+        self.max_token_ttl = max_token_ttl
+        self.static = static or None
+        self.refresh_seconds = refresh_seconds
+        self.keys: Dict[str, bytes] = {}
+        self.active: Optional[str] = None
+        self.version = 0
+        self.reloaded_at = 0.0
+
+    async def load(self):
+        """Read the ring, creating the first key if there is none"""
+        if self.static:
+            self._set(list(self.static), {kid: secret.encode() for kid, secret in self.static.items()})
+            return
+        await self.refresh()
+        if not self.active:
+            await self.rotate()
+
+    async def refresh(self):
+        if self.static:
+            return
+        self.reloaded_at = time.monotonic()
+        docs = await self.collection.find({"retired_at": None}, {"_id": 0}).to_list(None)
+        # Superseded keys only verify while tokens they signed can still be live
+        cutoff = datetime.utcnow() - self.max_token_ttl
+        docs = [d for d in docs if not d.get("superseded_at") or d["superseded_at"] > cutoff]
+        docs.sort(key=lambda d: d["created_at"], reverse=True)
+        self._set([d["kid"] for d in docs], {d["kid"]: d["secret"].encode() for d in docs})
+
+    def _set(self, order: List[str], keys: Dict[str, bytes]):
+        active = order[0] if order else None
+        if keys != self.keys or active != self.active:
+            self.keys = keys
+            self.active = active
+            self.version += 1
+            logger.info("Signing keys version %d: active %s, %d verifying", self.version, active, len(keys))
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(self.refresh_seconds)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning("Signing key refresh failed: %s", e)
+
+    async def reload_for(self, kid: str) -> bool:
+        """Reload once for a kid another worker may have just created"""
+        if self.static or time.monotonic() - self.reloaded_at < UNKNOWN_KID_RELOAD_SECONDS:
+            return False
+        await self.refresh()
+        return kid in self.keys
+
+    async def rotate(self) -> str:
+        """Start signing with a new key; returns its kid"""
+        if self.static:
+            raise KeyRingError("Signing keys are pinned by AUTH_SIGNING_KEYS")
+        now = datetime.utcnow()
+        kid = f"{now:%Y%m%d}-{secrets.token_hex(3)}"
+        await self.collection.insert_one({
+            "kid": kid,
+            "secret": secrets.token_urlsafe(32),
+            "created_at": now,
+            "superseded_at": None,
+            "retired_at": None,
+        })
+        await self.collection.update_many(
+            {"kid": {"$ne": kid}, "superseded_at": None},
+            {"$set": {"superseded_at": now}}
+        )
+        await self.refresh()
+        return kid
+
+    async def retire(self, kid: str) -> bool:
+        """Stop accepting tokens signed with `kid`; the active key can't be retired"""
+        if self.static:
+            raise KeyRingError("Signing keys are pinned by AUTH_SIGNING_KEYS")
+        if kid == self.active:
+            raise KeyRingError("Rotate before retiring the active key")
+        result = await self.collection.update_one(
+            {"kid": kid, "retired_at": None},
+            {"$set": {"retired_at": datetime.utcnow()}}
+        )
+        await self.refresh()
+        return result.modified_count > 0
+
+    async def describe(self) -> List[Dict[str, Any]]:
+        if self.static:
+            return [{"kid": kid, "active": kid == self.active, "source": "env"} for kid in self.keys]
+        docs = await self.collection.find({}, {"_id": 0, "secret": 0}).to_list(None)
+        docs.sort(key=lambda d: d["created_at"], reverse=True)
+        return [{**d, "active": d["kid"] == self.active, "verifying": d["kid"] in self.keys} for d in docs]
+
+
+class SessionTokens:
+    """Issues tokens and verifies them against the ring, caching verified claims"""
+
+    def __init__(self, ring: KeyRing, ttls: Dict[str, timedelta], cache_size: int = CACHE_SIZE,
+                 leeway: int = 30):
+        self.ring = ring
+        self.ttls = ttls
+        self.cache_size = cache_size
+        self.leeway = leeway
+        self.cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.cache_version = ring.version
+        self.hits = 0
+        self.misses = 0
+
+    def issue(self, subject: str, role: str, **claims) -> Dict[str, Any]:
+        """A signed token for `subject` acting as `role`, with its expiry"""
+        if role not in self.ttls:
+            raise ValueError(f"Unknown role {role!r}")
+        if not self.ring.active:
+            raise KeyRingError("No signing key loaded")
+        now = int(time.time())
+        expires = now + int(self.ttls[role].total_seconds())
+        token = jwt.encode(
+            {**claims, "sub": subject, "role": role, "iat": now, "exp": expires},
+            self.ring.keys[self.ring.active],
+            algorithm=ALGORITHM,
+            headers={"kid": self.ring.active}
+        )
+        return {"token": token, "expires_at": datetime.utcfromtimestamp(expires)}
+
+    def verify(self, token: str) -> Dict[str, Any]:
+        """The token's claims; raises InvalidToken"""
+        if self.cache_version != self.ring.version:
+            # A key was added or dropped; anything verified with a dropped key must be checked again
+            self.cache.clear()
+            self.cache_version = self.ring.version
+        claims = self.cache.get(token)
+        if claims is not None:
+            if claims["exp"] + self.leeway < time.time():
+                del self.cache[token]
+                raise InvalidToken("Token expired")
+            self.cache.move_to_end(token)
+            self.hits += 1
+            return claims
+
+        self.misses += 1
+        try:
+            kid = jwt.get_unverified_header(token).get("kid")
+        except jwt.InvalidTokenError:
+            raise InvalidToken("Malformed token")
+        key = self.ring.keys.get(kid)
+        if key is None:
+            raise UnknownKey(kid)
+        try:
+            claims = jwt.decode(token, key, algorithms=[ALGORITHM], leeway=self.leeway,
+                                options={"require": ["sub", "role", "exp"]})
+        except jwt.ExpiredSignatureError:
+            raise InvalidToken("Token expired")
+        except jwt.InvalidTokenError:
+            raise InvalidToken("Invalid token")
+        if claims["role"] not in self.ttls:
+            raise InvalidToken("Invalid token")
+
+        self.cache[token] = claims
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return claims
+
+    async def authenticate(self, token: str) -> Dict[str, Any]:
+        """verify(), reloading the ring once if the token names a key we haven't seen"""
+        try:
+            return self.verify(token)
+        except UnknownKey as e:
+            if await self.ring.reload_for(e.kid):
+                return self.verify(token)
+            raise InvalidToken("Invalid token")
+
+    def stats(self) -> Dict[str, Any]:
+        return {"cached": len(self.cache), "hits": self.hits, "misses": self.misses,
+                "key_version": self.ring.version}
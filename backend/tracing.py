@@ -0,0 +1,435 @@
+"""Lightweight distributed tracing.
+
+Spans are linked through a context variable, so anything that runs in the
+context of a request is part of its trace: awaited calls, tasks it spawns
+(asyncio copies the context into them), Motor commands (Motor runs PyMongo
+in the executor with the caller's context, so the command listener sees
+the current span), and WebSocket sends made by those tasks.
+
+Sampling is decided per trace. A trace is kept if its ID falls under the
+sample ratio, or if its root span turns out slower than the slow threshold.
+Spans of undecided traces wait in a small per-trace buffer until the root
+ends. Kept spans are exported in batches from a background thread, either
+as JSON lines to a file or as OTLP/HTTP JSON to a collector. Trace context
+comes in and goes out in the W3C `traceparent` header.
+"""
+import contextvars
+import functools
+import json
+import logging
+import os
+import queue
+import secrets
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+KINDS = {"internal": 1, "server": 2, "client": 3, "producer": 4, "consumer": 5}
+
+# Spans buffered per trace while waiting for the root to decide whether to keep it
+MAX_BUFFERED_SPANS = 512
+
+current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+
+
+class Trace:
+    """Shared by every span of one trace in this process"""
+    __slots__ = ("trace_id", "sampled", "keep", "buffer")
+
+    def __init__(self, trace_id: str, sampled: bool):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.keep: Optional[bool] = True if sampled else None
+        self.buffer: List["Span"] = []
+
+
+class Span:
+    __slots__ = ("tracer", "trace", "span_id", "parent_id", "name", "kind", "start_ns", "end_ns",
+                 "attributes", "error", "root")
+
+    def __init__(self, tracer: "Tracer", trace: Trace, name: str, kind: str,
+                 parent_id: Optional[str], attributes: Optional[Dict[str, Any]], root: bool):
+        self.tracer = tracer
+        self.trace = trace
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.attributes = dict(attributes) if attributes else {}
+        self.error: Optional[str] = None
+        self.root = root
+
+    @property
+    def trace_id(self) -> str:
+        return self.trace.trace_id
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def set_error(self, message: str):
+        self.error = message
+
+    def end(self):
+        if not self.end_ns:
+            self.end_ns = time.time_ns()
+            self.tracer._finish(self)
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace.trace_id}-{self.span_id}-{'01' if self.trace.sampled else '00'}"
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "kind": self.kind,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class _SpanScope:
+    """`with tracer.span(...)`: makes the span current and ends it on exit"""
+    __slots__ = ("span", "token")
+
+    def __init__(self, span: Span):
+        self.span = span
+
+    def __enter__(self) -> Span:
+        self.token = current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None and not isinstance(exc, GeneratorExit):
+            self.span.set_error(f"{exc_type.__name__}: {exc}")
+        current_span.reset(self.token)
+        self.span.end()
+        return False
+
+
+class _NoopScope:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP = _NoopScope()
+
+
+def parse_traceparent(header: Optional[str]):
+    """Return (trace_id, parent span_id, sampled) from a W3C traceparent, or None"""
+    if not header:
+        return None
+    parts = header.strip().split("-")
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+        flags = int(parts[3][:2], 16)
+    except ValueError:
+        return None
+    if parts[1] == "0" * 32:
+        return None
+    return parts[1], parts[2], bool(flags & 1)
+
+
+# ==================== TRACER ====================
+
+class Tracer:
+    def __init__(self, processor: Optional["BatchSpanProcessor"] = None, sample_ratio: float = 1.0,
+                 slow_ms: float = 0.0, service_name: str = "voct-backend"):
+        self.processor = processor
+        self.enabled = processor is not None
+        self.sample_ratio = sample_ratio
+        self.slow_ns = int(slow_ms * 1e6)
+        self.service_name = service_name
+
+    def _sampled(self, trace_id: str) -> bool:
+        return int(trace_id[:16], 16) < self.sample_ratio * (1 << 64)
+
+    def start_span(self, name: str, kind: str = "internal", attributes: Optional[Dict[str, Any]] = None,
+                   parent: Optional[Span] = None, traceparent: Optional[str] = None) -> Optional[Span]:
+        """Start a span under `parent` (default: the current span) or a remote traceparent"""
+        if not self.enabled:
+            return None
+        parent = parent or current_span.get()
+        if parent is not None:
+            return Span(self, parent.trace, name, kind, parent.span_id, attributes, root=False)
+
+        remote = parse_traceparent(traceparent)
+        if remote:
+            trace_id, parent_id, sampled = remote
+            trace = Trace(trace_id, sampled or self._sampled(trace_id))
+        else:
+            trace_id, parent_id = secrets.token_hex(16), None
+            trace = Trace(trace_id, self._sampled(trace_id))
+        return Span(self, trace, name, kind, parent_id, attributes, root=True)
+
+    def span(self, name: str, kind: str = "internal", attributes: Optional[Dict[str, Any]] = None,
+             traceparent: Optional[str] = None):
+        """Context manager for a span; a no-op when tracing is off"""
+        if not self.enabled:
+            return _NOOP
+        return _SpanScope(self.start_span(name, kind, attributes, traceparent=traceparent))
+
+    def traced(self, name: Optional[str] = None, kind: str = "internal"):
+        """Decorator wrapping every call of an async function in a span"""
+        def decorate(fn: Callable):
+            span_name = name or fn.__name__
+
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return await fn(*args, **kwargs)
+                with self.span(span_name, kind):
+                    return await fn(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def _finish(self, span: Span):
+        trace = span.trace
+        if span.root and trace.keep is None:
+            trace.keep = span.end_ns - span.start_ns >= self.slow_ns > 0
+            if trace.keep:
+                span.attributes["sampling.reason"] = "slow"
+                for buffered in trace.buffer:
+                    self.processor.submit(buffered)
+            trace.buffer = []
+        if trace.keep:
+            self.processor.submit(span)
+        elif trace.keep is None and len(trace.buffer) < MAX_BUFFERED_SPANS:
+            trace.buffer.append(span)
+
+    def shutdown(self):
+        if self.processor:
+            self.processor.shutdown()
+
+
+# ==================== EXPORT ====================
+
+class BatchSpanProcessor:
+    """Hands finished spans to an exporter in batches from a background thread"""
+
+    def __init__(self, exporter, max_queue: int = 4096, batch_size: int = 256, interval: float = 2.0):
+        self.exporter = exporter
+        self.queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.dropped = 0
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+        self.start_lock = threading.Lock()
+
+    def submit(self, span: Span):
+        # The exporter thread starts with the first span rather than at import
+        if self.thread.ident is None and not self.stopping.is_set():
+            with self.start_lock:
+                if self.thread.ident is None:
+                    self.thread.start()
+        try:
+            self.queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _drain(self, block: bool) -> List[Span]:
+        batch: List[Span] = []
+        try:
+            if block:
+                batch.append(self.queue.get(timeout=self.interval))
+            while len(batch) < self.batch_size:
+                batch.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _export(self, batch: List[Span]):
+        if not batch:
+            return
+        try:
+            self.exporter.export(batch)
+        except Exception as e:
+            logger.warning("Span export failed: %s", e)
+
+    def _run(self):
+        while not self.stopping.is_set():
+            self._export(self._drain(block=True))
+        while True:
+            batch = self._drain(block=False)
+            if not batch:
+                break
+            self._export(batch)
+
+    def shutdown(self):
+        self.stopping.set()
+        if self.thread.ident is not None:
+            self.thread.join(timeout=self.interval + 5)
+
+
+class FileSpanExporter:
+    """Appends spans as JSON lines"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+    def export(self, spans: List[Span]):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a") as f:
+            for span in spans:
+                f.write(json.dumps(span.to_dict(), default=str) + "\n")
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class OtlpHttpSpanExporter:
+    """POSTs spans to an OTLP/HTTP collector using the JSON encoding"""
+
+    def __init__(self, endpoint: str, service_name: str, headers: Optional[Dict[str, str]] = None,
+                 timeout: float = 5.0):
+        self.url = endpoint.rstrip("/") + "/v1/traces"
+        self.service_name = service_name
+        self.headers = {"Content-Type": "application/json", **(headers or {})}
+        self.timeout = timeout
+
+    def payload(self, spans: List[Span]) -> Dict[str, Any]:
+        return {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+            "scopeSpans": [{
+                "scope": {"name": "voct.tracing"},
+                "spans": [{
+                    "traceId": span.trace_id,
+                    "spanId": span.span_id,
+                    **({"parentSpanId": span.parent_id} if span.parent_id else {}),
+                    "name": span.name,
+                    "kind": KINDS.get(span.kind, 1),
+                    "startTimeUnixNano": str(span.start_ns),
+                    "endTimeUnixNano": str(span.end_ns),
+                    "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in span.attributes.items()],
+                    "status": {"code": 2, "message": span.error} if span.error else {"code": 0},
+                } for span in spans],
+            }],
+        }]}
+
+    def export(self, spans: List[Span]):
+        import requests
+        response = requests.post(self.url, json=self.payload(spans), headers=self.headers, timeout=self.timeout)
+        response.raise_for_status()
+
+
+def tracer_from_env(default_file: Path) -> Tracer:
+    """TRACING_EXPORTER=file|otlp turns tracing on; anything else leaves it off"""
+    exporter_name = os.environ.get("TRACING_EXPORTER", "none").lower()
+    service_name = os.environ.get("OTEL_SERVICE_NAME", "voct-backend")
+    if exporter_name == "file":
+        exporter = FileSpanExporter(Path(os.environ.get("TRACING_FILE", str(default_file))))
+    elif exporter_name == "otlp":
+        headers = dict(
+            item.split("=", 1) for item in os.environ.get("OTEL_EXPORTER_OTLP_HEADERS", "").split(",") if "=" in item
+        )
+        exporter = OtlpHttpSpanExporter(
+            os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318"), service_name, headers
+        )
+    else:
+        return Tracer()
+    return Tracer(
+        BatchSpanProcessor(exporter),
+        sample_ratio=float(os.environ.get("TRACING_SAMPLE_RATIO", "0.1")),
+        slow_ms=float(os.environ.get("TRACING_SLOW_MS", "1000")),
+        service_name=service_name,
+    )
+
+
+# ==================== INSTRUMENTATION ====================
+
+class MongoCommandTracer(monitoring.CommandListener):
+    """Records each Mongo command as a client span of whatever span issued it"""
+
+    def __init__(self, tracer: Tracer):
+        self.tracer = tracer
+        self.pending: Dict[Any, Span] = {}
+        self.lock = threading.Lock()
+
+    def started(self, event):
+        if not self.tracer.enabled or current_span.get() is None:
+            return
+        command = event.command_name
+        collection = event.command.get(command)
+        span = self.tracer.start_span(f"mongo.{command}", "client", {
+            "db.system": "mongodb",
+            "db.name": event.database_name,
+            "db.operation": command,
+            **({"db.mongodb.collection": collection} if isinstance(collection, str) else {}),
+        })
+        with self.lock:
+            self.pending[(event.connection_id, event.request_id)] = span
+
+    def _finish(self, event, error: Optional[str]):
+        with self.lock:
+            span = self.pending.pop((event.connection_id, event.request_id), None)
+        if span is None:
+            return
+        if error:
+            span.set_error(error)
+        span.end()
+
+    def succeeded(self, event):
+        self._finish(event, None)
+
+    def failed(self, event):
+        self._finish(event, f"{event.failure.get('codeName', 'Error')}: {event.failure.get('errmsg', '')}")
+
+
+class TracingMiddleware:
+    """ASGI middleware: a server span per HTTP request, continuing any incoming traceparent"""
+
+    def __init__(self, app, tracer: Tracer):
+        self.app = app
+        self.tracer = tracer
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.tracer.enabled:
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope.get("headers") or [])
+        incoming = headers.get(b"traceparent", b"").decode("latin-1") or None
+        with self.tracer.span(f"{scope['method']} {scope['path']}", "server", {
+            "http.method": scope["method"],
+            "http.target": scope["path"],
+        }, traceparent=incoming) as span:
+            async def send_with_trace(message):
+                if message["type"] == "http.response.start":
+                    span.set_attribute("http.status_code", message["status"])
+                    if message["status"] >= 500:
+                        span.set_error(f"HTTP {message['status']}")
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"traceparent", span.traceparent().encode())
+                    ]
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_with_trace)
+            finally:
+                # Name by route template once routing has matched, so spans aggregate
+                route = scope.get("route")
+                if route is not None and getattr(route, "path", None):
+                    span.name = f"{scope['method']} {route.path}"
@@ -0,0 +1,128 @@
+"""Negotiable websocket encodings for the user and physio channels.
+
+A client chooses an encoding with the `Sec-WebSocket-Protocol` header:
+
+    voct.json      JSON text frames
+    voct.msgpack   MessagePack binary frames (needs `msgpack`)
+    voct.cbor      CBOR binary frames (needs `cbor2`)
+
+Clients that ask for none of these get plain JSON text frames, one message
+per frame, exactly as before. Clients that pick a `voct.*` protocol also
+accept batch frames, `{"type": "batch", "messages": [...]}`, which carry
+several notifications at once (for example a replay after reconnecting).
+They may send batch frames too.
+
+Compression is permessage-deflate. The ASGI server negotiates it with the
+client (uvicorn does by default, see `--ws-per-message-deflate`), and it
+applies to every encoding.
+"""
+import json
+from typing import Any, Callable, Dict, List, Optional, Union
+
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+# Most notifications packed into one batch frame
+MAX_BATCH = 50
+
+
+class Codec:
+    def __init__(self, name: str, subprotocol: Optional[str], binary: bool,
+                 encode: Callable[[Any], Union[str, bytes]], decode: Callable[[Union[str, bytes]], Any]):
+        self.name = name
+        self.subprotocol = subprotocol
+        self.binary = binary
+        self.encode = encode
+        self.decode = decode
+
+    @property
+    def batches(self) -> bool:
+        # The legacy default predates batch frames
+        return self.subprotocol is not None
+
+
+def _json_dumps(message: Any) -> str:
+    # Same output as Starlette's send_json
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+
+
+JSON = Codec("json", None, False, _json_dumps, json.loads)
+
+
+def _load_codecs() -> Dict[str, Codec]:
+    codecs = {"voct.json": Codec("json", "voct.json", False, _json_dumps, json.loads)}
+    try:
+        import msgpack
+        codecs["voct.msgpack"] = Codec("msgpack", "voct.msgpack", True, msgpack.packb, msgpack.unpackb)
+    except ImportError:
+        pass
+    try:
+        import cbor2
+        codecs["voct.cbor"] = Codec("cbor", "voct.cbor", True, cbor2.dumps, cbor2.loads)
+    except ImportError:
+        pass
+    return codecs
+
+
+# Subprotocols this process can speak; binary ones only when their library is installed
+CODECS = _load_codecs()
+
+
+def negotiate(requested: List[str]) -> Codec:
+    """The first requested subprotocol we support, in the client's order of preference"""
+    for subprotocol in requested:
+        codec = CODECS.get(subprotocol.strip())
+        if codec:
+            return codec
+    return JSON
+
+
+def batch(messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {"type": "batch", "messages": messages}
+
+
+def frames(codec: Codec, messages: List[Dict[str, Any]]) -> List[Union[str, bytes]]:
+    """Encode messages into as few frames as the codec allows"""
+    if not codec.batches:
+        return [codec.encode(m) for m in messages]
+    encoded = []
+    for start in range(0, len(messages), MAX_BATCH):
+        chunk = messages[start:start + MAX_BATCH]
+        encoded.append(codec.encode(chunk[0] if len(chunk) == 1 else batch(chunk)))
+    return encoded
+
+
+def unpack(message: Any) -> List[Dict[str, Any]]:
+    if isinstance(message, dict) and message.get("type") == "batch":
+        return list(message.get("messages") or [])
+    return [message]
+
+
+class WireSocket:
+    """A WebSocket speaking the encoding its client negotiated"""
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.codec = negotiate(websocket.scope.get("subprotocols") or [])
+
+    async def accept(self):
+        await self.websocket.accept(subprotocol=self.codec.subprotocol)
+
+    async def send_messages(self, messages: List[Dict[str, Any]]):
+        for frame in frames(self.codec, messages):
+            if self.codec.binary:
+                await self.websocket.send_bytes(frame)
+            else:
+                await self.websocket.send_text(frame)
+
+    async def send_json(self, message: Dict[str, Any]):
+        await self.send_messages([message])
+
+    async def receive_messages(self) -> List[Dict[str, Any]]:
+        """The next frame's messages (several if the client sent a batch)"""
+        frame = await self.websocket.receive()
+        if frame["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(frame.get("code", 1000))
+        if frame.get("bytes") is not None:
+            return unpack(self.codec.decode(frame["bytes"]))
+        # Text frames are JSON whatever was negotiated
+        return unpack(json.loads(frame["text"]))
@@ -0,0 +1,125 @@
+"""Per-physio workload counters kept on the practitioner document.
+
+Each practitioner carries a `workload` sub-document (active bookings,
+sessions booked this week, last time they took a booking) that booking
+transitions update with single atomic writes. The matcher sorts and ranks
+candidates on these fields as part of the candidate query, so preferring
+under-utilised physios costs no extra reads.
+"""
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from pymongo import UpdateOne
+
+# Transitions that end a booking and free up the physio holding it
+RELEASING_STATUSES = ("completed", "cancelled")
+
+# Candidate query sort: least busy first, then longest since their last booking
+CANDIDATE_SORT = [("workload.active_bookings", 1), ("workload.last_assigned_at", 1)]
+
+
+def week_of(now: datetime) -> str:
+    """ISO week key; the weekly counter resets when this changes"""
+    year, week, _ = now.isocalendar()
+    return f"{year}-W{week:02d}"
+
+
+def week_start(now: datetime) -> datetime:
+    return (now - timedelta(days=now.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def summary(practitioner: Dict[str, Any], now: Optional[datetime] = None) -> Dict[str, Any]:
+    """Current counters, treating a counter from an earlier week as zero"""
+    now = now or datetime.utcnow()
+    counters = practitioner.get("workload") or {}
+    return {
+        "active_bookings": counters.get("active_bookings", 0),
+        "sessions_this_week": counters.get("sessions_this_week", 0) if counters.get("week") == week_of(now) else 0,
+        "last_assigned_at": counters.get("last_assigned_at"),
+    }
+
+
+def rank(physios: List[Dict[str, Any]], now: Optional[datetime] = None) -> List[Dict[str, Any]]:
+    """Order candidates so under-utilised physios are offered bookings first"""
+    now = now or datetime.utcnow()
+
+    def key(physio):
+        counters = summary(physio, now)
+        return (counters["active_bookings"], counters["sessions_this_week"], counters["last_assigned_at"] or datetime.min)
+    return sorted(physios, key=key)
+
+
+async def booking_taken(collection, physio_id: str, sessions: int, now: Optional[datetime] = None):
+    """A physio committed to a booking"""
+    now = now or datetime.utcnow()
+    week = week_of(now)
+    fields = {"workload.last_assigned_at": now}
+    # Two conditional writes instead of a read: bump this week's counter, or
+    # start a new week. If another writer rolled the week over in between,
+    # the first form matches on the retry.
+    for _ in range(3):
+        result = await collection.update_one(
+            {"id": physio_id, "workload.week": week},
+            {"$inc": {"workload.active_bookings": 1, "workload.sessions_this_week": sessions}, "$set": fields}
+        )
+        if result.matched_count:
+            return
+        result = await collection.update_one(
+            {"id": physio_id, "workload.week": {"$ne": week}},
+            {"$inc": {"workload.active_bookings": 1},
+             "$set": {**fields, "workload.week": week, "workload.sessions_this_week": sessions}}
+        )
+        if result.matched_count:
+            return
+
+
+async def booking_released(collection, physio_id: str):
+    """A booking the physio held was completed or cancelled"""
+    await collection.update_one(
+        {"id": physio_id, "workload.active_bookings": {"$gt": 0}},
+        {"$inc": {"workload.active_bookings": -1}}
+    )
+
+
+async def apply_transition(collection, before: Dict[str, Any], sets: Dict[str, Any]):
+    """Update counters for a booking transition, given the booking before it and the fields it set"""
+    if sets.get("assignment_status") == "accepted" and before.get("assignment_status") != "accepted":
+        physio_id = sets.get("assigned_physio_id") or before.get("assigned_physio_id")
+        if physio_id:
+            await booking_taken(collection, physio_id, before.get("session_count") or 1)
+    elif sets.get("status") in RELEASING_STATUSES and before.get("assignment_status") == "accepted":
+        if before.get("assigned_physio_id"):
+            await booking_released(collection, before["assigned_physio_id"])
+
+
+async def rebuild(bookings, practitioners, now: Optional[datetime] = None) -> int:
+    """Recompute every physio's counters from the bookings (backfill or drift repair)"""
+    now = now or datetime.utcnow()
+    week, since = week_of(now), week_start(now)
+    counters: Dict[str, Dict[str, Any]] = {}
+    cursor = bookings.find(
+        {"assignment_status": "accepted", "assigned_physio_id": {"$ne": None}},
+        {"_id": 0, "assigned_physio_id": 1, "status": 1, "session_count": 1, "created_at": 1}
+    ).batch_size(1000)
+    async for booking in cursor:
+        physio = counters.setdefault(booking["assigned_physio_id"], {
+            "active_bookings": 0, "sessions_this_week": 0, "last_assigned_at": None
+        })
+        if booking.get("status") not in RELEASING_STATUSES:
+            physio["active_bookings"] += 1
+        # Bookings don't record when they were accepted; creation time is close enough
+        created_at = booking.get("created_at")
+        if created_at and created_at >= since:
+            physio["sessions_this_week"] += booking.get("session_count") or 1
+        if created_at and (physio["last_assigned_at"] is None or created_at > physio["last_assigned_at"]):
+            physio["last_assigned_at"] = created_at
+
+    await practitioners.update_many({}, {"$set": {"workload": {
+        "active_bookings": 0, "sessions_this_week": 0, "week": week, "last_assigned_at": None
+    }}})
+    if counters:
+        await practitioners.bulk_write([
+            UpdateOne({"id": physio_id}, {"$set": {"workload": {**fields, "week": week}}})
+            for physio_id, fields in counters.items()
+        ], ordered=False)
+    return len(counters)
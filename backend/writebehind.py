@@ -0,0 +1,219 @@
+"""Write-behind buffer for documents nobody reads back on the request path.
+
+Contact messages, assessments and similar low-priority inserts are
+appended to a local spill file and queued in memory. A background task
+writes them with one `insert_many` per collection when a batch fills up
+or the oldest document has waited long enough. The request only pays for
+a buffered file append.
+
+Each flush starts a new spill segment and deletes the old ones once their
+documents are in the database. Segments left behind by a crash are
+replayed at startup. The replay relies on a unique index on `id`, so a
+document that was written just before the crash is not inserted twice.
+Segments are flock'ed while open, so a worker never replays another live
+worker's segments.
+"""
+import asyncio
+import fcntl
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from bson import json_util
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY = 11000
+
+
+class _Segment:
+    """One append-only spill file, exclusively locked while this process owns it"""
+
+    def __init__(self, path: Path, file):
+        self.path = path
+        self.file = file
+
+    @classmethod
+    def create(cls, directory: Path) -> "_Segment":
+        path = directory / f"{time.time_ns()}-{os.getpid()}.jsonl"
+        file = open(path, "a", encoding="utf-8")
+        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return cls(path, file)
+
+    @classmethod
+    def claim(cls, path: Path) -> Optional["_Segment"]:
+        """Take over a segment left by a dead process; None if a live one still holds it"""
+        file = open(path, "a+", encoding="utf-8")
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            file.close()
+            return None
+        return cls(path, file)
+
+    def append(self, collection: str, doc: Dict[str, Any]):
+        self.file.write(json_util.dumps({"c": collection, "d": doc}) + "\n")
+        self.file.flush()
+
+    def read(self) -> List[Tuple[str, Dict[str, Any]]]:
+        entries = []
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json_util.loads(line)
+                except ValueError:
+                    # A torn last line from the crash; everything before it is intact
+                    logger.warning("Skipping unreadable line in spill segment %s", self.path.name)
+                    continue
+                entries.append((entry["c"], entry["d"]))
+        return entries
+
+    def close(self, delete: bool):
+        self.file.close()
+        if delete:
+            self.path.unlink(missing_ok=True)
+
+
+class WriteBehindBuffer:
+    def __init__(self, storage, directory: Path, max_batch: int = 500, max_delay: float = 1.0):
+        self.storage = storage
+        self.directory = Path(directory)
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.pending: List[Tuple[str, Dict[str, Any]]] = []
+        self.segment: Optional[_Segment] = None
+        # Segments whose documents are still pending (a flush failed or they were replayed)
+        self.retained: List[_Segment] = []
+        self.oldest: Optional[float] = None
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.lock = asyncio.Lock()
+        self.flushed = 0
+        self.batches = 0
+        self.failures = 0
+
+    def depth(self) -> int:
+        return len(self.pending)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "depth": self.depth(),
+            "oldest_age_seconds": round(time.monotonic() - self.oldest, 3) if self.oldest else 0.0,
+            "flushed": self.flushed,
+            "batches": self.batches,
+            "failures": self.failures,
+            "segments": len(self.retained) + (1 if self.segment else 0),
+        }
+
+    def add(self, collection: str, doc: Dict[str, Any]):
+        """Queue `doc` for insertion; it is on disk when this returns"""
+        if self.segment is None:
+            self.segment = _Segment.create(self.directory)
+        self.segment.append(collection, doc)
+        self.pending.append((collection, doc))
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+        if len(self.pending) >= self.max_batch:
+            self.wakeup.set()
+
+    def find(self, collection: str, doc_id: str) -> Optional[Dict[str, Any]]:
+        """A queued document by `id`, for reads that arrive before the flush"""
+        for name, doc in reversed(self.pending):
+            if name == collection and doc.get("id") == doc_id:
+                return {k: v for k, v in doc.items() if k != "_id"}
+        return None
+
+    # ==================== FLUSHING ====================
+
+    async def flush(self):
+        """Write everything queued so far"""
+        async with self.lock:
+            if not self.pending:
+                return
+            entries, self.pending, self.oldest = self.pending, [], None
+            segments = self.retained + ([self.segment] if self.segment else [])
+            self.retained, self.segment = [], None
+
+            by_collection: Dict[str, List[Dict[str, Any]]] = {}
+            for collection, doc in entries:
+                by_collection.setdefault(collection, []).append(doc)
+            try:
+                for collection, docs in by_collection.items():
+                    for start in range(0, len(docs), self.max_batch):
+                        await self._insert(collection, docs[start:start + self.max_batch])
+            except Exception as e:
+                # Keep the documents and their segments; the next flush retries everything
+                self.failures += 1
+                logger.warning("Write-behind flush of %d documents failed: %s", len(entries), e)
+                self.pending = entries + self.pending
+                self.oldest = self.oldest or time.monotonic()
+                self.retained = segments + self.retained
+                return
+            self.flushed += len(entries)
+            for segment in segments:
+                segment.close(delete=True)
+
+    async def _insert(self, collection: str, docs: List[Dict[str, Any]]):
+        try:
+            await self.storage[collection].insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            # Duplicates are documents a replayed segment had already written
+            errors = [err for err in e.details.get("writeErrors", []) if err.get("code") != DUPLICATE_KEY]
+            if errors:
+                raise
+        self.batches += 1
+
+    async def _run(self):
+        while True:
+            timeout = self.max_delay
+            if self.oldest is not None:
+                timeout = max(0.0, self.oldest + self.max_delay - time.monotonic())
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            if self.pending and (len(self.pending) >= self.max_batch
+                                 or time.monotonic() - self.oldest >= self.max_delay):
+                await self.flush()
+
+    # ==================== LIFECYCLE ====================
+
+    def recover(self) -> int:
+        """Queue documents from segments left by processes that died before flushing"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        recovered = 0
+        for path in sorted(self.directory.glob("*.jsonl")):
+            segment = _Segment.claim(path)
+            if segment is None:
+                continue
+            entries = segment.read()
+            self.pending.extend(entries)
+            self.retained.append(segment)
+            recovered += len(entries)
+        if self.pending:
+            self.oldest = time.monotonic()
+            logger.warning("Replaying %d buffered documents from %d spill segments", recovered, len(self.retained))
+        return recovered
+
+    def start(self):
+        self.recover()
+        self.task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Stop the flusher and write what is left"""
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+        for segment in self.retained + ([self.segment] if self.segment else []):
+            # Whatever is left failed to flush; the next start replays it
+            segment.close(delete=False)
+        self.retained, self.segment = [], None
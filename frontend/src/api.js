@@ -8,10 +8,22 @@ const API = axios.create({
   },
 });
 
+// Internal dashboards and patients hold separate session tokens
+API.interceptors.request.use((config) => {
+  const token = localStorage.getItem(config.url.startsWith('/internal') ? 'internal_token' : 'voct_token');
+  // Signup and certificate uploads carry their own short-lived token
+  if (token && !config.headers.Authorization) {
+    config.headers.Authorization = `Bearer ${token}`;
+  }
+  return config;
+});
+
 // Auth APIs
 export const sendOTP = (phone) => API.post('/auth/send-otp', { phone });
 export const verifyOTP = (phone, otp) => API.post('/auth/verify-otp', { phone, otp });
-export const signup = (userData) => API.post('/auth/signup', userData);
+export const signup = (userData, signupToken) => API.post('/auth/signup', userData, {
+  headers: { Authorization: `Bearer ${signupToken}` },
+});
 export const getUser = (userId) => API.get(`/auth/user/${userId}`);
 export const updateUser = (userId, updates) => API.put(`/auth/user/${userId}`, updates);
 
@@ -19,6 +31,7 @@ export const updateUser = (userId, updates) => API.put(`/auth/user/${userId}`, u
 export const getServices = () => API.get('/services');
 export const getService = (serviceId) => API.get(`/services/${serviceId}`);
 export const getPricing = () => API.get('/pricing');
+export const getQuotes = (items, promoCode) => API.post('/quotes', { items, promo_code: promoCode });
 
 // Assessment APIs
 export const createAssessment = (data) => API.post('/assessment', data);
@@ -28,6 +41,8 @@ export const getAssessment = (assessmentId) => API.get(`/assessment/${assessment
 export const createBooking = (data) => API.post('/booking', data);
 export const getBooking = (bookingId) => API.get(`/booking/${bookingId}`);
 export const getUserBookings = (userId) => API.get(`/bookings/user/${userId}`);
+export const getUserBookingChanges = (userId, since = 0) => API.get(`/bookings/user/${userId}/changes`, { params: { since } });
+export const deleteBooking = (bookingId) => API.delete(`/booking/${bookingId}`);
 
 // Payment APIs
 export const createPaymentOrder = (data) => API.post('/payment/create-order', data);
@@ -36,16 +51,21 @@ export const mockPaymentSuccess = (bookingId) => API.post(`/payment/mock-success
 
 // Practitioner APIs
 export const applyAsPractitioner = (data) => API.post('/practitioner/apply', data);
-export const uploadCertificate = (practitionerId, file, certificateType) => {
+export const uploadCertificate = (practitionerId, file, certificateType, applicantToken) => {
   const formData = new FormData();
   formData.append('file', file);
   formData.append('certificate_type', certificateType);
   return API.post(`/practitioner/${practitionerId}/upload-certificate`, formData, {
-    headers: { 'Content-Type': 'multipart/form-data' },
+    headers: { 'Content-Type': 'multipart/form-data', Authorization: `Bearer ${applicantToken}` },
   });
 };
 
 // Contact APIs
 export const submitContact = (data) => API.post('/contact', data);
 
+// Admin live updates
+// Browsers can't set headers on websockets, so the token goes in the query string
+export const adminEventsURL = () =>
+  `${BACKEND_URL.replace(/^http/, 'ws')}/ws/admin?token=${encodeURIComponent(localStorage.getItem('internal_token') || '')}`;
+
 export default API;
@@ -12,6 +12,7 @@ const AuthModal = ({ isOpen, onClose }) => {
   const [loading, setLoading] = useState(false);
   const [error, setError] = useState('');
   const [demoOtp, setDemoOtp] = useState('');
+  const [signupToken, setSignupToken] = useState('');
   
   const [signupData, setSignupData] = useState({
     name: '',
@@ -51,11 +52,12 @@ const AuthModal = ({ isOpen, onClose }) => {
       const response = await verifyOTP(phone.startsWith('+') ? phone : `+91${phone}`, otp);
       if (response.data.user_id) {
         // Existing user - login
-        login({ id: response.data.user_id, phone });
+        login({ id: response.data.user_id, phone }, response.data.token);
         onClose();
         resetForm();
       } else {
         // New user - show signup
+        setSignupToken(response.data.token);
         setStep('signup');
       }
     } catch (err) {
@@ -76,9 +78,8 @@ const AuthModal = ({ isOpen, onClose }) => {
       const response = await signup({
         ...signupData,
         age: parseInt(signupData.age),
-        phone: phone.startsWith('+') ? phone : `+91${phone}`,
-      });
-      login(response.data);
+      }, signupToken);
+      login(response.data, response.data.token);
       onClose();
       resetForm();
     } catch (err) {
@@ -94,6 +95,7 @@ const AuthModal = ({ isOpen, onClose }) => {
     setSignupData({ name: '', age: '', gender: '' });
     setError('');
     setDemoOtp('');
+    setSignupToken('');
   };
 
   if (!isOpen) return null;
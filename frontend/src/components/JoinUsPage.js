@@ -107,10 +107,10 @@ const JoinUsPage = () => {
 
       // Upload files
       if (files.degree) {
-        await uploadCertificate(response.data.id, files.degree, 'degree');
+        await uploadCertificate(response.data.id, files.degree, 'degree', response.data.token);
       }
       for (const cert of files.certifications) {
-        await uploadCertificate(response.data.id, cert, 'certification');
+        await uploadCertificate(response.data.id, cert, 'certification', response.data.token);
       }
 
       setStep(5);
@@ -1,7 +1,45 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { Routes, Route, Link, useNavigate, useLocation } from 'react-router-dom';
 import { motion } from 'framer-motion';
-import API from '../../api';
+import API, { adminEventsURL } from '../../api';
+
+// Subscribe to incremental admin updates pushed over /ws/admin
+const useAdminEvents = (onEvent) => {
+  const handlerRef = useRef(onEvent);
+  handlerRef.current = onEvent;
+
+  useEffect(() => {
+    let socket;
+    let retryTimer;
+    let closed = false;
+
+    const connect = () => {
+      socket = new WebSocket(adminEventsURL());
+      socket.onmessage = (message) => handlerRef.current(JSON.parse(message.data));
+      socket.onclose = () => {
+        if (!closed) retryTimer = setTimeout(connect, 3000);
+      };
+    };
+    connect();
+
+    return () => {
+      closed = true;
+      clearTimeout(retryTimer);
+      socket?.close();
+    };
+  }, []);
+};
+
+const applyCounterDeltas = (overview, counters) => {
+  const next = { ...overview };
+  Object.entries(counters || {}).forEach(([key, delta]) => {
+    next[key] = (next[key] || 0) + delta;
+  });
+  next.cancellation_rate = next.total_bookings
+    ? Math.round((next.cancelled_bookings || 0) / next.total_bookings * 10000) / 100
+    : 0;
+  return next;
+};
 
 // Admin Sidebar
 const AdminSidebar = ({ user }) => {
@@ -80,19 +118,43 @@ const OverviewDashboard = () => {
   const [data, setData] = useState(null);
   const [loading, setLoading] = useState(true);
 
+  const fetchData = async () => {
+    try {
+      const response = await API.get('/internal/admin/dashboard');
+      setData(response.data);
+    } catch (error) {
+      console.error('Failed to fetch dashboard:', error);
+    }
+    setLoading(false);
+  };
+
   useEffect(() => {
-    const fetchData = async () => {
-      try {
-        const response = await API.get('/internal/admin/dashboard');
-        setData(response.data);
-      } catch (error) {
-        console.error('Failed to fetch dashboard:', error);
-      }
-      setLoading(false);
-    };
     fetchData();
   }, []);
 
+  useAdminEvents((event) => {
+    if (event.type === 'resync' || event.refresh_counters) {
+      fetchData();
+      return;
+    }
+    setData((current) => {
+      if (!current) return current;
+      let recent = current.recent_bookings || [];
+      if (event.type === 'booking_created') {
+        recent = [event.booking, ...recent].slice(0, 10);
+      } else if (event.type === 'booking_updated') {
+        recent = recent.map((b) => (b.id === event.booking_id ? { ...b, ...event.changes } : b));
+      } else if (event.type === 'booking_deleted') {
+        recent = recent.filter((b) => b.id !== event.booking_id);
+      }
+      return {
+        ...current,
+        overview: applyCounterDeltas(current.overview, event.counters),
+        recent_bookings: recent,
+      };
+    });
+  });
+
   if (loading) {
     return (
       <div className="flex items-center justify-center h-64">
@@ -260,19 +322,32 @@ const BookingsManagement = () => {
   const [bookings, setBookings] = useState([]);
   const [loading, setLoading] = useState(true);
 
+  const fetchBookings = async () => {
+    try {
+      const response = await API.get('/internal/admin/bookings?limit=100');
+      setBookings(response.data.bookings || []);
+    } catch (error) {
+      console.error('Failed to fetch bookings:', error);
+    }
+    setLoading(false);
+  };
+
   useEffect(() => {
-    const fetchBookings = async () => {
-      try {
-        const response = await API.get('/internal/admin/bookings?limit=100');
-        setBookings(response.data.bookings || []);
-      } catch (error) {
-        console.error('Failed to fetch bookings:', error);
-      }
-      setLoading(false);
-    };
     fetchBookings();
   }, []);
 
+  useAdminEvents((event) => {
+    if (event.type === 'resync') {
+      fetchBookings();
+    } else if (event.type === 'booking_created') {
+      setBookings((current) => [event.booking, ...current].slice(0, 100));
+    } else if (event.type === 'booking_updated') {
+      setBookings((current) => current.map((b) => (b.id === event.booking_id ? { ...b, ...event.changes } : b)));
+    } else if (event.type === 'booking_deleted') {
+      setBookings((current) => current.filter((b) => b.id !== event.booking_id));
+    }
+  });
+
   return (
     <div className="space-y-6">
       <h1 className="text-2xl font-bold text-gray-800">Bookings Management</h1>
@@ -14,21 +14,26 @@ export const AuthProvider = ({ children }) => {
     if (userId) {
       getUser(userId)
         .then((res) => setUser(res.data))
-        .catch(() => localStorage.removeItem('voct_user_id'))
+        .catch(() => {
+          localStorage.removeItem('voct_user_id');
+          localStorage.removeItem('voct_token');
+        })
         .finally(() => setLoading(false));
     } else {
       setLoading(false);
     }
   }, []);
 
-  const login = (userData) => {
+  const login = (userData, token) => {
     setUser(userData);
     localStorage.setItem('voct_user_id', userData.id);
+    localStorage.setItem('voct_token', token);
   };
 
   const logout = () => {
     setUser(null);
     localStorage.removeItem('voct_user_id');
+    localStorage.removeItem('voct_token');
   };
 
   return (